@@ -17,6 +17,30 @@ class Settings(BaseSettings):
     VOLCENGINE_ACCESS_KEY: str = ""
     VOLCENGINE_SECRET_KEY: str = ""
     VOLCENGINE_REGION: str = "cn-beijing"
+    VOLCENGINE_CLIENT: str = "sdk"  # "sdk" (thread pool) or "async" (native httpx client)
+    VOLCENGINE_HOST: str = "visual.volcengineapi.com"
+    VOLCENGINE_SCHEME: str = "https"
+    
+    # Async upstream client
+    UPSTREAM_MAX_CONNECTIONS: int = 200
+    UPSTREAM_MAX_KEEPALIVE: int = 50
+    UPSTREAM_CONNECT_TIMEOUT: float = 30.0
+    UPSTREAM_READ_TIMEOUT: float = 30.0
+    UPSTREAM_HTTP2: bool = False
+    
+    # SDK upstream client
+    UPSTREAM_SDK_WORKERS: int = 4  # Threads making the blocking SDK calls
+    
+    # Upstream resilience
+    UPSTREAM_MAX_RETRIES: int = 2  # For rate limits, 5xx and network errors; validation errors fail at once
+    UPSTREAM_RETRY_BACKOFF: float = 0.5  # Base delay in seconds, doubled per attempt, full jitter
+    UPSTREAM_RETRY_BACKOFF_MAX: float = 8.0
+    UPSTREAM_TIMEOUT_MIN: float = 10.0
+    UPSTREAM_TIMEOUT_MAX: float = 60.0  # Also the timeout until enough latencies were observed
+    UPSTREAM_TIMEOUT_P99_FACTOR: float = 2.0  # Attempt timeout = observed p99 latency x factor
+    UPSTREAM_BREAKER_THRESHOLD: int = 5  # Consecutive failures that open the circuit
+    UPSTREAM_BREAKER_RESET: float = 30.0  # Seconds the circuit stays open before a probe
+    UPSTREAM_HEDGE: bool = False  # Re-send seeded requests still running after the p95 latency
     
     # Image Generation Settings
     DEFAULT_WIDTH: int = 512
@@ -24,14 +48,99 @@ class Settings(BaseSettings):
     DEFAULT_STEPS: int = 20
     DEFAULT_SCALE: float = 7.5
     MAX_BATCH_SIZE: int = 4
+    UPSTREAM_FANOUT_CONCURRENCY: int = 4  # Concurrent sub-requests per multi-image task
     
     # Storage
     OUTPUT_DIR: str = "/app/data/output"
     HISTORY_FILE: str = "/app/data/history.json"
     MAX_HISTORY_SIZE: int = 1000
+    HISTORY_BACKEND: str = "journal"  # "journal" (append-only log), "json" (full rewrite) or "sqlite"
+    HISTORY_JOURNAL_FILE: str = "/app/data/history.jsonl"
+    JOURNAL_FSYNC: str = "interval"  # "always", "interval" or "never"
+    JOURNAL_FSYNC_INTERVAL: float = 1.0
+    JOURNAL_COMPACT_BYTES: int = 8 * 1024 * 1024
+    SQLITE_FILE: str = "/app/data/tasks.db"
+    # Tasks, history and the job queue: "local" (this process, persisted per
+    # HISTORY_BACKEND) or "redis" (shared by every worker via REDIS_URL)
+    STATE_BACKEND: str = "local"
+    
+    # Multipart image2image uploads, spooled to UPLOAD_DIR until the job runs
+    UPLOAD_DIR: str = "/app/data/uploads"
+    MAX_UPLOAD_BYTES: int = 10 * 1024 * 1024
+    MIN_UPLOAD_DIMENSION: int = 64
+    MAX_UPLOAD_DIMENSION: int = 4096
+    
+    # Mirroring of upstream result images into OUTPUT_DIR
+    MIRROR_IMAGES: bool = True
+    MIRROR_CONCURRENCY: int = 4
+    MIRROR_RETRIES: int = 3
+    MIRROR_BACKOFF: float = 0.5  # Base delay in seconds, doubled per attempt
+    MIRROR_TIMEOUT: float = 30.0
+    MIRROR_MAX_BYTES: int = 20 * 1024 * 1024
+    
+    # Saved images are stored once per content hash. A periodic pass deletes the
+    # ones no history entry shows any more and, over BLOB_QUOTA_BYTES, evicts the
+    # oldest non-favorite history entries first
+    BLOB_GC_INTERVAL: float = 600.0  # Seconds between passes, 0 disables
+    BLOB_GC_GRACE: float = 3600.0  # Keep younger unreferenced images; at least RESULT_CACHE_TTL
+    BLOB_QUOTA_BYTES: int = 0  # 0 disables the quota
+    
+    # GET /images: generated files are immutable and cached for IMAGE_CACHE_MAX_AGE.
+    # With IMAGE_ACCEL_REDIRECT_PREFIX, nginx sends the files (X-Accel-Redirect to
+    # <prefix>output/<name> and <prefix>thumbnails/<name>, see nginx.conf.fullstack)
+    IMAGE_CACHE_MAX_AGE: int = 365 * 24 * 3600
+    IMAGE_ETAG_CACHE_ENTRIES: int = 10000  # Files whose content-hash ETag is kept in memory
+    IMAGE_ACCEL_REDIRECT_PREFIX: str = ""  # e.g. "/_accel/"; empty serves files from the app
+    
+    # Resized derivatives of saved images, rendered by a process pool (needs Pillow)
+    THUMBNAILS_ENABLED: bool = True
+    THUMBNAIL_DIR: str = "/app/data/thumbnails"
+    THUMBNAIL_WIDTHS: list[int] = [256, 512, 1024]  # GET /images/{name}?w= snaps to these
+    THUMBNAIL_HISTORY_WIDTH: int = 256  # Width of the history's thumbnails
+    THUMBNAIL_FORMAT: str = "webp"  # "webp" or "avif" (WebP for clients that do not accept AVIF)
+    THUMBNAIL_QUALITY: int = 80
+    THUMBNAIL_WORKERS: int = 1  # Processes, i.e. CPUs thumbnailing may use
+    THUMBNAIL_CACHE_MAX_BYTES: int = 512 * 1024 * 1024
+    
+    # Result cache for seeded (deterministic) requests
+    RESULT_CACHE_ENABLED: bool = True
+    RESULT_CACHE_MAX_ENTRIES: int = 1000
+    RESULT_CACHE_MAX_BYTES: int = 16 * 1024 * 1024
+    RESULT_CACHE_TTL: float = 3600.0
+    
+    # Generation scheduler
+    SCHEDULER_WORKERS: int = 8
+    SCHEDULER_MAX_QUEUE: int = 100
+    SCHEDULER_SHUTDOWN_TIMEOUT: float = 10.0
+    SCHEDULER_BATCH_WORKERS: int = 6  # Workers batch jobs may occupy at once
+    SCHEDULER_MAX_BATCH_QUEUE: int = 5000
+    BATCH_MAX_ITEMS: int = 500
+    SCHEDULER_LEASE_SECONDS: float = 30.0  # Redis queue: re-queue jobs of a worker silent this long
+    
+    # Long-poll GET /tasks/{id}?wait=
+    LONG_POLL_MAX_WAIT: float = 60.0
+    LONG_POLL_MAX_WAITERS: int = 1000
     
     # Rate Limiting
-    RATE_LIMIT_PER_MINUTE: int = 10
+    RATE_LIMIT_PER_MINUTE: int = 10  # Per client IP / API key on /generate, 0 disables
+    RATE_LIMIT_BURST: int = 0  # Bucket size, 0 means RATE_LIMIT_PER_MINUTE
+    RATE_LIMIT_API_KEYS: list[str] = []  # X-API-Key values with a bucket of their own; others count by IP
+    RATE_LIMIT_TRUSTED_PROXIES: list[str] = []  # Peer IPs/networks whose X-Real-IP / X-Forwarded-For are used
+    RATE_LIMIT_TRUST_PROXY: bool = False  # Use those headers from any peer (only if the app is unreachable directly)
+    RATE_LIMIT_BACKEND: str = "memory"  # "memory" (per worker) or "redis" (shared)
+    REDIS_URL: str = "redis://localhost:6379/0"
+    UPSTREAM_QPS: float = 2.0  # Per req_key, 0 disables
+    UPSTREAM_BURST: int = 4
+    UPSTREAM_QPS_OVERRIDES: dict[str, float] = {}
+    
+    # Per-task tracing, see GET /tasks/{id}/trace
+    TRACE_SAMPLE_RATE: float = 0.01  # Share of generation requests traced, 0 disables
+    TRACE_MAX_TRACES: int = 1000  # Traces kept in memory, most recent tasks first
+    TRACE_EXPORT_FILE: str = ""  # Append spans as OTLP JSON lines, empty disables
+    TRACE_EXPORT_INTERVAL: float = 5.0
+    
+    # Prometheus /metrics
+    METRICS_ENABLED: bool = True
     
     # CORS
     CORS_ORIGINS: list[str] = ["*"]
@@ -0,0 +1,405 @@
+import asyncio
+import hashlib
+import hmac
+import ipaddress
+import logging
+import math
+from pathlib import Path
+from typing import Optional
+
+from fastapi import HTTPException, Request, Response
+from fastapi.requests import HTTPConnection
+
+from .config import Settings
+from .services.image_mirror import ImageMirror
+from .services.redis_scheduler import RedisGenerationScheduler
+from .services.scheduler import GenerationScheduler
+from .services.thumbnails import PIL_AVAILABLE, ThumbnailService
+from .services.volcengine_service import (
+    AsyncVolcengineImageService,
+    MockVolcengineImageService,
+    VolcengineImageService,
+)
+from .utils.blob_store import BlobStore
+from .utils.file_etags import ETagIndex
+from .utils.journal import HistoryJournal
+from .utils.persistence import HistoryPersistence, JsonHistoryFile
+from .utils.rate_limit import (
+    InMemoryRateLimitBackend,
+    RateLimitBackend,
+    RateLimiter,
+    RedisRateLimitBackend,
+    UpstreamRateLimiter,
+)
+from .utils.redis_store import RedisTaskStore
+from .utils.resilience import UpstreamResilience
+from .utils.result_cache import ResultCache
+from .utils.single_flight import SingleFlight
+from .utils.sqlite_store import SQLiteTaskStore
+from .utils.task_store import TaskStore
+from .utils.tracing import OTLPFileExporter, Tracer, tracer
+
+logger = logging.getLogger(__name__)
+
+
+def build_history_persistence(settings: Settings) -> HistoryPersistence:
+    """Create the history persistence engine selected by ``HISTORY_BACKEND``"""
+    if settings.HISTORY_BACKEND == "json":
+        return JsonHistoryFile(Path(settings.HISTORY_FILE))
+    if settings.HISTORY_BACKEND == "journal":
+        return HistoryJournal(
+            journal_file=Path(settings.HISTORY_JOURNAL_FILE),
+            legacy_file=Path(settings.HISTORY_FILE),
+            fsync=settings.JOURNAL_FSYNC,
+            fsync_interval=settings.JOURNAL_FSYNC_INTERVAL,
+            compact_threshold=settings.JOURNAL_COMPACT_BYTES,
+        )
+    raise ValueError(f"Unknown HISTORY_BACKEND: {settings.HISTORY_BACKEND}")
+
+
+def build_task_store(settings: Settings) -> TaskStore:
+    """Create the task store, shared across workers when ``STATE_BACKEND`` is redis"""
+    Path(settings.OUTPUT_DIR).mkdir(parents=True, exist_ok=True)
+    if settings.STATE_BACKEND == "redis":
+        return RedisTaskStore(
+            settings.REDIS_URL,
+            history_file=Path(settings.HISTORY_FILE),
+            max_history_size=settings.MAX_HISTORY_SIZE,
+        )
+    if settings.STATE_BACKEND != "local":
+        raise ValueError(f"Unknown STATE_BACKEND: {settings.STATE_BACKEND}")
+    if settings.HISTORY_BACKEND == "sqlite":
+        return SQLiteTaskStore(
+            db_file=Path(settings.SQLITE_FILE),
+            max_history_size=settings.MAX_HISTORY_SIZE,
+            legacy_file=Path(settings.HISTORY_FILE),
+        )
+    return TaskStore(
+        history_file=Path(settings.HISTORY_FILE),
+        max_history_size=settings.MAX_HISTORY_SIZE,
+        persistence=build_history_persistence(settings),
+    )
+
+
+def build_rate_limit_backend(settings: Settings) -> RateLimitBackend:
+    """Create the token bucket storage selected by ``RATE_LIMIT_BACKEND``"""
+    if settings.RATE_LIMIT_BACKEND == "redis":
+        return RedisRateLimitBackend(settings.REDIS_URL)
+    if settings.RATE_LIMIT_BACKEND == "memory":
+        return InMemoryRateLimitBackend()
+    raise ValueError(f"Unknown RATE_LIMIT_BACKEND: {settings.RATE_LIMIT_BACKEND}")
+
+
+def build_client_rate_limiter(settings: Settings, backend: RateLimitBackend) -> Optional[RateLimiter]:
+    """Create the per-client limiter for /generate, or ``None`` when disabled"""
+    if settings.RATE_LIMIT_PER_MINUTE <= 0:
+        return None
+    return RateLimiter(
+        backend,
+        per_minute=settings.RATE_LIMIT_PER_MINUTE,
+        burst=settings.RATE_LIMIT_BURST or None,
+        prefix="client:",
+    )
+
+
+def build_upstream_rate_limiter(settings: Settings, backend: RateLimitBackend) -> UpstreamRateLimiter:
+    """Create the shared limiter in front of the upstream API"""
+    return UpstreamRateLimiter(
+        backend,
+        qps=settings.UPSTREAM_QPS,
+        burst=settings.UPSTREAM_BURST,
+        overrides=settings.UPSTREAM_QPS_OVERRIDES,
+    )
+
+
+def build_upstream_resilience(settings: Settings) -> UpstreamResilience:
+    """Create the retry, timeout, circuit breaker and hedging policy for upstream calls"""
+    return UpstreamResilience(
+        max_retries=settings.UPSTREAM_MAX_RETRIES,
+        backoff=settings.UPSTREAM_RETRY_BACKOFF,
+        max_backoff=settings.UPSTREAM_RETRY_BACKOFF_MAX,
+        min_timeout=settings.UPSTREAM_TIMEOUT_MIN,
+        max_timeout=settings.UPSTREAM_TIMEOUT_MAX,
+        timeout_factor=settings.UPSTREAM_TIMEOUT_P99_FACTOR,
+        failure_threshold=settings.UPSTREAM_BREAKER_THRESHOLD,
+        reset_timeout=settings.UPSTREAM_BREAKER_RESET,
+        hedge=settings.UPSTREAM_HEDGE,
+    )
+
+
+def build_volcengine_service(
+    settings: Settings,
+    rate_limiter: Optional[UpstreamRateLimiter] = None,
+    resilience: Optional[UpstreamResilience] = None,
+):
+    """Create the Volcengine service, falling back to the mock in demo mode"""
+    if not settings.VOLCENGINE_ACCESS_KEY or not settings.VOLCENGINE_SECRET_KEY:
+        return MockVolcengineImageService()
+    if settings.VOLCENGINE_CLIENT == "async":
+        return AsyncVolcengineImageService(
+            access_key=settings.VOLCENGINE_ACCESS_KEY,
+            secret_key=settings.VOLCENGINE_SECRET_KEY,
+            max_concurrency=settings.UPSTREAM_FANOUT_CONCURRENCY,
+            rate_limiter=rate_limiter,
+            resilience=resilience,
+            host=settings.VOLCENGINE_HOST,
+            scheme=settings.VOLCENGINE_SCHEME,
+            max_connections=settings.UPSTREAM_MAX_CONNECTIONS,
+            max_keepalive_connections=settings.UPSTREAM_MAX_KEEPALIVE,
+            connect_timeout=settings.UPSTREAM_CONNECT_TIMEOUT,
+            read_timeout=settings.UPSTREAM_READ_TIMEOUT,
+            http2=settings.UPSTREAM_HTTP2,
+        )
+    return VolcengineImageService(
+        access_key=settings.VOLCENGINE_ACCESS_KEY,
+        secret_key=settings.VOLCENGINE_SECRET_KEY,
+        region=settings.VOLCENGINE_REGION,
+        max_concurrency=settings.UPSTREAM_FANOUT_CONCURRENCY,
+        rate_limiter=rate_limiter,
+        resilience=resilience,
+        host=settings.VOLCENGINE_HOST,
+        scheme=settings.VOLCENGINE_SCHEME,
+        executor_workers=settings.UPSTREAM_SDK_WORKERS,
+    )
+
+
+def build_scheduler(settings: Settings) -> GenerationScheduler:
+    """Create the generation scheduler, queueing in Redis when ``STATE_BACKEND`` is redis"""
+    if settings.STATE_BACKEND == "redis":
+        return RedisGenerationScheduler(
+            settings.REDIS_URL,
+            workers=settings.SCHEDULER_WORKERS,
+            max_queue_size=settings.SCHEDULER_MAX_QUEUE,
+            batch_workers=settings.SCHEDULER_BATCH_WORKERS,
+            max_batch_queue_size=settings.SCHEDULER_MAX_BATCH_QUEUE,
+            lease=settings.SCHEDULER_LEASE_SECONDS,
+        )
+    return GenerationScheduler(
+        workers=settings.SCHEDULER_WORKERS,
+        max_queue_size=settings.SCHEDULER_MAX_QUEUE,
+        batch_workers=settings.SCHEDULER_BATCH_WORKERS,
+        max_batch_queue_size=settings.SCHEDULER_MAX_BATCH_QUEUE,
+    )
+
+
+def build_result_cache(settings: Settings) -> Optional[ResultCache]:
+    """Create the result cache, or ``None`` when disabled"""
+    if not settings.RESULT_CACHE_ENABLED:
+        return None
+    return ResultCache(
+        max_entries=settings.RESULT_CACHE_MAX_ENTRIES,
+        max_bytes=settings.RESULT_CACHE_MAX_BYTES,
+        ttl=settings.RESULT_CACHE_TTL,
+    )
+
+
+def build_thumbnail_service(settings: Settings) -> Optional[ThumbnailService]:
+    """Create the thumbnail pipeline, or ``None`` when disabled or Pillow is missing"""
+    if not settings.THUMBNAILS_ENABLED:
+        return None
+    if not PIL_AVAILABLE:
+        logger.warning("Pillow is not installed, serving full-size images instead of thumbnails")
+        return None
+    return ThumbnailService(
+        Path(settings.OUTPUT_DIR),
+        Path(settings.THUMBNAIL_DIR),
+        widths=settings.THUMBNAIL_WIDTHS,
+        fmt=settings.THUMBNAIL_FORMAT,
+        quality=settings.THUMBNAIL_QUALITY,
+        workers=settings.THUMBNAIL_WORKERS,
+        max_cache_bytes=settings.THUMBNAIL_CACHE_MAX_BYTES,
+        history_width=settings.THUMBNAIL_HISTORY_WIDTH,
+    )
+
+
+def build_image_mirror(
+    settings: Settings,
+    store: TaskStore,
+    thumbnails: Optional[ThumbnailService] = None,
+    etags: Optional[ETagIndex] = None,
+) -> Optional[ImageMirror]:
+    """Create the background image mirror, or ``None`` when disabled"""
+    if not settings.MIRROR_IMAGES:
+        return None
+    output_dir = Path(settings.OUTPUT_DIR)
+    output_dir.mkdir(parents=True, exist_ok=True)
+    return ImageMirror(
+        output_dir,
+        store,
+        concurrency=settings.MIRROR_CONCURRENCY,
+        retries=settings.MIRROR_RETRIES,
+        backoff=settings.MIRROR_BACKOFF,
+        timeout=settings.MIRROR_TIMEOUT,
+        max_bytes=settings.MIRROR_MAX_BYTES,
+        thumbnails=thumbnails,
+        etags=etags,
+    )
+
+
+def build_blob_store(
+    settings: Settings,
+    store: TaskStore,
+    thumbnails: Optional[ThumbnailService] = None,
+    etags: Optional[ETagIndex] = None,
+) -> BlobStore:
+    """Create the garbage collector and quota for saved images"""
+    return BlobStore(
+        Path(settings.OUTPUT_DIR),
+        store,
+        quota_bytes=settings.BLOB_QUOTA_BYTES,
+        grace=settings.BLOB_GC_GRACE,
+        interval=settings.BLOB_GC_INTERVAL,
+        thumbnails=thumbnails,
+        etags=etags,
+    )
+
+
+def configure_tracer(settings: Settings) -> Tracer:
+    """Apply the sampling and export settings to the process-wide tracer"""
+    exporter = None
+    if settings.TRACE_EXPORT_FILE:
+        exporter = OTLPFileExporter(
+            Path(settings.TRACE_EXPORT_FILE),
+            service_name=settings.APP_NAME,
+            interval=settings.TRACE_EXPORT_INTERVAL,
+        )
+    tracer.configure(settings.TRACE_SAMPLE_RATE, max_traces=settings.TRACE_MAX_TRACES, exporter=exporter)
+    return tracer
+
+
+def prepare_upload_dir(settings: Settings) -> Path:
+    """Create the upload spool directory, removing files left by a previous run"""
+    upload_dir = Path(settings.UPLOAD_DIR)
+    upload_dir.mkdir(parents=True, exist_ok=True)
+    if settings.STATE_BACKEND == "redis":
+        # Other workers may still have queued jobs for these files
+        return upload_dir
+    for leftover in upload_dir.glob("*.upload"):
+        leftover.unlink(missing_ok=True)
+    return upload_dir
+
+
+def get_task_store(connection: HTTPConnection) -> TaskStore:
+    """Get the task store owned by the application lifespan"""
+    return connection.app.state.task_store
+
+
+def get_volcengine_service(connection: HTTPConnection):
+    """Get the Volcengine service owned by the application lifespan"""
+    return connection.app.state.volcengine_service
+
+
+def get_scheduler(connection: HTTPConnection) -> GenerationScheduler:
+    """Get the generation scheduler owned by the application lifespan"""
+    return connection.app.state.scheduler
+
+
+def get_result_cache(connection: HTTPConnection) -> Optional[ResultCache]:
+    """Get the result cache owned by the application lifespan"""
+    return connection.app.state.result_cache
+
+
+def get_single_flight(connection: HTTPConnection) -> SingleFlight:
+    """Get the in-flight request coalescer owned by the application lifespan"""
+    return connection.app.state.single_flight
+
+
+def get_long_poll_slots(connection: HTTPConnection) -> asyncio.Semaphore:
+    """Get the semaphore capping parked long-poll requests"""
+    return connection.app.state.long_poll_slots
+
+
+def get_tracer(connection: HTTPConnection) -> Tracer:
+    """Get the tracer configured by the application lifespan"""
+    return connection.app.state.tracer
+
+
+def get_image_mirror(connection: HTTPConnection) -> Optional[ImageMirror]:
+    """Get the background image mirror owned by the application lifespan"""
+    return connection.app.state.image_mirror
+
+
+def get_thumbnails(connection: HTTPConnection) -> Optional[ThumbnailService]:
+    """Get the thumbnail pipeline owned by the application lifespan"""
+    return connection.app.state.thumbnails
+
+
+def get_image_etags(connection: HTTPConnection) -> ETagIndex:
+    """Get the ETags of served images, owned by the application lifespan"""
+    return connection.app.state.image_etags
+
+
+def _is_trusted_proxy(address: Optional[str], settings: Settings) -> bool:
+    if not address or not settings.RATE_LIMIT_TRUSTED_PROXIES:
+        return False
+    try:
+        ip = ipaddress.ip_address(address)
+    except ValueError:
+        return False
+    return any(ip in ipaddress.ip_network(proxy, strict=False) for proxy in settings.RATE_LIMIT_TRUSTED_PROXIES)
+
+
+def client_address(request: Request, settings: Settings) -> Optional[str]:
+    """The client's IP; forwarding headers count only when set by a trusted proxy"""
+    address = request.client.host if request.client is not None else None
+    if not (settings.RATE_LIMIT_TRUST_PROXY or _is_trusted_proxy(address, settings)):
+        return address
+    forwarded = request.headers.get("X-Real-IP", "").strip()
+    if forwarded:
+        return forwarded
+    # Each proxy appends the peer it saw, so the client is the last hop not added by a trusted proxy
+    hops = [hop.strip() for hop in request.headers.get("X-Forwarded-For", "").split(",") if hop.strip()]
+    for hop in reversed(hops):
+        if not _is_trusted_proxy(hop, settings):
+            return hop
+    return hops[0] if hops else address
+
+
+def client_identity(request: Request, settings: Settings) -> str:
+    """Rate limit key for a request: its API key if configured, otherwise its IP.
+
+    Unknown API keys are ignored, so inventing keys does not buy fresh buckets.
+    """
+    api_key = request.headers.get("X-API-Key")
+    if api_key and any(hmac.compare_digest(api_key, known) for known in settings.RATE_LIMIT_API_KEYS):
+        return "key:" + hashlib.sha256(api_key.encode("utf-8")).hexdigest()[:32]
+    return f"ip:{client_address(request, settings) or 'unknown'}"
+
+
+async def charge_client(request: Request, response: Response, req_key: str, tokens: int = 1) -> None:
+    """Take ``tokens`` from the client's rate limit bucket and report rate limit budgets as headers.
+
+    Raises 429 while the bucket holds fewer tokens, and 422 when ``tokens``
+    is more than the bucket can ever hold.
+    """
+    state = request.app.state
+    headers = {}
+    limiter: Optional[RateLimiter] = state.client_rate_limiter
+    if limiter is not None:
+        if tokens > limiter.capacity:
+            raise HTTPException(
+                status_code=422,
+                detail=f"At most {limiter.capacity} images can be requested at once under the rate limit",
+            )
+        identity = client_identity(request, state.settings)
+        result = await limiter.hit(identity, tokens)
+        headers = {
+            "X-RateLimit-Limit": str(result.limit),
+            "X-RateLimit-Remaining": str(result.remaining),
+            "X-RateLimit-Reset": str(math.ceil(result.reset_after)),
+        }
+        if not result.allowed:
+            headers["Retry-After"] = str(max(1, math.ceil(result.retry_after)))
+            raise HTTPException(status_code=429, detail="Rate limit exceeded", headers=headers)
+    upstream: UpstreamRateLimiter = state.upstream_rate_limiter
+    headers["X-Upstream-RateLimit-Remaining"] = str(await upstream.remaining(req_key))
+    response.headers.update(headers)
+
+
+def client_rate_limit(req_key: str):
+    """Dependency enforcing the per-client limit and reporting rate limit budgets as headers"""
+
+    async def dependency(request: Request, response: Response) -> None:
+        await charge_client(request, response, req_key)
+
+    return dependency
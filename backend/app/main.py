@@ -1,19 +1,91 @@
+import asyncio
+from contextlib import asynccontextmanager
+from functools import partial
 from pathlib import Path
 
-from fastapi import FastAPI
+from fastapi import FastAPI, Request, Response
 from fastapi.middleware.cors import CORSMiddleware
-from fastapi.staticfiles import StaticFiles
 
 from .config import get_settings
-from .routers import generate, task
+from .dependencies import (
+    build_blob_store,
+    build_client_rate_limiter,
+    build_image_mirror,
+    build_rate_limit_backend,
+    build_result_cache,
+    build_scheduler,
+    build_task_store,
+    build_thumbnail_service,
+    build_upstream_rate_limiter,
+    build_upstream_resilience,
+    build_volcengine_service,
+    configure_tracer,
+    prepare_upload_dir,
+)
+from .routers import batch, generate, images, task
 from .schemas import HealthResponse
+from .utils import metrics
+from .utils.file_etags import ETagIndex
+from .utils.single_flight import SingleFlight
 
 settings = get_settings()
 
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    """Own the shared task store, scheduler and upstream service for the app's lifetime"""
+    app.state.settings = settings
+    tracer = app.state.tracer = configure_tracer(settings)
+    store = app.state.task_store = build_task_store(settings)
+    rate_limit_backend = build_rate_limit_backend(settings)
+    app.state.client_rate_limiter = build_client_rate_limiter(settings, rate_limit_backend)
+    upstream_limiter = app.state.upstream_rate_limiter = build_upstream_rate_limiter(settings, rate_limit_backend)
+    resilience = app.state.upstream_resilience = build_upstream_resilience(settings)
+    service = app.state.volcengine_service = build_volcengine_service(settings, upstream_limiter, resilience)
+    scheduler = app.state.scheduler = build_scheduler(settings)
+    cache = app.state.result_cache = build_result_cache(settings)
+    flights = app.state.single_flight = SingleFlight()
+    thumbnails = app.state.thumbnails = build_thumbnail_service(settings)
+    etags = app.state.image_etags = ETagIndex(settings.IMAGE_ETAG_CACHE_ENTRIES)
+    mirror = app.state.image_mirror = build_image_mirror(settings, store, thumbnails, etags)
+    blobs = app.state.blob_store = build_blob_store(settings, store, thumbnails, etags)
+    prepare_upload_dir(settings)
+    app.state.long_poll_slots = asyncio.Semaphore(settings.LONG_POLL_MAX_WAITERS)
+    metrics.TASKS_IN_FLIGHT.set_function(lambda: scheduler.in_flight)
+    metrics.QUEUE_DEPTH.set_function(lambda: scheduler.depth)
+    metrics.EXECUTOR_UTILIZATION.labels("upstream").set_function(service.utilization)
+    if thumbnails is not None:
+        metrics.EXECUTOR_UTILIZATION.labels("thumbnails").set_function(thumbnails.utilization)
+        await thumbnails.start()
+    jobs = generate.JobContext(store, service, cache, flights, mirror, Path(settings.OUTPUT_DIR))
+    scheduler.runner = partial(generate.build_job_run, ctx=jobs)
+    await store.start()
+    await blobs.start()
+    await tracer.start()
+    scheduler.start()
+    resume = asyncio.create_task(generate.resume_pending_tasks(scheduler, jobs))
+    try:
+        yield
+    finally:
+        resume.cancel()
+        # Persist queued and interrupted jobs so the next start re-queues them
+        await generate.suspend_pending_tasks(store, scheduler, settings.SCHEDULER_SHUTDOWN_TIMEOUT)
+        await app.state.volcengine_service.close()
+        if mirror is not None:
+            await mirror.close()
+        await blobs.close()
+        if thumbnails is not None:
+            await thumbnails.close()
+        await rate_limit_backend.close()
+        await app.state.task_store.close()
+        await tracer.close()
+
+
 app = FastAPI(
     title=settings.APP_NAME,
     version=settings.APP_VERSION,
     description="AI Image Generation API powered by Volcengine",
+    lifespan=lifespan,
 )
 
 app.add_middleware(
@@ -24,30 +96,40 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
+app.include_router(batch.router, prefix=settings.API_V1_PREFIX)
 app.include_router(generate.router, prefix=settings.API_V1_PREFIX)
 app.include_router(task.router, prefix=settings.API_V1_PREFIX)
+app.include_router(images.router)
 
-output_dir = Path(settings.OUTPUT_DIR)
-output_dir.mkdir(parents=True, exist_ok=True)
-
-try:
-    app.mount("/images", StaticFiles(directory=str(output_dir)), name="images")
-except Exception:
-    pass
+Path(settings.OUTPUT_DIR).mkdir(parents=True, exist_ok=True)
 
 
 @app.get("/health", response_model=HealthResponse)
-async def health_check():
-    """Health check endpoint"""
+async def health_check(request: Request):
+    """Health check endpoint; ``degraded`` while an upstream circuit is not closed"""
+    cache = request.app.state.result_cache
+    resilience = request.app.state.upstream_resilience
     return HealthResponse(
-        status="healthy",
+        status="healthy" if resilience.healthy else "degraded",
         version=settings.APP_VERSION,
         volcengine_configured=bool(
             settings.VOLCENGINE_ACCESS_KEY and settings.VOLCENGINE_SECRET_KEY
         ),
+        result_cache=cache.stats() if cache is not None else None,
+        coalescing=request.app.state.single_flight.stats(),
+        upstream=resilience.stats(),
+        storage=request.app.state.blob_store.stats(),
     )
 
 
+if settings.METRICS_ENABLED:
+
+    @app.get("/metrics", include_in_schema=False)
+    async def prometheus_metrics():
+        """Prometheus scrape endpoint (values are per worker process)"""
+        return Response(metrics.REGISTRY.render(), media_type=metrics.CONTENT_TYPE)
+
+
 @app.get("/")
 async def root():
     """Root endpoint"""
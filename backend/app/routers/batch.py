@@ -0,0 +1,254 @@
+from string import Template
+from pathlib import Path
+from typing import Optional
+from uuid import uuid4
+
+from fastapi import APIRouter, Depends, HTTPException, Query, Request, Response
+from fastapi.responses import StreamingResponse
+
+from ..config import Settings, get_settings
+from ..dependencies import (
+    charge_client,
+    get_image_mirror,
+    get_result_cache,
+    get_scheduler,
+    get_single_flight,
+    get_task_store,
+    get_volcengine_service,
+)
+from ..schemas import (
+    BatchRequest,
+    BatchResponse,
+    BatchResultsResponse,
+    BatchStatusResponse,
+    TaskStatus,
+)
+from ..services.image_mirror import ImageMirror
+from ..services.scheduler import PRIORITY_BATCH, GenerationScheduler, QueueFullError
+from ..services.volcengine_service import TEXT2IMAGE_REQ_KEY, VolcengineImageService
+from ..utils.result_cache import ResultCache
+from ..utils.single_flight import SingleFlight
+from ..utils.task_store import BatchRecord, TaskRecord, TaskStore
+from .generate import JobContext, _get_output_dir, _job, _lookup_cache, _queue_full, _spool_base64_image
+from .task import SSE_KEEPALIVE_SECONDS, TERMINAL_STATUSES, _to_status_response
+
+router = APIRouter(prefix="/generate/batch", tags=["batch"])
+
+
+def _expand_items(request: BatchRequest) -> list:
+    """The batch's requests, with template variables substituted"""
+    if (request.items is None) == (request.template is None):
+        raise HTTPException(status_code=422, detail="Provide exactly one of items or template")
+    if request.items is not None:
+        return request.items
+
+    base = request.template.base
+    items = []
+    for index, variables in enumerate(request.template.variables):
+        try:
+            update = {"prompt": Template(base.prompt).substitute(variables)}
+            if base.negative_prompt:
+                update["negative_prompt"] = Template(base.negative_prompt).substitute(variables)
+        except (KeyError, ValueError) as e:
+            raise HTTPException(status_code=422, detail=f"Template variables #{index}: missing or invalid {e}")
+        # Re-validate so substituted prompts still respect the length limits
+        items.append(type(base).model_validate({**base.model_dump(), **update}))
+    return items
+
+
+def _aggregate(batch: BatchRecord, tasks: list[TaskRecord]) -> BatchStatusResponse:
+    counts = {status: 0 for status in TaskStatus}
+    progress = 0
+    for task in tasks:
+        counts[task.status] += 1
+        progress += 100 if task.status in TERMINAL_STATUSES else (task.progress or 0)
+    finished = counts[TaskStatus.COMPLETED] + counts[TaskStatus.FAILED]
+    if finished == len(tasks):
+        status = TaskStatus.COMPLETED
+    elif counts[TaskStatus.PENDING] == len(tasks):
+        status = TaskStatus.PENDING
+    else:
+        status = TaskStatus.PROCESSING
+    return BatchStatusResponse(
+        batch_id=batch.id,
+        status=status,
+        total=len(tasks),
+        counts=counts,
+        progress=progress // len(tasks) if tasks else 100,
+        created_at=batch.created_at,
+    )
+
+
+async def _get_batch_or_404(store: TaskStore, batch_id: str) -> BatchRecord:
+    batch = await store.get_batch(batch_id)
+    if batch is None:
+        raise HTTPException(status_code=404, detail="Batch not found")
+    return batch
+
+
+@router.post("", response_model=BatchResponse)
+async def create_batch(
+    request: BatchRequest,
+    http_request: Request,
+    response: Response,
+    settings: Settings = Depends(get_settings),
+    store: TaskStore = Depends(get_task_store),
+    service: VolcengineImageService = Depends(get_volcengine_service),
+    scheduler: GenerationScheduler = Depends(get_scheduler),
+    cache: Optional[ResultCache] = Depends(get_result_cache),
+    flights: SingleFlight = Depends(get_single_flight),
+    mirror: Optional[ImageMirror] = Depends(get_image_mirror),
+):
+    """
+    Generate a batch of images
+
+    - **items**: Text2image and image2image requests, each tagged with `type`
+    - **template**: Alternatively, a `base` request whose prompts contain
+      `$name` placeholders, and a list of `variables` to substitute, one
+      request per entry
+
+    All tasks are created at once and queued behind interactive requests,
+    sharing workers fairly with other batches. Track them with
+    `GET /generate/batch/{batch_id}` or its `/results` and `/events`.
+    Each item counts as one request against the client rate limit.
+    """
+    items = _expand_items(request)
+    if len(items) > settings.BATCH_MAX_ITEMS:
+        raise HTTPException(status_code=422, detail=f"A batch holds at most {settings.BATCH_MAX_ITEMS} items")
+    for item in items:
+        if item.type == "image2image" and (not item.image or len(item.image) < 100):
+            raise HTTPException(status_code=400, detail="Invalid image data")
+    await charge_client(http_request, response, TEXT2IMAGE_REQ_KEY, tokens=len(items))
+
+    # Input images are spooled like uploads, so queued jobs carry only their paths
+    image_paths: list[Optional[Path]] = []
+    try:
+        lookups = []
+        for item in items:
+            image_path = image_digest = None
+            if item.type == "image2image":
+                image_path, image_digest = await _spool_base64_image(item.image, settings)
+            image_paths.append(image_path)
+            lookups.append(await _lookup_cache(cache, item.type, item, image_digest))
+        queued = sum(1 for _, cached in lookups if cached is None)
+        if not scheduler.has_capacity(queued, PRIORITY_BATCH):
+            raise _queue_full(scheduler.retry_after())
+
+        batch_id = str(uuid4())
+        tasks = await store.create_tasks(
+            [
+                {
+                    "task_type": item.type,
+                    "prompt": item.prompt,
+                    "negative_prompt": item.negative_prompt,
+                    "parameters": item.model_dump(exclude={"type", "image"}),
+                }
+                for item in items
+            ],
+            batch_id=batch_id,
+        )
+
+        ctx = JobContext(store, service, cache, flights, mirror, _get_output_dir(settings))
+        jobs = []
+        for task, item, image_path, (result_key, cached) in zip(tasks, items, image_paths, lookups):
+            if cached is not None:
+                if image_path is not None:
+                    image_path.unlink(missing_ok=True)
+                await store.complete_task(task.id, cached)
+                if mirror is not None:
+                    mirror.schedule(task.id, cached)
+                continue
+            jobs.append(
+                _job(ctx, item.type, task.id, item, result_key, image_path, priority=PRIORITY_BATCH, group=batch_id)
+            )
+        try:
+            await scheduler.submit_many(jobs)
+        except QueueFullError as e:
+            for job in jobs:
+                await store.fail_task(job.task_id, "Generation queue is full")
+            raise _queue_full(e.retry_after)
+    except BaseException:
+        for image_path in image_paths:
+            if image_path is not None:
+                image_path.unlink(missing_ok=True)
+        raise
+
+    return BatchResponse(
+        batch_id=batch_id,
+        task_ids=[task.id for task in tasks],
+        total=len(tasks),
+        cached=len(tasks) - len(jobs),
+        message="Batch created",
+        created_at=tasks[0].created_at,
+    )
+
+
+@router.get("/{batch_id}", response_model=BatchStatusResponse)
+async def get_batch_status(batch_id: str, store: TaskStore = Depends(get_task_store)):
+    """Aggregate status, per-status counts and progress of a batch"""
+    batch = await _get_batch_or_404(store, batch_id)
+    return _aggregate(batch, await store.get_tasks(batch.task_ids))
+
+
+@router.get("/{batch_id}/results", response_model=BatchResultsResponse)
+async def get_batch_results(
+    batch_id: str,
+    offset: int = Query(0, ge=0),
+    limit: int = Query(100, ge=1, le=500),
+    store: TaskStore = Depends(get_task_store),
+    scheduler: GenerationScheduler = Depends(get_scheduler),
+):
+    """Statuses and images of a batch's tasks, in submission order"""
+    batch = await _get_batch_or_404(store, batch_id)
+    tasks = await store.get_tasks(batch.task_ids[offset:offset + limit])
+    return BatchResultsResponse(
+        batch_id=batch.id,
+        total=len(batch.task_ids),
+        offset=offset,
+        items=[await _to_status_response(task, scheduler) for task in tasks],
+    )
+
+
+@router.get("/{batch_id}/events")
+async def stream_batch_events(
+    batch_id: str,
+    store: TaskStore = Depends(get_task_store),
+    scheduler: GenerationScheduler = Depends(get_scheduler),
+):
+    """Server-Sent Events stream of a batch.
+
+    Sends a ``status`` event with every task's current state, then one per
+    change, each round followed by a ``batch`` event with the aggregate.
+    The stream ends when every task has completed or failed.
+    """
+    batch = await _get_batch_or_404(store, batch_id)
+
+    async def stream():
+        # Subscribe before reading the current state so no change is missed
+        with store.events.subscribe(batch.task_ids) as subscription:
+            latest = {task.id: task for task in await store.get_tasks(batch.task_ids)}
+            for task_id in batch.task_ids:
+                if task_id not in latest:
+                    subscription.remove(task_id)
+            updates = list(latest.values())
+            while True:
+                for task in updates:
+                    latest[task.id] = task
+                    payload = (await _to_status_response(task, scheduler)).model_dump_json()
+                    yield f"event: status\ndata: {payload}\n\n"
+                    if task.status in TERMINAL_STATUSES:
+                        subscription.remove(task.id)
+                summary = _aggregate(batch, list(latest.values()))
+                yield f"event: batch\ndata: {summary.model_dump_json()}\n\n"
+                if not subscription.task_ids:
+                    return
+                updates = await subscription.get(timeout=SSE_KEEPALIVE_SECONDS)
+                while not updates:
+                    yield ": keepalive\n\n"
+                    updates = await subscription.get(timeout=SSE_KEEPALIVE_SECONDS)
+
+    return StreamingResponse(
+        stream(),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
@@ -1,25 +1,55 @@
 import asyncio
-import base64
+import binascii
+import hashlib
+from dataclasses import dataclass
+from functools import partial
 from pathlib import Path
-from typing import Optional
+from typing import Any, Awaitable, Callable, Optional, Union
 from uuid import uuid4
 
-from fastapi import APIRouter, Depends, HTTPException
+from fastapi import APIRouter, Depends, File, Form, HTTPException, UploadFile
+from fastapi.exceptions import RequestValidationError
+from pydantic import ValidationError
 from ..config import Settings, get_settings
 from ..schemas import (
     Text2ImageRequest,
+    Image2ImageParams,
     Image2ImageRequest,
     TaskResponse,
     TaskStatus,
     ErrorResponse,
 )
-from ..services.volcengine_service import VolcengineImageService, MockVolcengineImageService
+from ..dependencies import (
+    client_rate_limit,
+    get_image_mirror,
+    get_result_cache,
+    get_scheduler,
+    get_single_flight,
+    get_task_store,
+    get_volcengine_service,
+)
+from ..services.image_mirror import ImageMirror
+from ..services.scheduler import GenerationScheduler, Job, QueueFullError, PRIORITY_BATCH, PRIORITY_INTERACTIVE
+from ..services.volcengine_service import (
+    IMAGE2IMAGE_REQ_KEY,
+    TEXT2IMAGE_REQ_KEY,
+    VolcengineImageService,
+)
+from ..utils.image_files import (
+    encode_file_base64,
+    iter_base64_chunks,
+    read_image_dimensions,
+    save_base64_image,
+    sniff_image_extension,
+)
+from ..utils.result_cache import ResultCache, cache_key, is_deterministic
+from ..utils.single_flight import SingleFlight
 from ..utils.task_store import TaskStore
+from ..utils import tracing
+from ..utils.tracing import TracedRoute
 
-router = APIRouter(prefix="/generate", tags=["generation"])
+router = APIRouter(prefix="/generate", tags=["generation"], route_class=TracedRoute)
 
-_task_store: Optional[TaskStore] = None
-_volcengine_service: Optional[VolcengineImageService] = None
 _output_dir: Optional[Path] = None
 
 
@@ -33,107 +63,81 @@ def _get_output_dir(settings: Settings) -> Path:
     return _output_dir
 
 
-def get_task_store(settings: Settings = Depends(get_settings)) -> TaskStore:
-    """Get task store instance"""
-    global _task_store
-    if _task_store is None:
-        _get_output_dir(settings)
-        _task_store = TaskStore(
-            history_file=Path(settings.HISTORY_FILE),
-            max_history_size=settings.MAX_HISTORY_SIZE,
-        )
-    return _task_store
-
-
-def get_volcengine_service(settings: Settings = Depends(get_settings)):
-    """Get Volcengine service instance"""
-    global _volcengine_service
-    if _volcengine_service is None:
-        _get_output_dir(settings)
-        # Check if credentials are configured
-        if not settings.VOLCENGINE_ACCESS_KEY or not settings.VOLCENGINE_SECRET_KEY:
-            # Use mock service for demo
-            _volcengine_service = MockVolcengineImageService()
-        else:
-            _volcengine_service = VolcengineImageService(
-                access_key=settings.VOLCENGINE_ACCESS_KEY,
-                secret_key=settings.VOLCENGINE_SECRET_KEY,
-                region=settings.VOLCENGINE_REGION,
-            )
-    return _volcengine_service
-
+def _result_image_urls(result: dict) -> list[str]:
+    """Image URLs carried by a single upstream result"""
+    if isinstance(result, dict) and "data" in result:
+        return list(result["data"].get("image_urls", []))
+    return []
 
-def _normalize_base64(data: str) -> Optional[str]:
-    try:
-        if "," in data:
-            data = data.split(",", 1)[1]
-        data = data.strip()
-        if not data:
-            return None
-        # Add padding if necessary
-        missing_padding = len(data) % 4
-        if missing_padding:
-            data += "=" * (4 - missing_padding)
-        # Validate by decoding
-        base64.b64decode(data, validate=True)
-        return data
-    except Exception:
-        return None
 
+async def _save_result_images(result: dict, output_dir: Optional[Path]) -> dict:
+    """Save the inline ``binary_data_base64`` images of an upstream result.
 
-def _save_base64_image(data: str, output_dir: Path) -> Optional[str]:
-    normalized = _normalize_base64(data)
-    if not normalized:
-        return None
-    try:
-        image_bytes = base64.b64decode(normalized)
-        filename = f"{uuid4().hex}.png"
-        file_path = output_dir / filename
-        file_path.write_bytes(image_bytes)
-        return f"/images/{filename}"
-    except Exception:
-        return None
+    They are stream-decoded into ``output_dir`` and replace the result's
+    ``image_urls`` in place, so the images need no second download from the
+    temporary URLs. A result whose images do not all decode keeps its URLs.
+    """
+    data = result.get("data") if isinstance(result, dict) else None
+    if output_dir is None or not isinstance(data, dict) or not data.get("binary_data_base64"):
+        return result
+    encoded = data.pop("binary_data_base64")
+    with tracing.span("images.decode", count=len(encoded)):
+        saved = await asyncio.gather(*(save_base64_image(item, output_dir) for item in encoded))
+    if all(saved):
+        data["image_urls"] = list(saved)
+    return result
 
 
-def _extract_image_urls(payload: dict, output_dir: Path) -> list[str]:
-    urls: set[str] = set()
-    base64_items: list[str] = []
-
-    def walk(value, key: Optional[str] = None):
-        if isinstance(value, dict):
-            for k, v in value.items():
-                walk(v, k)
-        elif isinstance(value, list):
-            for item in value:
-                walk(item, key)
-        elif isinstance(value, str):
-            if key:
-                key_lower = key.lower()
-                if key_lower in {"image_urls", "urls", "url_list"}:
-                    urls.add(value)
-                elif key_lower in {"image_url", "url"}:
-                    urls.add(value)
-                elif key_lower in {"image_base64", "binary_data_base64", "binary_data", "image"}:
-                    base64_items.append(value)
-                elif key_lower in {"result", "data"}:
-                    if value.startswith("http"):
-                        urls.add(value)
-            else:
-                if value.startswith("http://") or value.startswith("https://"):
-                    urls.add(value)
-                else:
-                    maybe_base64 = _normalize_base64(value)
-                    if maybe_base64:
-                        base64_items.append(value)
+async def _lookup_cache(
+    cache: Optional[ResultCache],
+    kind: str,
+    request: Union[Text2ImageRequest, Image2ImageParams],
+    image_digest: Optional[str] = None,
+) -> tuple[Optional[str], Optional[list[str]]]:
+    """Return ``(key, cached images)`` for reusable requests, ``(None, None)`` otherwise.
 
-    walk(payload)
+    The key is also used to coalesce identical in-flight requests, so it is
+    computed even when the cache is disabled. Image2image keys include
+    ``image_digest``, the hash of the decoded input image.
+    """
+    if not request.use_cache:
+        return None, None
+    params = request.model_dump(mode="json", exclude={"image", "type"})
+    if not is_deterministic(params):
+        return None, None
+    with tracing.span("cache.lookup") as span:
+        key = cache_key(kind, params, image_digest)
+        cached = cache.get(key) if cache is not None else None
+        span.set("hit", cached is not None)
+    return key, cached
 
-    for item in base64_items:
-        saved = _save_base64_image(item, output_dir)
-        if saved:
-            urls.add(saved)
 
-    return list(urls)
+async def _complete_from_cache(
+    store: TaskStore,
+    task_type: str,
+    request: Union[Text2ImageRequest, Image2ImageParams],
+    parameters: dict,
+    images: list[str],
+    mirror: Optional[ImageMirror] = None,
+) -> TaskResponse:
+    """Create a task that is already completed with cached images"""
+    with tracing.span("store.create_task"):
+        task = await store.create_task(
+            task_type=task_type,
+            prompt=request.prompt,
+            negative_prompt=request.negative_prompt,
+            parameters=parameters,
+        )
+    tracing.bind_task(task.id)
+    await store.complete_task(task.id, images)
+    if mirror is not None:
+        mirror.schedule(task.id, images)
+    return TaskResponse(
+        task_id=task.id,
+        status=TaskStatus.COMPLETED,
+        message="Served from result cache",
+        created_at=task.created_at,
+    )
 
 
 async def process_text2image_task(
@@ -141,14 +145,40 @@ async def process_text2image_task(
     request: Text2ImageRequest,
     store: TaskStore,
     service: VolcengineImageService,
+    cache: Optional[ResultCache] = None,
+    result_key: Optional[str] = None,
+    flights: Optional[SingleFlight] = None,
+    mirror: Optional[ImageMirror] = None,
+    output_dir: Optional[Path] = None,
 ):
-    """Background task to process text-to-image generation"""
+    """Background task to process text-to-image generation.
+
+    With ``flights`` set, concurrent tasks sharing ``result_key`` attach to a
+    single upstream call and each receive its partial and final results.
+    Inline result images are saved to ``output_dir`` as each one lands.
+    """
     try:
         # Mark as processing
         await store.set_processing(task_id)
         
+        landed: list[str] = []
+        finished = 0
+        
+        async def on_result(index: int, res: dict) -> None:
+            # Stream partial results into the task as each image lands
+            nonlocal finished
+            finished += 1
+            landed.extend(_result_image_urls(res))
+            if finished < request.num_images:
+                await store.update_task(
+                    task_id,
+                    progress=finished * 100 // request.num_images,
+                    images=list(landed),
+                )
+        
         # Call Volcengine API
-        result = await service.text_to_image(
+        generate = partial(
+            service.text_to_image,
             prompt=request.prompt,
             negative_prompt=request.negative_prompt,
             width=request.width,
@@ -160,15 +190,30 @@ async def process_text2image_task(
             num_images=request.num_images,
         )
         
+        def saving(callback):
+            # Decode once per upstream result, before any task sees it
+            async def save_then(index: int, res: dict) -> None:
+                await callback(index, await _save_result_images(res, output_dir))
+            return save_then
+        
+        with tracing.span("upstream.generate", num_images=request.num_images):
+            if flights is not None:
+                result = await flights.do(result_key, lambda emit: generate(on_result=saving(emit)), on_result)
+            else:
+                result = await generate(on_result=saving(on_result))
+        
         if result.get("success"):
-            # Extract image URLs from results
-            image_urls = []
-            for res in result.get("results", []):
-                if isinstance(res, dict) and "data" in res:
-                    urls = res["data"].get("image_urls", [])
-                    image_urls.extend(urls)
-            
+            with tracing.span("images.extract"):
+                # Extract image URLs from results, in seed order
+                image_urls = []
+                for res in result.get("results", []):
+                    image_urls.extend(_result_image_urls(res))
+                
+                if cache is not None and result_key:
+                    cache.put(result_key, image_urls)
             await store.complete_task(task_id, image_urls)
+            if mirror is not None:
+                mirror.schedule(task_id, image_urls)
         else:
             error_msg = "Failed to generate image"
             if result.get("results"):
@@ -183,30 +228,60 @@ async def process_text2image_task(
 
 async def process_image2image_task(
     task_id: str,
-    request: Image2ImageRequest,
+    request: Image2ImageParams,
     store: TaskStore,
     service: VolcengineImageService,
+    cache: Optional[ResultCache] = None,
+    result_key: Optional[str] = None,
+    flights: Optional[SingleFlight] = None,
+    mirror: Optional[ImageMirror] = None,
+    image_path: Optional[Path] = None,
+    output_dir: Optional[Path] = None,
 ):
-    """Background task to process image-to-image generation"""
+    """Background task to process image-to-image generation.
+
+    The input image is spooled at ``image_path``, whether it was uploaded or
+    sent as base64 JSON. It is base64-encoded only right before the upstream
+    call and removed once the task finishes.
+    """
     try:
         await store.set_processing(task_id)
         
-        result = await service.image_to_image(
-            image_base64=request.image,
-            prompt=request.prompt,
-            negative_prompt=request.negative_prompt,
-            strength=request.strength,
-            steps=request.steps,
-            scale=request.scale,
-            seed=request.seed,
-            style_preset=request.style_preset.value,
-        )
+        if image_path is None or not image_path.exists():
+            await store.fail_task(task_id, "Uploaded image is no longer available, please resubmit")
+            return
+        
+        async def generate() -> dict:
+            image_base64 = await asyncio.to_thread(encode_file_base64, image_path)
+            result = await service.image_to_image(
+                image_base64=image_base64,
+                prompt=request.prompt,
+                negative_prompt=request.negative_prompt,
+                strength=request.strength,
+                steps=request.steps,
+                scale=request.scale,
+                seed=request.seed,
+                style_preset=request.style_preset.value,
+            )
+            await _save_result_images(result.get("result"), output_dir)
+            return result
+        
+        with tracing.span("upstream.generate"):
+            if flights is not None:
+                result = await flights.do(result_key, lambda emit: generate())
+            else:
+                result = await generate()
         
         if result.get("success"):
             res_data = result.get("result", {})
             if isinstance(res_data, dict) and "data" in res_data:
-                image_urls = res_data["data"].get("image_urls", [])
+                with tracing.span("images.extract"):
+                    image_urls = res_data["data"].get("image_urls", [])
+                    if cache is not None and result_key:
+                        cache.put(result_key, image_urls)
                 await store.complete_task(task_id, image_urls)
+                if mirror is not None:
+                    mirror.schedule(task_id, image_urls)
             else:
                 await store.fail_task(task_id, "Invalid response format")
         else:
@@ -215,13 +290,322 @@ async def process_image2image_task(
     
     except Exception as e:
         await store.fail_task(task_id, f"Internal error: {str(e)}")
+    finally:
+        if image_path is not None:
+            image_path.unlink(missing_ok=True)
+
+
+@dataclass
+class JobContext:
+    """Process-local dependencies that queued jobs run with"""
+
+    store: TaskStore
+    service: VolcengineImageService
+    cache: Optional[ResultCache] = None
+    flights: Optional[SingleFlight] = None
+    mirror: Optional[ImageMirror] = None
+    output_dir: Optional[Path] = None
+
+
+def job_spec(
+    kind: str,
+    task_id: str,
+    request: Union[Text2ImageRequest, Image2ImageParams],
+    result_key: Optional[str] = None,
+    image_path: Optional[Path] = None,
+) -> dict[str, Any]:
+    """JSON-serializable description of a generation job, see ``build_job_run``.
+
+    Input images stay in their spooled file at ``image_path``, so specs are
+    small enough to queue in Redis.
+    """
+    return {
+        "kind": kind,
+        "task_id": task_id,
+        "request": request.model_dump(mode="json", exclude={"type", "image"}),
+        "result_key": result_key,
+        "image_path": str(image_path) if image_path is not None else None,
+    }
+
+
+def build_job_run(spec: dict[str, Any], ctx: JobContext) -> Callable[[], Awaitable[None]]:
+    """Rebuild the coroutine function of a job from its ``job_spec``"""
+    deps = (ctx.store, ctx.service, ctx.cache, spec["result_key"], ctx.flights, ctx.mirror)
+    if spec["kind"] == "text2image":
+        run = partial(
+            process_text2image_task, spec["task_id"], Text2ImageRequest(**spec["request"]), *deps, output_dir=ctx.output_dir
+        )
+    else:
+        image_path = Path(spec["image_path"]) if spec["image_path"] else None
+        run = partial(
+            process_image2image_task, spec["task_id"], Image2ImageParams(**spec["request"]), *deps, image_path, ctx.output_dir
+        )
+    if spec.get("trace"):
+        return partial(_run_traced, run, spec)
+    return run
+
+
+async def _run_traced(run: Callable[[], Awaitable[None]], spec: dict[str, Any]) -> None:
+    """Run a job under the trace of the request that queued it"""
+    context = spec["trace"]
+    with tracing.tracer.resume(context, spec["task_id"], "job", kind=spec["kind"]):
+        tracing.record_span("queue.wait", context["enqueued_at"])
+        await run()
+
+
+def _job(
+    ctx: JobContext,
+    kind: str,
+    task_id: str,
+    request: Union[Text2ImageRequest, Image2ImageParams],
+    result_key: Optional[str] = None,
+    image_path: Optional[Path] = None,
+    priority: int = PRIORITY_INTERACTIVE,
+    group: Optional[str] = None,
+) -> Job:
+    spec = job_spec(kind, task_id, request, result_key, image_path)
+    trace = tracing.current_context()
+    if trace is not None:
+        spec["trace"] = trace
+    return Job(task_id=task_id, run=build_job_run(spec, ctx), priority=priority, group=group, spec=spec)
+
+
+UPLOAD_CHUNK_SIZE = 256 * 1024
+
+
+async def _receive_upload(upload: UploadFile, settings: Settings) -> tuple[Path, str]:
+    """Copy an uploaded image to UPLOAD_DIR in chunks and validate it from its header.
+
+    Returns the spooled file and the sha256 of its content. Raises 413 when it
+    exceeds MAX_UPLOAD_BYTES, 415 for unknown formats and 422 for dimensions
+    outside the allowed range.
+    """
+    path = Path(settings.UPLOAD_DIR) / f"{uuid4().hex}.upload"
+    digest = hashlib.sha256()
+    received = 0
+    handle = await asyncio.to_thread(open, path, "wb")
+    try:
+        try:
+            while chunk := await upload.read(UPLOAD_CHUNK_SIZE):
+                if received == 0 and sniff_image_extension(chunk) is None:
+                    raise HTTPException(status_code=415, detail="Unsupported image format")
+                received += len(chunk)
+                if received > settings.MAX_UPLOAD_BYTES:
+                    raise HTTPException(
+                        status_code=413,
+                        detail=f"Image exceeds {settings.MAX_UPLOAD_BYTES} bytes",
+                    )
+                digest.update(chunk)
+                await asyncio.to_thread(handle.write, chunk)
+        finally:
+            await asyncio.to_thread(handle.close)
+        if received == 0:
+            raise HTTPException(status_code=400, detail="Invalid image data")
+
+        dimensions = await asyncio.to_thread(read_image_dimensions, path)
+        if dimensions is None:
+            raise HTTPException(status_code=415, detail="Could not read image dimensions")
+        low, high = settings.MIN_UPLOAD_DIMENSION, settings.MAX_UPLOAD_DIMENSION
+        if not all(low <= side <= high for side in dimensions):
+            raise HTTPException(
+                status_code=422,
+                detail=f"Image is {dimensions[0]}x{dimensions[1]}, each side must be within {low}-{high} pixels",
+            )
+    except BaseException:
+        path.unlink(missing_ok=True)
+        raise
+    return path, digest.hexdigest()
+
+
+def _decode_image_file(data: str, path: Path) -> Optional[str]:
+    """Stream-decode a base64 image to ``path`` and return the sha256 of its content.
+
+    Returns ``None``, leaving no file behind, for invalid base64.
+    """
+    digest = hashlib.sha256()
+    try:
+        with open(path, "wb") as handle:
+            for chunk in iter_base64_chunks(data):
+                digest.update(chunk)
+                handle.write(chunk)
+    except (binascii.Error, ValueError):
+        path.unlink(missing_ok=True)
+        return None
+    return digest.hexdigest()
+
+
+async def _spool_base64_image(data: str, settings: Settings) -> tuple[Path, str]:
+    """Decode a base64 JSON image to UPLOAD_DIR, the way uploads are spooled.
+
+    Returns the spooled file and the sha256 of the image. Raises 400 for
+    invalid base64.
+    """
+    path = Path(settings.UPLOAD_DIR) / f"{uuid4().hex}.upload"
+    image_digest = await asyncio.to_thread(_decode_image_file, data, path)
+    if image_digest is None:
+        raise HTTPException(status_code=400, detail="Invalid image data")
+    return path, image_digest
+
+
+def _queue_full(retry_after: int) -> HTTPException:
+    return HTTPException(
+        status_code=429,
+        detail="Generation queue is full, please retry later",
+        headers={"Retry-After": str(retry_after)},
+    )
+
+
+async def _enqueue(scheduler: GenerationScheduler, store: TaskStore, job: Job) -> None:
+    """Submit a job for a created task, failing the task if the queue filled up meanwhile"""
+    try:
+        await scheduler.submit(job)
+    except QueueFullError as e:
+        await store.fail_task(job.task_id, "Generation queue is full")
+        raise _queue_full(e.retry_after)
 
 
-@router.post("/text2image", response_model=TaskResponse)
+def _image2image_form(
+    prompt: str = Form(...),
+    negative_prompt: Optional[str] = Form(None),
+    strength: Optional[float] = Form(None),
+    steps: Optional[int] = Form(None),
+    scale: Optional[float] = Form(None),
+    seed: Optional[int] = Form(None),
+    style_preset: Optional[str] = Form(None),
+    use_cache: Optional[bool] = Form(None),
+) -> Image2ImageParams:
+    """Image2ImageParams from form fields; omitted fields keep the model defaults"""
+    fields = {
+        "prompt": prompt,
+        "negative_prompt": negative_prompt,
+        "strength": strength,
+        "steps": steps,
+        "scale": scale,
+        "seed": seed,
+        "style_preset": style_preset,
+        "use_cache": use_cache,
+    }
+    try:
+        return Image2ImageParams(**{key: value for key, value in fields.items() if value is not None})
+    except ValidationError as e:
+        raise RequestValidationError(e.errors(include_url=False))
+
+
+@router.post(
+    "/image2image/upload",
+    response_model=TaskResponse,
+    dependencies=[Depends(client_rate_limit(IMAGE2IMAGE_REQ_KEY))],
+)
+async def image_to_image_upload(
+    params: Image2ImageParams = Depends(_image2image_form),
+    image: UploadFile = File(..., description="Input image file"),
+    settings: Settings = Depends(get_settings),
+    store: TaskStore = Depends(get_task_store),
+    service: VolcengineImageService = Depends(get_volcengine_service),
+    scheduler: GenerationScheduler = Depends(get_scheduler),
+    cache: Optional[ResultCache] = Depends(get_result_cache),
+    flights: SingleFlight = Depends(get_single_flight),
+    mirror: Optional[ImageMirror] = Depends(get_image_mirror),
+):
+    """
+    Generate image from an uploaded image file (multipart/form-data)
+    
+    Same as `/image2image`, but the image is sent as a binary file part
+    instead of a base64 JSON string, and the other parameters as form fields.
+    """
+    
+    if not scheduler.has_capacity():
+        raise _queue_full(scheduler.retry_after())
+    
+    with tracing.span("upload.receive"):
+        image_path, image_digest = await _receive_upload(image, settings)
+    try:
+        result_key, cached = await _lookup_cache(cache, "image2image", params, image_digest)
+        if cached is not None:
+            image_path.unlink(missing_ok=True)
+            return await _complete_from_cache(store, "image2image", params, params.model_dump(), cached, mirror)
+        
+        with tracing.span("store.create_task"):
+            task = await store.create_task(
+                task_type="image2image",
+                prompt=params.prompt,
+                negative_prompt=params.negative_prompt,
+                parameters=params.model_dump(),
+            )
+        tracing.bind_task(task.id)
+        ctx = JobContext(store, service, cache, flights, mirror, _get_output_dir(settings))
+        await _enqueue(scheduler, store, _job(ctx, "image2image", task.id, params, result_key, image_path))
+    except BaseException:
+        image_path.unlink(missing_ok=True)
+        raise
+    
+    return TaskResponse(
+        task_id=task.id,
+        status=task.status,
+        message="Image transformation task created",
+        created_at=task.created_at,
+    )
+
+
+async def resume_pending_tasks(scheduler: GenerationScheduler, ctx: JobContext) -> None:
+    """Re-queue tasks that a previous shutdown left pending, oldest first"""
+    if scheduler.shared:
+        # Their jobs are still in the shared queue
+        return
+    store = ctx.store
+    total, _ = await store.list_tasks(status=TaskStatus.PENDING, limit=1)
+    if not total:
+        return
+    _, tasks = await store.list_tasks(status=TaskStatus.PENDING, limit=total)
+    for task in reversed(tasks):
+        if task.type != "text2image":
+            # The input image of image2image requests is not persisted
+            await store.fail_task(task.id, "Interrupted by a server restart, please resubmit")
+            continue
+        try:
+            request = Text2ImageRequest(**task.parameters)
+        except Exception as e:
+            await store.fail_task(task.id, f"Could not resume task: {str(e)}")
+            continue
+        # Batch tasks go back to their batch's share of the workers
+        batch_id = task.parameters.get("batch_id")
+        await scheduler.submit_wait(
+            _job(
+                ctx,
+                "text2image",
+                task.id,
+                request,
+                priority=PRIORITY_BATCH if batch_id else PRIORITY_INTERACTIVE,
+                group=batch_id,
+            )
+        )
+
+
+async def suspend_pending_tasks(store: TaskStore, scheduler: GenerationScheduler, timeout: float) -> None:
+    """Stop the scheduler and persist every unfinished task for the next start"""
+    unfinished = await scheduler.stop(timeout=timeout)
+    # Include tasks that were still waiting to be resumed and never reached the queue
+    total, _ = await store.list_tasks(status=TaskStatus.PENDING, limit=1)
+    if total and not scheduler.shared:
+        _, pending = await store.list_tasks(status=TaskStatus.PENDING, limit=total)
+        unfinished.extend(task.id for task in pending)
+    await store.suspend_tasks(list(dict.fromkeys(unfinished)))
+
+
+@router.post(
+    "/text2image",
+    response_model=TaskResponse,
+    dependencies=[Depends(client_rate_limit(TEXT2IMAGE_REQ_KEY))],
+)
 async def text_to_image(
     request: Text2ImageRequest,
+    settings: Settings = Depends(get_settings),
     store: TaskStore = Depends(get_task_store),
     service: VolcengineImageService = Depends(get_volcengine_service),
+    scheduler: GenerationScheduler = Depends(get_scheduler),
+    cache: Optional[ResultCache] = Depends(get_result_cache),
+    flights: SingleFlight = Depends(get_single_flight),
+    mirror: Optional[ImageMirror] = Depends(get_image_mirror),
 ):
     """
     Generate image from text prompt
@@ -234,25 +618,29 @@ async def text_to_image(
     - **seed**: Random seed for reproducibility (-1 for random)
     - **style_preset**: Art style preset
     - **num_images**: Number of images to generate (1-4)
+    - **use_cache**: Reuse a previous result for identical seeded requests
     """
     
-    # Create task
-    task = await store.create_task(
-        task_type="text2image",
-        prompt=request.prompt,
-        negative_prompt=request.negative_prompt,
-        parameters=request.model_dump(),
-    )
+    result_key, cached = await _lookup_cache(cache, "text2image", request)
+    if cached is not None:
+        return await _complete_from_cache(store, "text2image", request, request.model_dump(), cached, mirror)
+    
+    if not scheduler.has_capacity():
+        raise _queue_full(scheduler.retry_after())
     
-    # Schedule background processing
-    asyncio.create_task(
-        process_text2image_task(
-            task.id,
-            request,
-            store,
-            service,
+    # Create task
+    with tracing.span("store.create_task"):
+        task = await store.create_task(
+            task_type="text2image",
+            prompt=request.prompt,
+            negative_prompt=request.negative_prompt,
+            parameters=request.model_dump(),
         )
-    )
+    tracing.bind_task(task.id)
+    
+    # Queue background processing
+    ctx = JobContext(store, service, cache, flights, mirror, _get_output_dir(settings))
+    await _enqueue(scheduler, store, _job(ctx, "text2image", task.id, request, result_key))
     
     return TaskResponse(
         task_id=task.id,
@@ -262,11 +650,20 @@ async def text_to_image(
     )
 
 
-@router.post("/image2image", response_model=TaskResponse)
+@router.post(
+    "/image2image",
+    response_model=TaskResponse,
+    dependencies=[Depends(client_rate_limit(IMAGE2IMAGE_REQ_KEY))],
+)
 async def image_to_image(
     request: Image2ImageRequest,
+    settings: Settings = Depends(get_settings),
     store: TaskStore = Depends(get_task_store),
     service: VolcengineImageService = Depends(get_volcengine_service),
+    scheduler: GenerationScheduler = Depends(get_scheduler),
+    cache: Optional[ResultCache] = Depends(get_result_cache),
+    flights: SingleFlight = Depends(get_single_flight),
+    mirror: Optional[ImageMirror] = Depends(get_image_mirror),
 ):
     """
     Generate image from input image and text prompt
@@ -279,29 +676,43 @@ async def image_to_image(
     - **scale**: CFG scale
     - **seed**: Random seed
     - **style_preset**: Art style preset
+    - **use_cache**: Reuse a previous result for identical seeded requests
     """
     
     # Validate base64 image
     if not request.image or len(request.image) < 100:
         raise HTTPException(status_code=400, detail="Invalid image data")
     
-    # Create task
-    task = await store.create_task(
-        task_type="image2image",
-        prompt=request.prompt,
-        negative_prompt=request.negative_prompt,
-        parameters=request.model_dump(exclude={"image"}),
-    )
-    
-    # Schedule background processing
-    asyncio.create_task(
-        process_image2image_task(
-            task.id,
-            request,
-            store,
-            service,
-        )
-    )
+    # Spool the image now so the queued job carries only its path
+    with tracing.span("upload.decode"):
+        image_path, image_digest = await _spool_base64_image(request.image, settings)
+    try:
+        result_key, cached = await _lookup_cache(cache, "image2image", request, image_digest)
+        if cached is not None:
+            image_path.unlink(missing_ok=True)
+            return await _complete_from_cache(
+                store, "image2image", request, request.model_dump(exclude={"image"}), cached, mirror
+            )
+        
+        if not scheduler.has_capacity():
+            raise _queue_full(scheduler.retry_after())
+        
+        # Create task
+        with tracing.span("store.create_task"):
+            task = await store.create_task(
+                task_type="image2image",
+                prompt=request.prompt,
+                negative_prompt=request.negative_prompt,
+                parameters=request.model_dump(exclude={"image"}),
+            )
+        tracing.bind_task(task.id)
+        
+        # Queue background processing
+        ctx = JobContext(store, service, cache, flights, mirror, _get_output_dir(settings))
+        await _enqueue(scheduler, store, _job(ctx, "image2image", task.id, request, result_key, image_path))
+    except BaseException:
+        image_path.unlink(missing_ok=True)
+        raise
     
     return TaskResponse(
         task_id=task.id,
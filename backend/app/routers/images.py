@@ -0,0 +1,107 @@
+import mimetypes
+import os
+from pathlib import Path
+from typing import Dict, Optional
+
+from fastapi import APIRouter, Depends, HTTPException, Query, Request, Response
+from fastapi.responses import FileResponse
+
+from ..config import Settings, get_settings
+from ..dependencies import get_image_etags, get_thumbnails
+from ..services.thumbnails import MEDIA_TYPES, ThumbnailService
+from ..utils.file_etags import ETagIndex, FileInfo, is_not_modified
+from ..utils.image_files import blob_path, blob_relpath
+
+router = APIRouter(prefix="/images", tags=["images"])
+
+
+class ImageFileResponse(FileResponse):
+    """``FileResponse`` whose ``If-Range`` check uses the validators it is sent with"""
+
+    def _should_use_range(self, http_if_range: str, stat_result: os.stat_result) -> bool:
+        return http_if_range in (self.headers.get("etag"), self.headers.get("last-modified"))
+
+
+def _image_name(name: str) -> str:
+    """``name`` if it can only refer to a saved image, or 404"""
+    if Path(name).name != name or name.startswith("."):
+        raise HTTPException(status_code=404, detail="Image not found")
+    return name
+
+
+def _cache_headers(settings: Settings, info: Optional[FileInfo], vary: bool) -> Dict[str, str]:
+    # Generated files are never rewritten under the same name
+    headers = {"Cache-Control": f"public, max-age={settings.IMAGE_CACHE_MAX_AGE}, immutable"}
+    if info is not None:
+        headers["ETag"] = info.etag
+        headers["Last-Modified"] = info.last_modified
+    if vary:
+        headers["Vary"] = "Accept"
+    return headers
+
+
+def _not_modified(request: Request, info: FileInfo) -> bool:
+    return is_not_modified(request.headers.get("if-none-match"), request.headers.get("if-modified-since"), info)
+
+
+async def _serve(
+    request: Request,
+    path: Path,
+    accel_path: str,
+    media_type: str,
+    settings: Settings,
+    etags: ETagIndex,
+    vary: bool = False,
+) -> Response:
+    info = etags.get(path)
+    if info is not None and _not_modified(request, info):
+        return Response(status_code=304, headers=_cache_headers(settings, info, vary))
+    if settings.IMAGE_ACCEL_REDIRECT_PREFIX:
+        # nginx sends the file, and answers range and conditional requests itself
+        headers = _cache_headers(settings, None, vary)
+        headers["X-Accel-Redirect"] = settings.IMAGE_ACCEL_REDIRECT_PREFIX + accel_path
+        return Response(headers=headers, media_type=media_type)
+    try:
+        info, stat = await etags.load(path)
+    except OSError:
+        raise HTTPException(status_code=404, detail="Image not found")
+    if _not_modified(request, info):
+        return Response(status_code=304, headers=_cache_headers(settings, info, vary))
+    return ImageFileResponse(path, media_type=media_type, headers=_cache_headers(settings, info, vary), stat_result=stat)
+
+
+@router.api_route("/{name}", methods=["GET", "HEAD"])
+async def get_image(
+    name: str,
+    request: Request,
+    w: Optional[int] = Query(None, ge=1, le=4096, description="Width of a resized derivative"),
+    settings: Settings = Depends(get_settings),
+    thumbnails: Optional[ThumbnailService] = Depends(get_thumbnails),
+    etags: ETagIndex = Depends(get_image_etags),
+):
+    """
+    Get a generated image
+
+    With `w`, a WebP/AVIF derivative at the nearest configured width
+    (THUMBNAIL_WIDTHS) is served instead, rendered on first request. The
+    original is served when thumbnails are disabled or cannot be rendered.
+
+    Responses carry a content-hash ETag and are cacheable forever; range and
+    conditional requests are supported.
+    """
+    name = _image_name(name)
+    if w is not None and thumbnails is not None:
+        fmt = thumbnails.negotiate(request.headers.get("accept", ""))
+        target = thumbnails.path(name, w, fmt)
+        info = etags.get(target)
+        if info is not None and _not_modified(request, info):
+            return Response(status_code=304, headers=_cache_headers(settings, info, vary=True))
+        derivative = await thumbnails.get(name, w, fmt)
+        if derivative is not None:
+            return await _serve(
+                request, derivative, f"thumbnails/{derivative.name}", MEDIA_TYPES[fmt], settings, etags, vary=True
+            )
+    media_type = mimetypes.guess_type(name)[0] or "application/octet-stream"
+    return await _serve(
+        request, blob_path(Path(settings.OUTPUT_DIR), name), f"output/{blob_relpath(name)}", media_type, settings, etags
+    )
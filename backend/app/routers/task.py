@@ -1,33 +1,42 @@
-from pathlib import Path
-from typing import Optional
+import asyncio
+import json
+import time
+from datetime import datetime, timezone
+from typing import List, Optional
 
-from fastapi import APIRouter, Depends, HTTPException, Query
+from fastapi import APIRouter, Depends, HTTPException, Query, Response, WebSocket, WebSocketDisconnect
+from fastapi.responses import StreamingResponse
 
 from ..config import Settings, get_settings
-from ..schemas import TaskStatusResponse, HistoryListResponse
-from ..utils.task_store import TaskStore
+from ..dependencies import get_long_poll_slots, get_scheduler, get_task_store, get_thumbnails, get_tracer
+from ..schemas import (
+    GenerationHistory,
+    HistoryDeleteRequest,
+    HistoryDeleteResponse,
+    HistoryListResponse,
+    HistorySearchResponse,
+    StylePreset,
+    TaskStatus,
+    TaskStatusResponse,
+    TaskTraceResponse,
+    TraceSpan,
+)
+from ..services.scheduler import GenerationScheduler
+from ..services.thumbnails import ThumbnailService
+from ..utils.history_search import HistoryQuery, decode_cursor, encode_cursor
+from ..utils.task_store import TaskRecord, TaskStore
+from ..utils.tracing import Tracer
 
 router = APIRouter(prefix="/tasks", tags=["tasks"])
 
-_store: Optional[TaskStore] = None
+TERMINAL_STATUSES = (TaskStatus.COMPLETED, TaskStatus.FAILED)
+# Comment lines keep idle SSE connections open through proxies
+SSE_KEEPALIVE_SECONDS = 15.0
+MAX_WS_SUBSCRIPTIONS = 500
 
 
-def get_task_store(settings: Settings = Depends(get_settings)) -> TaskStore:
-    global _store
-    if _store is None:
-        _store = TaskStore(
-            history_file=Path(settings.HISTORY_FILE),
-            max_history_size=settings.MAX_HISTORY_SIZE,
-        )
-    return _store
-
-
-@router.get("/{task_id}", response_model=TaskStatusResponse)
-async def get_task_status(task_id: str, store: TaskStore = Depends(get_task_store)):
-    task = await store.get_task(task_id)
-    if not task:
-        raise HTTPException(status_code=404, detail="Task not found")
-
+async def _to_status_response(task: TaskRecord, scheduler: GenerationScheduler) -> TaskStatusResponse:
+    queue_position = await scheduler.position(task.id) if task.status == TaskStatus.PENDING else None
     return TaskStatusResponse(
         task_id=task.id,
         status=task.status,
@@ -36,36 +45,384 @@ async def get_task_status(task_id: str, store: TaskStore = Depends(get_task_stor
         error=task.error,
         created_at=task.created_at,
         completed_at=task.completed_at,
+        queue_position=queue_position,
+        queue_depth=scheduler.depth if queue_position is not None else None,
     )
 
 
 @router.get("/", response_model=list[TaskStatusResponse])
-async def list_tasks(store: TaskStore = Depends(get_task_store)):
-    tasks = await store.list_tasks()
+async def list_tasks(
+    response: Response,
+    status: Optional[TaskStatus] = Query(None),
+    task_type: Optional[str] = Query(None, alias="type"),
+    offset: int = Query(0, ge=0),
+    limit: Optional[int] = Query(None, ge=1, le=1000),
+    store: TaskStore = Depends(get_task_store),
+    scheduler: GenerationScheduler = Depends(get_scheduler),
+):
+    """
+    Tasks newest first, optionally filtered by status and type
+
+    Pass `limit` to page through them; without it every matching task after
+    `offset` is returned. The `X-Total-Count` header holds the number of
+    matching tasks.
+    """
+    if limit is None:
+        total, _ = await store.list_tasks(status=status, task_type=task_type, limit=1)
+        limit = max(total - offset, 1)
+    total, tasks = await store.list_tasks(status=status, task_type=task_type, offset=offset, limit=limit)
+    response.headers["X-Total-Count"] = str(total)
+    return [await _to_status_response(task, scheduler) for task in tasks]
+
+
+def _with_thumbnails(items: List[GenerationHistory], thumbnails: Optional[ThumbnailService]) -> List[GenerationHistory]:
     return [
-        TaskStatusResponse(
-            task_id=task.id,
-            status=task.status,
-            progress=task.progress,
-            images=task.images,
-            error=task.error,
-            created_at=task.created_at,
-            completed_at=task.completed_at,
-        )
-        for task in tasks
+        item.model_copy(update={
+            "thumbnails": thumbnails.thumbnail_urls(item.images) if thumbnails is not None else list(item.images)
+        })
+        for item in items
     ]
 
 
+def _naive_utc(moment: Optional[datetime]) -> Optional[datetime]:
+    """History times are stored as naive UTC"""
+    if moment is None or moment.tzinfo is None:
+        return moment
+    return moment.astimezone(timezone.utc).replace(tzinfo=None)
+
+
 @router.get("/history", response_model=HistoryListResponse)
 async def get_history(
     page: int = Query(1, ge=1),
     page_size: int = Query(20, ge=1, le=100),
+    task_type: Optional[str] = Query(None, alias="type"),
     store: TaskStore = Depends(get_task_store),
+    thumbnails: Optional[ThumbnailService] = Depends(get_thumbnails),
 ):
-    total, items = await store.list_history(page=page, page_size=page_size)
+    total, items = await store.list_history(page=page, page_size=page_size, task_type=task_type)
     return HistoryListResponse(
         total=total,
-        items=items,
+        items=_with_thumbnails(items, thumbnails),
         page=page,
         page_size=page_size,
     )
+
+
+@router.get("/history/search", response_model=HistorySearchResponse)
+async def search_history(
+    q: str = Query("", max_length=200, description="Words the prompt or negative prompt must contain, as prefixes"),
+    task_type: Optional[str] = Query(None, alias="type"),
+    style_preset: Optional[StylePreset] = Query(None),
+    favorite: Optional[bool] = Query(None),
+    width: Optional[int] = Query(None, ge=1),
+    height: Optional[int] = Query(None, ge=1),
+    created_after: Optional[datetime] = Query(None, description="Inclusive lower bound on the creation time"),
+    created_before: Optional[datetime] = Query(None, description="Exclusive upper bound on the creation time"),
+    cursor: Optional[str] = Query(None, description="next_cursor of the previous page"),
+    limit: int = Query(20, ge=1, le=100),
+    store: TaskStore = Depends(get_task_store),
+    thumbnails: Optional[ThumbnailService] = Depends(get_thumbnails),
+):
+    """
+    Search history
+
+    Every word of `q` must start a word of the prompt or negative prompt
+    (CJK characters match one by one), and every other parameter given must
+    match. Results are newest first; pass `next_cursor` back as `cursor` for
+    the next page, which stays stable while new entries are added.
+    """
+    try:
+        position = decode_cursor(cursor) if cursor else None
+    except ValueError:
+        raise HTTPException(status_code=400, detail="Invalid cursor")
+    if position is not None:
+        position = (_naive_utc(position[0]), position[1])
+    query = HistoryQuery(
+        text=q,
+        task_type=task_type,
+        style_preset=style_preset.value if style_preset is not None else None,
+        favorite=favorite,
+        width=width,
+        height=height,
+        created_after=_naive_utc(created_after),
+        created_before=_naive_utc(created_before),
+        cursor=position,
+        limit=limit + 1,
+    )
+    items = await store.search_history(query)
+    next_cursor = encode_cursor(items[limit - 1]) if len(items) > limit else None
+    return HistorySearchResponse(items=_with_thumbnails(items[:limit], thumbnails), next_cursor=next_cursor)
+
+
+async def _set_favorite(
+    task_id: str, favorite: bool, store: TaskStore, thumbnails: Optional[ThumbnailService]
+) -> GenerationHistory:
+    history = await store.toggle_favorite(task_id, favorite)
+    if history is None:
+        raise HTTPException(status_code=404, detail="History entry not found")
+    return _with_thumbnails([history], thumbnails)[0]
+
+
+@router.put("/history/{task_id}/favorite", response_model=GenerationHistory)
+async def add_favorite(
+    task_id: str,
+    store: TaskStore = Depends(get_task_store),
+    thumbnails: Optional[ThumbnailService] = Depends(get_thumbnails),
+):
+    """
+    Mark a history entry as a favorite
+
+    Favorites are never trimmed from history or evicted for the image quota.
+    """
+    return await _set_favorite(task_id, True, store, thumbnails)
+
+
+@router.delete("/history/{task_id}/favorite", response_model=GenerationHistory)
+async def remove_favorite(
+    task_id: str,
+    store: TaskStore = Depends(get_task_store),
+    thumbnails: Optional[ThumbnailService] = Depends(get_thumbnails),
+):
+    """Unmark a favorite history entry"""
+    return await _set_favorite(task_id, False, store, thumbnails)
+
+
+@router.delete("/history/{task_id}", status_code=204)
+async def delete_history_entry(task_id: str, store: TaskStore = Depends(get_task_store)):
+    """
+    Delete a history entry and its task
+
+    Images no other entry shows are removed by the next image garbage
+    collection pass.
+    """
+    if not await store.delete_history([task_id]):
+        raise HTTPException(status_code=404, detail="History entry not found")
+    return Response(status_code=204)
+
+
+@router.post("/history/delete", response_model=HistoryDeleteResponse)
+async def delete_history_entries(request: HistoryDeleteRequest, store: TaskStore = Depends(get_task_store)):
+    """
+    Delete several history entries and their tasks
+
+    Unknown task ids are reported in `not_found` rather than failing the request.
+    """
+    task_ids = list(dict.fromkeys(request.task_ids))
+    deleted = {history.task_id for history in await store.delete_history(task_ids)}
+    return HistoryDeleteResponse(
+        deleted=[task_id for task_id in task_ids if task_id in deleted],
+        not_found=[task_id for task_id in task_ids if task_id not in deleted],
+    )
+
+
+@router.get("/{task_id}", response_model=TaskStatusResponse)
+async def get_task_status(
+    task_id: str,
+    wait: float = Query(0, ge=0, description="Seconds to wait for a status or progress change"),
+    since_status: Optional[TaskStatus] = Query(
+        None, description="Return immediately if the task is no longer in this status"
+    ),
+    store: TaskStore = Depends(get_task_store),
+    scheduler: GenerationScheduler = Depends(get_scheduler),
+    long_poll_slots: asyncio.Semaphore = Depends(get_long_poll_slots),
+    settings: Settings = Depends(get_settings),
+):
+    """
+    Get a task's status
+
+    With `wait`, the request is held (long-poll) until the task's status or
+    progress changes, or until `wait` seconds (capped at LONG_POLL_MAX_WAIT)
+    pass, and then returns the current status.
+    """
+    task = await store.get_task(task_id)
+    if not task:
+        raise HTTPException(status_code=404, detail="Task not found")
+
+    changed = since_status is not None and task.status != since_status
+    if wait > 0 and not changed and task.status not in TERMINAL_STATUSES:
+        if long_poll_slots.locked():
+            raise HTTPException(
+                status_code=429,
+                detail="Too many waiting requests, please retry later",
+                headers={"Retry-After": "1"},
+            )
+        async with long_poll_slots:
+            task = await _wait_for_change(
+                store, task.id, (task.status, task.progress), min(wait, settings.LONG_POLL_MAX_WAIT)
+            )
+        if task is None:
+            raise HTTPException(status_code=404, detail="Task not found")
+
+    return await _to_status_response(task, scheduler)
+
+
+@router.get("/{task_id}/trace", response_model=TaskTraceResponse)
+async def get_task_trace(task_id: str, tracer: Tracer = Depends(get_tracer)):
+    """
+    Timing spans of a sampled task
+
+    Covers request validation, task creation, queue wait, upstream calls,
+    image extraction and mirroring, and history persistence. Only a
+    TRACE_SAMPLE_RATE share of requests is traced, and only recent traces
+    are kept.
+    """
+    trace = tracer.get(task_id)
+    if trace is None:
+        raise HTTPException(status_code=404, detail="No trace recorded for this task")
+    spans = sorted(trace.spans, key=lambda span: (span.start, span.parent_id is not None))
+    if not spans:
+        raise HTTPException(status_code=404, detail="No trace recorded for this task")
+    end = max(span.end or time.time() for span in spans)
+    return TaskTraceResponse(
+        task_id=task_id,
+        trace_id=trace.trace_id,
+        duration_ms=round((end - spans[0].start) * 1000, 3),
+        spans=[
+            TraceSpan(**{**span.to_dict(), "start": datetime.utcfromtimestamp(span.start)})
+            for span in spans
+        ],
+    )
+
+
+async def _wait_for_change(
+    store: TaskStore,
+    task_id: str,
+    seen: tuple[TaskStatus, Optional[int]],
+    timeout: float,
+) -> Optional[TaskRecord]:
+    """Park on the task's change notifications until ``(status, progress)`` differs from ``seen``.
+
+    Stored tasks are mutated in place, so ``seen`` must be captured before waiting.
+    The store lock is never held while parked.
+    """
+    loop = asyncio.get_running_loop()
+    deadline = loop.time() + timeout
+    with store.events.subscribe([task_id]) as subscription:
+        # The task may have changed between the first read and subscribing
+        current = await store.get_task(task_id)
+        while current is not None and (current.status, current.progress) == seen:
+            remaining = deadline - loop.time()
+            if remaining <= 0:
+                break
+            updates = await subscription.get(timeout=remaining)
+            if updates:
+                current = updates[-1]
+    return current
+
+
+@router.get("/{task_id}/events")
+async def stream_task_events(
+    task_id: str,
+    store: TaskStore = Depends(get_task_store),
+    scheduler: GenerationScheduler = Depends(get_scheduler),
+):
+    """Server-Sent Events stream of a task's status.
+
+    Sends the current status immediately, then one ``status`` event per
+    change until the task completes or fails.
+    """
+    if await store.get_task(task_id) is None:
+        raise HTTPException(status_code=404, detail="Task not found")
+
+    async def stream():
+        # Subscribe before reading the current state so no change is missed
+        with store.events.subscribe([task_id]) as subscription:
+            task = await store.get_task(task_id)
+            while task is not None:
+                payload = (await _to_status_response(task, scheduler)).model_dump_json()
+                yield f"event: status\ndata: {payload}\n\n"
+                if task.status in TERMINAL_STATUSES:
+                    return
+                updates = await subscription.get(timeout=SSE_KEEPALIVE_SECONDS)
+                while not updates:
+                    yield ": keepalive\n\n"
+                    updates = await subscription.get(timeout=SSE_KEEPALIVE_SECONDS)
+                task = updates[-1]
+
+    return StreamingResponse(
+        stream(),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
+
+
+@router.websocket("/ws")
+async def task_events_websocket(
+    websocket: WebSocket,
+    store: TaskStore = Depends(get_task_store),
+    scheduler: GenerationScheduler = Depends(get_scheduler),
+):
+    """Multiplexed task status updates over one WebSocket.
+
+    Clients send ``{"action": "subscribe" | "unsubscribe", "task_ids": [...]}``
+    and receive ``{"type": "status", "task": {...}}`` for the current state of
+    each subscribed task and every later change. Tasks are unsubscribed
+    automatically once they complete or fail. Malformed commands get an
+    ``error`` message; binary frames close the socket with code 1003.
+    """
+    await websocket.accept()
+    send_lock = asyncio.Lock()
+
+    async def send(message: dict) -> None:
+        async with send_lock:
+            await websocket.send_json(message)
+
+    async def send_status(task: TaskRecord) -> None:
+        await send({"type": "status", "task": (await _to_status_response(task, scheduler)).model_dump(mode="json")})
+
+    with store.events.subscribe() as subscription:
+
+        async def receive_commands() -> None:
+            while True:
+                frame = await websocket.receive()
+                if frame["type"] == "websocket.disconnect":
+                    raise WebSocketDisconnect(frame.get("code", 1000))
+                if frame.get("text") is None:
+                    async with send_lock:
+                        await websocket.close(code=1003, reason="Commands must be text frames")
+                    return
+                try:
+                    message = json.loads(frame["text"])
+                except ValueError:
+                    await send({"type": "error", "detail": "Commands must be JSON"})
+                    continue
+                action = message.get("action") if isinstance(message, dict) else None
+                task_ids = message.get("task_ids") if isinstance(message, dict) else None
+                if action not in ("subscribe", "unsubscribe") or not isinstance(task_ids, list):
+                    await send({"type": "error", "detail": "Expected {action, task_ids}"})
+                    continue
+                for task_id in map(str, task_ids):
+                    if action == "unsubscribe":
+                        subscription.remove(task_id)
+                        continue
+                    if len(subscription.task_ids) >= MAX_WS_SUBSCRIPTIONS:
+                        await send({"type": "error", "task_id": task_id, "detail": "Too many subscriptions"})
+                        continue
+                    subscription.add(task_id)
+                    task = await store.get_task(task_id)
+                    if task is None:
+                        subscription.remove(task_id)
+                        await send({"type": "error", "task_id": task_id, "detail": "Task not found"})
+                        continue
+                    await send_status(task)
+                    if task.status in TERMINAL_STATUSES:
+                        subscription.remove(task_id)
+
+        async def push_updates() -> None:
+            while True:
+                for task in await subscription.get():
+                    await send_status(task)
+                    if task.status in TERMINAL_STATUSES:
+                        subscription.remove(task.id)
+
+        workers = [asyncio.create_task(receive_commands()), asyncio.create_task(push_updates())]
+        try:
+            done, _ = await asyncio.wait(workers, return_when=asyncio.FIRST_COMPLETED)
+            for worker in done:
+                error = worker.exception()
+                if error is not None and not isinstance(error, WebSocketDisconnect):
+                    raise error
+        finally:
+            for worker in workers:
+                worker.cancel()
+            await asyncio.gather(*workers, return_exceptions=True)
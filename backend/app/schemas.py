@@ -1,5 +1,5 @@
 from pydantic import BaseModel, Field
-from typing import Optional
+from typing import Annotated, Literal, Optional, Union
 from datetime import datetime
 from enum import Enum
 
@@ -42,11 +42,11 @@ class Text2ImageRequest(BaseModel):
     seed: Optional[int] = Field(None, ge=-1, description="Random seed, -1 for random")
     style_preset: StylePreset = Field(StylePreset.NONE, description="Style preset")
     num_images: int = Field(1, ge=1, le=4, description="Number of images to generate")
+    use_cache: bool = Field(True, description="Reuse a cached result for identical seeded requests")
 
 
-class Image2ImageRequest(BaseModel):
-    """Image to image generation request"""
-    image: str = Field(..., description="Base64 encoded input image")
+class Image2ImageParams(BaseModel):
+    """Image to image generation parameters, sent as form fields alongside an uploaded image"""
     prompt: str = Field(..., min_length=1, max_length=1000, description="Text prompt")
     negative_prompt: Optional[str] = Field(None, max_length=1000, description="Negative prompt")
     strength: float = Field(0.75, ge=0.0, le=1.0, description="Transformation strength")
@@ -54,6 +54,47 @@ class Image2ImageRequest(BaseModel):
     scale: float = Field(7.5, ge=1.0, le=20.0, description="CFG scale")
     seed: Optional[int] = Field(None, ge=-1, description="Random seed")
     style_preset: StylePreset = Field(StylePreset.NONE, description="Style preset")
+    use_cache: bool = Field(True, description="Reuse a cached result for identical seeded requests")
+
+
+class Image2ImageRequest(Image2ImageParams):
+    """Image to image generation request"""
+    image: str = Field(..., description="Base64 encoded input image")
+
+
+class BatchText2ImageItem(Text2ImageRequest):
+    """Text to image item of a batch"""
+    type: Literal["text2image"] = Field(..., description="Generation type")
+
+
+class BatchImage2ImageItem(Image2ImageRequest):
+    """Image to image item of a batch"""
+    type: Literal["image2image"] = Field(..., description="Generation type")
+
+
+BatchItem = Annotated[Union[BatchText2ImageItem, BatchImage2ImageItem], Field(discriminator="type")]
+
+
+class BatchTemplate(BaseModel):
+    """One request expanded once per set of template variables"""
+    base: BatchItem = Field(..., description="Request whose prompt and negative prompt may contain $variables")
+    variables: list[dict[str, str]] = Field(..., min_length=1, description="Substitutions, one item per entry")
+
+
+class BatchRequest(BaseModel):
+    """Batch generation request: explicit items or a prompt template"""
+    items: Optional[list[BatchItem]] = Field(None, min_length=1, description="Requests to run")
+    template: Optional[BatchTemplate] = Field(None, description="Prompt template to expand into requests")
+
+
+class BatchResponse(BaseModel):
+    """Batch creation response"""
+    batch_id: str
+    task_ids: list[str]
+    total: int
+    cached: int = Field(0, description="Items completed immediately from the result cache")
+    message: str = Field("Batch created successfully", description="Response message")
+    created_at: datetime
 
 
 class TaskResponse(BaseModel):
@@ -73,6 +114,45 @@ class TaskStatusResponse(BaseModel):
     error: Optional[str] = Field(None, description="Error message if failed")
     created_at: datetime
     completed_at: Optional[datetime] = None
+    queue_position: Optional[int] = Field(None, ge=1, description="1-based position while waiting in the queue")
+    queue_depth: Optional[int] = Field(None, ge=0, description="Number of jobs waiting in the queue")
+
+
+class TraceSpan(BaseModel):
+    """One timed operation of a task's trace"""
+    name: str
+    span_id: str
+    parent_id: Optional[str] = None
+    start: datetime
+    duration_ms: float
+    attributes: dict = Field(default_factory=dict)
+    error: Optional[str] = None
+
+
+class TaskTraceResponse(BaseModel):
+    """Spans recorded for a sampled task, in start order"""
+    task_id: str
+    trace_id: str
+    duration_ms: float = Field(..., description="From the first span's start to the last span's end")
+    spans: list[TraceSpan]
+
+
+class BatchStatusResponse(BaseModel):
+    """Aggregate status of a batch"""
+    batch_id: str
+    status: TaskStatus = Field(..., description="completed once every task has finished, even if some failed")
+    total: int
+    counts: dict[TaskStatus, int] = Field(..., description="Number of tasks per status")
+    progress: int = Field(..., ge=0, le=100, description="Average progress percentage")
+    created_at: datetime
+
+
+class BatchResultsResponse(BaseModel):
+    """Page of a batch's task statuses, in submission order"""
+    batch_id: str
+    total: int
+    offset: int
+    items: list[TaskStatusResponse]
 
 
 class GenerationHistory(BaseModel):
@@ -84,6 +164,7 @@ class GenerationHistory(BaseModel):
     negative_prompt: Optional[str] = None
     parameters: dict
     images: list[str]
+    thumbnails: list[str] = Field(default_factory=list, description="Thumbnail URLs, one per image")
     created_at: datetime
     favorite: bool = False
 
@@ -96,11 +177,32 @@ class HistoryListResponse(BaseModel):
     page_size: int
 
 
+class HistorySearchResponse(BaseModel):
+    """Page of history search results"""
+    items: list[GenerationHistory]
+    next_cursor: Optional[str] = Field(None, description="Cursor of the next page; absent on the last page")
+
+
+class HistoryDeleteRequest(BaseModel):
+    """Bulk history deletion request"""
+    task_ids: list[str] = Field(..., min_length=1, max_length=1000, description="Task ids of the entries to delete")
+
+
+class HistoryDeleteResponse(BaseModel):
+    """Bulk history deletion response"""
+    deleted: list[str] = Field(..., description="Task ids whose entries were deleted")
+    not_found: list[str] = Field(..., description="Task ids with no history entry")
+
+
 class HealthResponse(BaseModel):
     """Health check response"""
     status: str
     version: str
     volcengine_configured: bool
+    result_cache: Optional[dict] = Field(None, description="Result cache counters")
+    coalescing: Optional[dict] = Field(None, description="In-flight request coalescing counters")
+    upstream: Optional[dict] = Field(None, description="Circuit breaker state, timeouts and retry counters per upstream req_key")
+    storage: Optional[dict] = Field(None, description="Saved image quota and space reclaimed by garbage collection")
 
 
 class ErrorResponse(BaseModel):
@@ -0,0 +1,200 @@
+import asyncio
+import hashlib
+import logging
+import os
+import random
+from collections import OrderedDict
+from pathlib import Path
+from typing import Dict, List, Optional, Set
+from uuid import uuid4
+
+import httpx
+
+from ..utils import tracing
+from ..utils.file_etags import ETagIndex
+from ..utils.image_files import LOCAL_IMAGE_PREFIX, blob_path, store_blob
+from ..utils.task_store import TaskStore
+from .thumbnails import ThumbnailService
+
+logger = logging.getLogger(__name__)
+
+CHUNK_SIZE = 64 * 1024
+
+_CONTENT_TYPE_EXTENSIONS = {
+    "image/png": ".png",
+    "image/jpeg": ".jpg",
+    "image/jpg": ".jpg",
+    "image/webp": ".webp",
+    "image/gif": ".gif",
+}
+
+
+class MirrorError(Exception):
+    """Raised when a remote image cannot be mirrored"""
+
+    def __init__(self, message: str, retryable: bool = True):
+        super().__init__(message)
+        self.retryable = retryable
+
+
+class ImageMirror:
+    """Copies upstream result images into ``output_dir`` in the background.
+
+    Upstream result URLs are temporary, so once a task completes its images
+    are streamed to disk chunk by chunk over a pooled client and the task's
+    ``images`` are rewritten to local ``/images/...`` paths. Downloads are
+    bounded by ``concurrency``, retried with exponential backoff and jitter,
+    and shared between tasks that reference the same URL (coalesced or
+    cached results). Images that cannot be mirrored keep their remote URL.
+    With ``thumbnails``, mirrored images are queued for pre-rendering; with
+    ``etags``, their content hash is recorded while they stream in.
+    """
+
+    def __init__(
+        self,
+        output_dir: Path,
+        store: TaskStore,
+        concurrency: int = 4,
+        retries: int = 3,
+        backoff: float = 0.5,
+        timeout: float = 30.0,
+        max_bytes: int = 20 * 1024 * 1024,
+        remembered: int = 1000,
+        client: Optional[httpx.AsyncClient] = None,
+        thumbnails: Optional[ThumbnailService] = None,
+        etags: Optional[ETagIndex] = None,
+    ):
+        self.output_dir = output_dir
+        self.store = store
+        self.thumbnails = thumbnails
+        self.etags = etags
+        self.retries = retries
+        self.backoff = backoff
+        self.max_bytes = max_bytes
+        self.remembered = remembered
+        self._semaphore = asyncio.Semaphore(concurrency)
+        self._client = client or httpx.AsyncClient(
+            timeout=httpx.Timeout(timeout),
+            limits=httpx.Limits(max_connections=concurrency, max_keepalive_connections=concurrency),
+            follow_redirects=True,
+        )
+        self._downloads: Dict[str, asyncio.Task] = {}
+        self._mirrored: "OrderedDict[str, str]" = OrderedDict()
+        self._jobs: Set[asyncio.Task] = set()
+        self.downloaded = 0
+        self.failed = 0
+
+    @staticmethod
+    def needs_mirroring(url: str) -> bool:
+        return url.startswith(("http://", "https://"))
+
+    def schedule(self, task_id: str, images: List[str]) -> Optional[asyncio.Task]:
+        """Mirror ``images`` for ``task_id`` in the background"""
+        if not any(self.needs_mirroring(url) for url in images):
+            return None
+        job = asyncio.create_task(self.mirror_task(task_id, images), name=f"mirror-{task_id}")
+        self._jobs.add(job)
+        job.add_done_callback(self._jobs.discard)
+        return job
+
+    async def mirror_task(self, task_id: str, images: List[str]) -> List[str]:
+        """Mirror every remote image and point the task at the local copies"""
+        remote = [url for url in images if self.needs_mirroring(url)]
+        with tracing.span("images.mirror", count=len(remote)):
+            results = await asyncio.gather(*(self.mirror(url) for url in remote), return_exceptions=True)
+        local: Dict[str, str] = {}
+        for url, result in zip(remote, results):
+            if isinstance(result, BaseException):
+                logger.warning("Could not mirror %s for task %s: %s", url, task_id, result)
+            else:
+                local[url] = result
+        rewritten = [local.get(url, url) for url in images]
+        if local:
+            await self.store.replace_images(task_id, rewritten)
+            if self.thumbnails is not None:
+                self.thumbnails.schedule(local.values())
+        return rewritten
+
+    async def mirror(self, url: str) -> str:
+        """Return the local path of ``url``, downloading it once if needed"""
+        path = self._mirrored.get(url)
+        if path is not None and blob_path(self.output_dir, Path(path).name).exists():
+            self._mirrored.move_to_end(url)
+            return path
+        download = self._downloads.get(url)
+        if download is None:
+            download = asyncio.create_task(self._download_with_retry(url))
+            self._downloads[url] = download
+            download.add_done_callback(lambda _: self._downloads.pop(url, None))
+        return await asyncio.shield(download)
+
+    async def _download_with_retry(self, url: str) -> str:
+        attempt = 0
+        while True:
+            try:
+                async with self._semaphore:
+                    filename = await self._download(url)
+                break
+            except (MirrorError, httpx.TransportError) as e:
+                retryable = getattr(e, "retryable", True)
+                if not retryable or attempt >= self.retries:
+                    self.failed += 1
+                    raise
+                delay = self.backoff * (2 ** attempt)
+                attempt += 1
+                await asyncio.sleep(delay + random.uniform(0, delay))
+
+        self.downloaded += 1
+        path = LOCAL_IMAGE_PREFIX + filename
+        self._mirrored[url] = path
+        while len(self._mirrored) > self.remembered:
+            self._mirrored.popitem(last=False)
+        return path
+
+    async def _download(self, url: str) -> str:
+        """Stream one image to a temporary file and store it under its content hash"""
+        async with self._client.stream("GET", url) as response:
+            if response.status_code != 200:
+                retryable = response.status_code == 429 or response.status_code >= 500
+                raise MirrorError(f"HTTP {response.status_code}", retryable=retryable)
+            content_type = response.headers.get("content-type", "").split(";")[0].strip().lower()
+            extension = _CONTENT_TYPE_EXTENSIONS.get(content_type, ".png")
+            partial = self.output_dir / f".{uuid4().hex}.part"
+            handle = await asyncio.to_thread(open, partial, "wb")
+            digest = hashlib.sha256()
+            try:
+                received = 0
+                async for chunk in response.aiter_bytes(CHUNK_SIZE):
+                    received += len(chunk)
+                    if received > self.max_bytes:
+                        raise MirrorError(f"Image exceeds {self.max_bytes} bytes", retryable=False)
+                    digest.update(chunk)
+                    await asyncio.to_thread(handle.write, chunk)
+                await asyncio.to_thread(handle.close)
+                target = await asyncio.to_thread(
+                    store_blob, self.output_dir, partial, digest.hexdigest() + extension
+                )
+            except BaseException:
+                handle.close()
+                partial.unlink(missing_ok=True)
+                raise
+        if self.etags is not None:
+            self.etags.record(target, digest.hexdigest(), await asyncio.to_thread(os.stat, target))
+        return target.name
+
+    def stats(self) -> Dict[str, int]:
+        return {
+            "downloaded": self.downloaded,
+            "failed": self.failed,
+            "in_flight": len(self._downloads),
+        }
+
+    async def close(self) -> None:
+        """Cancel outstanding mirror jobs and close the HTTP client"""
+        for job in list(self._jobs):
+            job.cancel()
+        await asyncio.gather(*self._jobs, return_exceptions=True)
+        for download in list(self._downloads.values()):
+            download.cancel()
+        await asyncio.gather(*self._downloads.values(), return_exceptions=True)
+        await self._client.aclose()
@@ -0,0 +1,385 @@
+import asyncio
+import json
+import logging
+import time
+from typing import Dict, List, Optional
+
+from .scheduler import PRIORITY_BATCH, PRIORITY_INTERACTIVE, GenerationScheduler, Job, QueueFullError
+
+try:
+    import redis.asyncio as aioredis
+    REDIS_AVAILABLE = True
+except ImportError:
+    REDIS_AVAILABLE = False
+
+logger = logging.getLogger(__name__)
+
+# KEYS: interactive queue, batch queue, jobs, scores, rounds, virtual round, seq.
+# ARGV: interactive limit, batch limit, JSON [{id, batch, priority, group, job}], wake channel.
+# Returns {accepted, interactive depth, batch depth}; adds all jobs or none.
+# Scores pack (priority, or fair-share round for batch jobs) and arrival order
+# as high * 2^32 + seq, formatted explicitly since Lua prints numbers with 14 digits.
+_PUSH_SCRIPT = """
+local entries = cjson.decode(ARGV[3])
+local batch = 0
+for _, entry in ipairs(entries) do
+    if entry.batch then batch = batch + 1 end
+end
+local interactive_depth = redis.call('ZCARD', KEYS[1])
+local batch_depth = redis.call('ZCARD', KEYS[2])
+if interactive_depth + #entries - batch > tonumber(ARGV[1]) or batch_depth + batch > tonumber(ARGV[2]) then
+    return {0, interactive_depth, batch_depth}
+end
+local virtual_round = tonumber(redis.call('GET', KEYS[6]) or '0')
+for _, entry in ipairs(entries) do
+    local seq = redis.call('INCR', KEYS[7]) % 4294967296
+    local queue, score = KEYS[1], entry.priority * 4294967296 + seq
+    if entry.batch then
+        local round = math.max(tonumber(redis.call('HGET', KEYS[5], entry.group) or '0'), virtual_round)
+        redis.call('HSET', KEYS[5], entry.group, round + 1)
+        queue, score = KEYS[2], round * 4294967296 + seq
+    end
+    score = string.format('%.0f', score)
+    redis.call('ZADD', queue, score, entry.id)
+    redis.call('HSET', KEYS[3], entry.id, entry.job)
+    redis.call('HSET', KEYS[4], entry.id, score)
+end
+redis.call('PUBLISH', ARGV[4], '')
+return {1, redis.call('ZCARD', KEYS[1]), redis.call('ZCARD', KEYS[2])}
+"""
+
+# KEYS: interactive queue, batch queue, interactive running, batch running, jobs, scores, virtual round.
+# ARGV: now, lease deadline, whether a batch job may start.
+# Jobs whose lease expired (their process died) go back to their queue first.
+# Returns {id, job, is batch, interactive depth, batch depth}; id is '' when nothing is runnable.
+_CLAIM_SCRIPT = """
+for i = 1, 2 do
+    local expired = redis.call('ZRANGEBYSCORE', KEYS[i + 2], '-inf', ARGV[1])
+    for _, id in ipairs(expired) do
+        redis.call('ZREM', KEYS[i + 2], id)
+        local score = redis.call('HGET', KEYS[6], id)
+        if score then redis.call('ZADD', KEYS[i], score, id) end
+    end
+end
+local popped = redis.call('ZPOPMIN', KEYS[1])
+local is_batch = 0
+if #popped == 0 and ARGV[3] == '1' then
+    popped = redis.call('ZPOPMIN', KEYS[2])
+    if #popped > 0 then
+        is_batch = 1
+        local round = math.floor(tonumber(popped[2]) / 4294967296)
+        if round > tonumber(redis.call('GET', KEYS[7]) or '0') then
+            redis.call('SET', KEYS[7], round)
+        end
+    end
+end
+local depths = {redis.call('ZCARD', KEYS[1]), redis.call('ZCARD', KEYS[2])}
+if #popped == 0 then
+    return {'', '', 0, depths[1], depths[2]}
+end
+redis.call('ZADD', KEYS[3 + is_batch], ARGV[2], popped[1])
+return {popped[1], redis.call('HGET', KEYS[5], popped[1]) or '', is_batch, depths[1], depths[2]}
+"""
+
+# KEYS: interactive running, batch running, jobs, scores, batch queue, rounds. ARGV: id, wake channel.
+_FINISH_SCRIPT = """
+redis.call('ZREM', KEYS[1], ARGV[1])
+redis.call('ZREM', KEYS[2], ARGV[1])
+redis.call('HDEL', KEYS[3], ARGV[1])
+redis.call('HDEL', KEYS[4], ARGV[1])
+if redis.call('ZCARD', KEYS[2]) == 0 and redis.call('ZCARD', KEYS[5]) == 0 then
+    redis.call('DEL', KEYS[6])
+end
+redis.call('PUBLISH', ARGV[2], '')
+return 1
+"""
+
+# KEYS: running, queue, scores. ARGV: id. Puts a claimed job back with its original score.
+_REQUEUE_SCRIPT = """
+if redis.call('ZREM', KEYS[1], ARGV[1]) == 1 then
+    local score = redis.call('HGET', KEYS[3], ARGV[1])
+    if score then redis.call('ZADD', KEYS[2], score, ARGV[1]) end
+end
+return 1
+"""
+
+
+class RedisGenerationScheduler(GenerationScheduler):
+    """Generation queue shared by every API process through Redis.
+
+    Jobs are queued as their ``spec`` and rebuilt with ``runner`` by whichever
+    process claims them, so any worker can run any task. Ordering matches
+    :class:`GenerationScheduler`: interactive jobs first, then batch jobs
+    round-robin across batches. Claimed jobs hold a lease renewed while they
+    run; jobs of a process that dies without releasing them are re-queued
+    once the lease expires. ``max_queue_size`` limits are cluster-wide, while
+    ``workers`` and ``batch_workers`` apply to each process.
+    """
+
+    shared = True
+
+    def __init__(
+        self,
+        url: str,
+        workers: int = 8,
+        max_queue_size: int = 100,
+        batch_workers: Optional[int] = None,
+        max_batch_queue_size: int = 5000,
+        prefix: str = "imagegen:queue:",
+        lease: float = 30.0,
+        client=None,
+    ):
+        super().__init__(
+            workers=workers,
+            max_queue_size=max_queue_size,
+            batch_workers=batch_workers,
+            max_batch_queue_size=max_batch_queue_size,
+        )
+        if client is None:
+            if not REDIS_AVAILABLE:
+                raise ImportError("redis package not installed")
+            client = aioredis.from_url(url, decode_responses=True)
+        self._client = client
+        self.lease = lease
+        self._interactive_queue = prefix + "interactive"
+        self._batch_queue = prefix + "batch"
+        self._interactive_running = prefix + "running:interactive"
+        self._batch_running = prefix + "running:batch"
+        self._jobs = prefix + "jobs"
+        self._scores = prefix + "scores"
+        self._rounds = prefix + "rounds"
+        self._channel = prefix + "wake"
+        self._push_script = client.register_script(_PUSH_SCRIPT)
+        self._claim_script = client.register_script(_CLAIM_SCRIPT)
+        self._finish_script = client.register_script(_FINISH_SCRIPT)
+        self._requeue_script = client.register_script(_REQUEUE_SCRIPT)
+        self._push_keys = [
+            self._interactive_queue,
+            self._batch_queue,
+            self._jobs,
+            self._scores,
+            self._rounds,
+            prefix + "virtual_round",
+            prefix + "seq",
+        ]
+        self._claim_keys = [
+            self._interactive_queue,
+            self._batch_queue,
+            self._interactive_running,
+            self._batch_running,
+            self._jobs,
+            self._scores,
+            prefix + "virtual_round",
+        ]
+        # Last known cluster-wide depths, refreshed by every queue operation
+        self._depths = (0, 0)
+        self._background: List[asyncio.Task] = []
+
+    @property
+    def depth(self) -> int:
+        return sum(self._depths)
+
+    def start(self) -> None:
+        if self.runner is None:
+            raise RuntimeError("RedisGenerationScheduler needs a runner to rebuild queued jobs")
+        super().start()
+        self._background = [
+            asyncio.create_task(self._listen(), name="generation-queue-listener"),
+            asyncio.create_task(self._renew_leases(), name="generation-queue-leases"),
+        ]
+
+    async def submit_many(self, jobs: List[Job]) -> None:
+        if not self._accepting:
+            raise QueueFullError(self.retry_after())
+        now = time.time()
+        entries = [
+            {
+                "id": job.task_id,
+                "batch": job.is_batch,
+                "priority": job.priority,
+                "group": job.group or job.task_id,
+                "job": json.dumps({"priority": job.priority, "group": job.group, "spec": job.spec, "enqueued_at": now}),
+            }
+            for job in jobs
+        ]
+        accepted, *depths = await self._push_script(
+            keys=self._push_keys,
+            args=[self.max_queue_size, self.max_batch_queue_size, json.dumps(entries), self._channel],
+        )
+        self._depths = (int(depths[0]), int(depths[1]))
+        if not int(accepted):
+            raise QueueFullError(self.retry_after())
+
+    async def submit_wait(self, job: Job) -> None:
+        while True:
+            try:
+                await self.submit_many([job])
+                return
+            except QueueFullError:
+                if not self._accepting:
+                    raise
+            # Space frees up when any process finishes a job
+            try:
+                await asyncio.wait_for(self._park(self._space_waiters), self.lease / 3)
+            except asyncio.TimeoutError:
+                pass
+
+    def has_capacity(self, count: int = 1, priority: int = PRIORITY_INTERACTIVE) -> bool:
+        # Based on the last known depths; submit_many makes the authoritative check
+        if priority >= PRIORITY_BATCH:
+            free = self.max_batch_queue_size - self._depths[1]
+        else:
+            free = self.max_queue_size - self._depths[0]
+        return self._accepting and free >= count
+
+    async def position(self, task_id: str) -> Optional[int]:
+        async with self._client.pipeline(transaction=False) as pipe:
+            pipe.zrank(self._interactive_queue, task_id)
+            pipe.zrank(self._batch_queue, task_id)
+            pipe.zcard(self._interactive_queue)
+            pipe.zcard(self._batch_queue)
+            interactive_rank, batch_rank, interactive_depth, batch_depth = await pipe.execute()
+        self._depths = (interactive_depth, batch_depth)
+        if interactive_rank is not None:
+            return interactive_rank + 1
+        if batch_rank is not None:
+            return interactive_depth + batch_rank + 1
+        return None
+
+    async def _claim(self) -> Optional[Job]:
+        now = time.time()
+        task_id, payload, _, *depths = await self._claim_script(
+            keys=self._claim_keys,
+            args=[now, now + self.lease, int(self._running_batch < self.batch_workers)],
+        )
+        self._depths = (int(depths[0]), int(depths[1]))
+        if not task_id:
+            return None
+        try:
+            data = json.loads(payload)
+            run = self.runner(data["spec"])
+        except Exception:
+            logger.exception("Dropping queued job %s that cannot be rebuilt", task_id)
+            await self._finish(task_id)
+            return None
+        job = Job(
+            task_id=task_id,
+            run=run,
+            priority=data["priority"],
+            group=data["group"],
+            spec=data["spec"],
+            enqueued_at=data.get("enqueued_at", now),
+        )
+        job.record_wait()
+        return job
+
+    async def _finish(self, task_id: str) -> None:
+        await self._finish_script(
+            keys=[
+                self._interactive_running,
+                self._batch_running,
+                self._jobs,
+                self._scores,
+                self._batch_queue,
+                self._rounds,
+            ],
+            args=[task_id, self._channel],
+        )
+
+    async def _worker(self) -> None:
+        while self._accepting:
+            try:
+                job = await self._claim()
+            except Exception:
+                logger.exception("Could not claim a generation job")
+                job = None
+            if job is None:
+                # Woken by a queue change anywhere, or periodically to pick up expired leases
+                try:
+                    await asyncio.wait_for(self._park(self._idle_workers), self.lease / 3)
+                except asyncio.TimeoutError:
+                    pass
+                continue
+
+            self._running[job.task_id] = job
+            if job.is_batch:
+                self._running_batch += 1
+            started = time.monotonic()
+            try:
+                await job.run()
+            except Exception:
+                logger.exception("Generation job %s crashed", job.task_id)
+            # On cancellation the job stays claimed for stop() to re-queue
+            self._running.pop(job.task_id, None)
+            if job.is_batch:
+                self._running_batch -= 1
+            self._avg_duration = 0.8 * self._avg_duration + 0.2 * (time.monotonic() - started)
+            try:
+                await self._finish(job.task_id)
+            except Exception:
+                logger.exception("Could not release generation job %s", job.task_id)
+
+    async def _listen(self) -> None:
+        """Wake local workers and space waiters whenever any process changes the queue"""
+        while True:
+            try:
+                async with self._client.pubsub() as pubsub:
+                    await pubsub.subscribe(self._channel)
+                    async for message in pubsub.listen():
+                        if message["type"] == "message":
+                            self._wake(self._idle_workers, everyone=True)
+                            self._wake(self._space_waiters, everyone=True)
+            except asyncio.CancelledError:
+                raise
+            except Exception:
+                logger.exception("Queue notifications lost, reconnecting")
+                await asyncio.sleep(1.0)
+
+    async def _renew_leases(self) -> None:
+        while True:
+            await asyncio.sleep(self.lease / 3)
+            deadline = time.time() + self.lease
+            try:
+                async with self._client.pipeline(transaction=False) as pipe:
+                    for job in self._running.values():
+                        running = self._batch_running if job.is_batch else self._interactive_running
+                        pipe.zadd(running, {job.task_id: deadline}, xx=True)
+                    pipe.zcard(self._interactive_queue)
+                    pipe.zcard(self._batch_queue)
+                    results = await pipe.execute()
+                self._depths = (results[-2], results[-1])
+            except Exception:
+                logger.exception("Could not renew generation job leases")
+
+    async def stop(self, timeout: float = 10.0) -> List[str]:
+        """Stop claiming jobs and hand in-flight ones back to the shared queue.
+
+        Queued jobs stay in Redis for the other processes (or the next start).
+        In-flight jobs get ``timeout`` seconds to finish; the rest are
+        cancelled, re-queued and returned.
+        """
+        self._accepting = False
+        self._wake(self._idle_workers, everyone=True)
+        deadline = time.monotonic() + timeout
+        while self._running and time.monotonic() < deadline:
+            await asyncio.sleep(0.05)
+        interrupted: Dict[str, Job] = dict(self._running)
+
+        for task in [*self._worker_tasks, *self._background]:
+            task.cancel()
+        await asyncio.gather(*self._worker_tasks, *self._background, return_exceptions=True)
+        self._worker_tasks = []
+        self._background = []
+
+        for job in interrupted.values():
+            running, queue = (
+                (self._batch_running, self._batch_queue)
+                if job.is_batch
+                else (self._interactive_running, self._interactive_queue)
+            )
+            try:
+                await self._requeue_script(keys=[running, queue, self._scores], args=[job.task_id])
+            except Exception:
+                logger.exception("Could not re-queue generation job %s", job.task_id)
+        await self._client.aclose()
+        return list(interrupted)
@@ -0,0 +1,263 @@
+import asyncio
+import heapq
+import itertools
+import logging
+import math
+import time
+from collections import deque
+from dataclasses import dataclass
+from typing import Any, Awaitable, Callable, Dict, List, Optional, Tuple
+
+from ..utils.metrics import QUEUE_WAIT
+from ..utils.sorted_index import SortedIndex
+
+logger = logging.getLogger(__name__)
+
+# Lower values run first
+PRIORITY_INTERACTIVE = 0
+PRIORITY_BATCH = 10
+
+_INTERACTIVE_WAIT = QUEUE_WAIT.labels("interactive")
+_BATCH_WAIT = QUEUE_WAIT.labels("batch")
+
+
+class QueueFullError(Exception):
+    """Raised when the generation queue cannot accept more jobs"""
+
+    def __init__(self, retry_after: int):
+        super().__init__("Generation queue is full")
+        self.retry_after = retry_after
+
+
+@dataclass
+class Job:
+    """A queued generation job.
+
+    ``spec`` is a JSON-serializable description of the job from which
+    ``run`` can be rebuilt, for schedulers that queue jobs outside this process.
+    ``enqueued_at`` is the wall-clock time the job entered the queue.
+    """
+
+    task_id: str
+    run: Callable[[], Awaitable[None]]
+    priority: int = PRIORITY_INTERACTIVE
+    group: Optional[str] = None
+    spec: Optional[Dict[str, Any]] = None
+    enqueued_at: float = 0.0
+
+    @property
+    def is_batch(self) -> bool:
+        return self.priority >= PRIORITY_BATCH
+
+    def record_wait(self) -> None:
+        """Observe the job's queue wait as a worker starts it"""
+        (_BATCH_WAIT if self.is_batch else _INTERACTIVE_WAIT).observe(max(0.0, time.time() - self.enqueued_at))
+
+
+# Heap key: (priority, fair-share round, arrival order)
+JobKey = Tuple[int, int, int]
+
+# Rebuilds a job's ``run`` from its ``spec``
+JobRunner = Callable[[Dict[str, Any]], Callable[[], Awaitable[None]]]
+
+
+class GenerationScheduler:
+    """Bounded priority queue drained by a fixed pool of worker coroutines.
+
+    Interactive jobs always run before batch jobs. Batch jobs are interleaved
+    round-robin across their ``group`` (the batch id), so a large batch does
+    not delay a smaller one queued after it, and at most ``batch_workers``
+    of them run at once so some workers stay free for interactive requests.
+    """
+
+    # Whether queued jobs live outside this process and outlast it
+    shared = False
+
+    def __init__(
+        self,
+        workers: int = 8,
+        max_queue_size: int = 100,
+        batch_workers: Optional[int] = None,
+        max_batch_queue_size: int = 5000,
+    ):
+        self.workers = workers
+        self.max_queue_size = max_queue_size
+        self.batch_workers = max(1, min(batch_workers or workers, workers))
+        self.max_batch_queue_size = max_batch_queue_size
+        self._heap: List[Tuple[int, int, int, Job]] = []
+        # Futures of idle workers and of submit_wait callers waiting for space
+        self._idle_workers: deque = deque()
+        self._space_waiters: deque = deque()
+        self._counter = itertools.count()
+        self._queued: Dict[str, JobKey] = {}
+        # Queued jobs in run order, so a position is one bisect rather than a scan
+        self._order = SortedIndex()
+        self._queued_batch = 0
+        self._running: Dict[str, Job] = {}
+        self._running_batch = 0
+        # Start-time fair queuing: a group's next round, and the round of the
+        # last batch job started
+        self._group_rounds: Dict[str, int] = {}
+        self._virtual_round = 0
+        self._worker_tasks: List[asyncio.Task] = []
+        self._accepting = False
+        # Exponential moving average of job duration, used for Retry-After
+        self._avg_duration = 5.0
+        self.runner: Optional[JobRunner] = None
+
+    @property
+    def depth(self) -> int:
+        """Number of jobs waiting to start"""
+        return len(self._queued)
+
+    @property
+    def in_flight(self) -> int:
+        return len(self._running)
+
+    def start(self) -> None:
+        self._accepting = True
+        self._worker_tasks = [
+            asyncio.create_task(self._worker(), name=f"generation-worker-{i}")
+            for i in range(self.workers)
+        ]
+
+    def _free_slots(self, batch: bool) -> int:
+        if batch:
+            return self.max_batch_queue_size - self._queued_batch
+        return self.max_queue_size - (len(self._queued) - self._queued_batch)
+
+    def _push(self, job: Job) -> None:
+        round_ = 0
+        if job.is_batch:
+            group = job.group or job.task_id
+            round_ = max(self._group_rounds.get(group, 0), self._virtual_round)
+            self._group_rounds[group] = round_ + 1
+            self._queued_batch += 1
+        key = (job.priority, round_, next(self._counter))
+        job.enqueued_at = time.time()
+        heapq.heappush(self._heap, (*key, job))
+        self._queued[job.task_id] = key
+        self._order.add(key, job.task_id)
+        self._wake(self._idle_workers)
+
+    async def submit(self, job: Job) -> int:
+        """Enqueue a job and return its 1-based queue position"""
+        await self.submit_many([job])
+        return await self.position(job.task_id) or 1
+
+    async def submit_many(self, jobs: List[Job]) -> None:
+        """Enqueue several jobs at once, all or none"""
+        batch = sum(1 for job in jobs if job.is_batch)
+        if (
+            not self._accepting
+            or self._free_slots(batch=True) < batch
+            or self._free_slots(batch=False) < len(jobs) - batch
+        ):
+            raise QueueFullError(self.retry_after())
+        for job in jobs:
+            self._push(job)
+
+    async def submit_wait(self, job: Job) -> None:
+        """Enqueue a job, waiting for a free slot instead of rejecting it"""
+        while self._free_slots(job.is_batch) <= 0:
+            await self._park(self._space_waiters)
+        self._push(job)
+
+    def has_capacity(self, count: int = 1, priority: int = PRIORITY_INTERACTIVE) -> bool:
+        return self._accepting and self._free_slots(priority >= PRIORITY_BATCH) >= count
+
+    async def position(self, task_id: str) -> Optional[int]:
+        """1-based position of a queued job, or ``None`` if it is not waiting"""
+        key = self._queued.get(task_id)
+        if key is None:
+            return None
+        return 1 + self._order.rank(key, task_id)
+
+    def retry_after(self) -> int:
+        """Estimated seconds until a queue slot frees up"""
+        # With every worker busy, one job finishes roughly every avg_duration / workers
+        return max(1, math.ceil(self._avg_duration / max(self.workers, 1)))
+
+    @staticmethod
+    async def _park(waiters: deque) -> None:
+        waiter = asyncio.get_running_loop().create_future()
+        waiters.append(waiter)
+        try:
+            await waiter
+        finally:
+            if not waiter.done():
+                waiter.cancel()
+
+    @staticmethod
+    def _wake(waiters: deque, everyone: bool = False) -> None:
+        while waiters:
+            waiter = waiters.popleft()
+            if not waiter.done():
+                waiter.set_result(None)
+                if not everyone:
+                    return
+
+    def _next_runnable(self) -> Optional[Job]:
+        if not self._heap:
+            return None
+        job = self._heap[0][-1]
+        if job.is_batch and self._running_batch >= self.batch_workers:
+            # Only batch work is waiting and its share of workers is in use
+            return None
+        heapq.heappop(self._heap)
+        key = self._queued.pop(job.task_id)
+        self._order.discard(key, job.task_id)
+        if job.is_batch:
+            self._queued_batch -= 1
+            self._running_batch += 1
+            self._virtual_round = max(self._virtual_round, key[1])
+        self._running[job.task_id] = job
+        job.record_wait()
+        self._wake(self._space_waiters, everyone=True)
+        return job
+
+    async def _worker(self) -> None:
+        while True:
+            job = self._next_runnable()
+            while job is None:
+                await self._park(self._idle_workers)
+                job = self._next_runnable()
+            started = time.monotonic()
+            try:
+                await job.run()
+            except Exception:
+                logger.exception("Generation job %s crashed", job.task_id)
+            finally:
+                self._running.pop(job.task_id, None)
+                if job.is_batch:
+                    self._running_batch -= 1
+                    if not self._running_batch and not self._queued_batch:
+                        self._group_rounds.clear()
+                self._avg_duration = 0.8 * self._avg_duration + 0.2 * (time.monotonic() - started)
+                if job.is_batch:
+                    # A batch slot freed up; only an idle worker can take it
+                    self._wake(self._idle_workers)
+
+    async def stop(self, timeout: float = 10.0) -> List[str]:
+        """Stop accepting work and return ids of jobs that did not finish.
+
+        Queued jobs are dropped without running; in-flight jobs get ``timeout``
+        seconds to finish before they are cancelled.
+        """
+        self._accepting = False
+        unfinished: List[str] = [entry[-1].task_id for entry in sorted(self._heap)]
+        self._heap.clear()
+        self._queued.clear()
+        self._order = SortedIndex()
+        self._queued_batch = 0
+
+        deadline = time.monotonic() + timeout
+        while self._running and time.monotonic() < deadline:
+            await asyncio.sleep(0.05)
+        unfinished.extend(self._running)
+
+        for worker in self._worker_tasks:
+            worker.cancel()
+        await asyncio.gather(*self._worker_tasks, return_exceptions=True)
+        self._worker_tasks = []
+        return unfinished
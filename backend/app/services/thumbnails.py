@@ -0,0 +1,257 @@
+import asyncio
+import logging
+import multiprocessing
+import os
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from pathlib import Path
+from typing import Dict, Iterable, List, Optional, Sequence, Set
+
+from ..utils.image_files import LOCAL_IMAGE_PREFIX, blob_path
+
+try:
+    from PIL import Image, features
+    PIL_AVAILABLE = True
+except ImportError:
+    PIL_AVAILABLE = False
+
+logger = logging.getLogger(__name__)
+
+MEDIA_TYPES = {"webp": "image/webp", "avif": "image/avif"}
+# Niceness of the pool processes, so resizing yields the CPU to the API
+WORKER_NICENESS = 10
+
+
+def format_supported(fmt: str) -> bool:
+    """Whether the installed Pillow can encode ``fmt``"""
+    if not PIL_AVAILABLE or fmt not in MEDIA_TYPES:
+        return False
+    try:
+        return bool(features.check(fmt))
+    except ValueError:
+        # Pillow versions that do not know the feature at all
+        return False
+
+
+def _lower_priority() -> None:
+    try:
+        os.nice(WORKER_NICENESS)
+    except (AttributeError, OSError):
+        pass
+
+
+def render_derivative(source: str, target: str, width: int, fmt: str, quality: int) -> int:
+    """Write ``source`` scaled down to ``width`` as ``fmt`` to ``target``; runs in a pool process"""
+    partial = target + ".part"
+    with Image.open(source) as image:
+        # Never upscales; JPEGs are decoded at a reduced scale where possible
+        image.thumbnail((width, image.height * width // max(image.width, 1) + 1), Image.Resampling.LANCZOS)
+        if image.mode not in ("RGB", "RGBA"):
+            image = image.convert("RGBA" if image.mode in ("LA", "PA") or "transparency" in image.info else "RGB")
+        options = {"method": 4} if fmt == "webp" else {"speed": 8}
+        image.save(partial, format=fmt.upper(), quality=quality, **options)
+    os.replace(partial, target)
+    return os.path.getsize(target)
+
+
+class ThumbnailService:
+    """Resized WebP/AVIF derivatives of the images in ``output_dir``.
+
+    Derivatives are rendered at fixed ``widths`` by a pool of ``workers``
+    processes running at lowered priority, so resizing never runs on the
+    event loop and never takes more than ``workers`` CPUs. Saved images are
+    pre-rendered in the background (at most ``workers`` at a time, and only
+    while fewer than ``max_pending`` are waiting); anything else is rendered
+    on first request. Rendered files live in ``cache_dir``, which is kept
+    under ``max_cache_bytes`` by evicting the least recently used ones.
+    """
+
+    def __init__(
+        self,
+        output_dir: Path,
+        cache_dir: Path,
+        widths: Sequence[int] = (256, 512, 1024),
+        fmt: str = "webp",
+        quality: int = 80,
+        workers: int = 1,
+        max_cache_bytes: int = 512 * 1024 * 1024,
+        history_width: Optional[int] = None,
+        max_pending: int = 100,
+    ):
+        if not PIL_AVAILABLE:
+            raise ImportError("Pillow not installed")
+        self.output_dir = output_dir
+        self.cache_dir = cache_dir
+        self.widths = sorted(set(widths))
+        self.format = fmt if format_supported(fmt) else "webp"
+        if self.format != fmt:
+            logger.warning("Pillow cannot encode %s, rendering thumbnails as WebP", fmt)
+        self.quality = quality
+        self.workers = max(workers, 1)
+        self.max_cache_bytes = max_cache_bytes
+        self.history_width = self.snap(history_width or self.widths[0])
+        self.max_pending = max_pending
+        self._executor: Optional[ProcessPoolExecutor] = None
+        self._rendering: Dict[str, asyncio.Future] = {}
+        self._background_slots = asyncio.Semaphore(self.workers)
+        self._background: Set[asyncio.Task] = set()
+        # Cached file name -> size, least recently used first
+        self._entries: "OrderedDict[str, int]" = OrderedDict()
+        self._cache_bytes = 0
+        self._busy = 0
+        self.rendered = 0
+        self.failed = 0
+        self.evicted = 0
+        self.skipped = 0
+
+    async def start(self) -> None:
+        """Index derivatives left in ``cache_dir`` by earlier runs"""
+        self._entries = await asyncio.to_thread(self._scan)
+        self._cache_bytes = sum(self._entries.values())
+        await self._evict()
+
+    def _scan(self) -> "OrderedDict[str, int]":
+        self.cache_dir.mkdir(parents=True, exist_ok=True)
+        found = []
+        for path in self.cache_dir.iterdir():
+            if path.name.endswith(".part"):
+                path.unlink(missing_ok=True)
+                continue
+            stat = path.stat()
+            found.append((stat.st_mtime, path.name, stat.st_size))
+        return OrderedDict((name, size) for _, name, size in sorted(found))
+
+    def snap(self, width: int) -> int:
+        """The smallest configured width of at least ``width``, else the largest"""
+        return next((candidate for candidate in self.widths if candidate >= width), self.widths[-1])
+
+    def negotiate(self, accept: str) -> str:
+        """Format to serve to a client sending ``accept``"""
+        if self.format == "avif" and "image/avif" not in accept:
+            return "webp"
+        return self.format
+
+    def thumbnail_url(self, image: str) -> str:
+        """URL of the history-sized derivative of ``image``; remote images are returned as is"""
+        if not image.startswith(LOCAL_IMAGE_PREFIX):
+            return image
+        return f"{image}?w={self.history_width}"
+
+    def thumbnail_urls(self, images: Iterable[str]) -> List[str]:
+        return [self.thumbnail_url(image) for image in images]
+
+    def path(self, name: str, width: int, fmt: Optional[str] = None) -> Path:
+        """Where the derivative of ``name`` at ``width`` is (or would be) cached"""
+        return self.cache_dir / f"{name}.{self.snap(width)}.{fmt or self.format}"
+
+    async def get(self, name: str, width: int, fmt: Optional[str] = None) -> Optional[Path]:
+        """Path of the derivative of ``name`` at ``width``, rendering it if needed.
+
+        Returns ``None`` if the image cannot be rendered; callers then serve
+        the original.
+        """
+        fmt = fmt or self.format
+        target = self.path(name, width, fmt)
+        if target.name in self._entries and target.is_file():
+            self._entries.move_to_end(target.name)
+            return target
+        rendering = self._rendering.get(target.name)
+        if rendering is None:
+            rendering = asyncio.ensure_future(self._render(blob_path(self.output_dir, name), target, self.snap(width), fmt))
+            self._rendering[target.name] = rendering
+            rendering.add_done_callback(lambda _: self._rendering.pop(target.name, None))
+        return await asyncio.shield(rendering)
+
+    def _pool(self) -> ProcessPoolExecutor:
+        if self._executor is None:
+            self._executor = ProcessPoolExecutor(
+                max_workers=self.workers,
+                # Forking a process with running threads and an event loop is unsafe
+                mp_context=multiprocessing.get_context("spawn"),
+                initializer=_lower_priority,
+            )
+        return self._executor
+
+    async def _render(self, source: Path, target: Path, width: int, fmt: str) -> Optional[Path]:
+        loop = asyncio.get_running_loop()
+        self._busy += 1
+        try:
+            size = await loop.run_in_executor(
+                self._pool(), render_derivative, str(source), str(target), width, fmt, self.quality
+            )
+        except Exception as e:
+            self.failed += 1
+            logger.warning("Could not render %s at width %d: %s", source.name, width, e)
+            if isinstance(e, BrokenProcessPool) and self._executor is not None:
+                # A worker died (e.g. killed for memory); start a fresh pool next time
+                self._executor.shutdown(wait=False, cancel_futures=True)
+                self._executor = None
+            return None
+        finally:
+            self._busy -= 1
+        self.rendered += 1
+        self._cache_bytes += size - self._entries.pop(target.name, 0)
+        self._entries[target.name] = size
+        await self._evict()
+        return target
+
+    async def _evict(self) -> None:
+        victims = []
+        # The most recent entry stays, even if it alone exceeds the budget
+        while self._cache_bytes > self.max_cache_bytes and len(self._entries) > 1:
+            name, size = self._entries.popitem(last=False)
+            self._cache_bytes -= size
+            victims.append(self.cache_dir / name)
+        if victims:
+            self.evicted += len(victims)
+            await asyncio.to_thread(lambda: [path.unlink(missing_ok=True) for path in victims])
+
+    async def discard(self, names: Iterable[str]) -> None:
+        """Delete the cached derivatives of the images ``names``"""
+        prefixes = tuple(f"{name}." for name in names)
+        victims = [entry for entry in self._entries if entry.startswith(prefixes)]
+        for entry in victims:
+            self._cache_bytes -= self._entries.pop(entry)
+        if victims:
+            await asyncio.to_thread(lambda: [(self.cache_dir / entry).unlink(missing_ok=True) for entry in victims])
+
+    def schedule(self, images: Iterable[str]) -> None:
+        """Pre-render every width of the local ``images`` in the background"""
+        for image in images:
+            if not image.startswith(LOCAL_IMAGE_PREFIX):
+                continue
+            if len(self._background) >= self.max_pending:
+                self.skipped += 1
+                continue
+            job = asyncio.create_task(self._prerender(image[len(LOCAL_IMAGE_PREFIX):]))
+            self._background.add(job)
+            job.add_done_callback(self._background.discard)
+
+    async def _prerender(self, name: str) -> None:
+        for width in self.widths:
+            async with self._background_slots:
+                if await self.get(name, width) is None:
+                    return
+
+    def utilization(self) -> Optional[float]:
+        return min(self._busy, self.workers) / self.workers
+
+    def stats(self) -> Dict[str, int]:
+        return {
+            "rendered": self.rendered,
+            "failed": self.failed,
+            "evicted": self.evicted,
+            "skipped": self.skipped,
+            "cached": len(self._entries),
+            "cache_bytes": self._cache_bytes,
+        }
+
+    async def close(self) -> None:
+        """Cancel pre-rendering and shut the process pool down"""
+        for job in list(self._background):
+            job.cancel()
+        await asyncio.gather(*self._background, return_exceptions=True)
+        if self._executor is not None:
+            self._executor.shutdown(wait=False, cancel_futures=True)
+            self._executor = None
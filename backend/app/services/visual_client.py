@@ -0,0 +1,162 @@
+import hashlib
+import hmac
+import json
+from datetime import datetime, timezone
+from typing import Optional
+from urllib.parse import quote
+
+import httpx
+
+from ..utils import tracing
+
+try:
+    import h2  # noqa: F401
+    HTTP2_AVAILABLE = True
+except ImportError:
+    HTTP2_AVAILABLE = False
+
+VISUAL_HOST = "visual.volcengineapi.com"
+VISUAL_SERVICE = "cv"
+# The visual API is always signed for cn-north-1, matching the official SDK
+VISUAL_REGION = "cn-north-1"
+CV_PROCESS_QUERY = {"Action": "CVProcess", "Version": "2022-08-31"}
+
+SIGNING_ALGORITHM = "HMAC-SHA256"
+
+
+def _hmac_sha256(key: bytes, content: str) -> bytes:
+    return hmac.new(key, content.encode("utf-8"), hashlib.sha256).digest()
+
+
+def _canonical_query(query: dict) -> str:
+    return "&".join(
+        f"{quote(key, safe='-_.~')}={quote(str(query[key]), safe='-_.~')}" for key in sorted(query)
+    )
+
+
+def sign_request(
+    access_key: str,
+    secret_key: str,
+    method: str,
+    path: str,
+    query: dict,
+    headers: dict,
+    body: bytes,
+    x_date: Optional[str] = None,
+    region: str = VISUAL_REGION,
+    service: str = VISUAL_SERVICE,
+) -> dict:
+    """Return ``headers`` plus the Volcengine V4 (HMAC-SHA256) signing headers.
+
+    This mirrors ``volcengine.auth.SignerV4.sign``: ``Content-Type``, ``Host``
+    and every ``X-`` header are signed, and the body hash is sent as
+    ``X-Content-Sha256``.
+    """
+    if x_date is None:
+        x_date = datetime.now(timezone.utc).strftime("%Y%m%dT%H%M%SZ")
+    date = x_date[:8]
+
+    signed = dict(headers)
+    signed["X-Date"] = x_date
+    body_hash = hashlib.sha256(body).hexdigest()
+    signed["X-Content-Sha256"] = body_hash
+
+    canonical_headers = {}
+    for key, value in signed.items():
+        if key in ("Content-Type", "Content-Md5", "Host") or key.startswith("X-"):
+            canonical_headers[key.lower()] = value
+    host = canonical_headers.get("host")
+    if host and ":" in host:
+        name, port = host.split(":", 1)
+        if port in ("80", "443"):
+            canonical_headers["host"] = name
+
+    signed_header_names = ";".join(sorted(canonical_headers))
+    canonical_request = "\n".join([
+        method,
+        quote(path or "/").replace("%2F", "/").replace("+", "%20"),
+        _canonical_query(query).replace("+", "%20"),
+        "".join(f"{key}:{canonical_headers[key]}\n" for key in sorted(canonical_headers)),
+        signed_header_names,
+        body_hash,
+    ])
+
+    credential_scope = "/".join([date, region, service, "request"])
+    string_to_sign = "\n".join([
+        SIGNING_ALGORITHM,
+        x_date,
+        credential_scope,
+        hashlib.sha256(canonical_request.encode("utf-8")).hexdigest(),
+    ])
+
+    signing_key = _hmac_sha256(secret_key.encode("utf-8"), date)
+    for part in (region, service, "request"):
+        signing_key = _hmac_sha256(signing_key, part)
+    signature = hmac.new(signing_key, string_to_sign.encode("utf-8"), hashlib.sha256).hexdigest()
+
+    signed["Authorization"] = (
+        f"{SIGNING_ALGORITHM} Credential={access_key}/{credential_scope}, "
+        f"SignedHeaders={signed_header_names}, Signature={signature}"
+    )
+    return signed
+
+
+class AsyncVisualClient:
+    """asyncio-native client for the Volcengine visual API.
+
+    A single pooled keep-alive ``httpx.AsyncClient`` is shared by every
+    request, so concurrency is bounded by ``max_connections`` rather than by a
+    thread pool.
+    """
+
+    def __init__(
+        self,
+        access_key: str,
+        secret_key: str,
+        host: str = VISUAL_HOST,
+        scheme: str = "https",
+        max_connections: int = 200,
+        max_keepalive_connections: int = 50,
+        connect_timeout: float = 30.0,
+        read_timeout: float = 30.0,
+        http2: bool = False,
+    ):
+        self.access_key = access_key
+        self.secret_key = secret_key
+        self.host = host
+        self._client = httpx.AsyncClient(
+            base_url=f"{scheme}://{host}",
+            http2=http2 and HTTP2_AVAILABLE,
+            limits=httpx.Limits(
+                max_connections=max_connections,
+                max_keepalive_connections=max_keepalive_connections,
+            ),
+            timeout=httpx.Timeout(read_timeout, connect=connect_timeout),
+        )
+
+    async def cv_process(self, form: dict) -> dict:
+        """Async equivalent of ``VisualService.cv_process``"""
+        with tracing.span("upstream.sign"):
+            body = json.dumps(form).encode("utf-8")
+            headers = sign_request(
+                self.access_key,
+                self.secret_key,
+                method="POST",
+                path="/",
+                query=CV_PROCESS_QUERY,
+                headers={"Content-Type": "application/json", "Host": self.host},
+                body=body,
+            )
+        with tracing.span("upstream.http") as span:
+            response = await self._client.post("/", params=CV_PROCESS_QUERY, content=body, headers=headers)
+            span.set("http.status_code", response.status_code)
+        if response.status_code == 200:
+            return response.json()
+        # Like the SDK, surface structured upstream errors as their JSON body
+        try:
+            return response.json()
+        except ValueError:
+            raise Exception(response.text)
+
+    async def aclose(self) -> None:
+        await self._client.aclose()
@@ -1,26 +1,41 @@
 import asyncio
+import threading
 import time
-from typing import Optional
+from typing import Awaitable, Callable, Optional
 from concurrent.futures import ThreadPoolExecutor
 
+from ..utils import tracing
+from ..utils.metrics import UPSTREAM_LATENCY
+from ..utils.rate_limit import UpstreamRateLimiter
+from ..utils.resilience import UpstreamResilience
+from .visual_client import AsyncVisualClient
+
 try:
     from volcengine.visual.VisualService import VisualService
     VOLCENGINE_AVAILABLE = True
 except ImportError:
     VOLCENGINE_AVAILABLE = False
 
+TEXT2IMAGE_REQ_KEY = "text2image"
+IMAGE2IMAGE_REQ_KEY = "img2img"
+
+# Called with (seed_index, result) as each sub-request of a fan-out finishes
+ResultCallback = Callable[[int, dict], Awaitable[None]]
+
 
-class VolcengineImageService:
-    """Service for interacting with Volcengine Image Generation API"""
+class BaseVolcengineImageService:
+    """Request building and fan-out shared by the Volcengine transports"""
     
-    def __init__(self, access_key: str, secret_key: str, region: str = "cn-beijing"):
-        if not VOLCENGINE_AVAILABLE:
-            raise ImportError("volcengine SDK not installed")
-        
-        self.service = VisualService()
-        self.service.set_ak(access_key)
-        self.service.set_sk(secret_key)
-        self.executor = ThreadPoolExecutor(max_workers=4)
+    def __init__(
+        self,
+        max_concurrency: int = 4,
+        rate_limiter: Optional[UpstreamRateLimiter] = None,
+        resilience: Optional[UpstreamResilience] = None,
+    ):
+        self.max_concurrency = max_concurrency
+        self.rate_limiter = rate_limiter
+        self.resilience = resilience
+        self._latency = {req_key: UPSTREAM_LATENCY.labels(req_key) for req_key in (TEXT2IMAGE_REQ_KEY, IMAGE2IMAGE_REQ_KEY)}
     
     async def text_to_image(
         self,
@@ -33,11 +48,16 @@ class VolcengineImageService:
         seed: Optional[int] = None,
         style_preset: str = "none",
         num_images: int = 1,
+        on_result: Optional[ResultCallback] = None,
     ) -> dict:
-        """Generate image from text using Volcengine API"""
+        """Generate image from text using Volcengine API.
+
+        Sub-requests for each image are issued concurrently (at most
+        ``max_concurrency`` at a time); results are returned in seed order.
+        """
         
         payload = {
-            "req_key": "text2image",
+            "req_key": TEXT2IMAGE_REQ_KEY,
             "prompt": prompt,
             "width": width,
             "height": height,
@@ -58,24 +78,29 @@ class VolcengineImageService:
         if style_preset and style_preset != "none":
             payload["style_preset"] = style_preset
         
-        loop = asyncio.get_event_loop()
-        results = []
+        semaphore = asyncio.Semaphore(self.max_concurrency)
         
+        async def generate_one(index: int, current_payload: dict) -> dict:
+            async with semaphore:
+                try:
+                    result = await self._request(TEXT2IMAGE_REQ_KEY, current_payload, self._call_text2image)
+                except Exception as e:
+                    result = {"error": str(e)}
+            if on_result is not None:
+                await on_result(index, result)
+            return result
+        
+        payloads = []
         for i in range(num_images):
             current_payload = payload.copy()
             if seed is not None and seed >= 0:
                 current_payload["seed"] = seed + i
-            current_payload["req_key"] = "text2image"
-            
-            try:
-                result = await loop.run_in_executor(
-                    self.executor,
-                    self._call_text2image_sync,
-                    current_payload
-                )
-                results.append(result)
-            except Exception as e:
-                results.append({"error": str(e)})
+            current_payload["req_key"] = TEXT2IMAGE_REQ_KEY
+            payloads.append(current_payload)
+        
+        results = await asyncio.gather(
+            *(generate_one(i, current_payload) for i, current_payload in enumerate(payloads))
+        )
         
         return {
             "success": all("error" not in r for r in results),
@@ -83,14 +108,6 @@ class VolcengineImageService:
             "count": len(results)
         }
     
-    def _call_text2image_sync(self, payload: dict) -> dict:
-        """Synchronous call to Volcengine text2image API"""
-        try:
-            response = self.service.cv_process(payload)
-            return response
-        except Exception as e:
-            return {"error": str(e)}
-    
     async def image_to_image(
         self,
         image_base64: str,
@@ -108,7 +125,7 @@ class VolcengineImageService:
             image_base64 = image_base64.split(",")[1]
         
         payload = {
-            "req_key": "img2img",
+            "req_key": IMAGE2IMAGE_REQ_KEY,
             "prompt": prompt,
             "binary_data_base64": [image_base64],
             "strength": strength,
@@ -129,14 +146,8 @@ class VolcengineImageService:
         if style_preset and style_preset != "none":
             payload["style_preset"] = style_preset
         
-        loop = asyncio.get_event_loop()
-        
         try:
-            result = await loop.run_in_executor(
-                self.executor,
-                self._call_image2image_sync,
-                payload
-            )
+            result = await self._request(IMAGE2IMAGE_REQ_KEY, payload, self._call_image2image)
             return {
                 "success": "error" not in result,
                 "result": result
@@ -147,53 +158,199 @@ class VolcengineImageService:
                 "result": {"error": str(e)}
             }
     
+    async def _request(self, req_key: str, payload: dict, call: Callable[[dict], Awaitable[dict]]) -> dict:
+        """Send ``payload`` through ``call``, with retries, timeouts and the
+        circuit breaker when resilience is configured.
+
+        Seeded requests are deterministic, so they may be hedged.
+        """
+        if self.resilience is None:
+            await self._throttle(req_key)
+            return await self._timed(req_key, call, payload)
+        return await self.resilience.call(
+            req_key,
+            lambda: self._timed(req_key, call, payload),
+            throttle=self._throttle,
+            hedge="seed" in payload,
+        )
+    
+    async def _timed(self, req_key: str, call: Callable[[dict], Awaitable[dict]], payload: dict) -> dict:
+        """One upstream call, observed in the latency histogram unless it is cancelled"""
+        latency = self._latency[req_key]
+        with tracing.span("upstream.call", req_key=req_key):
+            started = time.perf_counter()
+            try:
+                result = await call(payload)
+            except Exception:
+                latency.observe(time.perf_counter() - started)
+                raise
+            latency.observe(time.perf_counter() - started)
+            return result
+    
+    def utilization(self) -> Optional[float]:
+        """Share of the transport's threads or connections in use"""
+        return None
+    
+    async def _throttle(self, req_key: str) -> None:
+        """Wait for the shared upstream budget of ``req_key``"""
+        if self.rate_limiter is not None:
+            await self.rate_limiter.acquire(req_key)
+    
+    async def _call_text2image(self, payload: dict) -> dict:
+        """Single upstream text2image call"""
+        raise NotImplementedError
+    
+    async def _call_image2image(self, payload: dict) -> dict:
+        """Single upstream image2image call"""
+        raise NotImplementedError
+    
+    async def close(self):
+        """Release transport resources"""
+
+
+class VolcengineImageService(BaseVolcengineImageService):
+    """Service for interacting with Volcengine Image Generation API through the SDK"""
+    
+    def __init__(
+        self,
+        access_key: str,
+        secret_key: str,
+        region: str = "cn-beijing",
+        max_concurrency: int = 4,
+        rate_limiter: Optional[UpstreamRateLimiter] = None,
+        resilience: Optional[UpstreamResilience] = None,
+        host: Optional[str] = None,
+        scheme: Optional[str] = None,
+        executor_workers: int = 4,
+    ):
+        if not VOLCENGINE_AVAILABLE:
+            raise ImportError("volcengine SDK not installed")
+        
+        super().__init__(max_concurrency=max_concurrency, rate_limiter=rate_limiter, resilience=resilience)
+        self.service = VisualService()
+        self.service.set_ak(access_key)
+        self.service.set_sk(secret_key)
+        if host:
+            self.service.set_host(host)
+        if scheme:
+            self.service.set_scheme(scheme)
+        if resilience is not None:
+            # Timed-out calls keep their thread until the socket gives up
+            self.service.set_socket_timeout(resilience.max_timeout)
+        self.executor_workers = executor_workers
+        self.executor = ThreadPoolExecutor(max_workers=self.executor_workers)
+        self._busy = 0
+        self._busy_lock = threading.Lock()
+    
+    async def _call_text2image(self, payload: dict) -> dict:
+        loop = asyncio.get_event_loop()
+        return await loop.run_in_executor(self.executor, self._call_text2image_sync, payload)
+    
+    def _call_text2image_sync(self, payload: dict) -> dict:
+        """Synchronous call to Volcengine text2image API"""
+        return self._cv_process_sync(payload)
+    
+    async def _call_image2image(self, payload: dict) -> dict:
+        loop = asyncio.get_event_loop()
+        return await loop.run_in_executor(self.executor, self._call_image2image_sync, payload)
+    
     def _call_image2image_sync(self, payload: dict) -> dict:
         """Synchronous call to Volcengine image2image API"""
+        return self._cv_process_sync(payload)
+    
+    def _cv_process_sync(self, payload: dict) -> dict:
+        # Counted on the executor thread, so timed-out calls still occupying one are included
+        with self._busy_lock:
+            self._busy += 1
         try:
-            response = self.service.cv_process(payload)
-            return response
-        except Exception as e:
-            return {"error": str(e)}
+            return self.service.cv_process(payload)
+        finally:
+            with self._busy_lock:
+                self._busy -= 1
+    
+    def utilization(self) -> Optional[float]:
+        return self._busy / self.executor_workers
     
     async def close(self):
         """Close executor"""
         self.executor.shutdown(wait=False)
 
 
+class AsyncVolcengineImageService(BaseVolcengineImageService):
+    """Service for the Volcengine Image Generation API over a native async HTTP client"""
+    
+    def __init__(
+        self,
+        access_key: str,
+        secret_key: str,
+        max_concurrency: int = 4,
+        rate_limiter: Optional[UpstreamRateLimiter] = None,
+        resilience: Optional[UpstreamResilience] = None,
+        **client_options,
+    ):
+        super().__init__(max_concurrency=max_concurrency, rate_limiter=rate_limiter, resilience=resilience)
+        self.client = AsyncVisualClient(access_key, secret_key, **client_options)
+        self.max_connections = client_options.get("max_connections", 200)
+        self._busy = 0
+    
+    async def _call_text2image(self, payload: dict) -> dict:
+        return await self._cv_process(payload)
+    
+    async def _call_image2image(self, payload: dict) -> dict:
+        return await self._cv_process(payload)
+    
+    async def _cv_process(self, payload: dict) -> dict:
+        self._busy += 1
+        try:
+            return await self.client.cv_process(payload)
+        finally:
+            self._busy -= 1
+    
+    def utilization(self) -> Optional[float]:
+        return self._busy / self.max_connections
+    
+    async def close(self):
+        """Close the pooled HTTP client"""
+        await self.client.aclose()
+
+
 class MockVolcengineImageService:
     """Mock service for testing without real API credentials"""
     
     def __init__(self, *args, **kwargs):
         pass
     
-    async def text_to_image(self, prompt: str, **kwargs) -> dict:
+    async def text_to_image(self, prompt: str, on_result: Optional[ResultCallback] = None, **kwargs) -> dict:
         """Mock text to image generation"""
         import random
         
-        await self._simulate_delay()
-        
         num_images = kwargs.get("num_images", 1)
         width = kwargs.get("width", 512)
         height = kwargs.get("height", 512)
         
-        images = []
-        for i in range(num_images):
+        async def generate_one(index: int) -> dict:
+            await self._simulate_delay()
             seed = kwargs.get("seed", random.randint(0, 999999))
             if seed is not None and seed >= 0:
-                seed = seed + i
+                seed = seed + index
             
             image_url = f"https://picsum.photos/seed/{seed}/{width}/{height}"
-            images.append({
+            result = {
                 "data": {
                     "image_urls": [image_url]
                 },
                 "code": 10000,
                 "message": "Success"
-            })
+            }
+            if on_result is not None:
+                await on_result(index, result)
+            return result
+        
+        images = await asyncio.gather(*(generate_one(i) for i in range(num_images)))
         
         return {
             "success": True,
-            "results": images,
+            "results": list(images),
             "count": len(images)
         }
     
@@ -220,6 +377,10 @@ class MockVolcengineImageService:
             }
         }
     
+    def utilization(self) -> Optional[float]:
+        """The mock has no transport to saturate"""
+        return None
+    
     async def _simulate_delay(self):
         """Simulate API processing time"""
         import random
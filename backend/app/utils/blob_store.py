@@ -0,0 +1,241 @@
+from __future__ import annotations
+
+import asyncio
+import logging
+import os
+import time
+from dataclasses import asdict, dataclass
+from pathlib import Path
+from typing import TYPE_CHECKING, Any, Dict, Iterable, List, NamedTuple, Optional, Tuple
+
+from .file_etags import ETagIndex
+from .image_files import FANOUT_DIR, IMAGE_EXTENSIONS, LOCAL_IMAGE_PREFIX
+from .metrics import STORAGE_BYTES, STORAGE_EVICTED_ITEMS, STORAGE_RECLAIMED_BYTES
+from .task_store import TaskStore
+
+if TYPE_CHECKING:
+    from ..services.thumbnails import ThumbnailService
+
+logger = logging.getLogger(__name__)
+
+# History entries fetched per round while evicting for the quota
+EVICTION_BATCH = 100
+
+
+class Blob(NamedTuple):
+    path: Path
+    size: int
+    mtime: float
+
+
+@dataclass
+class CollectionReport:
+    """Outcome of one garbage collection pass"""
+
+    finished_at: float
+    duration: float
+    images: int
+    bytes_used: int
+    evicted_items: int
+    removed_images: int
+    reclaimed_bytes: int
+
+
+class BlobStore:
+    """Garbage collection and disk quota for the images saved in ``root``.
+
+    Saved images are named by their content hash, so identical outputs are
+    stored once, and the task store counts the history entries showing each
+    one. Every ``interval`` seconds a pass scans ``root``; while the images
+    take more than ``quota_bytes`` and evicting can bring them under it, the
+    oldest history entries that are not favorites are evicted. It then
+    deletes the images no entry references.
+    Running tasks and the result cache point at images before any history
+    entry does, so unreferenced images younger than ``grace`` seconds are
+    kept, unless the quota eviction itself just released them. Passes
+    never overlap within a process; across processes sharing ``root`` they
+    only repeat each other's work.
+    """
+
+    def __init__(
+        self,
+        root: Path,
+        store: TaskStore,
+        quota_bytes: int = 0,
+        grace: float = 3600.0,
+        interval: float = 600.0,
+        thumbnails: Optional[ThumbnailService] = None,
+        etags: Optional[ETagIndex] = None,
+    ):
+        self.root = root
+        self.store = store
+        self.quota_bytes = quota_bytes
+        self.grace = grace
+        self.interval = interval
+        self.thumbnails = thumbnails
+        self.etags = etags
+        self.last_report: Optional[CollectionReport] = None
+        self._pass = asyncio.Lock()
+        self._loop: Optional[asyncio.Task] = None
+        self.reclaimed_bytes = 0
+        self.evicted_items = 0
+
+    async def start(self) -> None:
+        if self.interval > 0:
+            self._loop = asyncio.create_task(self._run(), name="blob-gc")
+
+    async def _run(self) -> None:
+        while True:
+            await asyncio.sleep(self.interval)
+            try:
+                await self.collect()
+            except asyncio.CancelledError:
+                raise
+            except Exception:
+                logger.exception("Image garbage collection failed")
+
+    async def collect(self) -> CollectionReport:
+        """Run one pass: enforce the quota, then delete unreferenced images"""
+        async with self._pass:
+            started = time.monotonic()
+            blobs, stale_partials = await asyncio.to_thread(self._scan, time.time() - self.grace)
+            used = sum(blob.size for blob in blobs.values())
+            evicted, released = 0, set()
+            if self.quota_bytes > 0 and used > self.quota_bytes:
+                evicted, released = await self._enforce_quota(blobs, used)
+
+            refs = await self.store.blob_refs(list(blobs))
+            cutoff = time.time() - self.grace
+            victims = [
+                image for image, blob in blobs.items()
+                if not refs.get(image) and (blob.mtime < cutoff or image in released)
+            ]
+            await asyncio.to_thread(self._remove, [blobs[image].path for image in victims] + stale_partials)
+            await self._forget(victims, blobs)
+
+            reclaimed = sum(blobs[image].size for image in victims)
+            report = CollectionReport(
+                finished_at=time.time(),
+                duration=round(time.monotonic() - started, 3),
+                images=len(blobs) - len(victims),
+                bytes_used=used - reclaimed,
+                evicted_items=evicted,
+                removed_images=len(victims),
+                reclaimed_bytes=reclaimed,
+            )
+        self.last_report = report
+        self.reclaimed_bytes += reclaimed
+        self.evicted_items += evicted
+        STORAGE_BYTES.set(report.bytes_used)
+        STORAGE_RECLAIMED_BYTES.inc(reclaimed)
+        STORAGE_EVICTED_ITEMS.inc(evicted)
+        if victims or evicted:
+            logger.info(
+                "Image GC removed %d images (%d bytes), evicted %d history entries; %d bytes in use",
+                len(victims), reclaimed, evicted, report.bytes_used,
+            )
+        return report
+
+    def _scan(self, partial_cutoff: float) -> Tuple[Dict[str, Blob], List[Path]]:
+        """Saved images by ``/images/`` URL, and temporary files abandoned before ``partial_cutoff``"""
+        blobs: Dict[str, Blob] = {}
+        stale_partials: List[Path] = []
+
+        def visit(directory: str) -> None:
+            with os.scandir(directory) as entries:
+                for entry in entries:
+                    if entry.is_dir(follow_symlinks=False):
+                        if directory == str(self.root) and FANOUT_DIR.match(entry.name):
+                            visit(entry.path)
+                        continue
+                    if not entry.is_file(follow_symlinks=False):
+                        continue
+                    stat = entry.stat(follow_symlinks=False)
+                    if entry.name.startswith("."):
+                        # Interrupted writes; live ones are seconds old
+                        if entry.name.endswith(".part") and stat.st_mtime < partial_cutoff:
+                            stale_partials.append(Path(entry.path))
+                        continue
+                    if os.path.splitext(entry.name)[1] not in IMAGE_EXTENSIONS:
+                        continue
+                    blobs[LOCAL_IMAGE_PREFIX + entry.name] = Blob(Path(entry.path), stat.st_size, stat.st_mtime)
+
+        if self.root.is_dir():
+            visit(str(self.root))
+        return blobs, stale_partials
+
+    async def _enforce_quota(self, blobs: Dict[str, Blob], used: int) -> Tuple[int, set]:
+        """Evict the oldest non-favorite history entries until their images free enough space.
+
+        An image is only freed once every entry showing it is gone, so images
+        of favorites stay, and so do unreferenced images within the grace
+        period. The eviction is planned before anything is deleted: when even
+        evicting every candidate cannot meet the quota, nothing is evicted,
+        and entries whose images would all stay are never evicted.
+
+        Returns the number of evicted entries and the images they showed.
+        """
+        refs = await self.store.blob_refs(list(blobs))
+        cutoff = time.time() - self.grace
+        # Unreferenced images past the grace period are deleted by this pass anyway
+        excess = used - self.quota_bytes - sum(
+            blob.size for image, blob in blobs.items() if not refs[image] and blob.mtime < cutoff
+        )
+        if excess <= 0:
+            return 0, set()
+        # Entries that would still show each image once the planned ones are evicted
+        remaining: Dict[str, int] = {}
+        released: set = set()
+        planned: List[Tuple[str, set]] = []
+        offset = 0
+        while excess > 0:
+            candidates = await self.store.evictable_history(EVICTION_BATCH, offset)
+            if not candidates:
+                break
+            offset += len(candidates)
+            for history in candidates:
+                images = {image for image in history.images if image in blobs}
+                planned.append((history.task_id, images))
+                for image in images:
+                    remaining[image] = remaining.get(image, refs[image]) - 1
+                    if remaining[image] == 0:
+                        released.add(image)
+                        excess -= blobs[image].size
+                if excess <= 0:
+                    break
+        if excess > 0:
+            logger.warning(
+                "Saved images exceed the %d byte quota, and evicting history could free %d bytes too few",
+                self.quota_bytes, excess,
+            )
+            return 0, set()
+        chosen = [task_id for task_id, images in planned if images & released]
+        removed = await self.store.delete_history(chosen)
+        return len(removed), released
+
+    @staticmethod
+    def _remove(paths: Iterable[Path]) -> None:
+        for path in paths:
+            path.unlink(missing_ok=True)
+
+    async def _forget(self, images: List[str], blobs: Dict[str, Blob]) -> None:
+        """Drop what other components cached about deleted images"""
+        if self.etags is not None:
+            for image in images:
+                self.etags.discard(blobs[image].path)
+        if self.thumbnails is not None and images:
+            await self.thumbnails.discard(image[len(LOCAL_IMAGE_PREFIX):] for image in images)
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "quota_bytes": self.quota_bytes,
+            "reclaimed_bytes": self.reclaimed_bytes,
+            "evicted_items": self.evicted_items,
+            "last_collection": asdict(self.last_report) if self.last_report is not None else None,
+        }
+
+    async def close(self) -> None:
+        if self._loop is not None:
+            self._loop.cancel()
+            await asyncio.gather(self._loop, return_exceptions=True)
+            self._loop = None
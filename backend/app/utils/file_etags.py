@@ -0,0 +1,103 @@
+from __future__ import annotations
+
+import asyncio
+import hashlib
+import os
+from collections import OrderedDict
+from dataclasses import dataclass
+from email.utils import formatdate, parsedate_to_datetime
+from pathlib import Path
+from typing import Optional
+
+CHUNK_SIZE = 256 * 1024
+
+
+@dataclass(frozen=True)
+class FileInfo:
+    """Validators of one immutable file"""
+
+    etag: str
+    size: int
+    mtime: float
+
+    @property
+    def last_modified(self) -> str:
+        return formatdate(self.mtime, usegmt=True)
+
+
+def etag_from_digest(digest: str) -> str:
+    """Strong ETag for a SHA-256 hex digest of the content"""
+    return f'"{digest[:32]}"'
+
+
+def _hash_file(path: Path) -> tuple[os.stat_result, str]:
+    digest = hashlib.sha256()
+    with open(path, "rb") as fh:
+        stat = os.fstat(fh.fileno())
+        for chunk in iter(lambda: fh.read(CHUNK_SIZE), b""):
+            digest.update(chunk)
+    return stat, digest.hexdigest()
+
+
+class ETagIndex:
+    """Strong, content-hash ETags of the immutable files served under ``/images``.
+
+    Generated images never change once written (their names are random), so
+    each file is hashed once: by the writer while it streams the file, or on
+    its first request otherwise. Conditional requests for a known file are
+    then answered from memory, without a ``stat`` or ``open``. Entries are
+    checked against the file's size and mtime whenever it is served in full,
+    and the ``max_entries`` most recently used files are kept.
+    """
+
+    def __init__(self, max_entries: int = 10000) -> None:
+        self.max_entries = max_entries
+        self._entries: "OrderedDict[str, FileInfo]" = OrderedDict()
+        self.hashed = 0
+
+    def get(self, path: Path) -> Optional[FileInfo]:
+        """Validators of ``path`` if known, without touching the disk"""
+        info = self._entries.get(str(path))
+        if info is not None:
+            self._entries.move_to_end(str(path))
+        return info
+
+    def record(self, path: Path, digest: str, stat: os.stat_result) -> FileInfo:
+        """Remember ``path`` as written with content hash ``digest``"""
+        info = FileInfo(etag_from_digest(digest), stat.st_size, stat.st_mtime)
+        self._entries[str(path)] = info
+        self._entries.move_to_end(str(path))
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+        return info
+
+    async def load(self, path: Path) -> tuple[FileInfo, os.stat_result]:
+        """Validators and ``stat`` of ``path``, hashing it if it is new or changed.
+
+        Raises ``FileNotFoundError`` (or another ``OSError``) if it cannot be read.
+        """
+        stat = await asyncio.to_thread(os.stat, path)
+        info = self.get(path)
+        if info is not None and info.size == stat.st_size and info.mtime == stat.st_mtime:
+            return info, stat
+        stat, digest = await asyncio.to_thread(_hash_file, path)
+        self.hashed += 1
+        return self.record(path, digest, stat), stat
+
+    def discard(self, path: Path) -> None:
+        self._entries.pop(str(path), None)
+
+
+def is_not_modified(if_none_match: Optional[str], if_modified_since: Optional[str], info: FileInfo) -> bool:
+    """Whether a conditional GET with these headers can be answered with 304"""
+    if if_none_match is not None:
+        # Weak comparison, as RFC 9110 prescribes for If-None-Match
+        tags = {tag.strip().removeprefix("W/") for tag in if_none_match.split(",")}
+        return "*" in tags or info.etag in tags
+    if if_modified_since is not None:
+        try:
+            since = parsedate_to_datetime(if_modified_since).timestamp()
+        except (TypeError, ValueError):
+            return False
+        return int(info.mtime) <= since
+    return False
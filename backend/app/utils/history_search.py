@@ -0,0 +1,148 @@
+from __future__ import annotations
+
+import base64
+import binascii
+import re
+from bisect import bisect_left, insort
+from dataclasses import dataclass
+from datetime import datetime
+from typing import Dict, Iterable, List, Optional, Set, Tuple
+
+from ..schemas import GenerationHistory
+
+# Han, kana and hangul are written without spaces, so each character is a
+# token of its own; other text is split into runs of letters and digits
+_CJK = "\u3040-\u30ff\u3400-\u4dbf\u4e00-\u9fff\uac00-\ud7af\uf900-\ufaff"
+_TOKEN = re.compile(rf"[{_CJK}]|[^\W_{_CJK}]+")
+
+# Keyset position: (created_at, task_id) of the last item of the previous page
+Cursor = Tuple[datetime, str]
+
+
+def tokenize(text: Optional[str]) -> List[str]:
+    """Lowercase search tokens of ``text``, in order, without duplicates"""
+    if not text:
+        return []
+    return list(dict.fromkeys(_TOKEN.findall(text.lower())))
+
+
+def prompt_tokens(prompt: str, negative_prompt: Optional[str]) -> List[str]:
+    return tokenize(f"{prompt} {negative_prompt or ''}")
+
+
+def history_tokens(history: GenerationHistory) -> List[str]:
+    return prompt_tokens(history.prompt, history.negative_prompt)
+
+
+def encode_cursor(history: GenerationHistory) -> str:
+    raw = f"{history.created_at.isoformat()}|{history.task_id}"
+    return base64.urlsafe_b64encode(raw.encode("utf-8")).decode("ascii").rstrip("=")
+
+
+def decode_cursor(cursor: str) -> Cursor:
+    """Raises ``ValueError`` for cursors this module did not produce"""
+    try:
+        raw = base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4)).decode("utf-8")
+        created_at, task_id = raw.split("|", 1)
+        return datetime.fromisoformat(created_at), task_id
+    except (binascii.Error, UnicodeDecodeError, ValueError) as e:
+        raise ValueError("Invalid cursor") from e
+
+
+@dataclass
+class HistoryQuery:
+    """Search over history: every term must prefix a word of the prompt or
+    negative prompt, and every filter that is set must hold. Results are
+    newest first, starting after ``cursor``.
+    """
+
+    text: str = ""
+    task_type: Optional[str] = None
+    style_preset: Optional[str] = None
+    favorite: Optional[bool] = None
+    width: Optional[int] = None
+    height: Optional[int] = None
+    created_after: Optional[datetime] = None
+    created_before: Optional[datetime] = None
+    cursor: Optional[Cursor] = None
+    limit: int = 20
+
+    @property
+    def terms(self) -> List[str]:
+        return tokenize(self.text)
+
+    @property
+    def parameter_filters(self) -> Dict[str, object]:
+        filters = {"style_preset": self.style_preset, "width": self.width, "height": self.height}
+        return {name: value for name, value in filters.items() if value is not None}
+
+    @property
+    def upper_bound(self) -> Optional[Cursor]:
+        """Results sort strictly below this ``(created_at, task_id)`` key"""
+        bounds = [bound for bound in (self.cursor, self.created_before and (self.created_before, "")) if bound]
+        return min(bounds) if bounds else None
+
+    def accepts(self, history: GenerationHistory) -> bool:
+        """Whether ``history`` passes the filters and the cursor (not the text terms)"""
+        if self.task_type is not None and history.type != self.task_type:
+            return False
+        if self.favorite is not None and history.favorite != self.favorite:
+            return False
+        for name, value in self.parameter_filters.items():
+            if history.parameters.get(name) != value:
+                return False
+        if self.created_after is not None and history.created_at < self.created_after:
+            return False
+        if self.created_before is not None and history.created_at >= self.created_before:
+            return False
+        return self.cursor is None or (history.created_at, history.task_id) < self.cursor
+
+
+class SearchIndex:
+    """Inverted index from prompt tokens to history task ids.
+
+    A sorted vocabulary lets a term match every token it prefixes with one
+    bisect. Entries are added and removed one at a time as history changes.
+    """
+
+    def __init__(self) -> None:
+        self._postings: Dict[str, Set[str]] = {}
+        self._vocabulary: List[str] = []
+
+    def add(self, history: GenerationHistory) -> None:
+        for token in history_tokens(history):
+            postings = self._postings.get(token)
+            if postings is None:
+                postings = self._postings[token] = set()
+                insort(self._vocabulary, token)
+            postings.add(history.task_id)
+
+    def remove(self, history: GenerationHistory) -> None:
+        for token in history_tokens(history):
+            postings = self._postings.get(token)
+            if postings is None:
+                continue
+            postings.discard(history.task_id)
+            if not postings:
+                del self._postings[token]
+                del self._vocabulary[bisect_left(self._vocabulary, token)]
+
+    def prefixed(self, term: str) -> Iterable[str]:
+        """Tokens starting with ``term``"""
+        for position in range(bisect_left(self._vocabulary, term), len(self._vocabulary)):
+            token = self._vocabulary[position]
+            if not token.startswith(term):
+                break
+            yield token
+
+    def match(self, terms: List[str]) -> Set[str]:
+        """Task ids whose text has a token starting with each of ``terms``"""
+        found: Optional[Set[str]] = None
+        for term in sorted(terms, key=len, reverse=True):
+            ids: Set[str] = set()
+            for token in self.prefixed(term):
+                ids |= self._postings[token]
+            found = ids if found is None else found & ids
+            if not found:
+                return set()
+        return found or set()
@@ -0,0 +1,241 @@
+from __future__ import annotations
+
+import asyncio
+import binascii
+import hashlib
+import os
+import re
+import struct
+from pathlib import Path
+from typing import BinaryIO, Iterator, Optional, Tuple, Union
+from uuid import uuid4
+
+LOCAL_IMAGE_PREFIX = "/images/"
+
+# Saved images are named by the SHA-256 of their content and fanned out over
+# sub-directories of OUTPUT_DIR by the first two hex digits. Images saved
+# before that keep their random names at the top level.
+_BLOB_NAME = re.compile(r"^[0-9a-f]{64}\.[a-z]+$")
+FANOUT_DIR = re.compile(r"^[0-9a-f]{2}$")
+
+# Base64 characters decoded per step; a multiple of 4 so slices stay aligned
+DECODE_CHUNK_CHARS = 256 * 1024
+
+_WHITESPACE = b" \t\r\n"
+_BASE64_PREFIX = re.compile(r"^[A-Za-z0-9+/=\s]+$")
+
+# (offset, signature, extension); checked in order against the first bytes
+_MAGIC_SIGNATURES = (
+    (0, b"\x89PNG\r\n\x1a\n", ".png"),
+    (0, b"\xff\xd8\xff", ".jpg"),
+    (0, b"GIF87a", ".gif"),
+    (0, b"GIF89a", ".gif"),
+    (8, b"WEBP", ".webp"),
+    (0, b"BM", ".bmp"),
+)
+SNIFF_BYTES = 16
+IMAGE_EXTENSIONS = frozenset(extension for _, _, extension in _MAGIC_SIGNATURES)
+
+# Start-of-frame markers carrying the JPEG dimensions
+_JPEG_SOF_MARKERS = {0xC0, 0xC1, 0xC2, 0xC3, 0xC5, 0xC6, 0xC7, 0xC9, 0xCA, 0xCB, 0xCD, 0xCE, 0xCF}
+
+Base64Data = Union[str, bytes, bytearray, memoryview]
+
+
+def sniff_image_extension(head: bytes) -> Optional[str]:
+    """File extension for the image format identified by its magic bytes"""
+    for offset, signature, extension in _MAGIC_SIGNATURES:
+        if head[offset:offset + len(signature)] == signature:
+            if extension == ".webp" and head[:4] != b"RIFF":
+                continue
+            return extension
+    return None
+
+
+def _payload_start(data: Base64Data) -> int:
+    """Offset of the base64 payload, skipping a ``data:...;base64,`` header"""
+    head = data[:128]
+    if isinstance(head, memoryview):
+        head = head.tobytes()
+    if isinstance(head, (bytes, bytearray)):
+        head = head.decode("ascii", errors="replace")
+    if head.startswith("data:"):
+        comma = head.find(",")
+        if comma != -1:
+            return comma + 1
+    return 0
+
+
+def looks_like_base64(data: Base64Data, sample: int = 4096) -> bool:
+    """Cheap check on a prefix of ``data``; full validation happens while decoding"""
+    start = _payload_start(data)
+    head = data[start:start + sample]
+    if isinstance(head, memoryview):
+        head = head.tobytes()
+    if isinstance(head, (bytes, bytearray)):
+        head = head.decode("ascii", errors="replace")
+    return bool(head.strip()) and bool(_BASE64_PREFIX.match(head))
+
+
+def iter_base64_chunks(data: Base64Data, chunk_chars: int = DECODE_CHUNK_CHARS) -> Iterator[bytes]:
+    """Validate and decode base64 in fixed-size slices.
+
+    ``str`` input is sliced per chunk and ``bytes`` input through a
+    ``memoryview``, so the payload is never copied or decoded as a whole.
+    Whitespace is ignored and missing padding is tolerated. Raises
+    ``binascii.Error`` on invalid characters.
+    """
+    view = memoryview(data).cast("B") if not isinstance(data, str) else data
+    chunk_chars -= chunk_chars % 4
+    carry = b""
+    for offset in range(_payload_start(data), len(view), chunk_chars):
+        piece = view[offset:offset + chunk_chars]
+        piece = piece.encode("ascii") if isinstance(piece, str) else piece.tobytes()
+        piece = piece.translate(None, _WHITESPACE)
+        if carry:
+            piece = carry + piece
+        usable = len(piece) - len(piece) % 4
+        carry = piece[usable:]
+        if usable:
+            yield binascii.a2b_base64(piece[:usable], strict_mode=True)
+    if carry:
+        if len(carry) == 1:
+            raise binascii.Error("Truncated base64 payload")
+        yield binascii.a2b_base64(carry + b"=" * (-len(carry) % 4), strict_mode=True)
+
+
+def blob_relpath(name: str) -> str:
+    """Path of the saved image ``name`` relative to OUTPUT_DIR"""
+    if _BLOB_NAME.match(name):
+        return f"{name[:2]}/{name}"
+    return name
+
+
+def blob_path(output_dir: Path, name: str) -> Path:
+    return output_dir / blob_relpath(name)
+
+
+def store_blob(output_dir: Path, partial: Path, name: str) -> Path:
+    """Move the fully written ``partial`` into place as ``name``.
+
+    ``name`` derives from the content, so an existing file already holds the
+    same bytes; the duplicate is dropped and the existing file's mtime is
+    refreshed, which restarts the garbage collector's grace period for it.
+    """
+    target = blob_path(output_dir, name)
+    if target.exists():
+        partial.unlink(missing_ok=True)
+        os.utime(target)
+    else:
+        target.parent.mkdir(exist_ok=True)
+        os.replace(partial, target)
+    return target
+
+
+def decode_base64_to_file(data: Base64Data, output_dir: Path) -> Optional[str]:
+    """Stream-decode an image into ``output_dir`` and return its file name.
+
+    The image is written to a temporary file and moved into place once it has
+    fully decoded, named by its content hash with the extension sniffed from
+    its magic bytes. Returns ``None`` for invalid base64 or payloads that are
+    not images.
+    """
+    partial = output_dir / f".{uuid4().hex}.part"
+    handle: Optional[BinaryIO] = None
+    extension: Optional[str] = None
+    head = b""
+    digest = hashlib.sha256()
+    try:
+        for chunk in iter_base64_chunks(data):
+            digest.update(chunk)
+            if extension is None:
+                head += chunk
+                if len(head) < SNIFF_BYTES:
+                    continue
+                extension = sniff_image_extension(head)
+                if extension is None:
+                    return None
+                handle = open(partial, "wb")
+                chunk, head = head, b""
+            handle.write(chunk)
+        if extension is None:
+            # Tiny payload: everything is still in ``head``
+            extension = sniff_image_extension(head)
+            if extension is None:
+                return None
+            handle = open(partial, "wb")
+            handle.write(head)
+        handle.close()
+        handle = None
+        return store_blob(output_dir, partial, digest.hexdigest() + extension).name
+    except (binascii.Error, ValueError):
+        return None
+    finally:
+        if handle is not None:
+            handle.close()
+        partial.unlink(missing_ok=True)
+
+
+async def save_base64_image(data: Base64Data, output_dir: Path) -> Optional[str]:
+    """Decode and save an image on a worker thread; returns its ``/images/`` path"""
+    filename = await asyncio.to_thread(decode_base64_to_file, data, output_dir)
+    return LOCAL_IMAGE_PREFIX + filename if filename else None
+
+
+def _jpeg_dimensions(handle: BinaryIO) -> Optional[Tuple[int, int]]:
+    """Walk JPEG segments up to the first start-of-frame marker"""
+    handle.seek(2)
+    while True:
+        marker = handle.read(2)
+        if len(marker) < 2 or marker[0] != 0xFF:
+            return None
+        code = marker[1]
+        while code == 0xFF:
+            code = handle.read(1)[0]
+        if code in (0xD8, 0x01) or 0xD0 <= code <= 0xD7:
+            continue
+        length = struct.unpack(">H", handle.read(2))[0]
+        if code in _JPEG_SOF_MARKERS:
+            height, width = struct.unpack(">xHH", handle.read(5))
+            return width, height
+        handle.seek(length - 2, os.SEEK_CUR)
+
+
+def read_image_dimensions(path: Path) -> Optional[Tuple[int, int]]:
+    """``(width, height)`` parsed from the image header, without decoding pixels"""
+    with open(path, "rb") as handle:
+        head = handle.read(32)
+        extension = sniff_image_extension(head)
+        try:
+            if extension == ".png" and head[12:16] == b"IHDR":
+                return struct.unpack(">II", head[16:24])
+            if extension == ".gif":
+                return struct.unpack("<HH", head[6:10])
+            if extension == ".bmp":
+                width, height = struct.unpack("<ii", head[18:26])
+                return width, abs(height)
+            if extension == ".webp":
+                chunk = head[12:16]
+                if chunk == b"VP8 ":
+                    width, height = struct.unpack("<HH", head[26:30])
+                    return width & 0x3FFF, height & 0x3FFF
+                if chunk == b"VP8L":
+                    bits = int.from_bytes(head[21:25], "little")
+                    return (bits & 0x3FFF) + 1, ((bits >> 14) & 0x3FFF) + 1
+                if chunk == b"VP8X":
+                    return int.from_bytes(head[24:27], "little") + 1, int.from_bytes(head[27:30], "little") + 1
+                return None
+            if extension == ".jpg":
+                return _jpeg_dimensions(handle)
+        except (struct.error, IndexError):
+            return None
+    return None
+
+
+def encode_file_base64(path: Path, chunk_size: int = 3 * 256 * 1024) -> str:
+    """Base64-encode a file in 3-byte aligned chunks"""
+    parts = []
+    with open(path, "rb") as handle:
+        while chunk := handle.read(chunk_size):
+            parts.append(binascii.b2a_base64(chunk, newline=False).decode("ascii"))
+    return "".join(parts)
@@ -0,0 +1,183 @@
+from __future__ import annotations
+
+import json
+import logging
+import os
+import threading
+import time
+from pathlib import Path
+from typing import Any, Awaitable, Dict, Iterable, List, Mapping, Optional, Tuple
+
+from ..schemas import GenerationHistory
+from .persistence import DERIVED_FIELDS, HistoryPersistence, atomic_write_text, load_history_file
+
+logger = logging.getLogger(__name__)
+
+FSYNC_ALWAYS = "always"
+FSYNC_INTERVAL = "interval"
+FSYNC_NEVER = "never"
+
+
+class HistoryJournal(HistoryPersistence):
+    """Append-only JSON Lines journal of history mutations.
+
+    Every ``put``/``delete`` appends a single record instead of rewriting the
+    whole history. The log is replayed on startup and compacted on the writer
+    thread once it grows past ``compact_threshold`` bytes; compaction writes a
+    fresh snapshot to a temp file and atomically renames it over the log.
+
+    A record torn by a crash is cut off the log on startup, so new records
+    start on a clean line. With the ``interval`` fsync policy a timer syncs
+    the last writes of a burst once ``fsync_interval`` has passed, even if
+    no further record arrives.
+    """
+
+    backend = "journal"
+
+    def __init__(
+        self,
+        journal_file: Path,
+        legacy_file: Optional[Path] = None,
+        fsync: str = FSYNC_INTERVAL,
+        fsync_interval: float = 1.0,
+        compact_threshold: int = 8 * 1024 * 1024,
+    ) -> None:
+        if fsync not in (FSYNC_ALWAYS, FSYNC_INTERVAL, FSYNC_NEVER):
+            raise ValueError(f"Unknown journal fsync policy: {fsync}")
+        super().__init__()
+        self.journal_file = journal_file
+        self.legacy_file = legacy_file
+        self.fsync = fsync
+        self.fsync_interval = fsync_interval
+        self.compact_threshold = compact_threshold
+        self._compact_at = compact_threshold
+        self._fh = None
+        self._size = 0
+        self._last_fsync = time.monotonic()
+        self._dirty = False
+        self._sync_timer: Optional[threading.Timer] = None
+
+    def load(self) -> List[GenerationHistory]:
+        self.journal_file.parent.mkdir(parents=True, exist_ok=True)
+        if not self.journal_file.exists():
+            items: List[GenerationHistory] = []
+            if self.legacy_file is not None and self.legacy_file.exists():
+                items = load_history_file(self.legacy_file)
+                logger.info("Importing %d history records from %s", len(items), self.legacy_file)
+            self._write_snapshot({item.task_id: item.model_dump(mode="json", exclude=DERIVED_FIELDS) for item in items})
+            self._open()
+            return items
+
+        records, valid_size = self._replay()
+        if valid_size < self.journal_file.stat().st_size:
+            # Drop the torn tail; appending after it would corrupt the next record too
+            with open(self.journal_file, "r+b") as fh:
+                fh.truncate(valid_size)
+                os.fsync(fh.fileno())
+        self._open()
+        return [GenerationHistory(**item) for item in records.values()]
+
+    def put(self, history: GenerationHistory, items: Mapping[str, GenerationHistory]) -> Awaitable[None]:
+        record = {"op": "put", "item": history.model_dump(mode="json", exclude=DERIVED_FIELDS)}
+        return self._submit(self._append, record)
+
+    def delete(self, task_ids: Iterable[str], items: Mapping[str, GenerationHistory]) -> Awaitable[None]:
+        record = {"op": "del", "task_ids": list(task_ids)}
+        return self._submit(self._append, record)
+
+    def _open(self) -> None:
+        self._fh = open(self.journal_file, "a", encoding="utf-8")
+        self._size = self.journal_file.stat().st_size
+        self._compact_at = max(self.compact_threshold, self._size * 2)
+
+    def _replay(self) -> Tuple[Dict[str, Dict[str, Any]], int]:
+        """Live records, and the size of the log up to the last complete record"""
+        records: Dict[str, Dict[str, Any]] = {}
+        valid_size = 0
+        with open(self.journal_file, "rb") as fh:
+            for line_no, line in enumerate(fh, start=1):
+                try:
+                    # Every record ends with a newline; a line without one was torn
+                    if not line.endswith(b"\n"):
+                        raise ValueError("missing newline")
+                    record = json.loads(line) if line.strip() else None
+                except ValueError:
+                    # A torn write can only be the tail of the log; stop replaying there
+                    logger.warning("Ignoring truncated journal record at %s:%d", self.journal_file, line_no)
+                    break
+                valid_size += len(line)
+                if record is None:
+                    continue
+                op = record.get("op")
+                if op == "put":
+                    item = record["item"]
+                    records[item["task_id"]] = item
+                elif op == "del":
+                    for task_id in record.get("task_ids", []):
+                        records.pop(task_id, None)
+        return records, valid_size
+
+    def _append(self, record: Dict[str, Any]) -> None:
+        line = json.dumps(record, ensure_ascii=False, separators=(",", ":")) + "\n"
+        self._fh.write(line)
+        self._fh.flush()
+        self._size += len(line.encode("utf-8"))
+        self._dirty = True
+        if self.fsync == FSYNC_ALWAYS:
+            self._sync()
+        elif self.fsync == FSYNC_INTERVAL:
+            elapsed = time.monotonic() - self._last_fsync
+            if elapsed >= self.fsync_interval:
+                self._sync()
+            elif self._sync_timer is None:
+                self._sync_timer = threading.Timer(self.fsync_interval - elapsed, self._schedule_sync)
+                self._sync_timer.daemon = True
+                self._sync_timer.start()
+        if self._size >= self._compact_at:
+            self._compact()
+
+    def _sync(self) -> None:
+        os.fsync(self._fh.fileno())
+        self._last_fsync = time.monotonic()
+        self._dirty = False
+
+    def _schedule_sync(self) -> None:
+        # Runs on the timer thread; the file is only touched on the writer thread
+        try:
+            self._writer.submit(self._sync_if_dirty)
+        except RuntimeError:
+            # Shut down meanwhile; closing synced already
+            pass
+
+    def _sync_if_dirty(self) -> None:
+        self._sync_timer = None
+        if self._dirty and self._fh is not None:
+            self._sync()
+
+    def _compact(self) -> None:
+        """Rewrite the log as one ``put`` per live record"""
+        self._fh.flush()
+        records, _ = self._replay()
+        self._fh.close()
+        self._write_snapshot(records)
+        self._open()
+        logger.info("Compacted history journal to %d records (%d bytes)", len(records), self._size)
+
+    def _write_snapshot(self, records: Dict[str, Dict[str, Any]]) -> None:
+        lines = [
+            json.dumps({"op": "put", "item": item}, ensure_ascii=False, separators=(",", ":")) + "\n"
+            for item in records.values()
+        ]
+        atomic_write_text(self.journal_file, "".join(lines), fsync=self.fsync != FSYNC_NEVER)
+
+    def _close_sync(self) -> None:
+        if self._sync_timer is not None:
+            self._sync_timer.cancel()
+            self._sync_timer = None
+        if self._fh is None:
+            return
+        self._fh.flush()
+        if self._dirty and self.fsync != FSYNC_NEVER:
+            self._sync()
+        self._fh.close()
+        self._fh = None
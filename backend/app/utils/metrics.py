@@ -0,0 +1,318 @@
+from __future__ import annotations
+
+import asyncio
+import math
+import re
+import time
+from bisect import bisect_left
+from typing import Callable, Dict, Iterator, List, Optional, Sequence, Tuple
+
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+# Seconds; generation calls take several seconds, lock and disk waits far less
+DEFAULT_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 20.0, 30.0, 60.0, 120.0)
+
+
+def _format_value(value: float) -> str:
+    if value == math.inf:
+        return "+Inf"
+    if value == int(value) and abs(value) < 1e15:
+        return str(int(value))
+    return repr(float(value))
+
+
+def _escape(value: str) -> str:
+    return value.replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _label_text(names: Sequence[str], values: Sequence[str]) -> str:
+    return ",".join(f'{name}="{_escape(value)}"' for name, value in zip(names, values))
+
+
+class CounterChild:
+    __slots__ = ("value",)
+
+    def __init__(self) -> None:
+        self.value = 0.0
+
+    def inc(self, amount: float = 1.0) -> None:
+        self.value += amount
+
+
+class GaugeChild:
+    __slots__ = ("value", "function")
+
+    def __init__(self) -> None:
+        self.value = 0.0
+        self.function: Optional[Callable[[], Optional[float]]] = None
+
+    def set(self, value: float) -> None:
+        self.value = value
+
+    def inc(self, amount: float = 1.0) -> None:
+        self.value += amount
+
+    def dec(self, amount: float = 1.0) -> None:
+        self.value -= amount
+
+    def set_function(self, function: Callable[[], Optional[float]]) -> None:
+        """Read the value from ``function`` at scrape time; ``None`` omits the sample"""
+        self.function = function
+
+    def get(self) -> Optional[float]:
+        return self.function() if self.function is not None else self.value
+
+
+class HistogramChild:
+    __slots__ = ("bounds", "counts", "sum")
+
+    def __init__(self, bounds: Tuple[float, ...]) -> None:
+        self.bounds = bounds
+        self.counts = [0] * len(bounds)
+        self.sum = 0.0
+
+    def observe(self, value: float) -> None:
+        self.counts[bisect_left(self.bounds, value)] += 1
+        self.sum += value
+
+
+class Metric:
+    """A named metric and its children, one per combination of label values"""
+
+    kind = ""
+
+    def __init__(self, name: str, documentation: str, labelnames: Sequence[str] = (), registry: Optional["Registry"] = None) -> None:
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._children: Dict[Tuple[str, ...], object] = {}
+        if not self.labelnames:
+            self._children[()] = self._new_child()
+        (registry if registry is not None else REGISTRY).register(self)
+
+    def _new_child(self):
+        raise NotImplementedError
+
+    def labels(self, *values: str):
+        """The child for ``values``; bind it once outside hot paths"""
+        child = self._children.get(values)
+        if child is None:
+            if len(values) != len(self.labelnames):
+                raise ValueError(f"{self.name} expects labels {self.labelnames}")
+            child = self._children[values] = self._new_child()
+        return child
+
+    def _render(self) -> Iterator[str]:
+        raise NotImplementedError
+
+    def render(self) -> Iterator[str]:
+        yield f"# HELP {self.name} {self.documentation}"
+        yield f"# TYPE {self.name} {self.kind}"
+        yield from self._render()
+
+    def _sample(self, suffix: str, values: Tuple[str, ...], value: float, extra: str = "") -> str:
+        labels = _label_text(self.labelnames, values)
+        if extra:
+            labels = f"{labels},{extra}" if labels else extra
+        return f"{self.name}{suffix}{{{labels}}} {_format_value(value)}" if labels else f"{self.name}{suffix} {_format_value(value)}"
+
+
+class Counter(Metric):
+    kind = "counter"
+
+    def _new_child(self) -> CounterChild:
+        return CounterChild()
+
+    def inc(self, amount: float = 1.0) -> None:
+        self._children[()].inc(amount)
+
+    def _render(self) -> Iterator[str]:
+        for values, child in list(self._children.items()):
+            yield self._sample("", values, child.value)
+
+
+class Gauge(Metric):
+    kind = "gauge"
+
+    def _new_child(self) -> GaugeChild:
+        return GaugeChild()
+
+    def set(self, value: float) -> None:
+        self._children[()].set(value)
+
+    def set_function(self, function: Callable[[], Optional[float]]) -> None:
+        self._children[()].set_function(function)
+
+    def _render(self) -> Iterator[str]:
+        for values, child in list(self._children.items()):
+            value = child.get()
+            if value is not None:
+                yield self._sample("", values, value)
+
+
+class Histogram(Metric):
+    kind = "histogram"
+
+    def __init__(
+        self,
+        name: str,
+        documentation: str,
+        labelnames: Sequence[str] = (),
+        buckets: Sequence[float] = DEFAULT_BUCKETS,
+        registry: Optional["Registry"] = None,
+    ) -> None:
+        bounds = sorted(set(float(bound) for bound in buckets))
+        if bounds[-1] != math.inf:
+            bounds.append(math.inf)
+        self.bounds = tuple(bounds)
+        super().__init__(name, documentation, labelnames, registry)
+
+    def _new_child(self) -> HistogramChild:
+        return HistogramChild(self.bounds)
+
+    def observe(self, value: float) -> None:
+        self._children[()].observe(value)
+
+    def _render(self) -> Iterator[str]:
+        for values, child in list(self._children.items()):
+            cumulative = 0
+            for bound, count in zip(self.bounds, child.counts):
+                cumulative += count
+                yield self._sample("_bucket", values, cumulative, f'le="{_format_value(bound)}"')
+            yield self._sample("_sum", values, child.sum)
+            yield self._sample("_count", values, cumulative)
+
+
+class Registry:
+    """In-process metrics, rendered for Prometheus at ``/metrics``.
+
+    Collectors are plain counters and fixed-bucket histograms updated in
+    place; label children are created once and cached, so instrumented hot
+    paths only bump numbers. Gauges of live objects are read through
+    callbacks at scrape time. Values are per process: with several uvicorn
+    workers each one reports its own.
+    """
+
+    def __init__(self) -> None:
+        self._metrics: Dict[str, Metric] = {}
+
+    def register(self, metric: Metric) -> None:
+        if metric.name in self._metrics:
+            raise ValueError(f"Metric {metric.name} is already registered")
+        self._metrics[metric.name] = metric
+
+    def render(self) -> str:
+        """All metrics in the Prometheus text exposition format"""
+        lines: List[str] = []
+        for metric in list(self._metrics.values()):
+            lines.extend(metric.render())
+        return "\n".join(lines) + "\n"
+
+
+REGISTRY = Registry()
+
+
+class InstrumentedLock(asyncio.Lock):
+    """``asyncio.Lock`` that records how long callers wait for it and hold it"""
+
+    def __init__(self, wait: HistogramChild, hold: HistogramChild) -> None:
+        super().__init__()
+        self._wait = wait
+        self._hold = hold
+        self._acquired_at = 0.0
+
+    async def acquire(self) -> bool:
+        started = time.perf_counter()
+        await super().acquire()
+        self._acquired_at = time.perf_counter()
+        self._wait.observe(self._acquired_at - started)
+        return True
+
+    def release(self) -> None:
+        self._hold.observe(time.perf_counter() - self._acquired_at)
+        super().release()
+
+
+UPSTREAM_LATENCY = Histogram(
+    "imagegen_upstream_request_seconds",
+    "Latency of single upstream API calls, including failed attempts",
+    ["req_key"],
+)
+QUEUE_WAIT = Histogram(
+    "imagegen_queue_wait_seconds",
+    "Time generation jobs wait in the scheduler queue before a worker starts them",
+    ["queue"],
+)
+TASK_DURATION = Histogram(
+    "imagegen_task_duration_seconds",
+    "End-to-end task duration from creation to completion or failure",
+    ["type", "status"],
+)
+TASK_STORE_LOCK_WAIT = Histogram(
+    "imagegen_task_store_lock_wait_seconds",
+    "Time spent waiting to acquire the task store lock",
+)
+TASK_STORE_LOCK_HOLD = Histogram(
+    "imagegen_task_store_lock_hold_seconds",
+    "Time the task store lock is held",
+)
+PERSISTENCE_LATENCY = Histogram(
+    "imagegen_history_persistence_seconds",
+    "Time the history writer thread spends per persistence operation",
+    ["backend"],
+)
+TASK_OUTCOMES = Counter(
+    "imagegen_tasks_total",
+    "Finished tasks by type, final status and error class",
+    ["type", "status", "error_class"],
+)
+TASKS_IN_FLIGHT = Gauge("imagegen_tasks_in_flight", "Generation jobs currently running in this process")
+QUEUE_DEPTH = Gauge("imagegen_queue_depth", "Generation jobs waiting to start")
+STORAGE_BYTES = Gauge("imagegen_storage_bytes", "Bytes of saved images in OUTPUT_DIR at the last garbage collection")
+STORAGE_RECLAIMED_BYTES = Counter(
+    "imagegen_storage_reclaimed_bytes_total",
+    "Bytes of unreferenced saved images deleted by the garbage collector",
+)
+STORAGE_EVICTED_ITEMS = Counter(
+    "imagegen_storage_evicted_items_total",
+    "History entries evicted to keep saved images under the disk quota",
+)
+EXECUTOR_UTILIZATION = Gauge(
+    "imagegen_executor_utilization",
+    "Share of the upstream transport's threads or connections in use",
+    ["executor"],
+)
+
+_UPSTREAM_CODE = re.compile(r"\(code (\d+)\)")
+_RATE_LIMIT_CODES = {"50429", "50430"}
+
+
+def error_class(error: Optional[str]) -> str:
+    """Coarse, low-cardinality class of a task's error message"""
+    if not error:
+        return "none"
+    match = _UPSTREAM_CODE.search(error)
+    if match:
+        code = match.group(1)
+        if code in _RATE_LIMIT_CODES:
+            return "rate_limited"
+        return "upstream_rejected" if code.startswith("504") else "upstream_error"
+    if "timed out" in error:
+        return "timeout"
+    if error.startswith("Upstream ") and "unavailable" in error:
+        return "circuit_open"
+    if error.startswith("Internal error"):
+        return "internal"
+    if error.startswith("Generation queue is full"):
+        return "queue_full"
+    return "other"
+
+
+def record_task_finished(task) -> None:
+    """Count a finished task and observe its end-to-end duration"""
+    status = task.status.value
+    TASK_OUTCOMES.labels(task.type, status, error_class(task.error)).inc()
+    if task.completed_at is not None:
+        TASK_DURATION.labels(task.type, status).observe(
+            max(0.0, (task.completed_at - task.created_at).total_seconds())
+        )
@@ -0,0 +1,124 @@
+from __future__ import annotations
+
+import asyncio
+import json
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+from typing import Any, Awaitable, Callable, Iterable, List, Mapping
+
+from ..schemas import GenerationHistory
+from .metrics import PERSISTENCE_LATENCY
+
+# History fields derived per response (from ``images``) and never stored
+DERIVED_FIELDS = {"thumbnails"}
+
+
+def atomic_write_text(path: Path, text: str, fsync: bool = True) -> None:
+    """Write ``text`` to a sibling temp file and rename it over ``path``"""
+    tmp_path = path.with_name(f".{path.name}.tmp")
+    with open(tmp_path, "w", encoding="utf-8") as fh:
+        fh.write(text)
+        fh.flush()
+        if fsync:
+            os.fsync(fh.fileno())
+    os.replace(tmp_path, path)
+    if fsync:
+        fsync_dir(path.parent)
+
+
+def fsync_dir(directory: Path) -> None:
+    """Make a rename durable by syncing the containing directory"""
+    try:
+        fd = os.open(directory, os.O_RDONLY)
+    except OSError:
+        return
+    try:
+        os.fsync(fd)
+    except OSError:
+        pass
+    finally:
+        os.close(fd)
+
+
+class HistoryPersistence:
+    """Durable storage for generation history.
+
+    Mutations are executed in order on a single writer thread. They return an
+    awaitable so the store can release its lock before waiting for the disk.
+    """
+
+    # Label of this engine's imagegen_history_persistence_seconds metric
+    backend = "none"
+
+    def __init__(self) -> None:
+        self._writer = ThreadPoolExecutor(max_workers=1, thread_name_prefix="history-writer")
+        self._latency = PERSISTENCE_LATENCY.labels(self.backend)
+
+    def load(self) -> List[GenerationHistory]:
+        raise NotImplementedError
+
+    def put(self, history: GenerationHistory, items: Mapping[str, GenerationHistory]) -> Awaitable[None]:
+        """Persist a new or changed history record"""
+        raise NotImplementedError
+
+    def delete(self, task_ids: Iterable[str], items: Mapping[str, GenerationHistory]) -> Awaitable[None]:
+        """Persist the removal of history records"""
+        raise NotImplementedError
+
+    def _submit(self, func: Callable[..., Any], *args: Any) -> Awaitable[None]:
+        return asyncio.get_running_loop().run_in_executor(self._writer, self._timed, func, *args)
+
+    def _timed(self, func: Callable[..., Any], *args: Any) -> Any:
+        started = time.perf_counter()
+        try:
+            return func(*args)
+        finally:
+            self._latency.observe(time.perf_counter() - started)
+
+    async def close(self) -> None:
+        await asyncio.get_running_loop().run_in_executor(self._writer, self._close_sync)
+        self._writer.shutdown(wait=True)
+
+    def _close_sync(self) -> None:
+        pass
+
+
+class JsonHistoryFile(HistoryPersistence):
+    """Legacy persistence that rewrites the whole ``history.json`` on every change"""
+
+    backend = "json"
+
+    def __init__(self, history_file: Path) -> None:
+        super().__init__()
+        self.history_file = history_file
+
+    def load(self) -> List[GenerationHistory]:
+        if not self.history_file.exists():
+            self.history_file.parent.mkdir(parents=True, exist_ok=True)
+            self.history_file.write_text(json.dumps({"items": []}, ensure_ascii=False, indent=2), encoding="utf-8")
+        return load_history_file(self.history_file)
+
+    def put(self, history: GenerationHistory, items: Mapping[str, GenerationHistory]) -> Awaitable[None]:
+        return self._submit(self._dump, self._snapshot(items))
+
+    def delete(self, task_ids: Iterable[str], items: Mapping[str, GenerationHistory]) -> Awaitable[None]:
+        return self._submit(self._dump, self._snapshot(items))
+
+    @staticmethod
+    def _snapshot(items: Mapping[str, GenerationHistory]) -> List[dict]:
+        return [history.model_dump(mode="json", exclude=DERIVED_FIELDS) for history in items.values()]
+
+    def _dump(self, snapshot: List[dict]) -> None:
+        data = {"items": snapshot}
+        atomic_write_text(self.history_file, json.dumps(data, ensure_ascii=False, indent=2), fsync=False)
+
+
+def load_history_file(history_file: Path) -> List[GenerationHistory]:
+    """Read a legacy ``history.json`` file, ignoring it if it is corrupt"""
+    try:
+        data = json.loads(history_file.read_text(encoding="utf-8"))
+    except (OSError, json.JSONDecodeError):
+        return []
+    return [GenerationHistory(**item) for item in data.get("items", [])]
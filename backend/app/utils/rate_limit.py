@@ -0,0 +1,182 @@
+from __future__ import annotations
+
+import asyncio
+import math
+import time
+from dataclasses import dataclass
+from typing import Dict, Optional, Tuple
+
+try:
+    import redis.asyncio as aioredis
+    REDIS_AVAILABLE = True
+except ImportError:
+    REDIS_AVAILABLE = False
+
+
+@dataclass
+class RateLimitResult:
+    """Outcome of taking tokens from a bucket"""
+
+    allowed: bool
+    limit: int
+    remaining: int
+    retry_after: float  # Seconds until the requested tokens are available
+    reset_after: float  # Seconds until the bucket is full again
+
+
+class RateLimitBackend:
+    """Token bucket storage. Buckets are identified by key and refill continuously."""
+
+    async def take(self, key: str, capacity: int, rate: float, tokens: int = 1) -> RateLimitResult:
+        raise NotImplementedError
+
+    async def close(self) -> None:
+        pass
+
+
+def _bucket_result(allowed: bool, level: float, capacity: int, rate: float, tokens: int) -> RateLimitResult:
+    deficit = 0.0 if allowed else tokens - level
+    return RateLimitResult(
+        allowed=allowed,
+        limit=capacity,
+        remaining=max(int(level), 0),
+        retry_after=deficit / rate if rate > 0 else math.inf,
+        reset_after=(capacity - level) / rate if rate > 0 else 0.0,
+    )
+
+
+class InMemoryRateLimitBackend(RateLimitBackend):
+    """Per-process buckets; limits only hold within a single worker.
+
+    A full bucket behaves like a missing one, so every ``sweep_interval``
+    seconds the buckets that have refilled since their last use are dropped;
+    memory follows the clients active within a refill period.
+    """
+
+    def __init__(self, sweep_interval: float = 60.0) -> None:
+        # key -> (level, updated, time the bucket is full again)
+        self._buckets: Dict[str, Tuple[float, float, float]] = {}
+        self.sweep_interval = sweep_interval
+        self._next_sweep = time.monotonic() + sweep_interval
+
+    async def take(self, key: str, capacity: int, rate: float, tokens: int = 1) -> RateLimitResult:
+        now = time.monotonic()
+        if now >= self._next_sweep:
+            self._sweep(now)
+        level, updated, _ = self._buckets.get(key, (float(capacity), now, now))
+        level = min(float(capacity), level + (now - updated) * rate)
+        allowed = level >= tokens
+        if allowed:
+            level -= tokens
+        full_at = now + (capacity - level) / rate if rate > 0 else (now if level >= capacity else math.inf)
+        self._buckets[key] = (level, now, full_at)
+        return _bucket_result(allowed, level, capacity, rate, tokens)
+
+    def _sweep(self, now: float) -> None:
+        self._buckets = {key: bucket for key, bucket in self._buckets.items() if bucket[2] > now}
+        self._next_sweep = now + self.sweep_interval
+
+    def __len__(self) -> int:
+        return len(self._buckets)
+
+
+# KEYS[1] bucket; ARGV: capacity, rate, now, tokens. Returns {allowed, level}.
+_TOKEN_BUCKET_SCRIPT = """
+local capacity = tonumber(ARGV[1])
+local rate = tonumber(ARGV[2])
+local now = tonumber(ARGV[3])
+local requested = tonumber(ARGV[4])
+local state = redis.call('HMGET', KEYS[1], 'level', 'ts')
+local level = tonumber(state[1]) or capacity
+local ts = tonumber(state[2]) or now
+level = math.min(capacity, level + math.max(0, now - ts) * rate)
+local allowed = 0
+if level >= requested then
+    level = level - requested
+    allowed = 1
+end
+redis.call('HSET', KEYS[1], 'level', tostring(level), 'ts', tostring(now))
+if rate > 0 then
+    redis.call('PEXPIRE', KEYS[1], math.ceil(capacity / rate * 1000) + 1000)
+end
+return {allowed, tostring(level)}
+"""
+
+
+class RedisRateLimitBackend(RateLimitBackend):
+    """Buckets in Redis, updated atomically by a Lua script so limits hold across workers"""
+
+    def __init__(self, url: str, prefix: str = "ratelimit:", client=None) -> None:
+        if client is None:
+            if not REDIS_AVAILABLE:
+                raise ImportError("redis package not installed")
+            client = aioredis.from_url(url)
+        self._client = client
+        self._prefix = prefix
+        self._script = client.register_script(_TOKEN_BUCKET_SCRIPT)
+
+    async def take(self, key: str, capacity: int, rate: float, tokens: int = 1) -> RateLimitResult:
+        allowed, level = await self._script(
+            keys=[self._prefix + key],
+            args=[capacity, rate, time.time(), tokens],
+        )
+        return _bucket_result(bool(int(allowed)), float(level), capacity, rate, tokens)
+
+    async def close(self) -> None:
+        await self._client.aclose()
+
+
+class RateLimiter:
+    """Token-bucket limiter: ``per_minute`` requests with bursts up to ``burst``"""
+
+    def __init__(self, backend: RateLimitBackend, per_minute: float, burst: Optional[int] = None, prefix: str = "") -> None:
+        self.backend = backend
+        self.capacity = burst or max(int(per_minute), 1)
+        self.rate = per_minute / 60.0
+        self.prefix = prefix
+
+    async def hit(self, key: str, tokens: int = 1) -> RateLimitResult:
+        return await self.backend.take(self.prefix + key, self.capacity, self.rate, tokens)
+
+    async def peek(self, key: str) -> RateLimitResult:
+        """Report the remaining budget without consuming it"""
+        return await self.backend.take(self.prefix + key, self.capacity, self.rate, 0)
+
+
+class UpstreamRateLimiter:
+    """Shared limiter in front of the upstream API with one bucket per ``req_key``.
+
+    Unlike client limits, callers wait for a token instead of being rejected.
+    """
+
+    def __init__(
+        self,
+        backend: RateLimitBackend,
+        qps: float,
+        burst: int,
+        overrides: Optional[Dict[str, float]] = None,
+    ) -> None:
+        self.backend = backend
+        self.qps = qps
+        self.burst = burst
+        self.overrides = overrides or {}
+
+    def _bucket(self, req_key: str) -> Tuple[str, int, float]:
+        qps = self.overrides.get(req_key, self.qps)
+        return f"upstream:{req_key}", max(self.burst, 1), qps
+
+    async def acquire(self, req_key: str) -> None:
+        key, capacity, rate = self._bucket(req_key)
+        if rate <= 0:
+            return
+        while True:
+            result = await self.backend.take(key, capacity, rate)
+            if result.allowed:
+                return
+            await asyncio.sleep(result.retry_after)
+
+    async def remaining(self, req_key: str) -> int:
+        key, capacity, rate = self._bucket(req_key)
+        if rate <= 0:
+            return capacity
+        return (await self.backend.take(key, capacity, rate, 0)).remaining
@@ -0,0 +1,632 @@
+from __future__ import annotations
+
+import asyncio
+import json
+import logging
+from datetime import datetime, timezone
+from pathlib import Path
+from typing import Any, AsyncIterator, Awaitable, Dict, List, Optional
+from uuid import uuid4
+
+from ..schemas import GenerationHistory, TaskStatus
+from . import tracing
+from .history_search import HistoryQuery, prompt_tokens
+from .metrics import record_task_finished
+from .persistence import HistoryPersistence
+from .task_store import BatchRecord, TaskRecord, TaskStore
+
+try:
+    import redis.asyncio as aioredis
+    REDIS_AVAILABLE = True
+except ImportError:
+    REDIS_AVAILABLE = False
+
+logger = logging.getLogger(__name__)
+
+TERMINAL_STATUSES = (TaskStatus.COMPLETED, TaskStatus.FAILED)
+
+# Fields of a task hash besides the TaskRecord ones, set once it enters history
+_HISTORY_FIELDS = ("history_id", "history_at", "favorite")
+# Prompt tokens of a task, written at creation and indexed once it enters history
+_SEARCH_FIELD = "search_tokens"
+
+# Every key a script touches is passed in KEYS rather than built inside the
+# script, so Redis knows which keys each call reads and writes. Scripts that
+# write history get the shared keys first:
+#   KEYS[1] <prefix>blob_refs, counting the history entries showing each local image
+#   KEYS[2] <prefix>search_vocabulary, the tokens of every <prefix>search:<token>
+#           set, for prefix lookups
+#   KEYS[3] <prefix>favorites and KEYS[4] <prefix>evictable, splitting history
+#           (trimming evicts from the latter), both scored like history
+#   KEYS[5] <prefix>history:* and KEYS[6] <prefix>tasks:*:*
+# followed by the keys of each task they change, as listed by
+# ``RedisTaskStore._task_keys``: its hash, history:<type>, tasks:*:<type>,
+# tasks:<status>:*, tasks:<status>:<type>, then its search postings in the
+# order of its search_tokens. Those depend on the task's status, so scripts
+# check it is still the one the keys were chosen for.
+_LUA_HELPERS = """
+local function count_refs(task, delta)
+    local seen = {}
+    for _, image in ipairs(cjson.decode(redis.call('HGET', task, 'images'))) do
+        if not seen[image] and string.sub(image, 1, 8) == '/images/' then
+            seen[image] = true
+            if redis.call('HINCRBY', KEYS[1], image, delta) <= 0 then
+                redis.call('HDEL', KEYS[1], image)
+            end
+        end
+    end
+end
+local function index_search(task, first, id, add)
+    local tokens = redis.call('HGET', task, 'search_tokens')
+    if not tokens then
+        return
+    end
+    for i, token in ipairs(cjson.decode(tokens)) do
+        local postings = KEYS[first + i - 1]
+        if add then
+            redis.call('SADD', postings, id)
+            redis.call('ZADD', KEYS[2], 0, token)
+        elseif redis.call('SREM', postings, id) == 1 and redis.call('EXISTS', postings) == 0 then
+            redis.call('ZREM', KEYS[2], token)
+        end
+    end
+end
+local function remove_task(base, id)
+    local task = KEYS[base]
+    if redis.call('HEXISTS', task, 'history_id') == 1 then
+        count_refs(task, -1)
+        index_search(task, base + 5, id, false)
+        redis.call('ZREM', KEYS[3], id)
+        redis.call('ZREM', KEYS[4], id)
+    end
+    redis.call('ZREM', KEYS[5], id)
+    redis.call('ZREM', KEYS[6], id)
+    for i = base + 1, base + 4 do
+        redis.call('ZREM', KEYS[i], id)
+    end
+    redis.call('DEL', task)
+end
+"""
+
+# KEYS: shared keys, the task's keys up to tasks:<status>:<type> (KEYS[7] to
+# KEYS[11]), tasks:<new status>:* and tasks:<new status>:<type>, then its
+# search postings. ARGV: current status, JSON {field: encoded value}, new
+# status or '', history fields JSON or '', history score, max history size,
+# events channel. Moves the task between status indexes, records it in
+# history and publishes the new state. Returns {1, task hash, number of
+# history entries over the limit}, {0} if the status changed meanwhile, or nil.
+_UPDATE_SCRIPT = _LUA_HELPERS + """
+local task = KEYS[7]
+if redis.call('EXISTS', task) == 0 then
+    return nil
+end
+local current = cjson.decode(redis.call('HGET', task, 'status'))
+if current ~= ARGV[1] then
+    return {0}
+end
+local id = cjson.decode(redis.call('HGET', task, 'id'))
+local status = ARGV[3]
+if status ~= '' and status ~= current then
+    local score = redis.call('ZSCORE', KEYS[6], id)
+    redis.call('ZREM', KEYS[10], id)
+    redis.call('ZREM', KEYS[11], id)
+    redis.call('ZADD', KEYS[12], score, id)
+    redis.call('ZADD', KEYS[13], score, id)
+end
+local in_history = redis.call('HEXISTS', task, 'history_id') == 1
+if in_history then
+    count_refs(task, -1)
+end
+for field, value in pairs(cjson.decode(ARGV[2])) do
+    redis.call('HSET', task, field, value)
+end
+if ARGV[4] ~= '' then
+    for field, value in pairs(cjson.decode(ARGV[4])) do
+        redis.call('HSET', task, field, value)
+    end
+    in_history = true
+end
+if in_history then
+    count_refs(task, 1)
+end
+local overflow = 0
+if ARGV[4] ~= '' then
+    redis.call('ZADD', KEYS[5], ARGV[5], id)
+    redis.call('ZADD', KEYS[8], ARGV[5], id)
+    redis.call('ZADD', KEYS[4], ARGV[5], id)
+    index_search(task, 14, id, true)
+    overflow = redis.call('ZCARD', KEYS[5]) - tonumber(ARGV[6])
+end
+local state = redis.call('HGETALL', task)
+redis.call('PUBLISH', ARGV[7], cjson.encode(state))
+return {1, state, overflow}
+"""
+
+# KEYS: task hash, <prefix>history:*, <prefix>favorites, <prefix>evictable.
+# ARGV: encoded favorite flag. Only touches tasks in history.
+_FAVORITE_SCRIPT = """
+if redis.call('HEXISTS', KEYS[1], 'history_id') == 0 then
+    return nil
+end
+local id = cjson.decode(redis.call('HGET', KEYS[1], 'id'))
+local score = redis.call('ZSCORE', KEYS[2], id)
+redis.call('HSET', KEYS[1], 'favorite', ARGV[1])
+if cjson.decode(ARGV[1]) then
+    redis.call('ZADD', KEYS[3], score, id)
+    redis.call('ZREM', KEYS[4], id)
+else
+    redis.call('ZREM', KEYS[3], id)
+    redis.call('ZADD', KEYS[4], score, id)
+end
+return redis.call('HGETALL', KEYS[1])
+"""
+
+# KEYS: shared keys, then the keys of each task in turn. ARGV: history size
+# to trim down to, or '' to remove every listed task that is in history; then
+# (id, status, number of search postings) per task. When trimming, only
+# evictable entries are removed, and only while history is over that size.
+# Returns {removed task hashes, ids whose status changed meanwhile}.
+_DELETE_SCRIPT = _LUA_HELPERS + """
+local removed, stale = {}, {}
+local base = 7
+for i = 2, #ARGV, 3 do
+    local id, task = ARGV[i], KEYS[base]
+    if ARGV[1] ~= '' then
+        if redis.call('ZCARD', KEYS[5]) <= tonumber(ARGV[1]) then
+            break
+        end
+        if not redis.call('ZSCORE', KEYS[4], id) then
+            id = nil
+        end
+    end
+    if id and redis.call('HEXISTS', task, 'history_id') == 1 then
+        if cjson.decode(redis.call('HGET', task, 'status')) ~= ARGV[i + 1] then
+            table.insert(stale, id)
+        else
+            table.insert(removed, redis.call('HGETALL', task))
+            remove_task(base, id)
+        end
+    end
+    base = base + 5 + tonumber(ARGV[i + 2])
+end
+return {removed, stale}
+"""
+
+
+def _score(moment: datetime) -> float:
+    # Stored datetimes are naive UTC
+    return moment.replace(tzinfo=timezone.utc).timestamp()
+
+
+def _pairs(flat: List[str]) -> Dict[str, str]:
+    return dict(zip(flat[::2], flat[1::2]))
+
+
+def _encode_task(task: TaskRecord) -> Dict[str, str]:
+    return {field: json.dumps(value, ensure_ascii=False) for field, value in task.to_dict().items()}
+
+
+def _decode_task(fields: Dict[str, str]) -> TaskRecord:
+    return TaskRecord.from_dict({
+        field: json.loads(value)
+        for field, value in fields.items()
+        if field not in _HISTORY_FIELDS and field != _SEARCH_FIELD
+    })
+
+
+def _decode_history(fields: Dict[str, str]) -> GenerationHistory:
+    task = _decode_task(fields)
+    return GenerationHistory(
+        id=json.loads(fields["history_id"]),
+        task_id=task.id,
+        type=task.type,
+        prompt=task.prompt,
+        negative_prompt=task.negative_prompt,
+        parameters=task.parameters,
+        images=task.images,
+        created_at=datetime.fromisoformat(json.loads(fields["history_at"])),
+        favorite=json.loads(fields["favorite"]),
+    )
+
+
+class RedisTaskStore(TaskStore):
+    """Task store shared by every API process through Redis.
+
+    Each task is a hash; ``(status, type)`` indexes and history are sorted
+    sets scored by time. Updates run as Lua scripts that also publish the new
+    state, which every process relays to its local subscribers, so SSE,
+    WebSocket and long-poll clients see changes made by any worker. Nothing
+    is kept in process memory.
+    """
+
+    def __init__(
+        self,
+        url: str,
+        history_file: Path,
+        max_history_size: int = 1000,
+        prefix: str = "imagegen:",
+        client=None,
+    ) -> None:
+        if client is None:
+            if not REDIS_AVAILABLE:
+                raise ImportError("redis package not installed")
+            client = aioredis.from_url(url, decode_responses=True)
+        self._client = client
+        self._prefix = prefix
+        self._channel = prefix + "events"
+        self._update_script = client.register_script(_UPDATE_SCRIPT)
+        self._favorite_script = client.register_script(_FAVORITE_SCRIPT)
+        self._delete_script = client.register_script(_DELETE_SCRIPT)
+        self._listener: Optional[asyncio.Task] = None
+        # History lives in Redis; the base persistence is never written to
+        super().__init__(
+            history_file=history_file,
+            max_history_size=max_history_size,
+            persistence=HistoryPersistence(),
+        )
+
+    def _load_history(self) -> None:
+        pass
+
+    def _load_suspended(self) -> None:
+        pass
+
+    def _load_batches(self) -> None:
+        pass
+
+    def _save_suspended(self, tasks: List[TaskRecord]) -> Optional[Awaitable[Any]]:
+        return None
+
+    def _task_key(self, task_id: str) -> str:
+        return f"{self._prefix}task:{task_id}"
+
+    def _index_key(self, status: Optional[str], task_type: Optional[str]) -> str:
+        return f"{self._prefix}tasks:{status or '*'}:{task_type or '*'}"
+
+    def _shared_keys(self) -> List[str]:
+        """KEYS[1] to KEYS[6] of the scripts that write history"""
+        return [
+            f"{self._prefix}blob_refs",
+            f"{self._prefix}search_vocabulary",
+            f"{self._prefix}favorites",
+            f"{self._prefix}evictable",
+            f"{self._prefix}history:*",
+            self._index_key(None, None),
+        ]
+
+    def _task_keys(self, task_id: str, task_type: str, status: str) -> List[str]:
+        """Keys of a task's hash and its type and status indexes"""
+        return [
+            self._task_key(task_id),
+            f"{self._prefix}history:{task_type}",
+            self._index_key(None, task_type),
+            self._index_key(status, None),
+            self._index_key(status, task_type),
+        ]
+
+    def _postings_keys(self, tokens: List[str]) -> List[str]:
+        return [f"{self._prefix}search:{token}" for token in tokens]
+
+    async def _index_state(self, task_ids: List[str]) -> List[Optional[tuple[str, str, List[str]]]]:
+        """``(type, status, search tokens)`` of each task, which pick its index keys"""
+        async with self._client.pipeline(transaction=False) as pipe:
+            for task_id in task_ids:
+                pipe.hmget(self._task_key(task_id), ["type", "status", _SEARCH_FIELD])
+            states = await pipe.execute()
+        return [
+            (json.loads(task_type), json.loads(status), json.loads(tokens) if tokens else [])
+            if task_type is not None else None
+            for task_type, status, tokens in states
+        ]
+
+    async def start(self) -> None:
+        await self._split_favorites()
+        self._listener = asyncio.create_task(self._relay_events(), name="task-events-relay")
+
+    async def _split_favorites(self) -> None:
+        """Sort history written before favorites and evictable entries were kept
+        apart into both sets. Idempotent; skipped once anything is evictable.
+        """
+        if await self._client.exists(f"{self._prefix}evictable"):
+            return
+        entries = await self._client.zrange(f"{self._prefix}history:*", 0, -1, withscores=True)
+        if not entries:
+            return
+        async with self._client.pipeline(transaction=False) as pipe:
+            for task_id, _ in entries:
+                pipe.hget(self._task_key(task_id), "favorite")
+            favorites = await pipe.execute()
+        async with self._client.pipeline(transaction=True) as pipe:
+            for (task_id, score), favorite in zip(entries, favorites):
+                key = "favorites" if favorite and json.loads(favorite) else "evictable"
+                pipe.zadd(f"{self._prefix}{key}", {task_id: score})
+            await pipe.execute()
+
+    async def _relay_events(self) -> None:
+        """Hand task updates published by any process to local subscribers"""
+        while True:
+            try:
+                async with self._client.pubsub() as pubsub:
+                    await pubsub.subscribe(self._channel)
+                    async for message in pubsub.listen():
+                        if message["type"] != "message":
+                            continue
+                        fields = _pairs(json.loads(message["data"]))
+                        task_id = json.loads(fields["id"])
+                        if self.events.is_watched(task_id):
+                            self.events.publish(_decode_task(fields))
+            except asyncio.CancelledError:
+                raise
+            except Exception:
+                logger.exception("Task event relay lost its connection, reconnecting")
+                await asyncio.sleep(1.0)
+
+    async def create_task(
+        self,
+        task_type: str,
+        prompt: str,
+        negative_prompt: Optional[str],
+        parameters: Dict[str, Any],
+    ) -> TaskRecord:
+        item = {"task_type": task_type, "prompt": prompt, "negative_prompt": negative_prompt, "parameters": parameters}
+        return (await self.create_tasks([item]))[0]
+
+    async def create_tasks(self, items: List[Dict[str, Any]], batch_id: Optional[str] = None) -> List[TaskRecord]:
+        tasks = [self._new_task(**item) for item in self._batch_items(items, batch_id)]
+        async with self._client.pipeline(transaction=True) as pipe:
+            for task in tasks:
+                score = _score(task.created_at)
+                fields = _encode_task(task)
+                fields[_SEARCH_FIELD] = json.dumps(prompt_tokens(task.prompt, task.negative_prompt), ensure_ascii=False)
+                pipe.hset(self._task_key(task.id), mapping=fields)
+                for status in (None, task.status.value):
+                    for task_type in (None, task.type):
+                        pipe.zadd(self._index_key(status, task_type), {task.id: score})
+            if batch_id is not None:
+                batch = BatchRecord(batch_id, [task.id for task in tasks], datetime.utcnow())
+                pipe.set(
+                    f"{self._prefix}batch:{batch_id}",
+                    json.dumps({"task_ids": batch.task_ids, "created_at": batch.created_at.isoformat()}),
+                )
+            await pipe.execute()
+        return tasks
+
+    async def get_batch(self, batch_id: str) -> Optional[BatchRecord]:
+        data = await self._client.get(f"{self._prefix}batch:{batch_id}")
+        if data is None:
+            return None
+        data = json.loads(data)
+        return BatchRecord(batch_id, data["task_ids"], datetime.fromisoformat(data["created_at"]))
+
+    async def _fetch(self, task_ids: List[str]) -> List[Dict[str, str]]:
+        """Hashes of ``task_ids`` in one round trip, skipping missing tasks"""
+        if not task_ids:
+            return []
+        async with self._client.pipeline(transaction=False) as pipe:
+            for task_id in task_ids:
+                pipe.hgetall(self._task_key(task_id))
+            return [fields for fields in await pipe.execute() if fields]
+
+    async def get_task(self, task_id: str) -> Optional[TaskRecord]:
+        fields = await self._client.hgetall(self._task_key(task_id))
+        return _decode_task(fields) if fields else None
+
+    async def get_tasks(self, task_ids: List[str]) -> List[TaskRecord]:
+        return [_decode_task(fields) for fields in await self._fetch(task_ids)]
+
+    async def update_task(
+        self,
+        task_id: str,
+        *,
+        status: Optional[TaskStatus] = None,
+        progress: Optional[int] = None,
+        images: Optional[List[str]] = None,
+        error: Optional[str] = None,
+        completed: bool = False,
+    ) -> Optional[TaskRecord]:
+        changes: Dict[str, Any] = {}
+        if status is not None:
+            changes["status"] = status.value
+        if progress is not None:
+            changes["progress"] = progress
+        if images is not None:
+            changes["images"] = images
+        if error is not None:
+            changes["error"] = error
+        history, history_score = "", 0.0
+        if completed:
+            completed_at = datetime.utcnow()
+            changes["completed_at"] = completed_at.isoformat()
+            if status == TaskStatus.COMPLETED:
+                history = json.dumps({
+                    "history_id": json.dumps(str(uuid4())),
+                    "history_at": json.dumps(completed_at.isoformat()),
+                    "favorite": json.dumps(False),
+                })
+                history_score = _score(completed_at)
+        encoded = json.dumps({field: json.dumps(value, ensure_ascii=False) for field, value in changes.items()})
+        with tracing.span("store.persist_history") if history else tracing.NOOP_SPAN:
+            while True:
+                state = (await self._index_state([task_id]))[0]
+                if state is None:
+                    return None
+                task_type, current, tokens = state
+                new_status = status.value if status is not None else current
+                result = await self._update_script(
+                    keys=[
+                        *self._shared_keys(),
+                        *self._task_keys(task_id, task_type, current),
+                        self._index_key(new_status, None),
+                        self._index_key(new_status, task_type),
+                        *self._postings_keys(tokens),
+                    ],
+                    args=[
+                        current,
+                        encoded,
+                        status.value if status is not None else "",
+                        history,
+                        history_score,
+                        self.max_history_size,
+                        self._channel,
+                    ],
+                )
+                if not result:
+                    return None
+                # Otherwise another process changed the status first; retry with its keys
+                if int(result[0]):
+                    break
+            _, fields, overflow = result
+            if int(overflow) > 0:
+                await self._trim_history(int(overflow))
+        task = _decode_task(_pairs(fields))
+        if completed:
+            record_task_finished(task)
+        return task
+
+    async def list_tasks(
+        self,
+        status: Optional[TaskStatus] = None,
+        task_type: Optional[str] = None,
+        offset: int = 0,
+        limit: int = 100,
+    ) -> tuple[int, List[TaskRecord]]:
+        key = self._index_key(status.value if status else None, task_type)
+        async with self._client.pipeline(transaction=False) as pipe:
+            pipe.zcard(key)
+            pipe.zrevrange(key, offset, offset + limit - 1)
+            total, task_ids = await pipe.execute()
+        return total, await self.get_tasks(task_ids)
+
+    async def list_history(
+        self,
+        page: int = 1,
+        page_size: int = 20,
+        task_type: Optional[str] = None,
+    ) -> tuple[int, List[GenerationHistory]]:
+        key = f"{self._prefix}history:{task_type or '*'}"
+        offset = (page - 1) * page_size
+        async with self._client.pipeline(transaction=False) as pipe:
+            pipe.zcard(key)
+            pipe.zrevrange(key, offset, offset + page_size - 1)
+            total, task_ids = await pipe.execute()
+        return total, [_decode_history(fields) for fields in await self._fetch(task_ids)]
+
+    async def search_history(self, query: HistoryQuery) -> List[GenerationHistory]:
+        found: List[GenerationHistory] = []
+        async for task_ids in self._search_candidates(query):
+            for history in map(_decode_history, await self._fetch(task_ids)):
+                if query.accepts(history):
+                    found.append(history)
+                    if len(found) >= query.limit:
+                        return found
+        return found
+
+    async def _search_candidates(self, query: HistoryQuery) -> AsyncIterator[List[str]]:
+        """Pages of history task ids that may match ``query``, newest first"""
+        bound = query.upper_bound
+        # Inclusive score bounds; ties with the cursor are settled by ``query.accepts``
+        high = _score(bound[0]) if bound is not None else float("inf")
+        low = _score(query.created_after) if query.created_after is not None else float("-inf")
+        terms = query.terms
+        if not terms:
+            if query.favorite:
+                key = f"{self._prefix}favorites"
+            else:
+                key = f"{self._prefix}history:{query.task_type or '*'}"
+            offset = 0
+            while True:
+                task_ids = await self._client.zrevrangebyscore(key, high, low, start=offset, num=query.limit)
+                if not task_ids:
+                    return
+                offset += len(task_ids)
+                yield task_ids
+
+        vocabulary = f"{self._prefix}search_vocabulary"
+        async with self._client.pipeline(transaction=False) as pipe:
+            for term in terms:
+                pipe.zrangebylex(vocabulary, f"[{term}", b"(" + term.encode("utf-8") + b"\xff")
+            matches = await pipe.execute()
+        if not all(matches):
+            return
+        async with self._client.pipeline(transaction=False) as pipe:
+            for tokens in matches:
+                pipe.sunion([f"{self._prefix}search:{token}" for token in tokens])
+            candidates = set.intersection(*map(set, await pipe.execute()))
+        if not candidates:
+            return
+        ranked = list(candidates)
+        scores = await self._client.zmscore(f"{self._prefix}history:*", ranked)
+        ranked = sorted(
+            ((score, task_id) for score, task_id in zip(scores, ranked) if score is not None and low <= score <= high),
+            reverse=True,
+        )
+        for start in range(0, len(ranked), query.limit):
+            yield [task_id for _, task_id in ranked[start:start + query.limit]]
+
+    async def suspend_tasks(self, task_ids: List[str]) -> None:
+        """Reset interrupted tasks to pending; their jobs stay in the shared queue"""
+        for task in await self.get_tasks(task_ids):
+            if task.status not in TERMINAL_STATUSES:
+                await self.update_task(task.id, status=TaskStatus.PENDING, progress=0, images=[])
+
+    async def toggle_favorite(self, task_id: str, favorite: bool) -> Optional[GenerationHistory]:
+        fields = await self._favorite_script(
+            keys=[
+                self._task_key(task_id),
+                f"{self._prefix}history:*",
+                f"{self._prefix}favorites",
+                f"{self._prefix}evictable",
+            ],
+            args=[json.dumps(favorite)],
+        )
+        return _decode_history(_pairs(fields)) if fields else None
+
+    async def replace_images(self, task_id: str, images: List[str]) -> bool:
+        return await self.update_task(task_id, images=list(images)) is not None
+
+    async def blob_refs(self, images: List[str]) -> Dict[str, int]:
+        if not images:
+            return {}
+        counts = await self._client.hmget(f"{self._prefix}blob_refs", images)
+        return {image: int(count or 0) for image, count in zip(images, counts)}
+
+    async def evictable_history(self, limit: int, offset: int = 0) -> List[GenerationHistory]:
+        task_ids = await self._client.zrange(f"{self._prefix}evictable", offset, offset + limit - 1)
+        return [_decode_history(fields) for fields in await self._fetch(task_ids)]
+
+    async def delete_history(self, task_ids: List[str]) -> List[GenerationHistory]:
+        removed: List[List[str]] = []
+        while task_ids:
+            fields, task_ids = await self._remove_history(task_ids)
+            removed.extend(fields)
+        return [_decode_history(_pairs(fields)) for fields in removed]
+
+    async def _trim_history(self, overflow: int) -> None:
+        """Evict the oldest entries that are not favorites while history is over its size"""
+        task_ids = await self._client.zrange(f"{self._prefix}evictable", 0, overflow - 1)
+        while task_ids:
+            _, task_ids = await self._remove_history(task_ids, keep=self.max_history_size)
+
+    async def _remove_history(
+        self, task_ids: List[str], keep: Optional[int] = None
+    ) -> tuple[List[List[str]], List[str]]:
+        """Run the delete script over ``task_ids``; returns the removed hashes and
+        the ids to retry because their status changed meanwhile.
+        """
+        keys, args = self._shared_keys(), ["" if keep is None else keep]
+        for task_id, state in zip(task_ids, await self._index_state(task_ids)):
+            if state is not None:
+                task_type, status, tokens = state
+                keys += self._task_keys(task_id, task_type, status) + self._postings_keys(tokens)
+                args += [task_id, status, len(tokens)]
+        if len(args) == 1:
+            return [], []
+        removed, stale = await self._delete_script(keys=keys, args=args)
+        return removed, stale
+
+    async def close(self) -> None:
+        if self._listener is not None:
+            self._listener.cancel()
+            await asyncio.gather(self._listener, return_exceptions=True)
+        await self._client.aclose()
+        await super().close()
@@ -0,0 +1,342 @@
+from __future__ import annotations
+
+import asyncio
+import json
+import logging
+import math
+import random
+import time
+from collections import deque
+from typing import Any, Awaitable, Callable, Deque, Dict, List, Optional
+
+logger = logging.getLogger(__name__)
+
+SUCCESS_CODE = 10000
+# Upstream business codes worth retrying: QPS and concurrency limits, internal
+# errors and the post-generation review, which passes on a fresh sample.
+# Everything else (parameter validation, prompt and input image review) is
+# permanent.
+RETRYABLE_CODES = frozenset({50429, 50430, 50500, 50501, 50511})
+
+# Sends one upstream request
+Send = Callable[[], Awaitable[dict]]
+# Waits for upstream budget of a req_key before each attempt
+Throttle = Callable[[str], Awaitable[None]]
+
+
+class UpstreamError(Exception):
+    """A failed upstream attempt, classified as transient or permanent"""
+
+    def __init__(self, message: str, code: Optional[int] = None, retryable: bool = True):
+        super().__init__(message)
+        self.code = code
+        self.retryable = retryable
+
+
+class CircuitOpenError(UpstreamError):
+    def __init__(self, req_key: str, retry_after: float):
+        super().__init__(
+            f"Upstream {req_key} is unavailable, retry in {math.ceil(retry_after)}s",
+            retryable=False,
+        )
+        self.retry_after = retry_after
+
+
+def _error_from_body(body: dict, fallback: str) -> UpstreamError:
+    code = body.get("code")
+    if isinstance(code, int):
+        message = body.get("message") or fallback
+        return UpstreamError(f"{message} (code {code})", code=code, retryable=code in RETRYABLE_CODES)
+    if "error" in body:
+        return UpstreamError(str(body["error"]))
+    # Gateway errors (bad credentials, unknown action) carry ResponseMetadata only
+    return UpstreamError(fallback, retryable=False)
+
+
+def error_from_result(result: dict) -> Optional[UpstreamError]:
+    """The error carried by an upstream response body, or ``None`` on success"""
+    code = result.get("code")
+    if code == SUCCESS_CODE or (code is None and "error" not in result and "ResponseMetadata" not in result):
+        return None
+    return _error_from_body(result, json.dumps(result.get("ResponseMetadata", result))[:500])
+
+
+def error_from_exception(error: Exception) -> UpstreamError:
+    """Classify an exception raised by a transport.
+
+    The SDK raises non-200 responses as an exception holding the body; those
+    are classified by their code. Anything else is a network failure and is
+    worth retrying.
+    """
+    message = str(error)
+    try:
+        body = json.loads(message)
+    except ValueError:
+        return UpstreamError(message or type(error).__name__)
+    if not isinstance(body, dict):
+        return UpstreamError(message)
+    return _error_from_body(body, message[:500])
+
+
+class LatencyWindow:
+    """The latest ``size`` successful request latencies, for quantiles"""
+
+    def __init__(self, size: int = 200, min_samples: int = 20) -> None:
+        self.samples: Deque[float] = deque(maxlen=size)
+        self.min_samples = min_samples
+
+    def add(self, seconds: float) -> None:
+        self.samples.append(seconds)
+
+    def quantile(self, q: float) -> Optional[float]:
+        """The ``q`` quantile, or ``None`` until enough samples were seen"""
+        if len(self.samples) < self.min_samples:
+            return None
+        ordered = sorted(self.samples)
+        return ordered[min(len(ordered) - 1, int(q * len(ordered)))]
+
+
+class CircuitBreaker:
+    """Opens after ``failure_threshold`` consecutive failures.
+
+    While open every call is rejected. After ``reset_timeout`` seconds a
+    single probe is let through (half-open): its success closes the circuit,
+    its failure opens it again.
+    """
+
+    CLOSED = "closed"
+    OPEN = "open"
+    HALF_OPEN = "half_open"
+
+    def __init__(self, failure_threshold: int = 5, reset_timeout: float = 30.0) -> None:
+        self.failure_threshold = max(failure_threshold, 1)
+        self.reset_timeout = reset_timeout
+        self.state = self.CLOSED
+        self.failures = 0
+        self.opened = 0
+        self._opened_at = 0.0
+        self._probing = False
+
+    @property
+    def retry_after(self) -> float:
+        if self.state != self.OPEN:
+            return 0.0
+        return max(0.0, self._opened_at + self.reset_timeout - time.monotonic())
+
+    def allow(self) -> bool:
+        if self.state == self.OPEN:
+            if self.retry_after > 0:
+                return False
+            self.state = self.HALF_OPEN
+        if self.state == self.HALF_OPEN:
+            if self._probing:
+                return False
+            self._probing = True
+        return True
+
+    def record_success(self) -> None:
+        self.state = self.CLOSED
+        self.failures = 0
+        self._probing = False
+
+    def record_failure(self) -> None:
+        self._probing = False
+        self.failures += 1
+        if self.state == self.HALF_OPEN or self.failures >= self.failure_threshold:
+            if self.state != self.OPEN:
+                self.opened += 1
+                logger.warning("Circuit opened after %d consecutive upstream failures", self.failures)
+            self.state = self.OPEN
+            self._opened_at = time.monotonic()
+
+    def release(self) -> None:
+        """Give up a call without an outcome, e.g. when it was cancelled"""
+        self._probing = False
+
+
+class UpstreamResilience:
+    """Retries, adaptive timeouts, circuit breaking and hedging per ``req_key``.
+
+    - Transient failures are retried up to ``max_retries`` times with full
+      jitter exponential backoff; permanent ones are returned immediately.
+    - Each attempt times out after ``timeout_factor`` times the observed p99
+      latency, kept within ``min_timeout``..``max_timeout`` (``max_timeout``
+      until enough latencies were observed).
+    - A circuit breaker per ``req_key`` fails calls fast while the upstream is
+      unhealthy.
+    - When ``hedge`` is set, a call the caller marks as hedgeable (a seeded,
+      deterministic request) that is still running after the p95 latency is
+      sent a second time; the first success wins and the other is cancelled.
+    """
+
+    def __init__(
+        self,
+        max_retries: int = 2,
+        backoff: float = 0.5,
+        max_backoff: float = 8.0,
+        min_timeout: float = 10.0,
+        max_timeout: float = 60.0,
+        timeout_factor: float = 2.0,
+        failure_threshold: int = 5,
+        reset_timeout: float = 30.0,
+        hedge: bool = False,
+        hedge_quantile: float = 0.95,
+        window: int = 200,
+    ) -> None:
+        self.max_retries = max_retries
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.min_timeout = min_timeout
+        self.max_timeout = max_timeout
+        self.timeout_factor = timeout_factor
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.hedge = hedge
+        self.hedge_quantile = hedge_quantile
+        self.window = window
+        self._breakers: Dict[str, CircuitBreaker] = {}
+        self._latencies: Dict[str, LatencyWindow] = {}
+        self.retries = 0
+        self.timeouts = 0
+        self.rejected = 0
+        self.hedged = 0
+        self.hedge_wins = 0
+
+    def breaker(self, req_key: str) -> CircuitBreaker:
+        breaker = self._breakers.get(req_key)
+        if breaker is None:
+            breaker = self._breakers[req_key] = CircuitBreaker(self.failure_threshold, self.reset_timeout)
+        return breaker
+
+    def latency(self, req_key: str) -> LatencyWindow:
+        window = self._latencies.get(req_key)
+        if window is None:
+            window = self._latencies[req_key] = LatencyWindow(self.window)
+        return window
+
+    def timeout(self, req_key: str) -> float:
+        """Per-attempt timeout derived from the p99 latency of ``req_key``"""
+        p99 = self.latency(req_key).quantile(0.99)
+        if p99 is None:
+            return self.max_timeout
+        return min(self.max_timeout, max(self.min_timeout, p99 * self.timeout_factor))
+
+    async def call(
+        self,
+        req_key: str,
+        send: Send,
+        throttle: Optional[Throttle] = None,
+        hedge: bool = False,
+    ) -> dict:
+        """Run ``send`` with retries; return its response or ``{"error", "code"}``"""
+        breaker = self.breaker(req_key)
+        attempt = 0
+        while True:
+            if not breaker.allow():
+                self.rejected += 1
+                error: UpstreamError = CircuitOpenError(req_key, breaker.retry_after)
+                return {"error": str(error), "code": error.code}
+            timeout = self.timeout(req_key)
+            try:
+                if hedge and self.hedge:
+                    return self._succeeded(breaker, await self._hedged(req_key, send, throttle, timeout))
+                return self._succeeded(breaker, await self._attempt(req_key, send, throttle, timeout))
+            except UpstreamError as e:
+                error = e
+            except BaseException:
+                breaker.release()
+                raise
+
+            if error.retryable:
+                breaker.record_failure()
+            else:
+                # The upstream answered; the request itself was at fault
+                breaker.record_success()
+            if not error.retryable or attempt >= self.max_retries:
+                return {"error": str(error), "code": error.code}
+            delay = min(self.max_backoff, self.backoff * (2 ** attempt))
+            attempt += 1
+            self.retries += 1
+            await asyncio.sleep(random.uniform(0, delay))
+
+    @staticmethod
+    def _succeeded(breaker: CircuitBreaker, result: dict) -> dict:
+        breaker.record_success()
+        return result
+
+    async def _attempt(self, req_key: str, send: Send, throttle: Optional[Throttle], timeout: float) -> dict:
+        """One timed request, raising ``UpstreamError`` unless it succeeded"""
+        if throttle is not None:
+            await throttle(req_key)
+        started = time.monotonic()
+        try:
+            result = await asyncio.wait_for(send(), timeout)
+        except asyncio.TimeoutError:
+            self.timeouts += 1
+            raise UpstreamError(f"Upstream request timed out after {timeout:.1f}s")
+        except Exception as e:
+            raise error_from_exception(e)
+        error = error_from_result(result)
+        if error is not None:
+            raise error
+        self.latency(req_key).add(time.monotonic() - started)
+        return result
+
+    async def _hedged(self, req_key: str, send: Send, throttle: Optional[Throttle], timeout: float) -> dict:
+        """Race a second request against one still running after the p95 latency"""
+        delay = self.latency(req_key).quantile(self.hedge_quantile)
+        primary = asyncio.ensure_future(self._attempt(req_key, send, throttle, timeout))
+        legs: List[asyncio.Future] = [primary]
+        try:
+            if delay is not None:
+                done, _ = await asyncio.wait(legs, timeout=delay)
+                if not done:
+                    self.hedged += 1
+                    legs.append(asyncio.ensure_future(self._attempt(req_key, send, throttle, timeout)))
+            error: Optional[UpstreamError] = None
+            pending = set(legs)
+            while pending:
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                for leg in done:
+                    try:
+                        result = leg.result()
+                    except UpstreamError as e:
+                        error = e
+                        continue
+                    if leg is not primary:
+                        self.hedge_wins += 1
+                    return result
+            raise error
+        finally:
+            for leg in legs:
+                if not leg.done():
+                    leg.cancel()
+                elif not leg.cancelled():
+                    leg.exception()  # Mark a losing failure as retrieved
+
+    def stats(self) -> Dict[str, Any]:
+        upstreams = {}
+        for req_key, breaker in self._breakers.items():
+            window = self.latency(req_key)
+            p95, p99 = window.quantile(0.95), window.quantile(0.99)
+            upstreams[req_key] = {
+                "state": breaker.state,
+                "consecutive_failures": breaker.failures,
+                "opened": breaker.opened,
+                "retry_after": round(breaker.retry_after, 1),
+                "timeout": round(self.timeout(req_key), 2),
+                "p95": round(p95, 3) if p95 is not None else None,
+                "p99": round(p99, 3) if p99 is not None else None,
+            }
+        return {
+            "breakers": upstreams,
+            "retries": self.retries,
+            "timeouts": self.timeouts,
+            "rejected": self.rejected,
+            "hedged": self.hedged,
+            "hedge_wins": self.hedge_wins,
+        }
+
+    @property
+    def healthy(self) -> bool:
+        return all(breaker.state == CircuitBreaker.CLOSED for breaker in self._breakers.values())
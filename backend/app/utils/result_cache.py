@@ -0,0 +1,95 @@
+from __future__ import annotations
+
+import hashlib
+import json
+import time
+from collections import OrderedDict
+from dataclasses import dataclass
+from typing import Any, Dict, List, Optional
+
+# Request fields that do not influence the generated image
+NON_DETERMINISTIC_FIELDS = {"use_cache", "image"}
+
+
+def is_deterministic(params: Dict[str, Any]) -> bool:
+    """Only requests with a fixed seed reproduce the same image"""
+    seed = params.get("seed")
+    return seed is not None and seed >= 0
+
+
+def cache_key(kind: str, params: Dict[str, Any], image_digest: Optional[str] = None) -> str:
+    """Canonical hash of a normalized generation request"""
+    normalized = {
+        key: value
+        for key, value in params.items()
+        if key not in NON_DETERMINISTIC_FIELDS
+    }
+    normalized["prompt"] = str(normalized.get("prompt", "")).strip()
+    normalized["negative_prompt"] = (normalized.get("negative_prompt") or "").strip() or None
+    payload = {"kind": kind, "params": normalized, "image": image_digest}
+    canonical = json.dumps(payload, sort_keys=True, separators=(",", ":"), ensure_ascii=False, default=str)
+    return hashlib.sha256(canonical.encode("utf-8")).hexdigest()
+
+
+@dataclass
+class _CacheEntry:
+    images: List[str]
+    expires_at: float
+    size: int
+
+
+class ResultCache:
+    """LRU + TTL cache of completed image lists, bounded by entry count and bytes"""
+
+    def __init__(self, max_entries: int = 1000, max_bytes: int = 16 * 1024 * 1024, ttl: float = 3600.0) -> None:
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self._entries: "OrderedDict[str, _CacheEntry]" = OrderedDict()
+        self._bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, key: str) -> Optional[List[str]]:
+        entry = self._entries.get(key)
+        if entry is None:
+            self.misses += 1
+            return None
+        if entry.expires_at <= time.monotonic():
+            self._drop(key)
+            self.misses += 1
+            return None
+        self._entries.move_to_end(key)
+        self.hits += 1
+        return list(entry.images)
+
+    def put(self, key: str, images: List[str]) -> None:
+        if not images:
+            return
+        size = len(key) + sum(len(image.encode("utf-8")) for image in images)
+        if size > self.max_bytes:
+            return
+        if key in self._entries:
+            self._drop(key)
+        self._entries[key] = _CacheEntry(list(images), time.monotonic() + self.ttl, size)
+        self._bytes += size
+        while len(self._entries) > self.max_entries or self._bytes > self.max_bytes:
+            oldest = next(iter(self._entries))
+            self._drop(oldest)
+            self.evictions += 1
+
+    def _drop(self, key: str) -> None:
+        entry = self._entries.pop(key)
+        self._bytes -= entry.size
+
+    def stats(self) -> Dict[str, Any]:
+        lookups = self.hits + self.misses
+        return {
+            "entries": len(self._entries),
+            "bytes": self._bytes,
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "hit_ratio": round(self.hits / lookups, 4) if lookups else 0.0,
+        }
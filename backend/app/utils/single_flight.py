@@ -0,0 +1,94 @@
+from __future__ import annotations
+
+import asyncio
+import logging
+from typing import Any, Awaitable, Callable, Dict, List, Optional, Tuple
+
+logger = logging.getLogger(__name__)
+
+# Called with (index, result) for each partial result of a shared call
+EventCallback = Callable[[int, Any], Awaitable[None]]
+
+
+class _Flight:
+    """One shared call and the callers attached to it"""
+
+    def __init__(self) -> None:
+        self.task: Optional[asyncio.Future] = None
+        self.events: List[Tuple[int, Any]] = []
+        self.listeners: List[EventCallback] = []
+        self.waiters = 0
+
+    async def emit(self, index: int, result: Any) -> None:
+        self.events.append((index, result))
+        for listener in list(self.listeners):
+            try:
+                await listener(index, result)
+            except Exception:
+                logger.exception("Single-flight listener failed")
+
+
+class SingleFlight:
+    """Coalesce concurrent calls with the same key into one upstream call.
+
+    The first caller for a key starts ``fn(emit)``; callers arriving while it
+    is running wait for the same result (or exception). Partial results passed
+    to ``emit`` are forwarded to every caller's ``on_result``, and replayed to
+    callers that join late. The shared call is only cancelled once every
+    caller waiting on it has been cancelled.
+    """
+
+    def __init__(self) -> None:
+        self._flights: Dict[str, _Flight] = {}
+        self.calls = 0
+        self.coalesced = 0
+
+    @property
+    def in_flight(self) -> int:
+        return len(self._flights)
+
+    async def do(
+        self,
+        key: Optional[str],
+        fn: Callable[[EventCallback], Awaitable[Any]],
+        on_result: Optional[EventCallback] = None,
+    ) -> Any:
+        flight = self._flights.get(key) if key else None
+        if flight is None:
+            self.calls += 1
+            flight = _Flight()
+            flight.task = asyncio.ensure_future(fn(flight.emit))
+            if key:
+                self._flights[key] = flight
+                flight.task.add_done_callback(lambda _: self._forget(key, flight))
+            replay: List[Tuple[int, Any]] = []
+        else:
+            self.coalesced += 1
+            replay = list(flight.events) if on_result is not None else []
+
+        if on_result is not None:
+            flight.listeners.append(on_result)
+        flight.waiters += 1
+        try:
+            for index, result in replay:
+                await on_result(index, result)
+            return await asyncio.shield(flight.task)
+        except asyncio.CancelledError:
+            if flight.waiters == 1 and not flight.task.done():
+                flight.task.cancel()
+            raise
+        finally:
+            flight.waiters -= 1
+            if on_result is not None:
+                flight.listeners.remove(on_result)
+
+    def _forget(self, key: str, flight: _Flight) -> None:
+        if self._flights.get(key) is flight:
+            del self._flights[key]
+
+    def stats(self) -> Dict[str, int]:
+        return {
+            "calls": self.calls,
+            "coalesced": self.coalesced,
+            "in_flight": self.in_flight,
+        }
@@ -0,0 +1,57 @@
+from __future__ import annotations
+
+from typing import Any, Iterator, List, Optional, Tuple
+
+from sortedcontainers import SortedList
+
+
+class SortedIndex:
+    """Ordered secondary index of ``(sort_key, item_id)`` pairs.
+
+    Entries live in a blocked sorted list, so inserts, removals (including
+    from either end) and rank or bound lookups are ``O(log n)``, and paging
+    through the index never has to sort the underlying records.
+    """
+
+    def __init__(self) -> None:
+        self._entries: SortedList = SortedList()
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def __iter__(self) -> Iterator[str]:
+        return (item_id for _, item_id in self._entries)
+
+    def add(self, key: Any, item_id: str) -> None:
+        self._entries.add((key, item_id))
+
+    def discard(self, key: Any, item_id: str) -> None:
+        self._entries.discard((key, item_id))
+
+    def rank(self, key: Any, item_id: str) -> int:
+        """Number of entries ordered before ``(key, item_id)``"""
+        return self._entries.bisect_left((key, item_id))
+
+    def page(self, offset: int, limit: int, newest_first: bool = True) -> List[str]:
+        """Return up to ``limit`` ids after skipping ``offset`` entries"""
+        if offset < 0 or limit <= 0:
+            return []
+        if newest_first:
+            stop = len(self._entries) - offset
+            if stop <= 0:
+                return []
+            entries = self._entries.islice(max(stop - limit, 0), stop, reverse=True)
+        else:
+            entries = self._entries.islice(offset, offset + limit)
+        return [item_id for _, item_id in entries]
+
+    def newest_before(self, bound: Optional[Tuple[Any, str]] = None) -> Iterator[str]:
+        """Ids newest first, starting below ``(sort_key, item_id)`` ``bound`` (keyset paging)"""
+        if bound is None:
+            entries = reversed(self._entries)
+        else:
+            entries = self._entries.irange(maximum=bound, inclusive=(True, False), reverse=True)
+        return (item_id for _, item_id in entries)
+
+    def oldest(self, count: int) -> List[str]:
+        return self.page(0, count, newest_first=False)
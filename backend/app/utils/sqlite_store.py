@@ -0,0 +1,574 @@
+from __future__ import annotations
+
+import json
+import logging
+import sqlite3
+from datetime import datetime
+from pathlib import Path
+from typing import Any, Awaitable, Callable, Dict, Iterable, List, Mapping, Optional
+
+from ..schemas import GenerationHistory, TaskStatus
+from .history_search import HistoryQuery, history_tokens
+from .persistence import HistoryPersistence, load_history_file
+from .task_store import BatchRecord, TaskRecord, TaskStore
+
+logger = logging.getLogger(__name__)
+
+TERMINAL_STATUSES = (TaskStatus.COMPLETED, TaskStatus.FAILED)
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS tasks (
+    id TEXT PRIMARY KEY,
+    type TEXT NOT NULL,
+    status TEXT NOT NULL,
+    prompt TEXT NOT NULL,
+    negative_prompt TEXT,
+    parameters TEXT NOT NULL,
+    images TEXT NOT NULL,
+    progress INTEGER,
+    error TEXT,
+    created_at TEXT NOT NULL,
+    completed_at TEXT
+);
+CREATE INDEX IF NOT EXISTS idx_tasks_created ON tasks (created_at);
+CREATE INDEX IF NOT EXISTS idx_tasks_status_created ON tasks (status, created_at);
+CREATE INDEX IF NOT EXISTS idx_tasks_type_created ON tasks (type, created_at);
+
+CREATE TABLE IF NOT EXISTS history (
+    task_id TEXT PRIMARY KEY,
+    id TEXT NOT NULL,
+    type TEXT NOT NULL,
+    prompt TEXT NOT NULL,
+    negative_prompt TEXT,
+    parameters TEXT NOT NULL,
+    images TEXT NOT NULL,
+    created_at TEXT NOT NULL,
+    favorite INTEGER NOT NULL DEFAULT 0
+);
+CREATE INDEX IF NOT EXISTS idx_history_created ON history (created_at);
+CREATE INDEX IF NOT EXISTS idx_history_type_created ON history (type, created_at);
+CREATE INDEX IF NOT EXISTS idx_history_favorite_created ON history (favorite, created_at);
+
+-- Prompt search: the tokenized prompt of each history row, under the same rowid
+CREATE VIRTUAL TABLE IF NOT EXISTS history_fts USING fts5 (tokens);
+CREATE TRIGGER IF NOT EXISTS history_fts_delete AFTER DELETE ON history BEGIN
+    DELETE FROM history_fts WHERE rowid = OLD.rowid;
+END;
+
+CREATE TABLE IF NOT EXISTS batches (
+    id TEXT PRIMARY KEY,
+    task_ids TEXT NOT NULL,
+    created_at TEXT NOT NULL
+);
+
+-- Number of history entries showing each local (/images/) image, kept by triggers
+CREATE TABLE IF NOT EXISTS blob_refs (
+    image TEXT PRIMARY KEY,
+    refs INTEGER NOT NULL
+);
+CREATE TRIGGER IF NOT EXISTS history_refs_insert AFTER INSERT ON history BEGIN
+    INSERT INTO blob_refs (image, refs)
+        SELECT DISTINCT value, 1 FROM json_each(NEW.images) WHERE value LIKE '/images/%'
+        ON CONFLICT (image) DO UPDATE SET refs = refs + 1;
+END;
+CREATE TRIGGER IF NOT EXISTS history_refs_delete AFTER DELETE ON history BEGIN
+    UPDATE blob_refs SET refs = refs - 1 WHERE image IN (SELECT value FROM json_each(OLD.images));
+    DELETE FROM blob_refs WHERE refs <= 0 AND image IN (SELECT value FROM json_each(OLD.images));
+END;
+CREATE TRIGGER IF NOT EXISTS history_refs_update AFTER UPDATE OF images ON history BEGIN
+    UPDATE blob_refs SET refs = refs - 1 WHERE image IN (SELECT value FROM json_each(OLD.images));
+    INSERT INTO blob_refs (image, refs)
+        SELECT DISTINCT value, 1 FROM json_each(NEW.images) WHERE value LIKE '/images/%'
+        ON CONFLICT (image) DO UPDATE SET refs = refs + 1;
+    DELETE FROM blob_refs WHERE refs <= 0 AND image IN (SELECT value FROM json_each(OLD.images));
+END;
+"""
+
+# Keeps ``IN (...)`` queries below SQLite's bound-parameter limit
+_MAX_QUERY_IDS = 500
+
+
+class SQLiteDatabase(HistoryPersistence):
+    """SQLite (WAL) connection confined to the persistence writer thread"""
+
+    backend = "sqlite"
+
+    def __init__(self, db_file: Path) -> None:
+        super().__init__()
+        self.db_file = db_file
+        self._conn: Optional[sqlite3.Connection] = None
+
+    def call(self, func: Callable[..., Any], *args: Any) -> Any:
+        """Run ``func(conn, *args)`` on the database thread and wait for it (startup only)"""
+        return self._writer.submit(self._with_conn, func, *args).result()
+
+    def run(self, func: Callable[..., Any], *args: Any) -> Awaitable[Any]:
+        """Schedule ``func(conn, *args)`` on the database thread without blocking the loop"""
+        return self._submit(self._with_conn, func, *args)
+
+    def _with_conn(self, func: Callable[..., Any], *args: Any) -> Any:
+        if self._conn is None:
+            self.db_file.parent.mkdir(parents=True, exist_ok=True)
+            self._conn = sqlite3.connect(self.db_file, isolation_level=None)
+            self._conn.row_factory = sqlite3.Row
+            self._conn.execute("PRAGMA journal_mode=WAL")
+            self._conn.execute("PRAGMA synchronous=NORMAL")
+            # INSERT OR REPLACE fires the delete trigger for the replaced row
+            self._conn.execute("PRAGMA recursive_triggers=ON")
+            self._conn.executescript(_SCHEMA)
+        return func(self._conn, *args)
+
+    def load(self) -> List[GenerationHistory]:
+        rows = self.call(lambda conn: conn.execute("SELECT * FROM history").fetchall())
+        return [_row_to_history(row) for row in rows]
+
+    def put(self, history: GenerationHistory, items: Mapping[str, GenerationHistory]) -> Awaitable[None]:
+        return self.run(_upsert_history, history)
+
+    def delete(self, task_ids: Iterable[str], items: Mapping[str, GenerationHistory]) -> Awaitable[None]:
+        return self.run(_delete_history, list(task_ids))
+
+    def _close_sync(self) -> None:
+        if self._conn is not None:
+            self._conn.close()
+            self._conn = None
+
+
+class SQLiteTaskStore(TaskStore):
+    """Task store that keeps tasks and history in SQLite.
+
+    Only in-flight tasks are held in memory; finished tasks and history are
+    queried from indexed tables, so memory use does not grow with history size.
+    """
+
+    def __init__(
+        self,
+        db_file: Path,
+        max_history_size: int = 1000,
+        legacy_file: Optional[Path] = None,
+    ) -> None:
+        self.legacy_file = legacy_file
+        self._db = SQLiteDatabase(db_file)
+        super().__init__(history_file=db_file, max_history_size=max_history_size, persistence=self._db)
+
+    def _load_history(self) -> None:
+        if self.legacy_file is not None and self.legacy_file.exists():
+            if self._db.call(lambda conn: conn.execute("SELECT COUNT(*) FROM history").fetchone()[0]) == 0:
+                items = load_history_file(self.legacy_file)
+                if items:
+                    logger.info("Importing %d history records from %s", len(items), self.legacy_file)
+                    self._db.call(_import_history, items)
+
+        self._db.call(_backfill_blob_refs)
+        self._db.call(_backfill_search_index)
+
+        # Tasks interrupted by a restart are re-queued as pending
+        rows = self._db.call(_restore_in_flight_tasks)
+        for row in rows:
+            task = _row_to_task(row)
+            self._tasks[task.id] = task
+            self._index_task(task)
+
+    def _load_suspended(self) -> None:
+        # Suspended tasks already live in the tasks table
+        pass
+
+    def _save_suspended(self, tasks: List[TaskRecord]) -> Optional[Awaitable[Any]]:
+        return None
+
+    def _load_batches(self) -> None:
+        # Batches are read from the batches table on demand
+        pass
+
+    def _on_tasks_created(self, tasks: List[TaskRecord], batch: Optional[BatchRecord]) -> Optional[Awaitable[Any]]:
+        return self._db.run(_insert_tasks, [task.to_dict() for task in tasks], batch)
+
+    async def get_batch(self, batch_id: str) -> Optional[BatchRecord]:
+        def query(conn: sqlite3.Connection):
+            return conn.execute("SELECT * FROM batches WHERE id = ?", (batch_id,)).fetchone()
+
+        row = await self._db.run(query)
+        if row is None:
+            return None
+        return BatchRecord(
+            id=row["id"],
+            task_ids=json.loads(row["task_ids"]),
+            created_at=datetime.fromisoformat(row["created_at"]),
+        )
+
+    async def get_tasks(self, task_ids: List[str]) -> List[TaskRecord]:
+        found = {task_id: self._tasks[task_id] for task_id in task_ids if task_id in self._tasks}
+        missing = [task_id for task_id in task_ids if task_id not in found]
+
+        def query(conn: sqlite3.Connection):
+            rows = []
+            for start in range(0, len(missing), _MAX_QUERY_IDS):
+                chunk = missing[start:start + _MAX_QUERY_IDS]
+                placeholders = ", ".join("?" * len(chunk))
+                rows.extend(conn.execute(f"SELECT * FROM tasks WHERE id IN ({placeholders})", chunk).fetchall())
+            return rows
+
+        if missing:
+            for row in await self._db.run(query):
+                found.setdefault(row["id"], _row_to_task(row))
+        return [found[task_id] for task_id in task_ids if task_id in found]
+
+    def _on_task_changed(self, task: TaskRecord) -> Optional[Awaitable[Any]]:
+        pending = self._db.run(_upsert_task, task.to_dict())
+        if task.status in TERMINAL_STATUSES and task.completed_at is not None:
+            # Finished tasks are served from the database from now on
+            self._tasks.pop(task.id, None)
+            self._unindex_task(task)
+        return pending
+
+    async def get_task(self, task_id: str) -> Optional[TaskRecord]:
+        task = self._tasks.get(task_id)
+        if task is not None:
+            return task
+
+        def query(conn: sqlite3.Connection):
+            row = conn.execute("SELECT * FROM tasks WHERE id = ?", (task_id,)).fetchone()
+            if row is not None:
+                return _row_to_task(row)
+            # History imported from history.json has no task row
+            row = conn.execute("SELECT * FROM history WHERE task_id = ?", (task_id,)).fetchone()
+            return self._task_from_history(_row_to_history(row)) if row else None
+
+        return await self._db.run(query)
+
+    async def list_tasks(
+        self,
+        status: Optional[TaskStatus] = None,
+        task_type: Optional[str] = None,
+        offset: int = 0,
+        limit: int = 100,
+    ) -> tuple[int, List[TaskRecord]]:
+        clauses, params = [], []
+        if status is not None:
+            clauses.append("status = ?")
+            params.append(status.value)
+        if task_type is not None:
+            clauses.append("type = ?")
+            params.append(task_type)
+        where = f"WHERE {' AND '.join(clauses)}" if clauses else ""
+
+        def query(conn: sqlite3.Connection):
+            total = conn.execute(f"SELECT COUNT(*) FROM tasks {where}", params).fetchone()[0]
+            rows = conn.execute(
+                f"SELECT * FROM tasks {where} ORDER BY created_at DESC, id DESC LIMIT ? OFFSET ?",
+                [*params, limit, offset],
+            ).fetchall()
+            return total, rows
+
+        total, rows = await self._db.run(query)
+        return total, [_row_to_task(row) for row in rows]
+
+    async def list_history(
+        self,
+        page: int = 1,
+        page_size: int = 20,
+        task_type: Optional[str] = None,
+    ) -> tuple[int, List[GenerationHistory]]:
+        where, params = ("WHERE type = ?", [task_type]) if task_type else ("", [])
+
+        def query(conn: sqlite3.Connection):
+            total = conn.execute(f"SELECT COUNT(*) FROM history {where}", params).fetchone()[0]
+            rows = conn.execute(
+                f"SELECT * FROM history {where} ORDER BY created_at DESC, task_id DESC LIMIT ? OFFSET ?",
+                [*params, page_size, (page - 1) * page_size],
+            ).fetchall()
+            return total, rows
+
+        total, rows = await self._db.run(query)
+        return total, [_row_to_history(row) for row in rows]
+
+    async def search_history(self, query: HistoryQuery) -> List[GenerationHistory]:
+        clauses, params = [], []
+        terms = query.terms
+        if terms:
+            clauses.append("rowid IN (SELECT rowid FROM history_fts WHERE history_fts MATCH ?)")
+            params.append(" ".join(f'"{term}"*' for term in terms))
+        if query.task_type is not None:
+            clauses.append("type = ?")
+            params.append(query.task_type)
+        if query.favorite is not None:
+            clauses.append("favorite = ?")
+            params.append(int(query.favorite))
+        for name, value in query.parameter_filters.items():
+            clauses.append(f"json_extract(parameters, '$.{name}') = ?")
+            params.append(value)
+        if query.created_after is not None:
+            clauses.append("created_at >= ?")
+            params.append(query.created_after.isoformat())
+        if query.created_before is not None:
+            clauses.append("created_at < ?")
+            params.append(query.created_before.isoformat())
+        if query.cursor is not None:
+            clauses.append("(created_at, task_id) < (?, ?)")
+            params.extend((query.cursor[0].isoformat(), query.cursor[1]))
+        where = f"WHERE {' AND '.join(clauses)}" if clauses else ""
+
+        def search(conn: sqlite3.Connection):
+            return conn.execute(
+                f"SELECT * FROM history {where} ORDER BY created_at DESC, task_id DESC LIMIT ?",
+                [*params, query.limit],
+            ).fetchall()
+
+        return [_row_to_history(row) for row in await self._db.run(search)]
+
+    async def toggle_favorite(self, task_id: str, favorite: bool) -> Optional[GenerationHistory]:
+        def update(conn: sqlite3.Connection):
+            conn.execute("UPDATE history SET favorite = ? WHERE task_id = ?", (int(favorite), task_id))
+            return conn.execute("SELECT * FROM history WHERE task_id = ?", (task_id,)).fetchone()
+
+        row = await self._db.run(update)
+        return _row_to_history(row) if row else None
+
+    async def replace_images(self, task_id: str, images: List[str]) -> bool:
+        encoded = json.dumps(images, ensure_ascii=False)
+        async with self._lock:
+            task = self._tasks.get(task_id)
+            if task is not None:
+                task.images = list(images)
+                self._notify(task)
+
+        def update(conn: sqlite3.Connection) -> bool:
+            changed = 0
+
+            def run() -> None:
+                nonlocal changed
+                changed += conn.execute("UPDATE tasks SET images = ? WHERE id = ?", (encoded, task_id)).rowcount
+                changed += conn.execute(
+                    "UPDATE history SET images = ? WHERE task_id = ?", (encoded, task_id)
+                ).rowcount
+
+            _in_transaction(conn, run)
+            return changed > 0
+
+        return await self._db.run(update)
+
+    async def blob_refs(self, images: List[str]) -> Dict[str, int]:
+        def query(conn: sqlite3.Connection) -> Dict[str, int]:
+            refs = dict.fromkeys(images, 0)
+            for start in range(0, len(images), _MAX_QUERY_IDS):
+                chunk = images[start:start + _MAX_QUERY_IDS]
+                placeholders = ", ".join("?" * len(chunk))
+                refs.update(conn.execute(f"SELECT image, refs FROM blob_refs WHERE image IN ({placeholders})", chunk))
+            return refs
+
+        return await self._db.run(query)
+
+    async def evictable_history(self, limit: int, offset: int = 0) -> List[GenerationHistory]:
+        def query(conn: sqlite3.Connection):
+            return conn.execute(
+                "SELECT * FROM history WHERE favorite = 0 ORDER BY created_at, task_id LIMIT ? OFFSET ?",
+                (limit, offset),
+            ).fetchall()
+
+        return [_row_to_history(row) for row in await self._db.run(query)]
+
+    async def delete_history(self, task_ids: List[str]) -> List[GenerationHistory]:
+        rows = await self._db.run(_delete_history_and_tasks, list(task_ids))
+        removed = [_row_to_history(row) for row in rows]
+        async with self._lock:
+            for history in removed:
+                task = self._tasks.pop(history.task_id, None)
+                if task is not None:
+                    self._unindex_task(task)
+        return removed
+
+    def _persist_history(self, task: TaskRecord) -> Awaitable[Any]:
+        history = self._build_history(task)
+        return self._db.run(_insert_history_and_trim, history, self.max_history_size)
+
+
+def _row_to_task(row: sqlite3.Row) -> TaskRecord:
+    return TaskRecord(
+        id=row["id"],
+        type=row["type"],
+        status=TaskStatus(row["status"]),
+        prompt=row["prompt"],
+        negative_prompt=row["negative_prompt"],
+        parameters=json.loads(row["parameters"]),
+        images=json.loads(row["images"]),
+        progress=row["progress"],
+        error=row["error"],
+        created_at=datetime.fromisoformat(row["created_at"]),
+        completed_at=datetime.fromisoformat(row["completed_at"]) if row["completed_at"] else None,
+    )
+
+
+def _row_to_history(row: sqlite3.Row) -> GenerationHistory:
+    return GenerationHistory(
+        id=row["id"],
+        task_id=row["task_id"],
+        type=row["type"],
+        prompt=row["prompt"],
+        negative_prompt=row["negative_prompt"],
+        parameters=json.loads(row["parameters"]),
+        images=json.loads(row["images"]),
+        created_at=datetime.fromisoformat(row["created_at"]),
+        favorite=bool(row["favorite"]),
+    )
+
+
+def _history_params(history: GenerationHistory) -> tuple:
+    return (
+        history.task_id,
+        history.id,
+        history.type,
+        history.prompt,
+        history.negative_prompt,
+        json.dumps(history.parameters, ensure_ascii=False),
+        json.dumps(history.images, ensure_ascii=False),
+        history.created_at.isoformat(),
+        int(history.favorite),
+    )
+
+
+def _upsert_task(conn: sqlite3.Connection, data: Dict[str, Any]) -> None:
+    conn.execute(
+        "INSERT OR REPLACE INTO tasks (id, type, status, prompt, negative_prompt, parameters, images,"
+        " progress, error, created_at, completed_at) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+        (
+            data["id"],
+            data["type"],
+            data["status"],
+            data["prompt"],
+            data["negative_prompt"],
+            json.dumps(data["parameters"], ensure_ascii=False),
+            json.dumps(data["images"], ensure_ascii=False),
+            data["progress"],
+            data["error"],
+            data["created_at"],
+            data["completed_at"],
+        ),
+    )
+
+
+def _upsert_history(conn: sqlite3.Connection, history: GenerationHistory) -> None:
+    conn.execute(
+        "INSERT OR REPLACE INTO history (task_id, id, type, prompt, negative_prompt, parameters, images,"
+        " created_at, favorite) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)",
+        _history_params(history),
+    )
+    # The replaced row's search tokens went with it (history_fts_delete)
+    conn.execute(
+        "INSERT INTO history_fts (rowid, tokens) SELECT rowid, ? FROM history WHERE task_id = ?",
+        (" ".join(history_tokens(history)), history.task_id),
+    )
+
+
+def _delete_history(conn: sqlite3.Connection, task_ids: List[str]) -> None:
+    conn.executemany("DELETE FROM history WHERE task_id = ?", [(task_id,) for task_id in task_ids])
+
+
+def _delete_history_and_tasks(conn: sqlite3.Connection, task_ids: List[str]) -> List[sqlite3.Row]:
+    removed: List[sqlite3.Row] = []
+
+    def delete_all() -> None:
+        for start in range(0, len(task_ids), _MAX_QUERY_IDS):
+            chunk = task_ids[start:start + _MAX_QUERY_IDS]
+            placeholders = ", ".join("?" * len(chunk))
+            rows = conn.execute(f"SELECT * FROM history WHERE task_id IN ({placeholders})", chunk).fetchall()
+            if not rows:
+                continue
+            removed.extend(rows)
+            # Only tasks in history; ids of in-flight tasks are left alone
+            found = [row["task_id"] for row in rows]
+            placeholders = ", ".join("?" * len(found))
+            conn.execute(f"DELETE FROM history WHERE task_id IN ({placeholders})", found)
+            conn.execute(f"DELETE FROM tasks WHERE id IN ({placeholders})", found)
+        if removed:
+            conn.execute(_DELETE_EMPTY_BATCHES)
+
+    _in_transaction(conn, delete_all)
+    return removed
+
+
+def _insert_tasks(conn: sqlite3.Connection, tasks: List[Dict[str, Any]], batch: Optional[BatchRecord]) -> None:
+    def insert_all() -> None:
+        for data in tasks:
+            _upsert_task(conn, data)
+        if batch is not None:
+            conn.execute(
+                "INSERT OR REPLACE INTO batches (id, task_ids, created_at) VALUES (?, ?, ?)",
+                (batch.id, json.dumps(batch.task_ids), batch.created_at.isoformat()),
+            )
+
+    _in_transaction(conn, insert_all)
+
+
+def _in_transaction(conn: sqlite3.Connection, func: Callable[[], None]) -> None:
+    conn.execute("BEGIN")
+    try:
+        func()
+        conn.execute("COMMIT")
+    except Exception:
+        conn.execute("ROLLBACK")
+        raise
+
+
+def _restore_in_flight_tasks(conn: sqlite3.Connection) -> List[sqlite3.Row]:
+    conn.execute(
+        "UPDATE tasks SET status = ? WHERE status = ?",
+        (TaskStatus.PENDING.value, TaskStatus.PROCESSING.value),
+    )
+    return conn.execute(
+        "SELECT * FROM tasks WHERE status = ? ORDER BY created_at",
+        (TaskStatus.PENDING.value,),
+    ).fetchall()
+
+
+def _import_history(conn: sqlite3.Connection, items: List[GenerationHistory]) -> None:
+    def insert_all() -> None:
+        for history in items:
+            _upsert_history(conn, history)
+
+    _in_transaction(conn, insert_all)
+
+
+# The oldest entries beyond the size limit; favorites are never trimmed
+_OVERFLOW_HISTORY = (
+    "SELECT task_id FROM history WHERE favorite = 0 ORDER BY created_at, task_id"
+    " LIMIT MAX((SELECT COUNT(*) FROM history) - ?, 0)"
+)
+# Batches whose tasks have all been removed
+_DELETE_EMPTY_BATCHES = (
+    "DELETE FROM batches WHERE NOT EXISTS (SELECT 1 FROM json_each(batches.task_ids) AS t"
+    " JOIN tasks ON tasks.id = t.value)"
+)
+
+
+def _insert_history_and_trim(conn: sqlite3.Connection, history: GenerationHistory, max_size: int) -> None:
+    def insert_and_trim() -> None:
+        _upsert_history(conn, history)
+        trimmed = conn.execute(f"DELETE FROM tasks WHERE id IN ({_OVERFLOW_HISTORY})", (max_size,)).rowcount
+        if trimmed:
+            conn.execute(_DELETE_EMPTY_BATCHES)
+        conn.execute(f"DELETE FROM history WHERE task_id IN ({_OVERFLOW_HISTORY})", (max_size,))
+
+    _in_transaction(conn, insert_and_trim)
+
+
+def _backfill_blob_refs(conn: sqlite3.Connection) -> None:
+    """Count the images of history written before the triggers existed"""
+    if conn.execute("SELECT 1 FROM blob_refs LIMIT 1").fetchone() is not None:
+        return
+    conn.execute(
+        "INSERT INTO blob_refs (image, refs) SELECT value, COUNT(*) FROM"
+        " (SELECT DISTINCT history.task_id, value FROM history, json_each(history.images)"
+        " WHERE value LIKE '/images/%') GROUP BY value"
+    )
+
+
+def _backfill_search_index(conn: sqlite3.Connection) -> None:
+    """Tokenize the prompts of history written before the search index existed"""
+    if conn.execute("SELECT 1 FROM history_fts LIMIT 1").fetchone() is not None:
+        return
+    rows = conn.execute("SELECT * FROM history").fetchall()
+    if rows:
+        conn.executemany(
+            "INSERT INTO history_fts (rowid, tokens) SELECT rowid, ? FROM history WHERE task_id = ?",
+            [(" ".join(history_tokens(history)), history.task_id) for history in map(_row_to_history, rows)],
+        )
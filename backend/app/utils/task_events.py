@@ -0,0 +1,86 @@
+from __future__ import annotations
+
+import asyncio
+from typing import TYPE_CHECKING, Dict, Iterable, List, Optional, Set
+
+if TYPE_CHECKING:
+    from .task_store import TaskRecord
+
+
+class TaskSubscription:
+    """A set of watched task ids and the latest unread snapshot of each.
+
+    Updates are coalesced per task: a slow consumer only ever sees the most
+    recent state, so memory stays bounded by the number of watched tasks.
+    """
+
+    def __init__(self, bus: "TaskEventBus") -> None:
+        self._bus = bus
+        self.task_ids: Set[str] = set()
+        self._pending: Dict[str, "TaskRecord"] = {}
+        self._ready = asyncio.Event()
+
+    def add(self, task_id: str) -> None:
+        if task_id not in self.task_ids:
+            self.task_ids.add(task_id)
+            self._bus._subscribers.setdefault(task_id, set()).add(self)
+
+    def remove(self, task_id: str) -> None:
+        self.task_ids.discard(task_id)
+        self._pending.pop(task_id, None)
+        subscribers = self._bus._subscribers.get(task_id)
+        if subscribers is not None:
+            subscribers.discard(self)
+            if not subscribers:
+                del self._bus._subscribers[task_id]
+
+    def close(self) -> None:
+        for task_id in list(self.task_ids):
+            self.remove(task_id)
+
+    def _push(self, task: "TaskRecord") -> None:
+        self._pending[task.id] = task
+        self._ready.set()
+
+    async def get(self, timeout: Optional[float] = None) -> List["TaskRecord"]:
+        """Wait for updates and return them; an empty list means ``timeout`` expired"""
+        if not self._pending:
+            try:
+                await asyncio.wait_for(self._ready.wait(), timeout)
+            except asyncio.TimeoutError:
+                return []
+        updates = list(self._pending.values())
+        self._pending.clear()
+        self._ready.clear()
+        return updates
+
+    def __enter__(self) -> "TaskSubscription":
+        return self
+
+    def __exit__(self, *exc_info) -> None:
+        self.close()
+
+
+class TaskEventBus:
+    """Fan-out of task change notifications to subscribers, keyed by task id"""
+
+    def __init__(self) -> None:
+        self._subscribers: Dict[str, Set[TaskSubscription]] = {}
+
+    def subscribe(self, task_ids: Iterable[str] = ()) -> TaskSubscription:
+        subscription = TaskSubscription(self)
+        for task_id in task_ids:
+            subscription.add(task_id)
+        return subscription
+
+    def is_watched(self, task_id: str) -> bool:
+        return task_id in self._subscribers
+
+    def publish(self, task: "TaskRecord") -> None:
+        """Hand ``task`` (an immutable snapshot) to every subscriber of its id"""
+        for subscription in self._subscribers.get(task.id, ()):
+            subscription._push(task)
+
+    @property
+    def watched(self) -> int:
+        return len(self._subscribers)
@@ -1,14 +1,24 @@
 from __future__ import annotations
 
+import asyncio
 import json
-from dataclasses import dataclass, asdict
+from dataclasses import dataclass, asdict, replace
 from datetime import datetime
 from pathlib import Path
-from typing import Optional, Dict, Any, List
+from typing import Optional, Dict, Any, Iterable, List, Awaitable
 from uuid import uuid4
-from asyncio import Lock
 
 from ..schemas import TaskStatus, GenerationHistory
+from .history_search import HistoryQuery, SearchIndex
+from .image_files import LOCAL_IMAGE_PREFIX
+from .metrics import TASK_STORE_LOCK_HOLD, TASK_STORE_LOCK_WAIT, InstrumentedLock, record_task_finished
+from .persistence import HistoryPersistence, JsonHistoryFile, atomic_write_text
+from . import tracing
+from .sorted_index import SortedIndex
+from .task_events import TaskEventBus
+
+# Index key: (status, type), where ``None`` acts as a wildcard for that dimension
+IndexKey = tuple[Optional[TaskStatus], Optional[str]]
 
 
 @dataclass
@@ -51,45 +61,221 @@ class TaskRecord:
         )
 
 
+@dataclass
+class BatchRecord:
+    """Tasks submitted together through the batch endpoint"""
+
+    id: str
+    task_ids: List[str]
+    created_at: datetime
+
+
 class TaskStore:
-    """Simple task and history store based on JSON persistence"""
+    """In-memory task and history store with pluggable history persistence.
+
+    Besides tasks and history, every store keeps a reference count per local
+    image: the number of history entries showing it, which the blob garbage
+    collector uses to find images it may delete. History is searchable by
+    prompt through an index each store updates as entries come and go.
+    """
 
-    def __init__(self, history_file: Path, max_history_size: int = 1000) -> None:
+    def __init__(
+        self,
+        history_file: Path,
+        max_history_size: int = 1000,
+        persistence: Optional[HistoryPersistence] = None,
+        pending_file: Optional[Path] = None,
+    ) -> None:
         self.history_file = history_file
+        self.pending_file = pending_file or history_file.with_name("pending_tasks.json")
         self.max_history_size = max_history_size
+        self._persistence = persistence or JsonHistoryFile(history_file)
         self._tasks: Dict[str, TaskRecord] = {}
         self._history: Dict[str, GenerationHistory] = {}
-        self._lock = Lock()
+        self._task_indexes: Dict[IndexKey, SortedIndex] = {}
+        self._history_indexes: Dict[Optional[str], SortedIndex] = {}
+        self._blob_refs: Dict[str, int] = {}
+        self._search = SearchIndex()
+        # History entries split by favorite flag; the non-favorites are what trimming may evict
+        self._favorites = SortedIndex()
+        self._evictable = SortedIndex()
+        self._lock = InstrumentedLock(TASK_STORE_LOCK_WAIT.labels(), TASK_STORE_LOCK_HOLD.labels())
+        self.events = TaskEventBus()
+        self._batches: Dict[str, BatchRecord] = {}
         self._load_history()
+        self._load_suspended()
+        self._load_batches()
+
+    @staticmethod
+    def _task_index_keys(task: TaskRecord) -> tuple[IndexKey, ...]:
+        return (
+            (None, None),
+            (task.status, None),
+            (None, task.type),
+            (task.status, task.type),
+        )
+
+    def _index_task(self, task: TaskRecord) -> None:
+        for key in self._task_index_keys(task):
+            self._task_indexes.setdefault(key, SortedIndex()).add(task.created_at, task.id)
+
+    def _unindex_task(self, task: TaskRecord) -> None:
+        for key in self._task_index_keys(task):
+            index = self._task_indexes.get(key)
+            if index is not None:
+                index.discard(task.created_at, task.id)
+
+    def _index_history(self, history: GenerationHistory) -> None:
+        for key in (None, history.type):
+            self._history_indexes.setdefault(key, SortedIndex()).add(history.created_at, history.task_id)
+        self._count_refs(history.images, 1)
+        self._search.add(history)
+        if history.favorite:
+            self._favorites.add(history.created_at, history.task_id)
+        else:
+            self._evictable.add(history.created_at, history.task_id)
+
+    def _unindex_history(self, history: GenerationHistory) -> None:
+        for key in (None, history.type):
+            index = self._history_indexes.get(key)
+            if index is not None:
+                index.discard(history.created_at, history.task_id)
+        self._count_refs(history.images, -1)
+        self._search.remove(history)
+        self._favorites.discard(history.created_at, history.task_id)
+        self._evictable.discard(history.created_at, history.task_id)
+
+    def _count_refs(self, images: Iterable[str], delta: int) -> None:
+        for image in set(images):
+            if not image.startswith(LOCAL_IMAGE_PREFIX):
+                continue
+            refs = self._blob_refs.get(image, 0) + delta
+            if refs > 0:
+                self._blob_refs[image] = refs
+            else:
+                self._blob_refs.pop(image, None)
+
+    def _remove_history(self, task_id: str) -> Optional[GenerationHistory]:
+        history = self._history.pop(task_id, None)
+        if history is not None:
+            self._unindex_history(history)
+        return history
 
     def _load_history(self) -> None:
-        if not self.history_file.exists():
-            self.history_file.parent.mkdir(parents=True, exist_ok=True)
-            self.history_file.write_text(json.dumps({"items": []}, ensure_ascii=False, indent=2), encoding="utf-8")
+        for history in self._persistence.load():
+            previous = self._history.pop(history.task_id, None)
+            if previous is not None:
+                self._unindex_history(previous)
+            self._history[history.task_id] = history
+            self._index_history(history)
+            task = self._task_from_history(history)
+            previous_task = self._tasks.get(task.id)
+            if previous_task is not None:
+                self._unindex_task(previous_task)
+            self._tasks[task.id] = task
+            self._index_task(task)
 
+    def _load_suspended(self) -> None:
+        """Restore tasks that were still queued when the previous process shut down"""
+        if not self.pending_file.exists():
+            return
         try:
-            data = json.loads(self.history_file.read_text(encoding="utf-8"))
-            items = data.get("items", [])
-            for item in items:
-                history = GenerationHistory(**item)
-                self._history[history.task_id] = history
-                task = TaskRecord(
-                    id=history.task_id,
-                    type=history.type,
-                    status=TaskStatus.COMPLETED,
-                    prompt=history.prompt,
-                    negative_prompt=history.negative_prompt,
-                    parameters=history.parameters,
-                    images=history.images,
-                    progress=100,
-                    error=None,
-                    created_at=history.created_at,
-                    completed_at=history.created_at,
-                )
-                self._tasks[task.id] = task
-        except json.JSONDecodeError:
-            self._tasks = {}
-            self._history = {}
+            items = json.loads(self.pending_file.read_text(encoding="utf-8"))
+        except (OSError, json.JSONDecodeError):
+            items = []
+        for item in items:
+            task = TaskRecord.from_dict(item)
+            if task.id in self._tasks:
+                continue
+            self._tasks[task.id] = task
+            self._index_task(task)
+        self.pending_file.unlink(missing_ok=True)
+
+    def _load_batches(self) -> None:
+        """Rebuild batch handles from the ``batch_id`` recorded in task parameters"""
+        for task in sorted(self._tasks.values(), key=lambda task: task.created_at):
+            batch_id = task.parameters.get("batch_id")
+            if not batch_id:
+                continue
+            batch = self._batches.get(batch_id)
+            if batch is None:
+                batch = self._batches[batch_id] = BatchRecord(batch_id, [], task.created_at)
+            batch.task_ids.append(task.id)
+
+    def _save_suspended(self, tasks: List[TaskRecord]) -> Optional[Awaitable[Any]]:
+        """Persist suspended tasks so the next start can re-queue them"""
+        if not tasks:
+            return None
+        text = json.dumps([task.to_dict() for task in tasks], ensure_ascii=False)
+        return asyncio.to_thread(atomic_write_text, self.pending_file, text)
+
+    @staticmethod
+    def _task_from_history(history: GenerationHistory) -> TaskRecord:
+        return TaskRecord(
+            id=history.task_id,
+            type=history.type,
+            status=TaskStatus.COMPLETED,
+            prompt=history.prompt,
+            negative_prompt=history.negative_prompt,
+            parameters=history.parameters,
+            images=history.images,
+            progress=100,
+            error=None,
+            created_at=history.created_at,
+            completed_at=history.created_at,
+        )
+
+    def _notify(self, task: TaskRecord) -> None:
+        """Publish a snapshot of ``task`` to its subscribers"""
+        if self.events.is_watched(task.id):
+            self.events.publish(replace(task, images=list(task.images)))
+
+    def _on_task_changed(self, task: TaskRecord) -> Optional[Awaitable[Any]]:
+        """Hook called under the lock after a task is created or updated.
+
+        Storage engines that persist in-flight tasks return their pending write.
+        """
+        return None
+
+    def _on_tasks_created(self, tasks: List[TaskRecord], batch: Optional[BatchRecord]) -> Optional[Awaitable[Any]]:
+        """Hook called under the lock after ``create_tasks``; engines may write all rows at once"""
+        if batch is not None:
+            self._batches[batch.id] = batch
+        pending = [write for write in map(self._on_task_changed, tasks) if write is not None]
+        return asyncio.gather(*pending) if pending else None
+
+    @staticmethod
+    def _new_task(
+        task_type: str,
+        prompt: str,
+        negative_prompt: Optional[str],
+        parameters: Dict[str, Any],
+    ) -> TaskRecord:
+        return TaskRecord(
+            id=str(uuid4()),
+            type=task_type,
+            status=TaskStatus.PENDING,
+            prompt=prompt,
+            negative_prompt=negative_prompt,
+            parameters=parameters,
+            images=[],
+            progress=0,
+            error=None,
+            created_at=datetime.utcnow(),
+            completed_at=None,
+        )
+
+    def _add_task(
+        self,
+        task_type: str,
+        prompt: str,
+        negative_prompt: Optional[str],
+        parameters: Dict[str, Any],
+    ) -> TaskRecord:
+        task = self._new_task(task_type, prompt, negative_prompt, parameters)
+        self._tasks[task.id] = task
+        self._index_task(task)
+        return task
 
     async def create_task(
         self,
@@ -99,23 +285,44 @@ class TaskStore:
         parameters: Dict[str, Any],
     ) -> TaskRecord:
         async with self._lock:
-            task_id = str(uuid4())
-            now = datetime.utcnow()
-            task = TaskRecord(
-                id=task_id,
-                type=task_type,
-                status=TaskStatus.PENDING,
-                prompt=prompt,
-                negative_prompt=negative_prompt,
-                parameters=parameters,
-                images=[],
-                progress=0,
-                error=None,
-                created_at=now,
-                completed_at=None,
-            )
-            self._tasks[task_id] = task
-            return task
+            task = self._add_task(task_type, prompt, negative_prompt, parameters)
+            pending = self._on_task_changed(task)
+            self._notify(task)
+
+        if pending is not None:
+            await pending
+        return task
+
+    async def create_tasks(self, items: List[Dict[str, Any]], batch_id: Optional[str] = None) -> List[TaskRecord]:
+        """Create several tasks in one step; ``items`` hold ``create_task`` keyword arguments.
+
+        With ``batch_id`` the tasks are grouped under a batch handle, and the id
+        is recorded in each task's parameters.
+        """
+        async with self._lock:
+            tasks = [self._add_task(**item) for item in self._batch_items(items, batch_id)]
+            batch = None
+            if batch_id is not None:
+                batch = BatchRecord(batch_id, [task.id for task in tasks], datetime.utcnow())
+            pending = self._on_tasks_created(tasks, batch)
+
+        if pending is not None:
+            await pending
+        return tasks
+
+    @staticmethod
+    def _batch_items(items: List[Dict[str, Any]], batch_id: Optional[str]) -> List[Dict[str, Any]]:
+        """``create_task`` arguments with ``batch_id`` recorded in the parameters"""
+        if batch_id is None:
+            return items
+        return [{**item, "parameters": {**item["parameters"], "batch_id": batch_id}} for item in items]
+
+    async def get_batch(self, batch_id: str) -> Optional[BatchRecord]:
+        return self._batches.get(batch_id)
+
+    async def get_tasks(self, task_ids: List[str]) -> List[TaskRecord]:
+        """Tasks for ``task_ids`` in the same order, skipping unknown ids"""
+        return [self._tasks[task_id] for task_id in task_ids if task_id in self._tasks]
 
     async def update_task(
         self,
@@ -132,8 +339,10 @@ class TaskStore:
             if not task:
                 return None
 
-            if status:
+            if status and status != task.status:
+                self._unindex_task(task)
                 task.status = status
+                self._index_task(task)
             if progress is not None:
                 task.progress = progress
             if images is not None:
@@ -143,11 +352,21 @@ class TaskStore:
             if completed:
                 task.completed_at = datetime.utcnow()
 
-            self._tasks[task_id] = task
-
+            writes = [self._on_task_changed(task)]
+            persist_span = tracing.NOOP_SPAN
             if completed and task.status == TaskStatus.COMPLETED:
-                await self._persist_history(task)
-            return task
+                persist_span = tracing.span("store.persist_history")
+                writes.append(self._persist_history(task))
+            self._notify(task)
+            pending = [write for write in writes if write is not None]
+
+        if completed:
+            record_task_finished(task)
+        # Wait for the disk outside the lock so readers are not blocked on I/O
+        if pending:
+            await asyncio.gather(*pending)
+        persist_span.finish()
+        return task
 
     async def fail_task(self, task_id: str, error: str) -> Optional[TaskRecord]:
         return await self.update_task(
@@ -171,33 +390,179 @@ class TaskStore:
         return await self.update_task(task_id, status=TaskStatus.PROCESSING, progress=10)
 
     async def get_task(self, task_id: str) -> Optional[TaskRecord]:
+        # A single dict lookup cannot interleave with other coroutines, so
+        # status polls do not need to queue on the lock
+        return self._tasks.get(task_id)
+
+    async def list_tasks(
+        self,
+        status: Optional[TaskStatus] = None,
+        task_type: Optional[str] = None,
+        offset: int = 0,
+        limit: int = 100,
+    ) -> tuple[int, List[TaskRecord]]:
+        """Return newest-first tasks matching the filters, resolved from the secondary indexes"""
         async with self._lock:
-            return self._tasks.get(task_id)
+            index = self._task_indexes.get((status, task_type))
+            if index is None:
+                return 0, []
+            return len(index), [self._tasks[task_id] for task_id in index.page(offset, limit)]
 
-    async def list_tasks(self) -> List[TaskRecord]:
+    async def list_history(
+        self,
+        page: int = 1,
+        page_size: int = 20,
+        task_type: Optional[str] = None,
+    ) -> tuple[int, List[GenerationHistory]]:
+        async with self._lock:
+            index = self._history_indexes.get(task_type)
+            if index is None:
+                return 0, []
+            task_ids = index.page((page - 1) * page_size, page_size)
+            return len(index), [self._history[task_id] for task_id in task_ids]
+
+    async def search_history(self, query: HistoryQuery) -> List[GenerationHistory]:
+        """Up to ``query.limit`` history entries matching ``query``, newest first"""
         async with self._lock:
-            return sorted(self._tasks.values(), key=lambda t: t.created_at, reverse=True)
+            # Walk the narrowest ordered index newest first and stop at the
+            # limit; text terms only narrow it to their posting set
+            if query.favorite is None:
+                index = self._history_indexes.get(query.task_type, SortedIndex())
+            else:
+                index = self._favorites if query.favorite else self._evictable
+            task_ids: Iterable[str] = index.newest_before(query.upper_bound)
+            terms = query.terms
+            if terms:
+                matched = self._search.match(terms)
+                task_ids = filter(matched.__contains__, task_ids) if matched else ()
+            candidates = map(self._history.__getitem__, task_ids)
+            found: List[GenerationHistory] = []
+            for history in candidates:
+                if query.created_after is not None and history.created_at < query.created_after:
+                    break
+                if query.accepts(history):
+                    found.append(history)
+                    if len(found) >= query.limit:
+                        break
+            return found
 
-    async def list_history(self, page: int = 1, page_size: int = 20) -> tuple[int, List[GenerationHistory]]:
+    async def suspend_tasks(self, task_ids: List[str]) -> None:
+        """Reset unfinished tasks to pending and persist them for the next start"""
         async with self._lock:
-            items = sorted(self._history.values(), key=lambda h: h.created_at, reverse=True)
-            total = len(items)
-            start = (page - 1) * page_size
-            end = start + page_size
-            return total, items[start:end]
+            suspended: List[TaskRecord] = []
+            writes: List[Optional[Awaitable[Any]]] = []
+            for task_id in task_ids:
+                task = self._tasks.get(task_id)
+                if task is None or task.status in (TaskStatus.COMPLETED, TaskStatus.FAILED):
+                    continue
+                if task.status != TaskStatus.PENDING:
+                    self._unindex_task(task)
+                    task.status = TaskStatus.PENDING
+                    self._index_task(task)
+                task.progress = 0
+                task.images = []
+                suspended.append(task)
+                writes.append(self._on_task_changed(task))
+                self._notify(task)
+            writes.append(self._save_suspended(suspended))
+            pending = [write for write in writes if write is not None]
+
+        if pending:
+            await asyncio.gather(*pending)
 
     async def toggle_favorite(self, task_id: str, favorite: bool) -> Optional[GenerationHistory]:
         async with self._lock:
             history = self._history.get(task_id)
             if not history:
                 return None
+            if history.favorite == favorite:
+                return history
             history.favorite = favorite
-            self._history[task_id] = history
-            await self._dump_history()
-            return history
+            if favorite:
+                self._favorites.add(history.created_at, task_id)
+                self._evictable.discard(history.created_at, task_id)
+            else:
+                self._favorites.discard(history.created_at, task_id)
+                self._evictable.add(history.created_at, task_id)
+            pending = self._persistence.put(history, self._history)
+        await pending
+        return history
 
-    async def _persist_history(self, task: TaskRecord) -> None:
-        history = GenerationHistory(
+    async def replace_images(self, task_id: str, images: List[str]) -> bool:
+        """Swap the image URLs of a finished task and its history entry, e.g. for mirrored copies"""
+        async with self._lock:
+            writes: List[Optional[Awaitable[Any]]] = []
+            task = self._tasks.get(task_id)
+            if task is not None:
+                task.images = list(images)
+                writes.append(self._on_task_changed(task))
+                self._notify(task)
+            history = self._history.get(task_id)
+            if history is not None:
+                self._count_refs(history.images, -1)
+                history.images = list(images)
+                self._count_refs(history.images, 1)
+                writes.append(self._persistence.put(history, self._history))
+            pending = [write for write in writes if write is not None]
+
+        if pending:
+            await asyncio.gather(*pending)
+        return task is not None or history is not None
+
+    async def blob_refs(self, images: List[str]) -> Dict[str, int]:
+        """Number of history entries showing each of the local ``images``"""
+        return {image: self._blob_refs.get(image, 0) for image in images}
+
+    async def evictable_history(self, limit: int, offset: int = 0) -> List[GenerationHistory]:
+        """Up to ``limit`` history entries that are not favorites, oldest first, skipping ``offset``"""
+        async with self._lock:
+            return [self._history[task_id] for task_id in self._evictable.page(offset, limit, newest_first=False)]
+
+    async def delete_history(self, task_ids: List[str]) -> List[GenerationHistory]:
+        """Remove history entries and their tasks; returns the removed entries"""
+        async with self._lock:
+            removed = [history for history in map(self._remove_history, task_ids) if history is not None]
+            for history in removed:
+                task = self._tasks.pop(history.task_id, None)
+                if task is not None:
+                    self._unindex_task(task)
+            if not removed:
+                return []
+            pending = self._persistence.delete([history.task_id for history in removed], self._history)
+
+        await pending
+        return removed
+
+    async def start(self) -> None:
+        """Start background work; the in-process store has none"""
+
+    async def close(self) -> None:
+        """Flush and release the history persistence"""
+        await self._persistence.close()
+
+    def _persist_history(self, task: TaskRecord) -> Awaitable[Any]:
+        """Record a completed task in history; returns the pending disk write"""
+        history = self._build_history(task)
+        self._remove_history(task.id)
+        self._history[task.id] = history
+        self._index_history(history)
+
+        writes = [self._persistence.put(history, self._history)]
+
+        # Trim history if exceeds max size, oldest entries first; favorites are never trimmed
+        overflow = len(self._history) - self.max_history_size
+        if overflow > 0:
+            trimmed = self._evictable.oldest(overflow)
+            for key in trimmed:
+                self._remove_history(key)
+            if trimmed:
+                writes.append(self._persistence.delete(trimmed, self._history))
+
+        return asyncio.gather(*writes)
+
+    @staticmethod
+    def _build_history(task: TaskRecord) -> GenerationHistory:
+        return GenerationHistory(
             id=str(uuid4()),
             task_id=task.id,
             type=task.type,
@@ -208,20 +573,3 @@ class TaskStore:
             created_at=task.completed_at or datetime.utcnow(),
             favorite=False,
         )
-        self._history[task.id] = history
-
-        # Trim history if exceeds max size
-        if len(self._history) > self.max_history_size:
-            # remove oldest entries
-            sorted_items = sorted(self._history.items(), key=lambda kv: kv[1].created_at)
-            to_remove = len(self._history) - self.max_history_size
-            for key, _ in sorted_items[:to_remove]:
-                self._history.pop(key, None)
-
-        await self._dump_history()
-
-    async def _dump_history(self) -> None:
-        data = {
-            "items": [history.model_dump(mode="json") for history in self._history.values()]
-        }
-        self.history_file.write_text(json.dumps(data, ensure_ascii=False, indent=2), encoding="utf-8")
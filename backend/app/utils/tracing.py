@@ -0,0 +1,334 @@
+from __future__ import annotations
+
+import asyncio
+import functools
+import json
+import logging
+import random
+import secrets
+import time
+from collections import OrderedDict
+from contextvars import ContextVar
+from pathlib import Path
+from typing import Any, Callable, Dict, List, Optional, Union
+
+from fastapi import Request, Response
+from fastapi.routing import APIRoute
+
+logger = logging.getLogger(__name__)
+
+# Span of the current request or job; ``None`` when it is not sampled
+_current_span: ContextVar[Optional["Span"]] = ContextVar("current_span", default=None)
+
+
+class Span:
+    """A timed operation within a trace. Use as a context manager, or call ``finish``."""
+
+    __slots__ = ("trace", "name", "span_id", "parent_id", "start", "end", "attributes", "error", "_token")
+
+    def __init__(
+        self,
+        trace: "Trace",
+        name: str,
+        parent_id: Optional[str],
+        attributes: Dict[str, Any],
+        start: Optional[float] = None,
+    ) -> None:
+        self.trace = trace
+        self.name = name
+        self.span_id = secrets.token_hex(8)
+        self.parent_id = parent_id
+        self.start = time.time() if start is None else start
+        self.end: Optional[float] = None
+        self.attributes = attributes
+        self.error: Optional[str] = None
+        self._token = None
+
+    def __enter__(self) -> "Span":
+        self._token = _current_span.set(self)
+        return self
+
+    def __exit__(self, exc_type, exc, tb) -> None:
+        _current_span.reset(self._token)
+        if exc is not None:
+            self.error = str(exc) or exc_type.__name__
+        self.finish()
+
+    def set(self, key: str, value: Any) -> None:
+        self.attributes[key] = value
+
+    def finish(self, end: Optional[float] = None) -> None:
+        if self.end is None:
+            self.end = time.time() if end is None else end
+            self.trace.tracer.finished(self)
+
+    def to_dict(self) -> Dict[str, Any]:
+        return {
+            "name": self.name,
+            "span_id": self.span_id,
+            "parent_id": self.parent_id,
+            "start": self.start,
+            "duration_ms": round(((self.end or time.time()) - self.start) * 1000, 3),
+            "attributes": dict(self.attributes),
+            "error": self.error,
+        }
+
+
+class _NoopSpan:
+    """Stand-in returned when nothing is being traced, shared by every caller"""
+
+    __slots__ = ()
+
+    def __enter__(self) -> "_NoopSpan":
+        return self
+
+    def __exit__(self, exc_type, exc, tb) -> None:
+        pass
+
+    def set(self, key: str, value: Any) -> None:
+        pass
+
+    def finish(self, end: Optional[float] = None) -> None:
+        pass
+
+
+NOOP_SPAN = _NoopSpan()
+
+
+class Trace:
+    """Spans recorded for one sampled request and the job it queued"""
+
+    def __init__(self, tracer: "Tracer", trace_id: Optional[str] = None) -> None:
+        self.tracer = tracer
+        self.trace_id = trace_id or secrets.token_hex(16)
+        self.spans: List[Span] = []
+
+    def span(self, name: str, parent_id: Optional[str] = None, start: Optional[float] = None, **attributes: Any) -> Span:
+        return Span(self, name, parent_id, attributes, start)
+
+
+class OTLPFileExporter:
+    """Appends finished spans to a file as OTLP/JSON ``ExportTraceServiceRequest`` lines.
+
+    Spans are buffered and written in batches every ``interval`` seconds (or
+    once ``max_batch`` are waiting) on a worker thread.
+    """
+
+    def __init__(self, path: Path, service_name: str, interval: float = 5.0, max_batch: int = 512) -> None:
+        self.path = path
+        self.service_name = service_name
+        self.interval = interval
+        self.max_batch = max_batch
+        self._buffer: List[Span] = []
+        self._task: Optional[asyncio.Task] = None
+        self._wake = asyncio.Event()
+
+    def add(self, span: Span) -> None:
+        self._buffer.append(span)
+        if len(self._buffer) >= self.max_batch:
+            self._wake.set()
+
+    def start(self) -> None:
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        self._task = asyncio.create_task(self._run(), name="trace-exporter")
+
+    async def _run(self) -> None:
+        while True:
+            try:
+                await asyncio.wait_for(self._wake.wait(), self.interval)
+            except asyncio.TimeoutError:
+                pass
+            self._wake.clear()
+            await self.flush()
+
+    async def flush(self) -> None:
+        if not self._buffer:
+            return
+        spans, self._buffer = self._buffer, []
+        try:
+            await asyncio.to_thread(self._write, spans)
+        except OSError:
+            logger.exception("Could not export %d spans to %s", len(spans), self.path)
+
+    def _write(self, spans: List[Span]) -> None:
+        with open(self.path, "a", encoding="utf-8") as fh:
+            fh.write(json.dumps(self.encode(spans), separators=(",", ":")) + "\n")
+
+    def encode(self, spans: List[Span]) -> Dict[str, Any]:
+        return {
+            "resourceSpans": [{
+                "resource": {"attributes": [_otlp_attribute("service.name", self.service_name)]},
+                "scopeSpans": [{
+                    "scope": {"name": __name__},
+                    "spans": [_otlp_span(span) for span in spans],
+                }],
+            }]
+        }
+
+    async def close(self) -> None:
+        if self._task is not None:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+        await self.flush()
+
+
+def _otlp_attribute(key: str, value: Any) -> Dict[str, Any]:
+    if isinstance(value, bool):
+        encoded = {"boolValue": value}
+    elif isinstance(value, int):
+        encoded = {"intValue": str(value)}
+    elif isinstance(value, float):
+        encoded = {"doubleValue": value}
+    else:
+        encoded = {"stringValue": str(value)}
+    return {"key": key, "value": encoded}
+
+
+def _otlp_span(span: Span) -> Dict[str, Any]:
+    encoded = {
+        "traceId": span.trace.trace_id,
+        "spanId": span.span_id,
+        "name": span.name,
+        "kind": 1,  # SPAN_KIND_INTERNAL
+        "startTimeUnixNano": str(int(span.start * 1e9)),
+        "endTimeUnixNano": str(int((span.end or span.start) * 1e9)),
+        "attributes": [_otlp_attribute(key, value) for key, value in span.attributes.items()],
+        "status": {"code": 2, "message": span.error} if span.error else {"code": 1},
+    }
+    if span.parent_id:
+        encoded["parentSpanId"] = span.parent_id
+    return encoded
+
+
+class Tracer:
+    """Samples requests and keeps the spans of recent traces by task id.
+
+    ``sample_rate`` of requests get a trace; everything else takes a no-op
+    path. Traces are kept for the ``max_traces`` most recent tasks and, with
+    an exporter, also written out as OTLP JSON. Traces live in the process
+    that recorded them; with a shared queue, spans of jobs that run in
+    another worker are recorded (and exported) there under the same trace id.
+    """
+
+    def __init__(self, sample_rate: float = 0.0, max_traces: int = 1000, max_spans: int = 256) -> None:
+        self.sample_rate = sample_rate
+        self.max_traces = max_traces
+        self.max_spans = max_spans
+        self.exporter: Optional[OTLPFileExporter] = None
+        self._traces: "OrderedDict[str, Trace]" = OrderedDict()
+
+    def configure(
+        self,
+        sample_rate: float,
+        max_traces: int = 1000,
+        exporter: Optional[OTLPFileExporter] = None,
+    ) -> None:
+        self.sample_rate = sample_rate
+        self.max_traces = max_traces
+        self.exporter = exporter
+
+    def start_trace(self, name: str, **attributes: Any) -> Optional[Span]:
+        """Root span of a new trace, or ``None`` if this request is not sampled"""
+        if self.sample_rate <= 0 or random.random() >= self.sample_rate:
+            return None
+        return Trace(self).span(name, **attributes)
+
+    def resume(self, context: Dict[str, Any], task_id: str, name: str, **attributes: Any) -> Span:
+        """Root span of a job continuing the trace described by ``context``"""
+        trace = self._traces.get(task_id)
+        if trace is None or trace.trace_id != context["trace_id"]:
+            trace = Trace(self, context["trace_id"])
+            self.bind(task_id, trace)
+        return trace.span(name, parent_id=context.get("span_id"), task_id=task_id, **attributes)
+
+    def bind(self, task_id: str, trace: Trace) -> None:
+        """Make ``trace`` retrievable by ``task_id``"""
+        self._traces[task_id] = trace
+        self._traces.move_to_end(task_id)
+        while len(self._traces) > self.max_traces:
+            self._traces.popitem(last=False)
+
+    def get(self, task_id: str) -> Optional[Trace]:
+        return self._traces.get(task_id)
+
+    def finished(self, span: Span) -> None:
+        if len(span.trace.spans) < self.max_spans:
+            span.trace.spans.append(span)
+        if self.exporter is not None:
+            self.exporter.add(span)
+
+    async def start(self) -> None:
+        if self.exporter is not None:
+            self.exporter.start()
+
+    async def close(self) -> None:
+        if self.exporter is not None:
+            await self.exporter.close()
+
+
+tracer = Tracer()
+
+
+def span(name: str, **attributes: Any) -> Union[Span, _NoopSpan]:
+    """Child span of the current span, or a no-op when nothing is traced"""
+    parent = _current_span.get()
+    if parent is None:
+        return NOOP_SPAN
+    return parent.trace.span(name, parent_id=parent.span_id, **attributes)
+
+
+def record_span(name: str, start: float, end: Optional[float] = None, **attributes: Any) -> None:
+    """Record an already finished interval, e.g. time spent waiting in a queue"""
+    parent = _current_span.get()
+    if parent is not None:
+        parent.trace.span(name, parent_id=parent.span_id, start=start, **attributes).finish(end)
+
+
+def bind_task(task_id: str) -> None:
+    """Tie the current trace to ``task_id`` so ``GET /tasks/{id}/trace`` finds it"""
+    current = _current_span.get()
+    if current is not None:
+        current.trace.tracer.bind(task_id, current.trace)
+        current.set("task_id", task_id)
+
+
+def current_context() -> Optional[Dict[str, Any]]:
+    """Serializable reference to the current span, for continuing the trace in a job"""
+    current = _current_span.get()
+    if current is None:
+        return None
+    return {"trace_id": current.trace.trace_id, "span_id": current.span_id, "enqueued_at": time.time()}
+
+
+class TracedRoute(APIRoute):
+    """Route that starts a sampled trace before the request body is read.
+
+    A ``request.validate`` span covers body parsing, validation and
+    dependencies, up to the moment the endpoint function starts.
+    """
+
+    def get_route_handler(self) -> Callable:
+        endpoint = self.dependant.call
+
+        @functools.wraps(endpoint)
+        async def traced_endpoint(*args: Any, **kwargs: Any) -> Any:
+            root = _current_span.get()
+            if root is not None:
+                record_span("request.validate", root.start)
+            return await endpoint(*args, **kwargs)
+
+        self.dependant.call = traced_endpoint
+        handler = super().get_route_handler()
+        name = f"{'/'.join(sorted(self.methods))} {self.path_format}"
+
+        async def traced_handler(request: Request) -> Response:
+            root = tracer.start_trace(name)
+            if root is None:
+                return await handler(request)
+            with root:
+                response = await handler(request)
+                root.set("http.status_code", response.status_code)
+                return response
+
+        return traced_handler
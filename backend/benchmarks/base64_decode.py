@@ -0,0 +1,127 @@
+"""Micro-benchmark: saving an inline base64 result image the old way vs. the live path.
+
+Run from ``backend/``::
+
+    python -m benchmarks.base64_decode --megabytes 8 --repeat 5
+
+The live path is ``_save_result_images`` from the generate router, which
+stream-decodes the ``binary_data_base64`` of each upstream result as it
+lands. For each path it reports wall-clock latency, peak Python heap allocation
+(``tracemalloc``) and the longest event loop stall seen by a 1 ms ticker
+running alongside the save.
+"""
+
+import argparse
+import asyncio
+import base64
+import json
+import os
+import statistics
+import tempfile
+import time
+import tracemalloc
+from pathlib import Path
+from uuid import uuid4
+
+from app.routers.generate import _save_result_images
+
+
+def legacy_save(data: str, output_dir: Path):
+    """The original base64 result saver: split, pad, decode twice, write on the loop"""
+    if "," in data:
+        data = data.split(",", 1)[1]
+    data = data.strip()
+    missing_padding = len(data) % 4
+    if missing_padding:
+        data += "=" * (4 - missing_padding)
+    base64.b64decode(data, validate=True)
+    image_bytes = base64.b64decode(data)
+    filename = f"{uuid4().hex}.png"
+    (output_dir / filename).write_bytes(image_bytes)
+    return f"/images/{filename}"
+
+
+async def legacy_path(data: str, output_dir: Path):
+    return legacy_save(data, output_dir)
+
+
+async def streaming_path(data: str, output_dir: Path):
+    result = await _save_result_images(upstream_result(data), output_dir)
+    saved = result["data"]["image_urls"][0]
+    return saved if saved.startswith("/images/") else None
+
+
+async def measure(path, data: str, output_dir: Path) -> dict:
+    stall = 0.0
+    running = True
+
+    async def ticker():
+        nonlocal stall
+        last = time.perf_counter()
+        while running:
+            await asyncio.sleep(0.001)
+            now = time.perf_counter()
+            stall = max(stall, now - last - 0.001)
+            last = now
+
+    tick = asyncio.create_task(ticker())
+    await asyncio.sleep(0.01)
+    tracemalloc.start()
+    started = time.perf_counter()
+    result = await path(data, output_dir)
+    elapsed = time.perf_counter() - started
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    running = False
+    await tick
+    if result is None:
+        raise RuntimeError("image was not saved")
+    return {"latency_ms": elapsed * 1000, "peak_mb": peak / 2**20, "max_loop_stall_ms": stall * 1000}
+
+
+def make_payload(megabytes: float) -> str:
+    image = b"\x89PNG\r\n\x1a\n" + os.urandom(int(megabytes * 2**20))
+    return base64.b64encode(image).decode("ascii")
+
+
+def upstream_result(data: str) -> dict:
+    """A successful CVProcess result carrying ``data`` inline, as the upstream returns it"""
+    return {
+        "code": 10000,
+        "data": {"binary_data_base64": [data], "image_urls": ["https://upstream.invalid/result.png"]},
+        "message": "Success",
+    }
+
+
+async def run(megabytes: float, repeat: int) -> dict:
+    data = make_payload(megabytes)
+    report = {"image_mb": megabytes, "payload_mb": len(data) / 2**20, "paths": {}}
+    with tempfile.TemporaryDirectory() as tmp:
+        for name, path in (("legacy", legacy_path), ("streaming", streaming_path)):
+            samples = [await measure(path, data, Path(tmp)) for _ in range(repeat)]
+            report["paths"][name] = {
+                key: round(statistics.median(sample[key] for sample in samples), 2)
+                for key in samples[0]
+            }
+    return report
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--megabytes", type=float, default=8.0, help="Decoded image size")
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument("--json", action="store_true", help="Print the report as JSON")
+    args = parser.parse_args()
+
+    report = asyncio.run(run(args.megabytes, args.repeat))
+    if args.json:
+        print(json.dumps(report, indent=2))
+        return
+    print(f"image {report['image_mb']:.1f} MiB, base64 payload {report['payload_mb']:.1f} MiB (median of {args.repeat})")
+    print(f"{'path':<10} {'latency ms':>12} {'peak MiB':>10} {'loop stall ms':>14}")
+    for name, stats in report["paths"].items():
+        print(f"{name:<10} {stats['latency_ms']:>12.1f} {stats['peak_mb']:>10.1f} {stats['max_loop_stall_ms']:>14.1f}")
+
+
+if __name__ == "__main__":
+    main()
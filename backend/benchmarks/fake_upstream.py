@@ -0,0 +1,256 @@
+"""Local stand-in for the Volcengine visual API, for load tests and benchmarks.
+
+Run from ``backend/``::
+
+    python -m benchmarks.fake_upstream --port 9100 --latency lognormal:1.5:0.4 \\
+        --error-rate 50429=0.05 --image-kb 512
+
+then point the backend at it with ``VOLCENGINE_HOST=127.0.0.1:9100``,
+``VOLCENGINE_SCHEME=http`` and any non-empty access and secret key.
+
+``POST /?Action=CVProcess`` answers like the real API: after a latency drawn
+from ``--latency`` it returns either an injected error (``--error-rate``) or
+``binary_data_base64`` and ``image_urls`` of a real PNG of about
+``--image-kb``. The URLs point back at this server (``GET /images/...``), so
+mirroring downloads them too. Latencies, errors and images come from a seeded
+generator, so the same ``--seed`` and request order replay the same run.
+"""
+
+import argparse
+import asyncio
+import base64
+import math
+import random
+import struct
+import threading
+import time
+import zlib
+from typing import Dict, Optional, Tuple
+from uuid import uuid4
+
+import uvicorn
+from fastapi import FastAPI, Request, Response
+from fastapi.responses import JSONResponse
+
+SUCCESS_CODE = 10000
+# Business errors the real API returns, with their HTTP status
+ERRORS = {
+    50412: (400, "Text Risk Not Pass"),
+    50429: (429, "Request Has Reached API Limit, Please Try Later"),
+    50430: (429, "Request Has Reached API Concurrent Limit, Please Try Later"),
+    50500: (500, "Internal Error"),
+    50511: (500, "Post Img Risk Not Pass"),
+}
+IMAGE_VARIANTS = 8
+
+
+class Latency:
+    """Latency distribution parsed from ``constant:S``, ``uniform:LO:HI``,
+    ``lognormal:MEDIAN:SIGMA`` or ``exponential:MEAN`` (seconds)"""
+
+    KINDS = {"constant": 1, "uniform": 2, "lognormal": 2, "exponential": 1}
+
+    def __init__(self, spec: str) -> None:
+        kind, *params = spec.split(":")
+        if kind not in self.KINDS or len(params) != self.KINDS[kind]:
+            raise ValueError(f"Invalid latency {spec!r}, expected one of constant:S, uniform:LO:HI, lognormal:MEDIAN:SIGMA, exponential:MEAN")
+        self.spec = spec
+        self.kind = kind
+        self.params = [float(param) for param in params]
+
+    def sample(self, rng: random.Random) -> float:
+        if self.kind == "constant":
+            return self.params[0]
+        if self.kind == "uniform":
+            return rng.uniform(*self.params)
+        if self.kind == "lognormal":
+            median, sigma = self.params
+            return rng.lognormvariate(math.log(median), sigma) if median > 0 else 0.0
+        return rng.expovariate(1 / self.params[0]) if self.params[0] > 0 else 0.0
+
+
+def parse_error_rates(spec: str) -> Dict[int, float]:
+    """``50429=0.05,50500=0.01`` as ``{code: probability}``"""
+    rates = {}
+    for item in filter(None, (part.strip() for part in spec.split(","))):
+        code, _, rate = item.partition("=")
+        if int(code) not in ERRORS:
+            raise ValueError(f"Unknown error code {code}, expected one of {sorted(ERRORS)}")
+        rates[int(code)] = float(rate)
+    if sum(rates.values()) > 1:
+        raise ValueError("Error rates add up to more than 1")
+    return rates
+
+
+def make_png(size: int, rng: random.Random) -> bytes:
+    """A valid RGB PNG of noise, about ``size`` bytes (noise does not compress)"""
+    width = 256
+    height = max(1, size // (width * 3 + 1))
+    rows = b"".join(b"\0" + rng.randbytes(width * 3) for _ in range(height))
+
+    def chunk(kind: bytes, data: bytes) -> bytes:
+        return struct.pack(">I", len(data)) + kind + data + struct.pack(">I", zlib.crc32(kind + data))
+
+    header = struct.pack(">IIBBBBB", width, height, 8, 2, 0, 0, 0)
+    return b"\x89PNG\r\n\x1a\n" + chunk(b"IHDR", header) + chunk(b"IDAT", zlib.compress(rows, 0)) + chunk(b"IEND", b"")
+
+
+class FakeUpstream:
+    """The fake visual API as an ASGI app, with counters of what it served"""
+
+    def __init__(
+        self,
+        latency: str = "lognormal:1.0:0.3",
+        error_rates: Optional[Dict[int, float]] = None,
+        image_bytes: int = 256 * 1024,
+        include_base64: bool = True,
+        seed: int = 0,
+    ) -> None:
+        self.latency = Latency(latency)
+        self.error_rates = error_rates or {}
+        self.include_base64 = include_base64
+        self.rng = random.Random(seed)
+        self.images = [make_png(image_bytes, self.rng) for _ in range(IMAGE_VARIANTS)]
+        self.encoded = [base64.b64encode(image).decode("ascii") for image in self.images]
+        self.requests = 0
+        self.in_flight = 0
+        self.max_in_flight = 0
+        self.errors: Dict[int, int] = {}
+        self.images_served = 0
+        self.bytes_sent = 0
+        self.app = self._build_app()
+
+    def _build_app(self) -> FastAPI:
+        app = FastAPI(title="Fake Volcengine visual API", docs_url=None, redoc_url=None, openapi_url=None)
+        app.add_api_route("/", self.cv_process, methods=["POST"])
+        app.add_api_route("/images/{variant}/{name}", self.image, methods=["GET"])
+        return app
+
+    def _draw(self) -> Tuple[float, Optional[int], int]:
+        """Latency, injected error code and image variant of the next request"""
+        delay = self.latency.sample(self.rng)
+        roll = self.rng.random()
+        code = None
+        for candidate, rate in self.error_rates.items():
+            if roll < rate:
+                code = candidate
+                break
+            roll -= rate
+        return delay, code, self.rng.randrange(IMAGE_VARIANTS)
+
+    def _metadata(self, request_id: str) -> dict:
+        return {"RequestId": request_id, "Action": "CVProcess", "Version": "2022-08-31", "Service": "cv", "Region": "cn-north-1"}
+
+    async def cv_process(self, request: Request) -> Response:
+        request_id = uuid4().hex
+        if request.query_params.get("Action") != "CVProcess" or not request.headers.get("Authorization", "").startswith("HMAC-SHA256 "):
+            # Gateway errors carry ResponseMetadata only
+            metadata = self._metadata(request_id)
+            metadata["Error"] = {"Code": "InvalidAuthorization", "Message": "Missing or unsupported Authorization"}
+            return JSONResponse({"ResponseMetadata": metadata}, status_code=401)
+        form = await request.json()
+        self.requests += 1
+        self.in_flight += 1
+        self.max_in_flight = max(self.max_in_flight, self.in_flight)
+        started = time.perf_counter()
+        delay, code, variant = self._draw()
+        try:
+            await asyncio.sleep(delay)
+        finally:
+            self.in_flight -= 1
+        elapsed = f"{(time.perf_counter() - started) * 1000:.0f}ms"
+
+        if code is not None:
+            self.errors[code] = self.errors.get(code, 0) + 1
+            status, message = ERRORS[code]
+            body = {"code": code, "data": None, "message": message, "request_id": request_id, "status": code, "time_elapsed": elapsed}
+            return JSONResponse(body, status_code=status)
+
+        urls = []
+        if form.get("return_url"):
+            urls.append(f"{str(request.base_url).rstrip('/')}/images/{variant}/{request_id}.png")
+        body = {
+            "code": SUCCESS_CODE,
+            "data": {
+                "binary_data_base64": [self.encoded[variant]] if self.include_base64 else [],
+                "image_urls": urls,
+            },
+            "message": "Success",
+            "request_id": request_id,
+            "status": SUCCESS_CODE,
+            "time_elapsed": elapsed,
+        }
+        return JSONResponse(body)
+
+    async def image(self, variant: int, name: str) -> Response:
+        if not 0 <= variant < IMAGE_VARIANTS:
+            return Response(status_code=404)
+        self.images_served += 1
+        self.bytes_sent += len(self.images[variant])
+        return Response(self.images[variant], media_type="image/png")
+
+    def stats(self) -> dict:
+        return {
+            "requests": self.requests,
+            "max_in_flight": self.max_in_flight,
+            "errors": {str(code): count for code, count in sorted(self.errors.items())},
+            "images_served": self.images_served,
+            "image_bytes_sent": self.bytes_sent,
+        }
+
+
+class BackgroundServer:
+    """Serves an ASGI app with uvicorn on a daemon thread, e.g. next to a benchmark"""
+
+    def __init__(self, app, host: str = "127.0.0.1", port: int = 0) -> None:
+        config = uvicorn.Config(app, host=host, port=port, log_level="warning", lifespan="off", access_log=False)
+        self.server = uvicorn.Server(config)
+        self.thread = threading.Thread(target=self.server.run, daemon=True, name="fake-upstream")
+        # ``host:port`` actually bound, for ``VOLCENGINE_HOST``
+        self.address = ""
+
+    def start(self, timeout: float = 10.0) -> "BackgroundServer":
+        self.thread.start()
+        deadline = time.monotonic() + timeout
+        while not self.server.started:
+            if not self.thread.is_alive() or time.monotonic() > deadline:
+                raise RuntimeError("Fake upstream did not start")
+            time.sleep(0.01)
+        host, port = self.server.servers[0].sockets[0].getsockname()[:2]
+        self.address = f"{host}:{port}"
+        return self
+
+    def stop(self) -> None:
+        self.server.should_exit = True
+        self.thread.join(timeout=10)
+
+
+def add_arguments(parser: argparse.ArgumentParser) -> None:
+    parser.add_argument("--latency", default="lognormal:1.0:0.3", help="Upstream latency distribution (seconds)")
+    parser.add_argument("--error-rate", default="", help="Injected errors, e.g. 50429=0.05,50500=0.01")
+    parser.add_argument("--image-kb", type=int, default=256, help="Size of each returned PNG")
+    parser.add_argument("--no-base64", action="store_true", help="Return image URLs only, without binary_data_base64")
+    parser.add_argument("--seed", type=int, default=0)
+
+
+def from_arguments(args: argparse.Namespace) -> FakeUpstream:
+    return FakeUpstream(
+        latency=args.latency,
+        error_rates=parse_error_rates(args.error_rate),
+        image_bytes=args.image_kb * 1024,
+        include_base64=not args.no_base64,
+        seed=args.seed,
+    )
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=9100)
+    add_arguments(parser)
+    args = parser.parse_args()
+    uvicorn.run(from_arguments(args).app, host=args.host, port=args.port, log_level="warning")
+
+
+if __name__ == "__main__":
+    main()
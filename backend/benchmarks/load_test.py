@@ -0,0 +1,391 @@
+"""Load test: the full FastAPI app against a local fake Volcengine upstream.
+
+Run from ``backend/``::
+
+    python -m benchmarks.load_test --concurrency 32 --requests 500 --json report.json
+    python -m benchmarks.load_test --concurrency 32 --requests 500 --baseline report.json
+
+The app runs in its own uvicorn process, configured through environment
+variables (``--env KEY=VALUE`` adds more) with a throwaway data directory, and
+talks to ``benchmarks.fake_upstream`` served on a thread of this process.
+``--concurrency`` clients each submit a text2image task and long-poll it until
+it finishes, then submit the next one.
+
+The report covers throughput, submit and end-to-end task latency
+percentiles, the app's resident memory and CPU time and what the fake
+upstream served. ``--json`` writes it for later runs; ``--baseline`` compares
+against such a file and exits with status 1 when a metric regressed by more
+than ``--tolerance``.
+"""
+
+import argparse
+import asyncio
+import itertools
+import json
+import os
+import platform
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+from datetime import datetime, timezone
+from pathlib import Path
+from typing import Dict, List, Optional, Tuple
+
+import httpx
+
+from app.config import Settings
+from app.utils.metrics import error_class
+from benchmarks.fake_upstream import BackgroundServer, add_arguments, from_arguments
+
+BACKEND_DIR = Path(__file__).resolve().parent.parent
+TERMINAL = {"completed", "failed"}
+
+# (report path, whether higher is better) of the metrics --baseline compares
+COMPARED = [
+    ("throughput_rps", True),
+    ("task_latency_ms.p50", False),
+    ("task_latency_ms.p95", False),
+    ("task_latency_ms.p99", False),
+    ("submit_latency_ms.p95", False),
+    ("submit_latency_ms.p99", False),
+    ("memory_mb.peak", False),
+    ("cpu_ms_per_task", False),
+]
+
+
+def _free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def _proc_status(pid: int) -> Dict[str, int]:
+    """Memory fields of ``/proc/<pid>/status`` in KiB; empty off Linux"""
+    fields = {}
+    try:
+        with open(f"/proc/{pid}/status") as fh:
+            for line in fh:
+                key, _, value = line.partition(":")
+                if key in ("VmRSS", "VmHWM"):
+                    fields[key] = int(value.split()[0])
+    except OSError:
+        pass
+    return fields
+
+
+def _cpu_seconds(pid: int) -> Optional[float]:
+    """User plus system CPU time of ``pid``"""
+    try:
+        with open(f"/proc/{pid}/stat") as fh:
+            fields = fh.read().rsplit(")", 1)[1].split()
+    except OSError:
+        return None
+    return (int(fields[11]) + int(fields[12])) / os.sysconf("SC_CLK_TCK")
+
+
+def percentiles(samples: List[float]) -> Dict[str, Optional[float]]:
+    """p50/p95/p99, mean and max of ``samples`` in milliseconds"""
+    if not samples:
+        return {"p50": None, "p95": None, "p99": None, "mean": None, "max": None}
+    ordered = sorted(samples)
+
+    def at(q: float) -> float:
+        # Linear interpolation between closest ranks
+        position = q * (len(ordered) - 1)
+        low = int(position)
+        high = min(low + 1, len(ordered) - 1)
+        return ordered[low] + (ordered[high] - ordered[low]) * (position - low)
+
+    return {
+        "p50": round(at(0.50) * 1000, 2),
+        "p95": round(at(0.95) * 1000, 2),
+        "p99": round(at(0.99) * 1000, 2),
+        "mean": round(sum(ordered) / len(ordered) * 1000, 2),
+        "max": round(ordered[-1] * 1000, 2),
+    }
+
+
+class AppProcess:
+    """The backend under test, as a uvicorn subprocess"""
+
+    def __init__(self, env: Dict[str, str], data_dir: Path) -> None:
+        self.port = _free_port()
+        self.url = f"http://127.0.0.1:{self.port}"
+        self.log = open(data_dir / "app.log", "wb")
+        self.process = subprocess.Popen(
+            [sys.executable, "-m", "uvicorn", "app.main:app", "--host", "127.0.0.1", "--port", str(self.port), "--log-level", "warning"],
+            # Outside backend/ so a developer's .env does not leak into the run
+            cwd=data_dir,
+            env={**os.environ, "PYTHONPATH": str(BACKEND_DIR), **env},
+            stdout=self.log,
+            stderr=subprocess.STDOUT,
+        )
+
+    async def wait_ready(self, client: httpx.AsyncClient, timeout: float = 30.0) -> None:
+        deadline = time.monotonic() + timeout
+        while time.monotonic() < deadline:
+            if self.process.poll() is not None:
+                break
+            try:
+                if (await client.get(f"{self.url}/health")).status_code == 200:
+                    return
+            except httpx.TransportError:
+                pass
+            await asyncio.sleep(0.1)
+        raise RuntimeError(f"App did not become healthy, see {self.log.name}")
+
+    def stop(self) -> None:
+        self.process.terminate()
+        try:
+            self.process.wait(timeout=15)
+        except subprocess.TimeoutExpired:
+            self.process.kill()
+            self.process.wait()
+        self.log.close()
+
+
+def app_environment(args: argparse.Namespace, upstream: str, data_dir: Path) -> Dict[str, str]:
+    env = {
+        "VOLCENGINE_ACCESS_KEY": "AKBENCHMARK",
+        "VOLCENGINE_SECRET_KEY": "SKBENCHMARK",
+        "VOLCENGINE_CLIENT": args.client,
+        "VOLCENGINE_HOST": upstream,
+        "VOLCENGINE_SCHEME": "http",
+        "OUTPUT_DIR": str(data_dir / "output"),
+        "UPLOAD_DIR": str(data_dir / "uploads"),
+        "HISTORY_FILE": str(data_dir / "history.json"),
+        "HISTORY_JOURNAL_FILE": str(data_dir / "history.jsonl"),
+        "SQLITE_FILE": str(data_dir / "tasks.db"),
+        "THUMBNAIL_DIR": str(data_dir / "thumbnails"),
+        # Measure the app, not the limits that protect it
+        "RATE_LIMIT_PER_MINUTE": "0",
+        "UPSTREAM_QPS": "0",
+        "TRACE_SAMPLE_RATE": "0",
+    }
+    for item in args.env:
+        key, _, value = item.partition("=")
+        env[key] = value
+    return env
+
+
+class LoadRun:
+    """Closed-loop clients submitting tasks and long-polling them to completion"""
+
+    def __init__(self, args: argparse.Namespace, api: str, client: httpx.AsyncClient) -> None:
+        self.args = args
+        self.api = api
+        self.client = client
+        self.counter = itertools.count()
+        self.submit_latencies: List[float] = []
+        self.task_latencies: List[float] = []
+        self.statuses: Dict[str, int] = {}
+        self.errors: Dict[str, int] = {}
+        self.rejected: Dict[str, int] = {}
+
+    def _body(self, index: int) -> dict:
+        body = {"prompt": f"benchmark prompt {index}", "num_images": self.args.num_images}
+        if self.args.seeded:
+            body["seed"] = index
+        return body
+
+    async def one(self, index: int, record: bool) -> None:
+        started = time.perf_counter()
+        response = await self.client.post(f"{self.api}/generate/text2image", json=self._body(index))
+        submitted = time.perf_counter()
+        if response.status_code != 200:
+            if record:
+                key = str(response.status_code)
+                self.rejected[key] = self.rejected.get(key, 0) + 1
+            return
+        task_id = response.json()["task_id"]
+        while True:
+            poll = await self.client.get(f"{self.api}/tasks/{task_id}", params={"wait": self.args.poll_wait})
+            poll.raise_for_status()
+            task = poll.json()
+            if task["status"] in TERMINAL:
+                break
+        if record:
+            self.submit_latencies.append(submitted - started)
+            self.task_latencies.append(time.perf_counter() - started)
+            self.statuses[task["status"]] = self.statuses.get(task["status"], 0) + 1
+            if task["status"] == "failed":
+                kind = error_class(task.get("error"))
+                self.errors[kind] = self.errors.get(kind, 0) + 1
+
+    async def worker(self, total: int, record: bool) -> None:
+        while True:
+            index = next(self.counter)
+            if index >= total:
+                return
+            await self.one(index, record)
+
+    async def run(self, total: int, record: bool = True) -> float:
+        self.counter = itertools.count()
+        started = time.perf_counter()
+        await asyncio.gather(*(self.worker(total, record) for _ in range(self.args.concurrency)))
+        return time.perf_counter() - started
+
+
+async def sample_memory(pid: int, peak: List[int], interval: float = 0.1) -> None:
+    """Track the highest RSS seen; ``VmHWM`` covers spikes between samples"""
+    while True:
+        rss = _proc_status(pid).get("VmRSS")
+        if rss is not None:
+            peak[0] = max(peak[0], rss)
+        await asyncio.sleep(interval)
+
+
+async def run(args: argparse.Namespace) -> dict:
+    fake = from_arguments(args)
+    upstream = BackgroundServer(fake.app).start()
+    try:
+        with tempfile.TemporaryDirectory(prefix="imagegen-bench-") as tmp:
+            app = AppProcess(app_environment(args, upstream.address, Path(tmp)), Path(tmp))
+            try:
+                limits = httpx.Limits(max_connections=args.concurrency * 2, max_keepalive_connections=args.concurrency * 2)
+                timeout = httpx.Timeout(args.poll_wait + 30)
+                async with httpx.AsyncClient(limits=limits, timeout=timeout) as client:
+                    await app.wait_ready(client)
+                    load = LoadRun(args, f"{app.url}{Settings().API_V1_PREFIX}", client)
+                    if args.warmup:
+                        await load.run(args.warmup, record=False)
+                    pid = app.process.pid
+                    rss_start = _proc_status(pid).get("VmRSS", 0)
+                    cpu_start = _cpu_seconds(pid)
+                    peak = [rss_start]
+                    sampler = asyncio.create_task(sample_memory(pid, peak))
+                    duration = await load.run(args.requests)
+                    sampler.cancel()
+                    status = _proc_status(pid)
+                    cpu_end = _cpu_seconds(pid)
+            finally:
+                app.stop()
+    finally:
+        upstream.stop()
+
+    finished = sum(load.statuses.values())
+    cpu = cpu_end - cpu_start if cpu_start is not None and cpu_end is not None else None
+    return {
+        "benchmark": "load_test",
+        "timestamp": datetime.now(timezone.utc).isoformat(timespec="seconds"),
+        "app_version": Settings().APP_VERSION,
+        "python": platform.python_version(),
+        "config": {
+            "requests": args.requests,
+            "warmup": args.warmup,
+            "concurrency": args.concurrency,
+            "num_images": args.num_images,
+            "seeded": args.seeded,
+            "client": args.client,
+            "latency": args.latency,
+            "error_rate": args.error_rate,
+            "image_kb": args.image_kb,
+            "base64": not args.no_base64,
+            "seed": args.seed,
+            "env": args.env,
+        },
+        "tasks": {"finished": finished, "rejected": sum(load.rejected.values()), **load.statuses},
+        "rejected": load.rejected,
+        "errors": load.errors,
+        "duration_s": round(duration, 3),
+        "throughput_rps": round(finished / duration, 3) if duration else None,
+        "submit_latency_ms": percentiles(load.submit_latencies),
+        "task_latency_ms": percentiles(load.task_latencies),
+        "memory_mb": {
+            "start": round(rss_start / 1024, 1),
+            "peak": round(max(peak[0], status.get("VmHWM", 0)) / 1024, 1),
+            "end": round(status.get("VmRSS", 0) / 1024, 1),
+        } if status else None,
+        "cpu_seconds": round(cpu, 3) if cpu is not None else None,
+        "cpu_ms_per_task": round(cpu * 1000 / finished, 3) if cpu is not None and finished else None,
+        "upstream": fake.stats(),
+    }
+
+
+def _lookup(report: dict, path: str) -> Optional[float]:
+    value = report
+    for key in path.split("."):
+        if not isinstance(value, dict):
+            return None
+        value = value.get(key)
+    return value if isinstance(value, (int, float)) else None
+
+
+def compare(report: dict, baseline: dict, tolerance: float) -> List[Tuple[str, float, float, float, bool]]:
+    """``(metric, baseline, current, relative change, regressed)`` per compared metric"""
+    rows = []
+    for path, higher_is_better in COMPARED:
+        before, after = _lookup(baseline, path), _lookup(report, path)
+        if before is None or after is None or before == 0:
+            continue
+        change = (after - before) / before
+        regressed = change < -tolerance if higher_is_better else change > tolerance
+        rows.append((path, before, after, change, regressed))
+    return rows
+
+
+def print_report(report: dict) -> None:
+    config = report["config"]
+    tasks = report["tasks"]
+    print(
+        f"{config['requests']} tasks x {config['num_images']} image(s), concurrency {config['concurrency']}, "
+        f"{config['client']} client, upstream {config['latency']}"
+    )
+    print(
+        f"finished {tasks['finished']} (completed {tasks.get('completed', 0)}, failed {tasks.get('failed', 0)}), "
+        f"rejected {tasks['rejected']} in {report['duration_s']:.1f}s: {report['throughput_rps']} tasks/s"
+    )
+    print(f"{'latency ms':<12} {'p50':>9} {'p95':>9} {'p99':>9} {'max':>9}")
+    for name in ("submit", "task"):
+        stats = report[f"{name}_latency_ms"]
+        if stats["p50"] is not None:
+            print(f"{name:<12} {stats['p50']:>9.1f} {stats['p95']:>9.1f} {stats['p99']:>9.1f} {stats['max']:>9.1f}")
+    if report["memory_mb"]:
+        memory = report["memory_mb"]
+        print(f"app RSS MiB: start {memory['start']}, peak {memory['peak']}, end {memory['end']}; CPU {report['cpu_seconds']}s")
+    if report["errors"]:
+        print(f"errors: {report['errors']}")
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--requests", type=int, default=200, help="Measured tasks")
+    parser.add_argument("--warmup", type=int, default=20, help="Tasks run before measuring")
+    parser.add_argument("--concurrency", type=int, default=16, help="Concurrent clients")
+    parser.add_argument("--num-images", type=int, default=1)
+    parser.add_argument("--seeded", action="store_true", help="Send seeds (enables the result cache path)")
+    parser.add_argument("--client", choices=["sdk", "async"], default="async", help="VOLCENGINE_CLIENT of the app")
+    parser.add_argument("--poll-wait", type=float, default=30.0, help="Long-poll wait of GET /tasks/{id}")
+    parser.add_argument("--env", action="append", default=[], metavar="KEY=VALUE", help="Extra app setting")
+    add_arguments(parser)
+    parser.add_argument("--json", metavar="FILE", help="Write the report as JSON ('-' for stdout)")
+    parser.add_argument("--baseline", metavar="FILE", help="Report of an earlier run to compare against")
+    parser.add_argument("--tolerance", type=float, default=0.10, help="Allowed relative regression")
+    args = parser.parse_args()
+
+    report = asyncio.run(run(args))
+    if args.json == "-":
+        print(json.dumps(report, indent=2))
+    else:
+        print_report(report)
+        if args.json:
+            Path(args.json).write_text(json.dumps(report, indent=2) + "\n")
+    if not args.baseline:
+        return
+
+    baseline = json.loads(Path(args.baseline).read_text())
+    rows = compare(report, baseline, args.tolerance)
+    print(f"\nvs {args.baseline} (tolerance {args.tolerance:.0%})", file=sys.stderr)
+    if baseline.get("config") != report["config"]:
+        print("warning: the baseline was run with a different configuration", file=sys.stderr)
+    for path, before, after, change, regressed in rows:
+        flag = "REGRESSED" if regressed else "ok"
+        print(f"{path:<24} {before:>10.2f} -> {after:>10.2f} {change:>+8.1%}  {flag}", file=sys.stderr)
+    if any(row[-1] for row in rows):
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -17,6 +17,8 @@ export interface Image2ImagePayload extends Omit<Text2ImagePayload, 'num_images'
   strength: number
 }
 
+export type Image2ImageUploadParams = Omit<Image2ImagePayload, 'image'>
+
 export interface TaskResponse {
   task_id: string
   status: string
@@ -32,6 +34,42 @@ export interface TaskStatusResponse {
   error?: string
   created_at: string
   completed_at?: string | null
+  queue_position?: number | null
+  queue_depth?: number | null
+}
+
+export type BatchItem =
+  | ({ type: 'text2image' } & Text2ImagePayload)
+  | ({ type: 'image2image' } & Image2ImagePayload)
+
+export interface BatchPayload {
+  items?: BatchItem[]
+  template?: { base: BatchItem; variables: Record<string, string>[] }
+}
+
+export interface BatchResponse {
+  batch_id: string
+  task_ids: string[]
+  total: number
+  cached: number
+  message: string
+  created_at: string
+}
+
+export interface BatchStatusResponse {
+  batch_id: string
+  status: string
+  total: number
+  counts: Record<string, number>
+  progress: number
+  created_at: string
+}
+
+export interface BatchResultsResponse {
+  batch_id: string
+  total: number
+  offset: number
+  items: TaskStatusResponse[]
 }
 
 export interface HistoryItem {
@@ -42,6 +80,7 @@ export interface HistoryItem {
   negative_prompt?: string
   parameters: Record<string, unknown>
   images: string[]
+  thumbnails?: string[]
   created_at: string
   favorite: boolean
 }
@@ -62,6 +101,31 @@ export const GenerationApi = {
     return apiClient.post<TaskResponse>('/generate/image2image', payload)
   },
 
+  imageToImageUpload(image: Blob, params: Image2ImageUploadParams) {
+    const form = new FormData()
+    form.append('image', image)
+    Object.entries(params).forEach(([key, value]) => {
+      if (value !== undefined && value !== null) form.append(key, String(value))
+    })
+    return apiClient.post<TaskResponse>('/generate/image2image/upload', form, {
+      headers: { 'Content-Type': 'multipart/form-data' },
+    })
+  },
+
+  createBatch(payload: BatchPayload) {
+    return apiClient.post<BatchResponse>('/generate/batch', payload)
+  },
+
+  getBatchStatus(batchId: string) {
+    return apiClient.get<BatchStatusResponse>(`/generate/batch/${batchId}`)
+  },
+
+  getBatchResults(batchId: string, offset = 0, limit = 100) {
+    return apiClient.get<BatchResultsResponse>(`/generate/batch/${batchId}/results`, {
+      params: { offset, limit },
+    })
+  },
+
   getTaskStatus(taskId: string) {
     return apiClient.get<TaskStatusResponse>(`/tasks/${taskId}`)
   },
@@ -76,3 +140,75 @@ export const GenerationApi = {
     })
   },
 }
+
+const TERMINAL_STATUSES = ['completed', 'failed']
+
+export interface TaskSubscriptionOptions {
+  /** Called when the status can no longer be fetched; the subscription stops */
+  onError?: (error: unknown) => void
+  /** Polling interval used when Server-Sent Events are unavailable */
+  pollIntervalMs?: number
+}
+
+/**
+ * Follow a task until it completes or fails.
+ *
+ * Updates are pushed over Server-Sent Events (`/tasks/{id}/events`); if the
+ * browser lacks EventSource or the stream errors, it falls back to polling
+ * `GET /tasks/{id}`. Returns a function that stops the subscription.
+ */
+export function subscribeTask(
+  taskId: string,
+  onUpdate: (task: TaskStatusResponse) => void,
+  { onError, pollIntervalMs = 2000 }: TaskSubscriptionOptions = {}
+): () => void {
+  let closed = false
+  let source: EventSource | null = null
+  let timer: ReturnType<typeof setInterval> | null = null
+
+  const stop = () => {
+    closed = true
+    source?.close()
+    source = null
+    if (timer) clearInterval(timer)
+    timer = null
+  }
+
+  const deliver = (task: TaskStatusResponse) => {
+    if (closed) return
+    onUpdate(task)
+    if (TERMINAL_STATUSES.includes(task.status)) stop()
+  }
+
+  const startPolling = () => {
+    if (closed || timer) return
+    const poll = async () => {
+      try {
+        const { data } = await GenerationApi.getTaskStatus(taskId)
+        deliver(data)
+      } catch (error) {
+        if (closed) return
+        stop()
+        onError?.(error)
+      }
+    }
+    timer = setInterval(poll, pollIntervalMs)
+    poll()
+  }
+
+  if (typeof EventSource === 'undefined') {
+    startPolling()
+  } else {
+    source = new EventSource(`${apiClient.defaults.baseURL}/tasks/${taskId}/events`)
+    source.addEventListener('status', (event) => {
+      deliver(JSON.parse((event as MessageEvent).data))
+    })
+    source.onerror = () => {
+      source?.close()
+      source = null
+      startPolling()
+    }
+  }
+
+  return stop
+}
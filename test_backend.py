@@ -7,6 +7,20 @@ import os
 # Add backend to path
 sys.path.insert(0, os.path.join(os.path.dirname(__file__), 'backend'))
 
+# Keep the app's data out of /app/data, and its background work off the network
+import tempfile
+DATA_DIR = tempfile.mkdtemp(prefix="imagegen-test-")
+for name, path in (
+    ("OUTPUT_DIR", "output"),
+    ("HISTORY_FILE", "history.json"),
+    ("HISTORY_JOURNAL_FILE", "history.jsonl"),
+    ("SQLITE_FILE", "tasks.db"),
+    ("UPLOAD_DIR", "uploads"),
+    ("THUMBNAIL_DIR", "thumbnails"),
+):
+    os.environ[name] = os.path.join(DATA_DIR, path)
+os.environ["MIRROR_IMAGES"] = "false"
+
 print("🧪 Testing backend imports...")
 
 try:
@@ -48,6 +62,971 @@ except Exception as e:
     traceback.print_exc()
     sys.exit(1)
 
+try:
+    import tempfile
+    from pathlib import Path
+    from app.utils.journal import HistoryJournal
+    from app.utils.task_store import TaskStore
+
+    async def test_journal_recovery(root):
+        journal_file = root / "history.jsonl"
+
+        async def complete(prompts, fsync_interval=1.0):
+            journal = HistoryJournal(journal_file, fsync_interval=fsync_interval)
+            store = TaskStore(root / "history.json", persistence=journal)
+            for prompt in prompts:
+                task = await store.create_task("text2image", prompt, None, {})
+                await store.complete_task(task.id, [])
+            return store, journal
+
+        async def prompts():
+            store = TaskStore(root / "history.json", persistence=HistoryJournal(journal_file))
+            _, items = await store.list_history()
+            await store.close()
+            return sorted(history.prompt for history in items)
+
+        store, _ = await complete(["t1"])
+        await store.close()
+        # A crash in the middle of a write leaves half a record at the tail
+        with open(journal_file, "a", encoding="utf-8") as fh:
+            fh.write('{"op":"put","item":{"task_id":')
+        store, journal = await complete(["t2", "t3"], fsync_interval=0.05)
+        await asyncio.sleep(0.2)
+        # The interval timer synced the burst without a further write
+        synced = not journal._dirty
+        await store.close()
+        return await prompts(), synced
+
+    with tempfile.TemporaryDirectory() as tmp:
+        recovered, synced = asyncio.run(test_journal_recovery(Path(tmp)))
+    if recovered != ["t1", "t2", "t3"] or not synced:
+        print(f"❌ Journal recovery mismatch: {recovered} synced={synced}")
+        sys.exit(1)
+    print("✅ History journal drops a torn tail record and keeps writes made after it")
+except Exception as e:
+    print(f"❌ Journal error: {e}")
+    import traceback
+    traceback.print_exc()
+    sys.exit(1)
+
+try:
+    import json
+    import sqlite3
+    import tempfile
+    from pathlib import Path
+    from app.utils.history_search import HistoryQuery
+    from app.utils.sqlite_store import SQLiteTaskStore
+
+    async def test_sqlite_store(root):
+        legacy = root / "history.json"
+        legacy.write_text(json.dumps({"items": [{
+            "id": "h0", "task_id": "legacy", "type": "text2image", "prompt": "old red fox",
+            "parameters": {}, "images": [], "created_at": "2020-01-01T00:00:00", "favorite": True,
+        }]}), encoding="utf-8")
+        store = SQLiteTaskStore(root / "tasks.db", max_history_size=2, legacy_file=legacy)
+        ids = []
+        for prompt in ("blue fox", "green fox", "grey fox"):
+            task = await store.create_task("text2image", prompt, None, {})
+            await store.complete_task(task.id, [])
+            ids.append(task.id)
+        total, items = await store.list_history()
+        found = [history.task_id for history in await store.search_history(HistoryQuery(text="fox"))]
+        imported = await store.get_task("legacy")
+        await store.close()
+
+        conn = sqlite3.connect(root / "tasks.db")
+        mode = conn.execute("PRAGMA journal_mode").fetchone()[0]
+        # Trimmed rows left the full-text index with them
+        indexed = conn.execute("SELECT COUNT(*) FROM history_fts").fetchone()[0]
+        trimmed_tasks = conn.execute("SELECT COUNT(*) FROM tasks WHERE id = ?", (ids[0],)).fetchone()[0]
+        conn.close()
+        return ids, total, [history.task_id for history in items], found, imported, mode, indexed, trimmed_tasks
+
+    with tempfile.TemporaryDirectory() as tmp:
+        ids, total, listed, found, imported, mode, indexed, trimmed = asyncio.run(test_sqlite_store(Path(tmp)))
+    # The size limit keeps the imported favorite and the newest entry
+    expected = [ids[2], "legacy"]
+    if (
+        mode != "wal"
+        or total != 2
+        or listed != expected
+        or found != expected
+        or imported is None
+        or indexed != 2
+        or trimmed != 0
+    ):
+        print(f"❌ SQLite store mismatch: {mode} {total} {listed} {found} {indexed} {trimmed}")
+        sys.exit(1)
+    print("✅ SQLite store imports history.json, trims in SQL, keeps FTS in step and runs in WAL mode")
+except Exception as e:
+    print(f"❌ SQLite store error: {e}")
+    import traceback
+    traceback.print_exc()
+    sys.exit(1)
+
+try:
+    from app.services.volcengine_service import BaseVolcengineImageService
+
+    class RecordingService(BaseVolcengineImageService):
+        # Upstream stand-in that records how many calls overlap
+        def __init__(self):
+            super().__init__(max_concurrency=2)
+            self.running = self.peak = 0
+
+        async def _call_text2image(self, payload):
+            self.running += 1
+            self.peak = max(self.peak, self.running)
+            await asyncio.sleep(0.05 * (4 - payload["seed"]))
+            self.running -= 1
+            if payload["seed"] == 2:
+                raise RuntimeError("upstream failed")
+            return {"data": {"seed": payload["seed"]}}
+
+    fanout = RecordingService()
+    finished = []
+
+    async def record(index, result):
+        finished.append(index)
+
+    result = asyncio.run(fanout.text_to_image("a cat", seed=0, num_images=4, on_result=record))
+    seeds = [item.get("data", {}).get("seed") for item in result["results"]]
+    if fanout.peak != 2 or seeds != [0, 1, None, 3] or result["success"] or sorted(finished) != [0, 1, 2, 3]:
+        print(f"❌ Fan-out mismatch: peak={fanout.peak} {result}")
+        sys.exit(1)
+    print("✅ Multi-image requests fan out concurrently, capped, in seed order with isolated failures")
+except Exception as e:
+    print(f"❌ Fan-out error: {e}")
+    import traceback
+    traceback.print_exc()
+    sys.exit(1)
+
+try:
+    from app.services.visual_client import sign_request
+    # Reference signature produced by volcengine.auth.SignerV4.sign for the same
+    # request with X-Date pinned to 20240101T000000Z
+    headers = sign_request(
+        "AKTEST",
+        "SKTEST",
+        method="POST",
+        path="/",
+        query={"Action": "CVProcess", "Version": "2022-08-31"},
+        headers={"Content-Type": "application/json", "Host": "visual.volcengineapi.com"},
+        body=b'{"req_key": "text2image", "prompt": "a cat"}',
+        x_date="20240101T000000Z",
+    )
+    expected = (
+        "HMAC-SHA256 Credential=AKTEST/20240101/cn-north-1/cv/request, "
+        "SignedHeaders=content-type;host;x-content-sha256;x-date, "
+        "Signature=5eba092242de536080b1c67aa77a932b911ef6be4ebaa003c78f1bd6a4cab490"
+    )
+    if headers["Authorization"] != expected:
+        print(f"❌ Request signature mismatch: {headers['Authorization']}")
+        sys.exit(1)
+    print("✅ Async client request signing matches SDK test vector")
+except Exception as e:
+    print(f"❌ Signing error: {e}")
+    import traceback
+    traceback.print_exc()
+    sys.exit(1)
+
+try:
+    import base64
+    import hashlib
+    import tempfile
+    from pathlib import Path
+    from app.utils.image_files import blob_path, decode_base64_to_file
+
+    jpeg = b"\xff\xd8\xff\xe0" + bytes(range(256)) * 4000
+    encoded = base64.b64encode(jpeg).decode("ascii")
+    wrapped = "\n".join(encoded[i:i + 76] for i in range(0, len(encoded), 76))
+    with tempfile.TemporaryDirectory() as tmp:
+        saved = decode_base64_to_file("data:image/jpeg;base64," + wrapped.rstrip("="), Path(tmp))
+        if (
+            not saved
+            or saved != hashlib.sha256(jpeg).hexdigest() + ".jpg"
+            or blob_path(Path(tmp), saved).read_bytes() != jpeg
+            or decode_base64_to_file(encoded, Path(tmp)) != saved
+        ):
+            print(f"❌ Streaming base64 decode mismatch: {saved}")
+            sys.exit(1)
+        rejected = [
+            decode_base64_to_file(encoded[:5000] + "*" + encoded[5000:], Path(tmp)),
+            decode_base64_to_file(base64.b64encode(b"not an image at all"), Path(tmp)),
+        ]
+        if rejected != [None, None] or len(list(Path(tmp).iterdir())) != 1:
+            print(f"❌ Invalid base64 payloads were saved: {rejected}")
+            sys.exit(1)
+    print("✅ Streaming base64 decode sniffs format and rejects bad payloads")
+except Exception as e:
+    print(f"❌ Base64 decode error: {e}")
+    import traceback
+    traceback.print_exc()
+    sys.exit(1)
+
+try:
+    from app.routers.generate import process_text2image_task
+    from app.schemas import Text2ImageRequest
+    from app.utils.task_store import TaskStore
+
+    class InlineService(BaseVolcengineImageService):
+        # Upstream stand-in returning the image inline next to a temporary URL
+        async def _call_text2image(self, payload):
+            inline = encoded if payload["seed"] == 0 else "not base64"
+            return {"data": {"binary_data_base64": [inline], "image_urls": [f"https://upstream/{payload['seed']}.jpg"]}}
+
+    async def test_inline_results(root):
+        store = TaskStore(root / "history.json")
+        task = await store.create_task(task_type="text2image", prompt="a cat", negative_prompt=None, parameters={})
+        request = Text2ImageRequest(prompt="a cat", seed=0, num_images=2)
+        await process_text2image_task(task.id, request, store, InlineService(), output_dir=root)
+        return (await store.get_task(task.id)).images
+
+    with tempfile.TemporaryDirectory() as tmp:
+        images = asyncio.run(test_inline_results(Path(tmp)))
+        saved = hashlib.sha256(jpeg).hexdigest() + ".jpg"
+        if images != ["/images/" + saved, "https://upstream/1.jpg"] or blob_path(Path(tmp), saved).read_bytes() != jpeg:
+            print(f"❌ Inline result images mismatch: {images}")
+            sys.exit(1)
+    print("✅ Inline upstream images are stream-decoded to OUTPUT_DIR, undecodable ones keep their URL")
+except Exception as e:
+    print(f"❌ Inline result images error: {e}")
+    import traceback
+    traceback.print_exc()
+    sys.exit(1)
+
+try:
+    from app.schemas import TaskStatus
+    from app.utils.single_flight import SingleFlight
+
+    class CountingService(BaseVolcengineImageService):
+        # Upstream stand-in counting the calls that reach it
+        def __init__(self, fail=False):
+            super().__init__()
+            self.calls = 0
+            self.fail = fail
+
+        async def _call_text2image(self, payload):
+            self.calls += 1
+            await asyncio.sleep(0.05)
+            if self.fail:
+                raise RuntimeError("upstream down")
+            return {"data": {"image_urls": [f"https://upstream/{payload['seed']}.png"]}}
+
+    async def test_coalescing(root):
+        store = TaskStore(root / "history.json")
+        flights = SingleFlight()
+        request = Text2ImageRequest(prompt="a fox", seed=7, num_images=2)
+        outcomes = []
+        for fail in (False, True):
+            service = CountingService(fail)
+            tasks = [await store.create_task("text2image", "a fox", None, {}) for _ in range(3)]
+            await asyncio.gather(*(
+                process_text2image_task(task.id, request, store, service, result_key=f"fox-{fail}", flights=flights)
+                for task in tasks
+            ))
+            outcomes.append((service.calls, [await store.get_task(task.id) for task in tasks]))
+
+        async def shared(emit):
+            await asyncio.sleep(0.05)
+            return "done"
+
+        async def broken(emit):
+            await asyncio.sleep(0.01)
+            raise ValueError("boom")
+
+        # Cancelling one caller leaves the shared call running for the others
+        cancelled = asyncio.create_task(flights.do("shared", shared))
+        waiting = asyncio.create_task(flights.do("shared", shared))
+        await asyncio.sleep(0)
+        cancelled.cancel()
+        errors = await asyncio.gather(flights.do("broken", broken), flights.do("broken", broken), return_exceptions=True)
+        return outcomes, await waiting, errors, flights.stats()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        outcomes, survivor, errors, stats = asyncio.run(test_coalescing(Path(tmp)))
+    (calls, completed), (failed_calls, failed) = outcomes
+    if (
+        calls != 2
+        or [task.images for task in completed] != [["https://upstream/7.png", "https://upstream/8.png"]] * 3
+        or len({task.id for task in completed}) != 3
+        or failed_calls != 2
+        or any(task.status != TaskStatus.FAILED or "upstream down" not in task.error for task in failed)
+        or survivor != "done"
+        or [type(error) for error in errors] != [ValueError, ValueError]
+        or stats != {"calls": 4, "coalesced": 6, "in_flight": 0}
+    ):
+        print(f"❌ Single-flight mismatch: {outcomes} {survivor} {errors} {stats}")
+        sys.exit(1)
+    print("✅ Identical in-flight requests share one upstream call, its results and its errors")
+except Exception as e:
+    print(f"❌ Single-flight error: {e}")
+    import traceback
+    traceback.print_exc()
+    sys.exit(1)
+
+try:
+    import tempfile
+    import threading
+    from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+    from pathlib import Path
+    from app.services.image_mirror import ImageMirror
+    from app.utils.task_store import TaskStore
+
+    png = b"\x89PNG\r\n\x1a\n" + b"\0" * 200_000
+    hits = []
+
+    class FlakyImageHandler(BaseHTTPRequestHandler):
+        # Stand-in for the upstream CDN: fails once, then serves the image
+        def do_GET(self):
+            hits.append(self.path)
+            if len(hits) == 1:
+                self.send_response(503)
+                self.end_headers()
+                return
+            self.send_response(200)
+            self.send_header("Content-Type", "image/png")
+            self.send_header("Content-Length", str(len(png)))
+            self.end_headers()
+            self.wfile.write(png)
+
+        def log_message(self, *args):
+            pass
+
+    server = ThreadingHTTPServer(("127.0.0.1", 0), FlakyImageHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    url = f"http://127.0.0.1:{server.server_port}/result.png"
+
+    async def test_mirror():
+        with tempfile.TemporaryDirectory() as tmp:
+            store = TaskStore(Path(tmp) / "history.json")
+            created = await store.create_task("text2image", "a cat", None, {})
+            await store.complete_task(created.id, [url])
+            mirror = ImageMirror(Path(tmp), store, backoff=0.01)
+            images = await mirror.mirror_task(created.id, [url])
+            saved = blob_path(Path(tmp), images[0].rsplit("/", 1)[1]).read_bytes()
+            stored = (await store.get_task(created.id)).images
+            await mirror.close()
+            await store.close()
+            return images, saved, stored
+
+    images, saved, stored = asyncio.run(test_mirror())
+    server.shutdown()
+    if not images[0].startswith("/images/") or saved != png or stored != images or len(hits) != 2:
+        print(f"❌ Image mirroring mismatch: {images} {stored} {hits}")
+        sys.exit(1)
+    print("✅ Image mirroring streams result images to OUTPUT_DIR with retry")
+except Exception as e:
+    print(f"❌ Image mirror error: {e}")
+    import traceback
+    traceback.print_exc()
+    sys.exit(1)
+
+try:
+    from app.services.scheduler import PRIORITY_BATCH, GenerationScheduler, Job
+
+    async def test_batch_scheduling():
+        started = []
+        scheduler = GenerationScheduler(workers=1)
+        # Workers only pick up jobs at the next await, after everything is queued
+        scheduler.start()
+
+        def job(name, priority=0, group=None):
+            async def run():
+                started.append(name)
+                await asyncio.sleep(0)
+            return Job(task_id=name, run=run, priority=priority, group=group)
+
+        await scheduler.submit_many([job(f"a{i}", PRIORITY_BATCH, "a") for i in range(3)])
+        await scheduler.submit_many([job(f"b{i}", PRIORITY_BATCH, "b") for i in range(2)])
+        await scheduler.submit_many([job("interactive")])
+        while scheduler.depth or scheduler.in_flight:
+            await asyncio.sleep(0.01)
+        await scheduler.stop()
+        return started
+
+    async def test_queue_positions():
+        scheduler = GenerationScheduler(workers=1)
+        # Nothing below yields to the loop, so the worker has not started any job yet
+        scheduler.start()
+
+        async def noop():
+            pass
+
+        await scheduler.submit_many([Job(f"a{i}", noop, PRIORITY_BATCH, "a") for i in range(2)])
+        await scheduler.submit_many([Job("b0", noop, PRIORITY_BATCH, "b")])
+        await scheduler.submit_many([Job(task_id="interactive", run=noop)])
+        positions = [await scheduler.position(task_id) for task_id in ("interactive", "a0", "b0", "a1", "missing")]
+        await scheduler.stop()
+        return positions
+
+    started = asyncio.run(test_batch_scheduling())
+    if started != ["interactive", "a0", "b0", "a1", "b1", "a2"]:
+        print(f"❌ Batch scheduling order mismatch: {started}")
+        sys.exit(1)
+    positions = asyncio.run(test_queue_positions())
+    if positions != [1, 2, 3, 4, None]:
+        print(f"❌ Queue positions mismatch: {positions}")
+        sys.exit(1)
+    print("✅ Scheduler runs interactive jobs first and interleaves batches")
+except Exception as e:
+    print(f"❌ Scheduler error: {e}")
+    import traceback
+    traceback.print_exc()
+    sys.exit(1)
+
+try:
+    from app.utils.resilience import UpstreamResilience
+
+    async def test_resilience():
+        resilience = UpstreamResilience(max_retries=2, backoff=0.001, failure_threshold=3, reset_timeout=60)
+        responses = []
+
+        async def send():
+            response = responses.pop(0)
+            if isinstance(response, Exception):
+                raise response
+            return response
+
+        responses[:] = [Exception("Connection reset"), {"code": 50429, "message": "QPS limit"}, {"code": 10000}]
+        retried = await resilience.call("text2image", send)
+        responses[:] = [{"code": 50412, "message": "Text risk not pass"}, {"code": 10000}]
+        permanent = await resilience.call("text2image", send)
+        responses[:] = [Exception("Connection reset")] * 3
+        await resilience.call("text2image", send)
+        rejected = await resilience.call("text2image", send)
+        return retried, permanent, rejected, resilience.stats()["breakers"]["text2image"]["state"]
+
+    retried, permanent, rejected, state = asyncio.run(test_resilience())
+    if retried != {"code": 10000} or permanent.get("code") != 50412 or "unavailable" not in rejected["error"] or state != "open":
+        print(f"❌ Upstream resilience mismatch: {retried} {permanent} {rejected} {state}")
+        sys.exit(1)
+    print("✅ Upstream calls retry transient errors and open the circuit breaker")
+except Exception as e:
+    print(f"❌ Upstream resilience error: {e}")
+    import traceback
+    traceback.print_exc()
+    sys.exit(1)
+
+try:
+    from starlette.requests import Request
+    from app.config import Settings
+    from app.dependencies import client_identity
+    from app.utils.rate_limit import InMemoryRateLimitBackend
+
+    def identify(peer, headers, **settings):
+        scope = {
+            "type": "http",
+            "client": (peer, 1234),
+            "headers": [(name.lower().encode(), value.encode()) for name, value in headers.items()],
+        }
+        return client_identity(Request(scope), Settings(**settings))
+
+    identities = [
+        identify("1.2.3.4", {"X-API-Key": "made-up"}, RATE_LIMIT_API_KEYS=["real"]),
+        identify("1.2.3.4", {"X-API-Key": "real"}, RATE_LIMIT_API_KEYS=["real"]).startswith("key:"),
+        identify("1.2.3.4", {"X-Real-IP": "9.9.9.9"}),
+        identify("127.0.0.1", {"X-Real-IP": "9.9.9.9"}, RATE_LIMIT_TRUSTED_PROXIES=["127.0.0.1"]),
+        identify("10.0.0.2", {"X-Forwarded-For": "6.6.6.6, 8.8.8.8, 10.0.0.1"}, RATE_LIMIT_TRUSTED_PROXIES=["10.0.0.0/8"]),
+    ]
+    expected = ["ip:1.2.3.4", True, "ip:1.2.3.4", "ip:9.9.9.9", "ip:8.8.8.8"]
+    if identities != expected:
+        print(f"❌ Client identity mismatch: {identities}")
+        sys.exit(1)
+
+    async def test_bucket_sweep():
+        backend = InMemoryRateLimitBackend(sweep_interval=0.05)
+        await backend.take("idle", capacity=2, rate=100.0)
+        await backend.take("busy", capacity=2, rate=0.001)
+        await asyncio.sleep(0.1)
+        await backend.take("busy", capacity=2, rate=0.001)
+        return len(backend)
+
+    if asyncio.run(test_bucket_sweep()) != 1:
+        print("❌ Refilled rate limit buckets were not swept")
+        sys.exit(1)
+    print("✅ Rate limits key on configured API keys and trusted proxies, and refilled buckets are swept")
+except Exception as e:
+    print(f"❌ Rate limit error: {e}")
+    import traceback
+    traceback.print_exc()
+    sys.exit(1)
+
+try:
+    from app.utils.metrics import Counter, Histogram, InstrumentedLock, Registry
+
+    registry = Registry()
+    waits = Histogram("test_wait_seconds", "Lock wait", buckets=(0.01, 1.0), registry=registry)
+    holds = Histogram("test_hold_seconds", "Lock hold", buckets=(0.01, 1.0), registry=registry)
+    outcomes = Counter("test_tasks_total", "Outcomes", ["status"], registry=registry)
+
+    async def test_metrics():
+        lock = InstrumentedLock(waits.labels(), holds.labels())
+
+        async def hold():
+            async with lock:
+                await asyncio.sleep(0.05)
+
+        await asyncio.gather(hold(), hold())
+        outcomes.labels("completed").inc()
+
+    asyncio.run(test_metrics())
+    text = registry.render()
+    expected = [
+        'test_wait_seconds_bucket{le="0.01"} 1',
+        'test_wait_seconds_count 2',
+        'test_hold_seconds_bucket{le="0.01"} 0',
+        'test_hold_seconds_bucket{le="+Inf"} 2',
+        'test_tasks_total{status="completed"} 1',
+    ]
+    missing = [line for line in expected if line not in text.splitlines()]
+    if missing:
+        print(f"❌ Metrics exposition mismatch: {missing}\n{text}")
+        sys.exit(1)
+    print("✅ Metrics record lock wait/hold and render Prometheus text")
+except Exception as e:
+    print(f"❌ Metrics error: {e}")
+    import traceback
+    traceback.print_exc()
+    sys.exit(1)
+
+try:
+    from app.utils import tracing
+
+    async def test_tracing():
+        tracer = tracing.Tracer(sample_rate=1.0)
+        with tracer.start_trace("POST /generate/text2image"):
+            with tracing.span("store.create_task"):
+                tracing.bind_task("task-1")
+            context = tracing.current_context()
+        # The job runs later, in another coroutine
+        with tracer.resume(context, "task-1", "job"):
+            tracing.record_span("queue.wait", context["enqueued_at"])
+            with tracing.span("upstream.call", req_key="text2image"):
+                await asyncio.sleep(0)
+        untraced = tracing.span("outside a trace")
+        return tracer.get("task-1"), untraced
+
+    trace, untraced = asyncio.run(test_tracing())
+    spans = {span.name: span for span in trace.spans}
+    encoded = tracing.OTLPFileExporter(Path("spans.jsonl"), "test").encode(trace.spans)
+    otlp_spans = encoded["resourceSpans"][0]["scopeSpans"][0]["spans"]
+    if (
+        set(spans) != {"POST /generate/text2image", "store.create_task", "job", "queue.wait", "upstream.call"}
+        or spans["job"].parent_id != spans["POST /generate/text2image"].span_id
+        or spans["upstream.call"].parent_id != spans["job"].span_id
+        or untraced is not tracing.NOOP_SPAN
+        or {span["traceId"] for span in otlp_spans} != {trace.trace_id}
+    ):
+        print(f"❌ Tracing mismatch: {[span.to_dict() for span in trace.spans]}")
+        sys.exit(1)
+    print("✅ Tracing nests spans across request and job and encodes OTLP JSON")
+except Exception as e:
+    print(f"❌ Tracing error: {e}")
+    import traceback
+    traceback.print_exc()
+    sys.exit(1)
+
+try:
+    from benchmarks.fake_upstream import BackgroundServer, FakeUpstream
+    from app.services.volcengine_service import AsyncVolcengineImageService
+
+    fake = FakeUpstream(latency="constant:0.01", error_rates={50412: 0.5}, image_bytes=4096, seed=7)
+    upstream = BackgroundServer(fake.app).start()
+
+    async def test_fake_upstream():
+        service = AsyncVolcengineImageService("AK", "SK", host=upstream.address, scheme="http")
+        result = await service.text_to_image("a cat", num_images=4)
+        await service.close()
+        return result["results"]
+
+    results = asyncio.run(test_fake_upstream())
+    upstream.stop()
+    images = [result["data"] for result in results if "data" in result]
+    rejected = [result for result in results if "code 50412" in result.get("error", "")]
+    if (
+        len(images) + len(rejected) != 4
+        or fake.stats()["errors"] != ({"50412": len(rejected)} if rejected else {})
+        or any(not data["image_urls"][0].startswith(f"http://{upstream.address}/images/") for data in images)
+        or any(not base64.b64decode(data["binary_data_base64"][0]).startswith(b"\x89PNG") for data in images)
+    ):
+        print(f"❌ Fake upstream mismatch: {results} {fake.stats()}")
+        sys.exit(1)
+    print("✅ Fake Volcengine upstream serves signed CVProcess calls and injected errors")
+except Exception as e:
+    print(f"❌ Fake upstream error: {e}")
+    import traceback
+    traceback.print_exc()
+    sys.exit(1)
+
+try:
+    from app.services.thumbnails import PIL_AVAILABLE, ThumbnailService, render_derivative
+
+    if PIL_AVAILABLE:
+        from PIL import Image
+
+        with tempfile.TemporaryDirectory() as tmp:
+            Image.new("RGB", (1200, 800), (200, 40, 40)).save(Path(tmp) / "a.png")
+            thumbnails = ThumbnailService(Path(tmp), Path(tmp) / "thumbs", widths=[512, 256, 1024])
+            target = Path(tmp) / "a.png.256.webp"
+            render_derivative(str(Path(tmp) / "a.png"), str(target), thumbnails.snap(200), "webp", 80)
+            with Image.open(target) as rendered:
+                size, kind = rendered.size, rendered.format
+            urls = thumbnails.thumbnail_urls(["/images/a.png", "https://cdn.example.com/b.png"])
+        if (
+            size != (256, 171)
+            or kind != "WEBP"
+            or thumbnails.snap(600) != 1024
+            or thumbnails.snap(4000) != 1024
+            or urls != ["/images/a.png?w=256", "https://cdn.example.com/b.png"]
+        ):
+            print(f"❌ Thumbnail mismatch: {size} {kind} {urls}")
+            sys.exit(1)
+        print("✅ Thumbnails render WebP derivatives at the configured widths")
+    else:
+        print("⚠️  Pillow not installed, thumbnails are disabled")
+except Exception as e:
+    print(f"❌ Thumbnail error: {e}")
+    import traceback
+    traceback.print_exc()
+    sys.exit(1)
+
+try:
+    import hashlib
+    from app.utils.file_etags import ETagIndex, etag_from_digest, is_not_modified
+
+    async def test_etags(path):
+        etags = ETagIndex(max_entries=1)
+        cold = etags.get(path)
+        info, _ = await etags.load(path)
+        again, _ = await etags.load(path)
+        return cold, info, again, etags.hashed
+
+    with tempfile.TemporaryDirectory() as tmp:
+        path = Path(tmp) / "a.png"
+        path.write_bytes(b"image bytes")
+        cold, info, again, hashed = asyncio.run(test_etags(path))
+    if (
+        cold is not None
+        or info != again
+        or hashed != 1
+        or info.etag != etag_from_digest(hashlib.sha256(b"image bytes").hexdigest())
+        or not is_not_modified(f'"other", W/{info.etag}', None, info)
+        or is_not_modified('"other"', info.last_modified, info)
+        or not is_not_modified(None, info.last_modified, info)
+    ):
+        print(f"❌ ETag mismatch: {cold} {info} {again} {hashed}")
+        sys.exit(1)
+    print("✅ Image ETags hash content once and answer conditional requests")
+except Exception as e:
+    print(f"❌ ETag error: {e}")
+    import traceback
+    traceback.print_exc()
+    sys.exit(1)
+
+try:
+    from app.utils.blob_store import BlobStore
+    from app.utils.image_files import store_blob
+    from app.utils.task_store import TaskStore
+
+    async def test_blob_gc(root):
+        def save(content):
+            partial = root / ".upload.part"
+            partial.write_bytes(content)
+            return "/images/" + store_blob(root, partial, hashlib.sha256(content).hexdigest() + ".png").name
+
+        shared, own, orphan = save(b"s" * 1000), save(b"o" * 4000), save(b"x" * 100)
+        assert save(b"s" * 1000) == shared
+        store = TaskStore(root / "history.json")
+        ids = []
+        for images in ([shared], [shared, own], [shared]):
+            task = await store.create_task("text2image", "a cat", None, {})
+            await store.complete_task(task.id, images)
+            ids.append(task.id)
+        await store.toggle_favorite(ids[0], True)
+        refs = await store.blob_refs([shared, own, orphan])
+        blobs = BlobStore(root, store, quota_bytes=2000, grace=0)
+        report = await blobs.collect()
+        # Evicting the last entry cannot free the favorite's image, so it stays
+        blobs.quota_bytes = 500
+        unmet = await blobs.collect()
+        _, left = await store.list_history()
+        await store.close()
+        return refs, (report, unmet), [history.task_id for history in left], ids
+
+    with tempfile.TemporaryDirectory() as tmp:
+        refs, (report, unmet), left, ids = asyncio.run(test_blob_gc(Path(tmp)))
+    if (
+        list(refs.values()) != [3, 1, 0]
+        or left != [ids[2], ids[0]]
+        or (report.evicted_items, report.removed_images, report.reclaimed_bytes, report.bytes_used) != (1, 2, 4100, 1000)
+        or (unmet.evicted_items, unmet.removed_images, unmet.bytes_used) != (0, 0, 1000)
+    ):
+        print(f"❌ Blob GC mismatch: {refs} {report} {left}")
+        sys.exit(1)
+    print("✅ Saved images are deduplicated, counted and collected under a quota that only evicts what it can free")
+except Exception as e:
+    print(f"❌ Blob GC error: {e}")
+    import traceback
+    traceback.print_exc()
+    sys.exit(1)
+
+try:
+    from app.utils.sorted_index import SortedIndex
+
+    index = SortedIndex()
+    for key in (5, 1, 4, 2, 3):
+        index.add(key, f"id-{key}")
+    index.discard(1, "id-1")
+    index.discard(9, "id-9")
+    if (
+        list(index) != ["id-2", "id-3", "id-4", "id-5"]
+        or index.page(1, 2) != ["id-4", "id-3"]
+        or index.oldest(2) != ["id-2", "id-3"]
+        or list(index.newest_before((4, "id-4"))) != ["id-3", "id-2"]
+        or index.rank(4, "id-4") != 2
+    ):
+        print(f"❌ Sorted index mismatch: {list(index)}")
+        sys.exit(1)
+    print("✅ Sorted index keeps entries ordered across out-of-order inserts and removals")
+except Exception as e:
+    print(f"❌ Sorted index error: {e}")
+    import traceback
+    traceback.print_exc()
+    sys.exit(1)
+
+try:
+    from app.utils.history_search import HistoryQuery
+    from app.utils.task_store import TaskStore
+
+    async def test_history_search(root):
+        store = TaskStore(root / "history.json")
+        ids = []
+        for prompt, parameters in (
+            ("A red fox in snow", {"style_preset": "anime", "width": 512}),
+            ("blue fox", {"style_preset": "none", "width": 1024}),
+            ("一只可爱的猫", {"style_preset": "anime", "width": 512}),
+        ):
+            task = await store.create_task("text2image", prompt, None, parameters)
+            await store.complete_task(task.id, [])
+            ids.append(task.id)
+        await store.toggle_favorite(ids[1], True)
+
+        async def search(**filters):
+            return [ids.index(history.task_id) for history in await store.search_history(HistoryQuery(**filters))]
+
+        found = [
+            await search(text="FO"),
+            await search(text="猫"),
+            await search(style_preset="anime", width=512),
+            await search(text="fox", favorite=True),
+            await search(text="fox", favorite=False),
+            await search(text="fox", limit=1),
+        ]
+        first = await store.search_history(HistoryQuery(limit=2))
+        found.append(await search(cursor=(first[-1].created_at, first[-1].task_id)))
+        await store.close()
+        return found
+
+    with tempfile.TemporaryDirectory() as tmp:
+        found = asyncio.run(test_history_search(Path(tmp)))
+    if found != [[1, 0], [2], [2, 0], [1], [0], [1], [0]]:
+        print(f"❌ History search mismatch: {found}")
+        sys.exit(1)
+    print("✅ History search matches prompt prefixes and CJK, filters and pages by cursor")
+except Exception as e:
+    print(f"❌ History search error: {e}")
+    import traceback
+    traceback.print_exc()
+    sys.exit(1)
+
+try:
+    from app.utils.task_store import TaskStore
+
+    async def test_history_trim(root):
+        store = TaskStore(root / "history.json", max_history_size=2)
+        ids = []
+
+        async def complete():
+            task = await store.create_task("text2image", "a cat", None, {})
+            await store.complete_task(task.id, [])
+            ids.append(task.id)
+
+        await complete()
+        await complete()
+        await store.toggle_favorite(ids[0], True)
+        await complete()
+        await complete()
+        _, trimmed = await store.list_history()
+        running = await store.create_task("text2image", "a dog", None, {})
+        deleted = await store.delete_history([ids[3], running.id])
+        kept = await store.get_task(running.id)
+        _, left = await store.list_history()
+        await store.close()
+        reloaded = TaskStore(root / "history.json", max_history_size=2)
+        _, persisted = await reloaded.list_history()
+        await reloaded.close()
+        return ids, [[history.task_id for history in items] for items in (trimmed, deleted, left, persisted)], kept
+
+    with tempfile.TemporaryDirectory() as tmp:
+        ids, (trimmed, deleted, left, persisted), kept = asyncio.run(test_history_trim(Path(tmp)))
+    if trimmed != [ids[3], ids[0]] or deleted != [ids[3]] or left != persisted or left != [ids[0]] or kept is None:
+        print(f"❌ History trim mismatch: {trimmed} {deleted} {left} {persisted}")
+        sys.exit(1)
+    print("✅ History trimming spares favorites, and deletions persist without touching running tasks")
+except Exception as e:
+    print(f"❌ History trim error: {e}")
+    import traceback
+    traceback.print_exc()
+    sys.exit(1)
+
+try:
+    import fakeredis
+    from app.schemas import TaskStatus
+    from app.services.redis_scheduler import RedisGenerationScheduler
+    from app.services.scheduler import Job
+    from app.utils.history_search import HistoryQuery
+    from app.services import redis_scheduler
+    from app.utils import redis_store
+    from app.utils.redis_store import RedisTaskStore
+
+    # Fails any script that touches a key it was not given in KEYS
+    KEYS_ONLY = """
+local declared = {}
+for _, key in ipairs(KEYS) do declared[key] = true end
+local call = redis.unchecked_call or redis.call
+redis.unchecked_call = call
+redis.call = function(command, key, ...)
+    if string.upper(command) ~= 'PUBLISH' and not declared[key] then
+        error('undeclared key ' .. tostring(key))
+    end
+    return call(command, key, ...)
+end
+"""
+    for module in (redis_store, redis_scheduler):
+        for name in dir(module):
+            if name.endswith("_SCRIPT"):
+                setattr(module, name, KEYS_ONLY + getattr(module, name))
+
+    async def test_redis_store(root):
+        # Two processes sharing one Redis
+        server = fakeredis.FakeServer()
+        stores = [
+            RedisTaskStore(
+                "redis://test",
+                root / "history.json",
+                max_history_size=2,
+                client=fakeredis.aioredis.FakeRedis(server=server, decode_responses=True),
+            )
+            for _ in range(2)
+        ]
+        writer, reader = stores
+        for store in stores:
+            await store.start()
+        try:
+            tasks = [await writer.create_task("text2image", f"red fox {i}", None, {}) for i in range(3)]
+            with reader.events.subscribe([tasks[0].id]) as subscription:
+                await asyncio.sleep(0.05)
+                await writer.set_processing(tasks[0].id)
+                relayed = [task.status for task in await subscription.get(timeout=2)]
+            await writer.complete_task(tasks[0].id, ["/images/a.png"])
+            await reader.toggle_favorite(tasks[0].id, True)
+            await writer.complete_task(tasks[1].id, ["/images/b.png"])
+            await writer.complete_task(tasks[2].id, ["/images/b.png"])
+            _, history = await reader.list_history()
+            found = await reader.search_history(HistoryQuery(text="fox"))
+            refs = await reader.blob_refs(["/images/a.png", "/images/b.png"])
+            deleted = await reader.delete_history([tasks[2].id])
+            remaining = await writer.blob_refs(["/images/b.png"])
+            gone = [await writer.get_task(task.id) for task in tasks[1:]]
+        finally:
+            for store in stores:
+                await store.close()
+        ids = [task.id for task in tasks]
+        return relayed, [item.task_id for item in history], [item.task_id for item in found], refs, deleted, remaining, gone, ids
+
+    relayed, history, found, refs, deleted, remaining, gone, ids = asyncio.run(test_redis_store(Path(DATA_DIR)))
+    if (
+        relayed != [TaskStatus.PROCESSING]
+        # The size limit evicts the oldest entry that is not a favorite
+        or history != [ids[2], ids[0]]
+        or found != [ids[2], ids[0]]
+        or refs != {"/images/a.png": 1, "/images/b.png": 1}
+        or [item.task_id for item in deleted] != [ids[2]]
+        or remaining != {"/images/b.png": 0}
+        or gone != [None, None]
+    ):
+        print(f"❌ Redis store mismatch: {relayed} {history} {found} {refs} {deleted} {remaining} {gone}")
+        sys.exit(1)
+
+    async def test_redis_scheduler():
+        server = fakeredis.FakeServer()
+        release = asyncio.Event()
+        started, finished = [], {"a": [], "b": []}
+
+        def scheduler(name):
+            def runner(spec):
+                async def run():
+                    started.append(spec["task_id"])
+                    await release.wait()
+                    finished[name].append(spec["task_id"])
+                return run
+
+            instance = RedisGenerationScheduler(
+                "redis://test", workers=1, lease=3, client=fakeredis.aioredis.FakeRedis(server=server, decode_responses=True)
+            )
+            instance.runner = runner
+            return instance
+
+        async def until(condition):
+            for _ in range(200):
+                if condition():
+                    return
+                await asyncio.sleep(0.01)
+            raise AssertionError("timed out")
+
+        first, second = scheduler("a"), scheduler("b")
+        first.start()
+        second.start()
+        ids = ["job-1", "job-2", "job-3"]
+        await first.submit_many([Job(task_id=i, run=None, spec={"task_id": i}) for i in ids])
+        await until(lambda: len(started) == 2)
+        waiting = await second.position("job-3")
+        # Stopping the second process hands its running job back to the queue
+        interrupted = await second.stop(timeout=0)
+        release.set()
+        await until(lambda: len(finished["a"]) == 3)
+        await first.stop()
+        inspect = fakeredis.aioredis.FakeRedis(server=server, decode_responses=True)
+        leftovers = [
+            await inspect.hlen("imagegen:queue:jobs"),
+            await inspect.zcard("imagegen:queue:interactive"),
+            await inspect.zcard("imagegen:queue:running:interactive"),
+        ]
+        return waiting, interrupted, finished, leftovers
+
+    waiting, interrupted, finished, leftovers = asyncio.run(test_redis_scheduler())
+    if (
+        waiting != 1
+        or len(interrupted) != 1
+        or finished["b"]
+        or sorted(finished["a"]) != ["job-1", "job-2", "job-3"]
+        # The re-queued job keeps its place ahead of later submissions
+        or finished["a"][1:] != [interrupted[0], "job-3"]
+        or leftovers != [0, 0, 0]
+    ):
+        print(f"❌ Redis scheduler mismatch: {waiting} {interrupted} {finished} {leftovers}")
+        sys.exit(1)
+    for module in (redis_store, redis_scheduler):
+        for name in dir(module):
+            if name.endswith("_SCRIPT"):
+                setattr(module, name, getattr(module, name).replace(KEYS_ONLY, ""))
+    print("✅ Redis scripts only touch their KEYS; the store relays events across processes and the queue claims, finishes and re-queues across schedulers")
+except Exception as e:
+    print(f"❌ Redis error: {e}")
+    import traceback
+    traceback.print_exc()
+    sys.exit(1)
+
 try:
     from app.routers import generate, task
     print("✅ Routers module imported")
@@ -67,5 +1046,303 @@ except Exception as e:
     traceback.print_exc()
     sys.exit(1)
 
+try:
+    from fastapi.testclient import TestClient
+
+    with TestClient(app) as client:
+        created = client.post("/api/v1/generate/text2image", json={"prompt": "a shared cat"}).json()
+        status = client.get(f"/api/v1/tasks/{created['task_id']}")
+        listed = client.get("/api/v1/tasks/", params={"type": "text2image"}).json()
+        for _ in range(2):
+            client.post("/api/v1/generate/text2image", json={"prompt": "another cat"})
+        unbounded = client.get("/api/v1/tasks/")
+        paged = client.get("/api/v1/tasks/", params={"limit": 1})
+        history = client.get("/api/v1/tasks/history")
+        store_task = client.portal.call(app.state.task_store.get_task, created["task_id"])
+    if (
+        status.status_code != 200
+        or created["task_id"] not in [item["task_id"] for item in listed]
+        or len(unbounded.json()) != int(unbounded.headers["X-Total-Count"])
+        or len(paged.json()) != 1
+        or paged.headers["X-Total-Count"] != unbounded.headers["X-Total-Count"]
+        or history.status_code != 200
+        or "items" not in history.json()
+        or store_task is None
+    ):
+        print(f"❌ Shared task store mismatch: {status.status_code} {listed} {history.text}")
+        sys.exit(1)
+    print("✅ Tasks created by /generate are visible to /tasks through the shared store")
+except Exception as e:
+    print(f"❌ Shared task store error: {e}")
+    import traceback
+    traceback.print_exc()
+    sys.exit(1)
+
+try:
+    from fastapi.testclient import TestClient
+    from app.utils.rate_limit import InMemoryRateLimitBackend, RateLimiter
+
+    def template_batch(count):
+        base = {"type": "text2image", "prompt": "a $animal"}
+        return {"template": {"base": base, "variables": [{"animal": f"cat {i}"} for i in range(count)]}}
+
+    with TestClient(app) as client:
+        app.state.client_rate_limiter = RateLimiter(InMemoryRateLimitBackend(), per_minute=5)
+        accepted = client.post("/api/v1/generate/batch", json=template_batch(3))
+        over_budget = client.post("/api/v1/generate/batch", json=template_batch(3))
+        oversized = client.post("/api/v1/generate/batch", json=template_batch(6))
+    if (
+        accepted.status_code != 200
+        or accepted.headers.get("X-RateLimit-Remaining") != "2"
+        or over_budget.status_code != 429
+        or "Retry-After" not in over_budget.headers
+        or oversized.status_code != 422
+    ):
+        print(f"❌ Batch rate limit mismatch: {accepted.status_code} {accepted.headers} {over_budget.status_code} {oversized.status_code}")
+        sys.exit(1)
+    print("✅ Batches are charged one rate limit token per expanded item")
+except Exception as e:
+    print(f"❌ Batch rate limit error: {e}")
+    import traceback
+    traceback.print_exc()
+    sys.exit(1)
+
+try:
+    import time
+    from fastapi.testclient import TestClient
+    from app.schemas import Text2ImageRequest
+    from app.utils.result_cache import ResultCache, cache_key
+
+    def request_key(**fields):
+        return cache_key("text2image", Text2ImageRequest(**fields).model_dump(mode="json", exclude={"image", "type"}))
+
+    lru = ResultCache(max_entries=2, max_bytes=1000, ttl=60)
+    lru.put("a", ["/images/a.png"])
+    lru.put("b", ["/images/b.png"])
+    lru.get("a")
+    lru.put("c", ["/images/c.png"])
+    lru.put("huge", ["/images/" + "x" * 1000])
+    expiring = ResultCache(ttl=0.01)
+    expiring.put("a", ["/images/a.png"])
+    time.sleep(0.02)
+    if (
+        request_key(prompt=" a cat ", seed=1) != request_key(prompt="a cat", seed=1, use_cache=False)
+        or request_key(prompt="a cat", seed=1) == request_key(prompt="a cat", seed=2)
+        or [lru.get(key) is not None for key in ("a", "b", "c", "huge")] != [True, False, True, False]
+        or expiring.get("a") is not None
+        or lru.stats()["evictions"] != 1
+    ):
+        print(f"❌ Result cache mismatch: {lru.stats()} {expiring.stats()}")
+        sys.exit(1)
+
+    seeded = {"prompt": "a cached cat", "seed": 42}
+    with TestClient(app) as client:
+        app.state.result_cache.put(request_key(**seeded), ["/images/cached.png"])
+        hit = client.post("/api/v1/generate/text2image", json=seeded).json()
+        cached_task = client.get(f"/api/v1/tasks/{hit['task_id']}").json()
+        opted_out = client.post("/api/v1/generate/text2image", json={**seeded, "use_cache": False}).json()
+        unseeded = client.post("/api/v1/generate/text2image", json={**seeded, "seed": -1}).json()
+        stats = app.state.result_cache.stats()
+    if (
+        hit["status"] != "completed"
+        or cached_task["images"] != ["/images/cached.png"]
+        or opted_out["status"] != "pending"
+        or unseeded["status"] != "pending"
+        or stats["hits"] != 1
+    ):
+        print(f"❌ Result cache endpoint mismatch: {hit} {cached_task} {opted_out} {unseeded} {stats}")
+        sys.exit(1)
+    print("✅ Seeded requests are served from an LRU/TTL result cache unless they opt out")
+except Exception as e:
+    print(f"❌ Result cache error: {e}")
+    import traceback
+    traceback.print_exc()
+    sys.exit(1)
+
+try:
+    import base64
+    import struct
+    import time
+    from fastapi.testclient import TestClient
+    from app.routers.generate import job_spec
+    from app.schemas import Image2ImageRequest
+
+    def png(width, height):
+        header = b"\x89PNG\r\n\x1a\n" + struct.pack(">I", 13) + b"IHDR" + struct.pack(">II", width, height)
+        return header + b"\x08\x02\x00\x00\x00" + bytes(200)
+
+    uploads = Path(os.environ["UPLOAD_DIR"])
+    fields = {"prompt": "a watercolor cat", "seed": "5"}
+    with TestClient(app) as client:
+        def upload(content, name="cat.png"):
+            return client.post("/api/v1/generate/image2image/upload", data=fields, files={"image": (name, content)})
+
+        accepted = upload(png(512, 512))
+        spooled = len(list(uploads.glob("*.upload")))
+        rejected = [upload(b"plain text, not an image" * 10, "cat.txt").status_code, upload(png(16, 16)).status_code]
+        for _ in range(50):
+            status = client.get(f"/api/v1/tasks/{accepted.json()['task_id']}").json()["status"]
+            if status == "completed":
+                break
+            time.sleep(0.1)
+        # The same image sent as base64 JSON shares the upload's cache entry
+        as_json = client.post(
+            "/api/v1/generate/image2image",
+            json={"prompt": "a watercolor cat", "seed": 5, "image": base64.b64encode(png(512, 512)).decode("ascii")},
+        ).json()
+        invalid_json = client.post("/api/v1/generate/image2image", json={"prompt": "a cat", "image": "!" * 200})
+    encoded = base64.b64encode(png(512, 512)).decode("ascii")
+    spec = job_spec("image2image", "task", Image2ImageRequest(prompt="a cat", image=encoded), None, uploads / "x.upload")
+    if (
+        accepted.status_code != 200
+        or spooled != 1
+        or rejected != [415, 422]
+        or status != "completed"
+        or list(uploads.glob("*.upload"))
+        or as_json["status"] != "completed"
+        or invalid_json.status_code != 400
+        or list(uploads.glob("*.upload"))
+        or "image" in spec["request"]
+        or spec["image_path"] != str(uploads / "x.upload")
+    ):
+        print(f"❌ Multipart upload mismatch: {accepted.text} {spooled} {rejected} {status} {as_json} {spec}")
+        sys.exit(1)
+    print("✅ Image2image inputs are spooled until the job runs, never queued inline, and uploads share the cache")
+except Exception as e:
+    print(f"❌ Multipart upload error: {e}")
+    import traceback
+    traceback.print_exc()
+    sys.exit(1)
+
+try:
+    import time
+    import httpx
+    from fastapi import FastAPI
+    from app.routers import task as task_router
+    from app.services.scheduler import GenerationScheduler
+    from app.utils.task_store import TaskStore
+
+    def task_api(root, waiters=1000):
+        """The /tasks router on its own, with state a test can drive directly"""
+        api = FastAPI()
+        api.include_router(task_router.router)
+        api.state.task_store = TaskStore(root / "history.json")
+        api.state.scheduler = GenerationScheduler(workers=1)
+        api.state.long_poll_slots = asyncio.Semaphore(waiters)
+        return api, httpx.AsyncClient(transport=httpx.ASGITransport(app=api), base_url="http://test")
+
+    async def test_long_poll(root):
+        api, client = task_api(root, waiters=1)
+        store = api.state.task_store
+        created = await store.create_task("text2image", "a cat", None, {})
+        url = f"/tasks/{created.id}"
+
+        started = time.monotonic()
+        timed_out = (await client.get(url, params={"wait": 0.2})).json()
+        waited = time.monotonic() - started
+
+        async def progress_later():
+            await asyncio.sleep(0.1)
+            await store.set_processing(created.id)
+
+        started = time.monotonic()
+        woken, _ = await asyncio.gather(client.get(url, params={"wait": 5}), progress_later())
+        woken_after = time.monotonic() - started
+
+        # The only slot is taken by a parked request, so the next one is turned away
+        parked = asyncio.create_task(client.get(url, params={"wait": 5}))
+        await asyncio.sleep(0.05)
+        rejected = await client.get(url, params={"wait": 5})
+        await store.complete_task(created.id, [])
+        finished = (await parked).json()
+        await client.aclose()
+        await store.close()
+        return timed_out, waited, woken.json(), woken_after, rejected, finished
+
+    with tempfile.TemporaryDirectory() as tmp:
+        timed_out, waited, woken, woken_after, rejected, finished = asyncio.run(test_long_poll(Path(tmp)))
+    if (
+        timed_out["status"] != "pending"
+        or waited < 0.2
+        or woken["status"] != "processing"
+        or woken_after > 2
+        or rejected.status_code != 429
+        or rejected.headers.get("retry-after") != "1"
+        or finished["status"] != "completed"
+    ):
+        print(f"❌ Long-poll mismatch: {timed_out} {waited} {woken} {woken_after} {rejected.status_code} {finished}")
+        sys.exit(1)
+    print("✅ Long-poll requests time out, wake on changes and are capped by the waiter limit")
+except Exception as e:
+    print(f"❌ Long-poll error: {e}")
+    import traceback
+    traceback.print_exc()
+    sys.exit(1)
+
+try:
+    import json
+    from fastapi.testclient import TestClient
+
+    async def test_sse(root):
+        api, client = task_api(root)
+        store = api.state.task_store
+        created = await store.create_task("text2image", "a cat", None, {})
+
+        async def progress_later():
+            # Spaced out: changes arriving faster than the client reads are coalesced
+            await asyncio.sleep(0.1)
+            await store.set_processing(created.id)
+            await asyncio.sleep(0.05)
+            await store.update_task(created.id, progress=60)
+            await asyncio.sleep(0.05)
+            await store.complete_task(created.id, ["/images/a.png"])
+
+        response, _ = await asyncio.gather(client.get(f"/tasks/{created.id}/events"), progress_later())
+        await client.aclose()
+        await store.close()
+        events = [
+            json.loads(line[len("data: "):]) for line in response.text.splitlines() if line.startswith("data: ")
+        ]
+        return response.headers["content-type"], [(event["status"], event["progress"]) for event in events]
+
+    with tempfile.TemporaryDirectory() as tmp:
+        content_type, events = asyncio.run(test_sse(Path(tmp)))
+    if not content_type.startswith("text/event-stream") or events != [
+        ("pending", 0), ("processing", 10), ("processing", 60), ("completed", 100)
+    ]:
+        print(f"❌ SSE mismatch: {content_type} {events}")
+        sys.exit(1)
+    print("✅ SSE streams every progress change of a task until it completes")
+
+    with tempfile.TemporaryDirectory() as tmp:
+        api, _ = task_api(Path(tmp))
+        store = api.state.task_store
+        with TestClient(api) as client:
+            created = client.portal.call(store.create_task, "text2image", "a cat", None, {})
+            with client.websocket_connect("/tasks/ws") as ws:
+                ws.send_text("not json")
+                malformed = ws.receive_json()
+                ws.send_json({"action": "subscribe", "task_ids": [created.id]})
+                current = ws.receive_json()
+                client.portal.call(store.complete_task, created.id, [])
+                pushed = ws.receive_json()
+                ws.send_bytes(b"\x00")
+                closed = ws.receive()
+            client.portal.call(store.close)
+    if (
+        malformed["type"] != "error"
+        or current["task"]["status"] != "pending"
+        or pushed["task"]["status"] != "completed"
+        or closed.get("code") != 1003
+    ):
+        print(f"❌ WebSocket mismatch: {malformed} {current} {pushed} {closed}")
+        sys.exit(1)
+    print("✅ WebSocket answers malformed commands with errors and closes on binary frames")
+except Exception as e:
+    print(f"❌ Task stream error: {e}")
+    import traceback
+    traceback.print_exc()
+    sys.exit(1)
+
 print("\n✨ All backend tests passed!")
 print("🚀 Ready to start with: uvicorn app.main:app --reload")